@@ -0,0 +1,500 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+CacheIndex.py
+
+An index of the GDAS/GFS files in the ancillary cache, sorted by valid time,
+so that the file for a pass can be found without running the retrieval script.
+
+Each record holds the model ('gdas1' or 'gfs'), the model cycle, the forecast
+hour, the valid time, the GRIB file and (once it has been transcoded) the IAPP
+ancillary NetCDF file. The index is kept in a JSON file at the top of the
+cache, and is rebuilt by scanning the cache if that file is missing. Records
+are added when a file is retrieved or transcoded, and removed when the file is
+evicted from the cache, or found to be missing when it is looked up.
+
+The index file is shared by all the IAPP processes using the cache, so it is
+only read or changed while holding an inter-process lock (see SingleFlight.py).
+Additions and removals are appended to a journal beside the index file rather
+than rewriting it, and each process reads only the journal entries it has not
+seen; the journal is folded into the index file once it has JOURNAL_LIMIT
+entries, or when the index is pruned.
+
+Copyright (c) 2013 University of Wisconsin SSEC. All rights reserved.
+Licensed under GNU GPLv3.
+"""
+
+import os
+import re
+import json
+import bisect
+import logging
+import traceback
+from os import path
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+from threading import Lock
+
+from SingleFlight import single_flight
+
+LOG = logging.getLogger(__name__)
+
+INDEX_FILE_NAME = '.iapp_anc_index.json'
+JOURNAL_FILE_NAME = '.iapp_anc_index.journal'
+INDEX_VERSION = 1
+JOURNAL_LIMIT = 1000
+
+# GDAS analyses are available up to about 9 hours after their valid time; for
+# more recent passes the GFS forecasts are used.
+GDAS_LATENCY = timedelta(hours=9)
+
+# The GFS forecast hours searched by get_anc_iapp_grib1_gdas_gfs.csh, in order
+# of preference.
+GFS_FORECAST_HOURS = [3, 6, 9, 12]
+
+GDAS_PATTERN = re.compile(r'^gdas1\.PGrbF00\.(\d{6})\.(\d{2})z$')
+GFS_PATTERN = re.compile(r'^gfs\.t(\d{2})\.(\d{6})\.pgrbf(\d{2})$')
+NETCDF_PATTERN = re.compile(r'^iapp_ancillary_(\d{10})-(.+)\.nc$')
+FORECAST_PATTERN = re.compile(r'^(\d+)hr_fcst$')
+
+TIME_FORMAT = '%Y%m%d%H'
+
+
+def parse_grib_name(grib_file):
+    '''
+    Return the (model, cycle, forecast hour) of a cached GDAS/GFS GRIB file,
+    or None if the name is not recognised.
+    '''
+    file_name = path.basename(grib_file)
+
+    match = GDAS_PATTERN.match(file_name)
+    if match:
+        cycle = datetime.strptime(''.join(match.groups()), '%y%m%d%H')
+        return 'gdas1', cycle, 0
+
+    match = GFS_PATTERN.match(file_name)
+    if match:
+        cycle_hour, date_str, forecast_hour = match.groups()
+        cycle = datetime.strptime(date_str + cycle_hour, '%y%m%d%H')
+        return 'gfs', cycle, int(forecast_hour)
+
+    return None
+
+
+def parse_netcdf_name(netcdf_file):
+    '''
+    Return the (cycle, forecast hour) of a transcoded ancillary NetCDF file,
+    or None if the name is not recognised.
+    '''
+    match = NETCDF_PATTERN.match(path.basename(netcdf_file))
+    if not match:
+        return None
+
+    cycle_str, descriptor = match.groups()
+    if descriptor == 'anl':
+        forecast_hour = 0
+    else:
+        forecast_match = FORECAST_PATTERN.match(descriptor)
+        if not forecast_match:
+            return None
+        forecast_hour = int(forecast_match.group(1))
+
+    return datetime.strptime(cycle_str, TIME_FORMAT), forecast_hour
+
+
+def gdas_valid_time(time_obj):
+    '''
+    The valid time of the GDAS analysis for time_obj: the nearest six-hourly
+    synoptic time, as chosen by get_anc_iapp_grib1_gdas_gfs.csh.
+    '''
+    day = datetime(time_obj.year, time_obj.month, time_obj.day)
+    minutes = 60 * time_obj.hour + time_obj.minute
+
+    return day + timedelta(hours=6 * ((minutes + 180) // 360))
+
+
+def gfs_valid_time(time_obj):
+    '''
+    The valid time of the GFS forecast for time_obj: the nearest three-hourly
+    time, as chosen by get_anc_iapp_grib1_gdas_gfs.csh.
+    '''
+    day = datetime(time_obj.year, time_obj.month, time_obj.day)
+    minutes = 60 * time_obj.hour + time_obj.minute
+
+    return day + timedelta(hours=3 * ((minutes + 89) // 180))
+
+
+class AncillaryCacheIndex(object):
+    '''
+    The GDAS/GFS files in the ancillary cache directory cache_dir, sorted by
+    valid time.
+    '''
+
+    def __init__(self, cache_dir):
+        self.cache_dir = path.abspath(cache_dir)
+        self.index_file = path.join(self.cache_dir, INDEX_FILE_NAME)
+        self.journal_file = path.join(self.cache_dir, JOURNAL_FILE_NAME)
+
+        # Parallel lists: sort keys (valid time, model, forecast hour, GRIB
+        # file) and the corresponding records.
+        self._keys = []
+        self._records = []
+        # The index file last read (as its inode and mtime), and how much of
+        # the journal has been read since.
+        self._signature = None
+        self._journal_offset = 0
+        self._journal_entries = 0
+        self._loaded = False
+        self._lock = Lock()
+
+    @contextmanager
+    def _locked(self):
+        '''Hold the lock of this object, and the lock of the index file.'''
+        with self._lock:
+            with single_flight(self.cache_dir, 'the ancillary cache index'):
+                yield
+
+    def _relative(self, file_name):
+        '''Paths inside the cache are stored relative to it.'''
+        file_name = path.abspath(file_name)
+        if file_name.startswith(self.cache_dir + os.sep):
+            return path.relpath(file_name, self.cache_dir)
+        return file_name
+
+    def _absolute(self, file_name):
+        if file_name is None:
+            return None
+        return path.join(self.cache_dir, file_name)
+
+    def _make_record(self, grib_file, netcdf_file=None):
+        parsed = parse_grib_name(grib_file)
+        if parsed is None:
+            return None
+
+        model, cycle, forecast_hour = parsed
+        return {'model': model,
+                'cycle': cycle,
+                'forecast_hour': forecast_hour,
+                'valid_time': cycle + timedelta(hours=forecast_hour),
+                'grib_file': self._relative(grib_file),
+                'netcdf_file': None if netcdf_file is None else self._relative(netcdf_file)}
+
+    @staticmethod
+    def _key(record):
+        return (record['valid_time'], record['model'], record['forecast_hour'],
+                record['grib_file'])
+
+    def _add(self, record):
+        '''Insert a record in sort order, replacing any for the same GRIB file.'''
+        key = self._key(record)
+        idx = bisect.bisect_left(self._keys, key)
+        if idx < len(self._keys) and self._keys[idx] == key:
+            self._records[idx] = record
+        else:
+            self._keys.insert(idx, key)
+            self._records.insert(idx, record)
+
+    def _discard(self, idx):
+        del self._keys[idx]
+        del self._records[idx]
+
+    def _evict(self, relative_name):
+        '''Remove the record of a GRIB file, or the NetCDF file from a record.'''
+        for idx in reversed(range(len(self._records))):
+            record = self._records[idx]
+            if record['grib_file'] == relative_name:
+                self._discard(idx)
+            elif record['netcdf_file'] == relative_name:
+                record['netcdf_file'] = None
+
+    @staticmethod
+    def _dump_record(record):
+        record = dict(record)
+        record['cycle'] = record['cycle'].strftime(TIME_FORMAT)
+        record['valid_time'] = record['valid_time'].strftime(TIME_FORMAT)
+        return record
+
+    @staticmethod
+    def _parse_record(record):
+        record['model'] = str(record['model'])
+        record['grib_file'] = str(record['grib_file'])
+        if record['netcdf_file'] is not None:
+            record['netcdf_file'] = str(record['netcdf_file'])
+        record['cycle'] = datetime.strptime(record['cycle'], TIME_FORMAT)
+        record['valid_time'] = datetime.strptime(record['valid_time'], TIME_FORMAT)
+        return record
+
+    def _apply(self, entry):
+        '''Apply a journal entry to the records.'''
+        if entry['op'] == 'add':
+            self._add(self._parse_record(entry['record']))
+        elif entry['op'] == 'evict':
+            self._evict(str(entry['file']))
+
+    def _find(self, grib_file):
+        '''Return the position of the record of grib_file, or None.'''
+        record = self._make_record(grib_file)
+        if record is None:
+            return None
+
+        idx = bisect.bisect_left(self._keys, self._key(record))
+        if idx < len(self._keys) and self._keys[idx] == self._key(record):
+            return idx
+        return None
+
+    def _load(self):
+        '''
+        Read the index file if it has been replaced since it was last read, or
+        build the index by scanning the cache if there is no index file, then
+        apply any new journal entries. Called with the locks held.
+        '''
+        try:
+            index_stat = os.stat(self.index_file)
+        except OSError:
+            if not self._loaded:
+                self._rebuild()
+            return
+
+        signature = (index_stat.st_ino, index_stat.st_mtime)
+        if signature != self._signature:
+            try:
+                index_obj = open(self.index_file, 'r')
+                index_dict = json.load(index_obj)
+                index_obj.close()
+            except Exception:
+                LOG.warn('Unable to read the ancillary cache index {}, rebuilding it'
+                         .format(self.index_file))
+                LOG.debug(traceback.format_exc())
+                self._rebuild()
+                return
+
+            if index_dict.get('version') != INDEX_VERSION:
+                self._rebuild()
+                return
+
+            self._keys = []
+            self._records = []
+            for record in index_dict['records']:
+                record = self._parse_record(record)
+                self._keys.append(self._key(record))
+                self._records.append(record)
+
+            self._signature = signature
+            self._journal_offset = 0
+            self._journal_entries = 0
+            self._loaded = True
+
+        self._read_journal()
+
+    def _read_journal(self):
+        '''Apply the journal entries written since it was last read.'''
+        try:
+            journal_obj = open(self.journal_file, 'r')
+        except IOError:
+            return
+
+        try:
+            journal_obj.seek(self._journal_offset)
+            for line in journal_obj:
+                if not line.endswith('\n'):
+                    # An entry whose writer died, skipped by the next writer
+                    break
+                self._journal_offset += len(line)
+                self._journal_entries += 1
+                try:
+                    self._apply(json.loads(line))
+                except Exception:
+                    LOG.debug('Skipping the bad ancillary cache index entry {!r}'.format(line))
+        finally:
+            journal_obj.close()
+
+    def _append(self, entry):
+        '''
+        Record a change in the journal, folding the journal into the index file
+        if it has grown too long. Called with the locks held.
+        '''
+        if self._journal_entries >= JOURNAL_LIMIT:
+            self._save()
+            return
+
+        try:
+            journal_obj = open(self.journal_file, 'a+')
+            journal_obj.seek(0, os.SEEK_END)
+            if journal_obj.tell() != self._journal_offset:
+                # Start after any partial entry
+                journal_obj.write('\n')
+            journal_obj.write(json.dumps(entry) + '\n')
+            self._journal_offset = journal_obj.tell()
+            self._journal_entries += 1
+            journal_obj.close()
+        except (IOError, OSError), err:
+            # A read-only cache can still be indexed in memory
+            LOG.debug('Unable to write the ancillary cache index journal: {}'.format(str(err)))
+
+    def _rebuild(self):
+        '''Build the index by scanning the cache directory.'''
+        LOG.info('Indexing the ancillary cache {}...'.format(self.cache_dir))
+
+        self._keys = []
+        self._records = []
+
+        for dir_name, dir_names, file_names in os.walk(self.cache_dir):
+            netcdf_files = {}
+            for file_name in file_names:
+                parsed = parse_netcdf_name(file_name)
+                if parsed is not None:
+                    netcdf_files[parsed] = path.join(dir_name, file_name)
+
+            for file_name in file_names:
+                record = self._make_record(path.join(dir_name, file_name))
+                if record is None:
+                    continue
+                netcdf_file = netcdf_files.get((record['cycle'], record['forecast_hour']))
+                if netcdf_file is not None:
+                    record['netcdf_file'] = self._relative(netcdf_file)
+                self._add(record)
+
+        LOG.debug('Indexed {} GDAS/GFS files'.format(len(self._records)))
+
+        self._loaded = True
+        self._save()
+
+    def _save(self):
+        '''
+        Write the index file, via a temporary file, and remove the journal
+        which it replaces. Called with the locks held.
+        '''
+        records = [self._dump_record(x) for x in self._records]
+
+        tmp_file = path.join(self.cache_dir, '.{}.{}.part'.format(INDEX_FILE_NAME, os.getpid()))
+        try:
+            tmp_obj = open(tmp_file, 'w')
+            json.dump({'version': INDEX_VERSION, 'records': records}, tmp_obj)
+            tmp_obj.close()
+            os.rename(tmp_file, self.index_file)
+            index_stat = os.stat(self.index_file)
+            self._signature = (index_stat.st_ino, index_stat.st_mtime)
+            if path.exists(self.journal_file):
+                os.unlink(self.journal_file)
+            self._journal_offset = 0
+            self._journal_entries = 0
+        except (IOError, OSError), err:
+            # A read-only cache can still be indexed in memory
+            LOG.debug('Unable to write the ancillary cache index: {}'.format(str(err)))
+            if path.exists(tmp_file):
+                os.unlink(tmp_file)
+
+    def lookup(self, time_obj, allow_forecast=True):
+        '''
+        Return the record of the cached GDAS/GFS file which the retrieval script
+        would choose for time_obj, or None on a miss. GDAS analyses are
+        preferred; GFS forecasts are only returned if allow_forecast is True.
+        Records of files which have disappeared from the cache are dropped.
+        '''
+        candidates = [('gdas1', gdas_valid_time(time_obj), [0])]
+        if allow_forecast:
+            candidates.append(('gfs', gfs_valid_time(time_obj), GFS_FORECAST_HOURS))
+
+        with self._locked():
+            self._load()
+            found = None
+
+            for model, valid_time, forecast_hours in candidates:
+                for forecast_hour in forecast_hours:
+                    idx = bisect.bisect_left(self._keys, (valid_time, model, forecast_hour))
+                    while (idx < len(self._keys)
+                           and self._keys[idx][:3] == (valid_time, model, forecast_hour)):
+                        record = self._records[idx]
+                        if not path.exists(self._absolute(record['grib_file'])):
+                            LOG.debug('{} has left the ancillary cache'.format(record['grib_file']))
+                            self._discard(idx)
+                            self._append({'op': 'evict', 'file': record['grib_file']})
+                            continue
+                        found = record
+                        break
+                    if found is not None:
+                        break
+                if found is not None:
+                    break
+
+        if found is None:
+            return None
+
+        record = dict(found)
+        record['grib_file'] = self._absolute(record['grib_file'])
+        record['netcdf_file'] = self._absolute(record['netcdf_file'])
+        if record['netcdf_file'] is not None and not path.exists(record['netcdf_file']):
+            record['netcdf_file'] = None
+
+        return record
+
+    def netcdf_file_of(self, grib_file):
+        '''Return the transcoded NetCDF file of grib_file, if it is in the cache.'''
+        with self._locked():
+            self._load()
+            idx = self._find(grib_file)
+            if idx is None or self._records[idx]['netcdf_file'] is None:
+                return None
+            netcdf_file = self._absolute(self._records[idx]['netcdf_file'])
+
+        return netcdf_file if path.exists(netcdf_file) else None
+
+    def insert(self, grib_file, netcdf_file=None):
+        '''
+        Add grib_file (and its transcoded NetCDF file, if given) to the index.
+        Files not named like the GDAS/GFS cache files are ignored.
+        '''
+        with self._locked():
+            self._load()
+            record = self._make_record(grib_file, netcdf_file)
+            if record is None:
+                LOG.debug('{} is not a cached GDAS/GFS file, not indexing it'.format(grib_file))
+                return
+
+            idx = self._find(grib_file)
+            if netcdf_file is None and idx is not None:
+                record['netcdf_file'] = self._records[idx]['netcdf_file']
+
+            self._add(record)
+            self._append({'op': 'add', 'record': self._dump_record(record)})
+
+    def evict(self, file_name):
+        '''
+        Remove a GRIB file, or a transcoded NetCDF file, from the index. This
+        does not delete the file.
+        '''
+        relative_name = self._relative(file_name)
+
+        with self._locked():
+            self._load()
+            self._evict(relative_name)
+            self._append({'op': 'evict', 'file': relative_name})
+
+    def prune(self):
+        '''Remove the records of files which are no longer in the cache.'''
+        with self._locked():
+            self._load()
+            for idx in reversed(range(len(self._records))):
+                record = self._records[idx]
+                if not path.exists(self._absolute(record['grib_file'])):
+                    self._discard(idx)
+                elif (record['netcdf_file'] is not None
+                        and not path.exists(self._absolute(record['netcdf_file']))):
+                    record['netcdf_file'] = None
+            self._save()
+
+    def __len__(self):
+        return len(self._records)
+
+
+_INDEXES = {}
+_INDEXES_LOCK = Lock()
+
+
+def get_cache_index(cache_dir):
+    '''Return the (per-process) index of the ancillary cache cache_dir.'''
+    cache_dir = path.abspath(cache_dir)
+    with _INDEXES_LOCK:
+        if cache_dir not in _INDEXES:
+            _INDEXES[cache_dir] = AncillaryCacheIndex(cache_dir)
+        return _INDEXES[cache_dir]
@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Radiosonde.py
+
+Radiosonde ingestion: the text soundings in a local archive are parsed once
+into a compact columnar cache, indexed by time and station location, and the
+soundings for a pass are selected from the index and written out for IAPP.
+
+Soundings are read in the NOAA/ESRL radiosonde database text format (the
+"FSL" format), in which each sounding starts with a type 254 line holding the
+nominal time, followed by the station identification lines (types 1 to 3) and
+one line per level (types 4 to 9) of pressure (tenths of hPa), height (m),
+temperature and dewpoint (tenths of C), wind direction and speed.
+
+Each archive file is cached as integer columns (Python arrays, pickled), one
+row per sounding and one row per level, in a cache directory with a manifest
+recording the size, mtime and time range of each archive file, so a file is
+parsed again only if it changes, and only the caches overlapping the time
+window of a pass are loaded. The loaded soundings are binned on a time/lat/lon
+grid, so selecting the soundings of a pass only looks at the grid cells which
+cover the pass footprint and time window.
+
+Checking the archive for changes walks and stats all of its files, so it is
+done at most once every REFRESH_INTERVAL seconds in a process: soundings
+added to the archive are seen by the passes processed after that.
+
+Copyright (c) 2013 University of Wisconsin SSEC. All rights reserved.
+Licensed under GNU GPLv3.
+"""
+
+import os
+import json
+import logging
+import traceback
+import cPickle as pickle
+from os import path
+from array import array
+from time import time
+from datetime import datetime, timedelta
+from threading import Lock
+
+LOG = logging.getLogger(__name__)
+
+CACHE_VERSION = 1
+MANIFEST_NAME = 'manifest.json'
+
+MISSING = 99999
+
+# The shortest time in seconds between checks of an archive for changes.
+REFRESH_INTERVAL = 60.
+
+# Grid of the sounding index: 6 hour time bins, and 5 degree lat/lon cells.
+TIME_BIN = 6 * 3600
+CELL_SIZE = 5.
+
+MONTHS = ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN',
+          'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC']
+
+# The level columns, in the order of the FSL data lines.
+LEVEL_COLUMNS = ['type', 'pressure', 'height', 'temperature', 'dewpoint',
+                 'wind_direction', 'wind_speed']
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def _seconds(time_obj):
+    return int((time_obj - EPOCH).total_seconds())
+
+
+def _parse_coordinate(coord_str):
+    '''Convert e.g. "24.55N" or "81.75W" to signed decimal degrees.'''
+    value = float(coord_str[:-1])
+    if coord_str[-1] in 'SW':
+        value = -value
+    return value
+
+
+def parse_fsl_file(sounding_file):
+    '''
+    Parse a text file of FSL format soundings into a dictionary of columns:
+    per sounding 'station', 'wmo_id', 'lat', 'lon', 'elevation', 'time', 'wind_units',
+    'first_level' and 'level_count'; per level the LEVEL_COLUMNS. Latitudes and
+    longitudes are stored in hundredths of a degree. Unparseable soundings are
+    skipped.
+    '''
+    columns = {'station': [],
+               'wmo_id': array('i'),
+               'lat': array('i'),
+               'lon': array('i'),
+               'elevation': array('i'),
+               'time': array('i'),
+               'wind_units': [],
+               'first_level': array('i'),
+               'level_count': array('i')}
+    for column in LEVEL_COLUMNS:
+        columns[column] = array('i')
+
+    sounding = None
+
+    def _finish(sounding):
+        if sounding is None or sounding.get('lat') is None or not sounding['levels']:
+            return
+        columns['station'].append(sounding['station'])
+        columns['wmo_id'].append(sounding['wmo_id'])
+        columns['lat'].append(int(round(100. * sounding['lat'])))
+        columns['lon'].append(int(round(100. * sounding['lon'])))
+        columns['elevation'].append(sounding['elevation'])
+        columns['time'].append(_seconds(sounding['time']))
+        columns['wind_units'].append(sounding['wind_units'])
+        columns['first_level'].append(len(columns['pressure']))
+        columns['level_count'].append(len(sounding['levels']))
+        for level in sounding['levels']:
+            for column, value in zip(LEVEL_COLUMNS, level):
+                columns[column].append(value)
+
+    file_obj = open(sounding_file, 'r')
+    for line_number, line in enumerate(file_obj):
+        tokens = line.split()
+        if not tokens:
+            continue
+        try:
+            line_type = int(tokens[0])
+            if line_type == 254:
+                _finish(sounding)
+                hour, day, month, year = (int(tokens[1]), int(tokens[2]),
+                                          MONTHS.index(tokens[3].upper()) + 1, int(tokens[4]))
+                sounding = {'time': datetime(year, month, day) + timedelta(hours=hour),
+                            'station': '', 'wmo_id': MISSING, 'lat': None, 'lon': None,
+                            'elevation': MISSING, 'wind_units': 'kt', 'levels': []}
+            elif sounding is None:
+                continue
+            elif line_type == 1:
+                sounding['wmo_id'] = int(tokens[2])
+                sounding['lat'] = _parse_coordinate(tokens[3])
+                sounding['lon'] = _parse_coordinate(tokens[4])
+                sounding['elevation'] = int(tokens[5])
+            elif line_type == 3:
+                sounding['station'] = tokens[1] if len(tokens) > 1 else ''
+                sounding['wind_units'] = tokens[-1] if len(tokens) > 3 else 'kt'
+            elif 4 <= line_type <= 9:
+                sounding['levels'].append([int(token) for token in tokens[:7]])
+        except (ValueError, IndexError):
+            LOG.debug('Skipping sounding at line {} of {}'.format(line_number + 1, sounding_file))
+            sounding = None
+    file_obj.close()
+
+    _finish(sounding)
+
+    return columns
+
+
+def write_fsl_file(soundings, output_file):
+    '''Write a list of sounding dictionaries (see RadiosondeArchive.select) in FSL format.'''
+    output_obj = open(output_file, 'w')
+
+    for sounding in soundings:
+        time_obj = sounding['time']
+        lat, lon = sounding['lat'], sounding['lon']
+        output_obj.write('{:7d}{:7d}{:7d}{:>7s}{:8d}\n'.format(
+            254, time_obj.hour, time_obj.day, MONTHS[time_obj.month - 1], time_obj.year))
+        output_obj.write('{:7d}{:7d}{:7d}{:>8s}{:>8s}{:7d}{:7d}\n'.format(
+            1, MISSING, sounding['wmo_id'],
+            '{:.2f}{}'.format(abs(lat), 'S' if lat < 0 else 'N'),
+            '{:.2f}{}'.format(abs(lon), 'W' if lon < 0 else 'E'),
+            sounding['elevation'], MISSING))
+        output_obj.write('{:7d}{:7d}{:7d}{:7d}{:7d}{:7d}{:7d}\n'.format(
+            2, MISSING, MISSING, MISSING, len(sounding['levels']) + 4, MISSING, MISSING))
+        output_obj.write('{:7d}{:>10s}{:>21s}{:>7s}\n'.format(
+            3, sounding['station'], str(MISSING), sounding['wind_units']))
+        for level in sounding['levels']:
+            output_obj.write(''.join(['{:7d}'.format(value) for value in level]) + '\n')
+
+    output_obj.close()
+
+    return output_file
+
+
+class RadiosondeArchive(object):
+    '''
+    The soundings in the text files under archive_dir, cached in cache_dir.
+    '''
+
+    def __init__(self, archive_dir, cache_dir):
+        self.archive_dir = path.abspath(archive_dir)
+        self.cache_dir = path.abspath(cache_dir)
+        self.manifest_file = path.join(self.cache_dir, MANIFEST_NAME)
+
+        self._manifest = {}
+        self._tables = {}      # archive file -> columns
+        self._grid = {}        # (time bin, lat cell, lon cell) -> [(archive file, row)]
+        self._refresh_time = None
+        self._lock = Lock()
+
+    def _cache_name(self, archive_file):
+        relative_name = path.relpath(archive_file, self.archive_dir)
+        return path.join(self.cache_dir, relative_name.replace(os.sep, '__') + '.raob')
+
+    def _read_manifest(self):
+        try:
+            manifest_obj = open(self.manifest_file, 'r')
+            manifest = json.load(manifest_obj)
+            manifest_obj.close()
+        except (IOError, ValueError):
+            return {}
+
+        if manifest.get('version') != CACHE_VERSION:
+            return {}
+        return manifest['files']
+
+    def _write_manifest(self):
+        tmp_file = '{}.{}.part'.format(self.manifest_file, os.getpid())
+        tmp_obj = open(tmp_file, 'w')
+        json.dump({'version': CACHE_VERSION, 'files': self._manifest}, tmp_obj)
+        tmp_obj.close()
+        os.rename(tmp_file, self.manifest_file)
+
+    def refresh(self, min_interval=None):
+        '''
+        Bring the cache up to date with the archive: parse new or changed
+        sounding files, and forget files which have gone. Does nothing if the
+        last refresh was less than min_interval seconds ago.
+        '''
+        with self._lock:
+            if min_interval is not None and self._refresh_time is not None \
+                    and time() - self._refresh_time < min_interval:
+                return
+
+            if not path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+
+            self._manifest = self._read_manifest()
+            seen = set()
+            changed = False
+
+            for dir_name, dir_names, file_names in os.walk(self.archive_dir):
+                for file_name in file_names:
+                    archive_file = path.join(dir_name, file_name)
+                    seen.add(archive_file)
+                    st = os.stat(archive_file)
+                    entry = self._manifest.get(archive_file)
+                    if entry is not None and entry['size'] == st.st_size \
+                            and entry['mtime'] == st.st_mtime \
+                            and path.exists(entry['cache_file']):
+                        continue
+
+                    LOG.debug('Parsing sounding file {}'.format(archive_file))
+                    try:
+                        columns = parse_fsl_file(archive_file)
+                    except Exception:
+                        LOG.warn('Unable to parse sounding file {}'.format(archive_file))
+                        LOG.debug(traceback.format_exc())
+                        continue
+
+                    cache_file = self._cache_name(archive_file)
+                    cache_obj = open(cache_file, 'wb')
+                    pickle.dump(columns, cache_obj, pickle.HIGHEST_PROTOCOL)
+                    cache_obj.close()
+
+                    times = columns['time']
+                    self._manifest[archive_file] = {
+                        'size': st.st_size, 'mtime': st.st_mtime, 'cache_file': cache_file,
+                        'count': len(times),
+                        'time_min': min(times) if times else None,
+                        'time_max': max(times) if times else None}
+                    self._tables.pop(archive_file, None)
+                    changed = True
+
+            for archive_file in list(self._manifest.keys()):
+                if archive_file not in seen:
+                    cache_file = self._manifest.pop(archive_file)['cache_file']
+                    if path.exists(cache_file):
+                        os.unlink(cache_file)
+                    self._tables.pop(archive_file, None)
+                    changed = True
+
+            if changed:
+                self._write_manifest()
+                self._grid = {}
+                self._tables = {}
+
+            self._refresh_time = time()
+
+    def _load(self, start_seconds, end_seconds):
+        '''Load, and grid, the cached files overlapping the time range.'''
+        for archive_file, entry in self._manifest.items():
+            if archive_file in self._tables or entry['time_min'] is None:
+                continue
+            if entry['time_max'] < start_seconds or entry['time_min'] > end_seconds:
+                continue
+
+            cache_obj = open(entry['cache_file'], 'rb')
+            columns = pickle.load(cache_obj)
+            cache_obj.close()
+            self._tables[archive_file] = columns
+
+            for row in xrange(len(columns['time'])):
+                key = (columns['time'][row] // TIME_BIN,
+                       int((columns['lat'][row] / 100. + 90.) // CELL_SIZE),
+                       int((columns['lon'][row] / 100. + 180.) // CELL_SIZE))
+                self._grid.setdefault(key, []).append((archive_file, row))
+
+    def select(self, start_time, end_time, bounds=None):
+        '''
+        Return the soundings between start_time and end_time, inside bounds
+        (lat_min, lat_max, lon_min, lon_max) if given, as a list of dictionaries
+        sorted by time and station.
+        '''
+        start_seconds, end_seconds = _seconds(start_time), _seconds(end_time)
+        lat_min, lat_max, lon_min, lon_max = (-90., 90., -180., 180.) if bounds is None else bounds
+
+        # Longitude ranges crossing the dateline are split in two
+        if lon_min <= lon_max:
+            lon_ranges = [(lon_min, lon_max)]
+        else:
+            lon_ranges = [(lon_min, 180.), (-180., lon_max)]
+
+        lat_cells = range(int((lat_min + 90.) // CELL_SIZE),
+                          int((min(lat_max, 89.99) + 90.) // CELL_SIZE) + 1)
+
+        soundings = []
+
+        with self._lock:
+            self._load(start_seconds, end_seconds)
+
+            for time_bin in xrange(start_seconds // TIME_BIN, end_seconds // TIME_BIN + 1):
+                for lon_range_min, lon_range_max in lon_ranges:
+                    lon_cells = range(int((lon_range_min + 180.) // CELL_SIZE),
+                                      int((min(lon_range_max, 179.99) + 180.) // CELL_SIZE) + 1)
+                    for lat_cell in lat_cells:
+                        for lon_cell in lon_cells:
+                            for archive_file, row in self._grid.get((time_bin, lat_cell, lon_cell), []):
+                                columns = self._tables[archive_file]
+                                lat = columns['lat'][row] / 100.
+                                lon = columns['lon'][row] / 100.
+                                time_seconds = columns['time'][row]
+                                if not (start_seconds <= time_seconds <= end_seconds
+                                        and lat_min <= lat <= lat_max
+                                        and lon_range_min <= lon <= lon_range_max):
+                                    continue
+                                soundings.append(self._sounding(columns, row))
+
+        soundings.sort(key=lambda sounding: (sounding['time'], sounding['station'],
+                                             sounding['wmo_id']))
+
+        return soundings
+
+    @staticmethod
+    def _sounding(columns, row):
+        first_level = columns['first_level'][row]
+        last_level = first_level + columns['level_count'][row]
+        levels = zip(*[columns[column][first_level:last_level] for column in LEVEL_COLUMNS])
+
+        return {'station': columns['station'][row],
+                'wmo_id': columns['wmo_id'][row],
+                'lat': columns['lat'][row] / 100.,
+                'lon': columns['lon'][row] / 100.,
+                'elevation': columns['elevation'][row],
+                'time': EPOCH + timedelta(seconds=columns['time'][row]),
+                'wind_units': columns['wind_units'][row],
+                'levels': [list(level) for level in levels]}
+
+
+_ARCHIVES = {}
+_ARCHIVES_LOCK = Lock()
+
+
+def get_radiosonde_archive(archive_dir, cache_dir, refresh_interval=REFRESH_INTERVAL):
+    '''
+    Return the (per-process) RadiosondeArchive of archive_dir, refreshed if it
+    wasn't in the last refresh_interval seconds.
+    '''
+    key = (path.abspath(archive_dir), path.abspath(cache_dir))
+    with _ARCHIVES_LOCK:
+        if key not in _ARCHIVES:
+            _ARCHIVES[key] = RadiosondeArchive(*key)
+        archive = _ARCHIVES[key]
+
+    archive.refresh(refresh_interval)
+
+    return archive
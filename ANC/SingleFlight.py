@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+SingleFlight.py
+
+Inter-process locks on the keys of ancillary artifacts (e.g. a GDAS/GFS
+valid time, or a GRIB file to be transcoded), so that when several IAPP
+processes need the same artifact at once, one of them produces it while the
+others wait and then reuse it.
+
+The locks are fcntl (POSIX) locks on files in a lock directory in the
+ancillary cache, which also work on NFS. The kernel releases the lock of a
+process which dies, but a lock can still outlive its holder, e.g. if an NFS
+client vanishes. The holder writes its host and pid into the lock file, and
+rewrites them every stale_timeout/4 seconds while it holds the lock, as a
+heartbeat. The lock file is broken (replaced by a new one) only if the holder
+is a dead process on this host, or if it isn't a live process on this host and
+the lock file hasn't been written for stale_timeout seconds (so the clocks of
+the hosts sharing a cache should roughly agree). Otherwise a waiter keeps
+waiting, however long the holder takes. If the lock directory can't be
+written, the caller runs unlocked.
+
+Copyright (c) 2013 University of Wisconsin SSEC. All rights reserved.
+Licensed under GNU GPLv3.
+"""
+
+import os
+import re
+import errno
+import fcntl
+import socket
+import logging
+import traceback
+from os import path
+from time import time, sleep
+from threading import Thread, Event
+
+LOG = logging.getLogger(__name__)
+
+LOCK_DIR_NAME = '.iapp_locks'
+POLL_INTERVAL = 0.5
+
+
+def _holder_state(lock_file):
+    '''
+    'dead' or 'alive' if lock_file names a process on this host which no
+    longer exists or which does, and None if its holder can't be checked.
+    '''
+    try:
+        lock_obj = open(lock_file, 'r')
+        host, pid = lock_obj.read().split()[:2]
+        lock_obj.close()
+        pid = int(pid)
+    except (IOError, ValueError):
+        return None
+
+    if host != socket.gethostname():
+        return None
+
+    try:
+        os.kill(pid, 0)
+    except OSError, err:
+        if err.errno == errno.ESRCH:
+            return 'dead'
+
+    return 'alive'
+
+
+class SingleFlight(object):
+    '''
+    A context manager holding the lock on key in lock_dir while its body runs.
+
+        with SingleFlight(lock_dir, key):
+            if not already_made():
+                make()
+    '''
+
+    def __init__(self, lock_dir, key, stale_timeout=1800.):
+        self.lock_dir = lock_dir
+        self.key = key
+        self.lock_file = path.join(lock_dir, re.sub(r'[^\w.-]', '_', key) + '.lock')
+        self.stale_timeout = stale_timeout
+        self.fd = None
+        self._stop = None
+        self._thread = None
+
+    def _break(self):
+        '''Replace the lock file, so that new lockers don't wait on the old one.'''
+        LOG.warn('Breaking the stale lock {}'.format(self.lock_file))
+        broken_file = '{}.{}.{}.broken'.format(self.lock_file, socket.gethostname(), os.getpid())
+        try:
+            os.rename(self.lock_file, broken_file)
+            os.unlink(broken_file)
+        except OSError:
+            LOG.debug(traceback.format_exc())
+
+    def _is_stale(self):
+        '''True if the holder of the lock file is verifiably gone.'''
+        state = _holder_state(self.lock_file)
+        if state is not None:
+            return state == 'dead'
+        try:
+            return time() - os.stat(self.lock_file).st_mtime > self.stale_timeout
+        except OSError:
+            return False
+
+    def _write_holder(self):
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        os.ftruncate(self.fd, 0)
+        os.write(self.fd, '{} {}\n'.format(socket.gethostname(), os.getpid()))
+
+    def _heartbeat(self):
+        while not self._stop.wait(self.stale_timeout / 4.):
+            try:
+                self._write_holder()
+            except OSError:
+                LOG.debug(traceback.format_exc())
+
+    def acquire(self):
+        waiting = False
+
+        while True:
+            fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0664)
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError, err:
+                os.close(fd)
+                if err.errno not in (errno.EACCES, errno.EAGAIN):
+                    raise
+                if not waiting:
+                    LOG.info('Waiting for another process to produce {}...'.format(self.key))
+                    waiting = True
+                if self._is_stale():
+                    self._break()
+                sleep(POLL_INTERVAL)
+                continue
+
+            # The lock file may have been broken and replaced while we locked it
+            try:
+                same_file = os.fstat(fd).st_ino == os.stat(self.lock_file).st_ino
+            except OSError:
+                same_file = False
+            if not same_file:
+                os.close(fd)
+                continue
+
+            self.fd = fd
+            self._write_holder()
+            self._stop = Event()
+            self._thread = Thread(target=self._heartbeat, name='LockHeartbeat')
+            self._thread.daemon = True
+            self._thread.start()
+            LOG.debug('Acquired the lock {}'.format(self.lock_file))
+            return
+
+    def release(self):
+        if self.fd is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        try:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN)
+        finally:
+            os.close(self.fd)
+            self.fd = None
+        LOG.debug('Released the lock {}'.format(self.lock_file))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.release()
+        return False
+
+
+class _NoLock(object):
+    '''Stands in for a SingleFlight when the lock directory can't be written.'''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+def single_flight(cache_dir, key, stale_timeout=1800.):
+    '''
+    Return an acquired SingleFlight lock on key in the lock directory of
+    cache_dir, to be used in a with statement, or a dummy lock if the lock
+    directory can't be written.
+    '''
+    lock_dir = path.join(cache_dir, LOCK_DIR_NAME)
+    try:
+        if not path.isdir(lock_dir):
+            try:
+                os.makedirs(lock_dir)
+            except OSError, err:
+                if err.errno != errno.EEXIST:
+                    raise
+        lock = SingleFlight(lock_dir, key, stale_timeout)
+        lock.acquire()
+        return lock
+    except (IOError, OSError), err:
+        LOG.debug('Unable to lock {} in {}, continuing unlocked: {}'
+                  .format(key, lock_dir, str(err)))
+        return _NoLock()
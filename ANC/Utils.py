@@ -17,7 +17,7 @@ import traceback
 from os import path
 import string
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import shlex
 import subprocess
@@ -26,8 +26,12 @@ from shutil import move
 from glob import glob
 
 from iapp_utils import sh, env, execute_binary_captured_inject_io
-from iapp_utils import CSPP_RT_HOME, CSPP_RT_ANC_CACHE_DIR, JPSS_REMOTE_ANC_DIR
-from iapp_utils import IAPP_HOME
+from iapp_utils import get_config, publish_file
+from iapp_utils import CsppEnvironment, AncillaryError
+
+from CacheIndex import get_cache_index, gdas_valid_time, gfs_valid_time, GDAS_LATENCY
+from SingleFlight import single_flight
+from Radiosonde import get_radiosonde_archive, write_fsl_file
 
 # every module should have a LOG object
 LOG = logging.getLogger(__name__)
@@ -145,7 +149,7 @@ def check_exe(exeName):
     except CalledProcessError:
         LOG.error("Required executable {} is not in the path or is not installed, aborting."
                   .format(exeName))
-        sys.exit(1)
+        raise CsppEnvironment("Required executable {} is not in the path".format(exeName))
 
 
 def check_exe2(program):
@@ -174,7 +178,27 @@ def retrieve_NCEP_grib_files(Level1D_obj, run_dir):
     Download the GRIB files which cover the dates of the geolocation files.
     '''
 
-    ANC_SCRIPTS_PATH = path.join(CSPP_RT_HOME, 'scripts', 'ANC')
+    config = get_config()
+    ANC_SCRIPTS_PATH = path.join(config.CSPP_RT_HOME, 'scripts', 'ANC')
+
+    LOG.info('Retrieving and granulating ancillary data for {}...'
+             .format(Level1D_obj.input_file))
+
+    # Look in the ancillary cache index first, only running the retrieval
+    # script on a miss. GFS forecasts are only used for recent passes, for
+    # which the GDAS analysis may not yet exist; otherwise the script gets the
+    # chance to download the analysis.
+    allow_forecast = datetime.utcnow() - Level1D_obj.timeObj_mid < GDAS_LATENCY
+    try:
+        cache_index = get_cache_index(config.CSPP_RT_ANC_CACHE_DIR)
+        record = cache_index.lookup(Level1D_obj.timeObj_mid, allow_forecast=allow_forecast)
+        if record is not None:
+            LOG.info('Found GDAS/GFS file in the ancillary cache: {}'.format(record['grib_file']))
+            return [record['grib_file']], 0
+    except Exception, err:
+        cache_index = None
+        LOG.warn("{}".format(str(err)))
+        LOG.debug(traceback.format_exc())
 
     # Check that we have access to the c-shell...
     csh_exe = 'csh'
@@ -182,10 +206,7 @@ def retrieve_NCEP_grib_files(Level1D_obj, run_dir):
     if check_exe2(csh_exe) is None:
         LOG.error("Required executable '{}' is not in the path or is not installed..."
                   .format(csh_exe))
-        return -1
-
-    LOG.info('Retrieving and granulating ancillary data for {}...'
-             .format(Level1D_obj.input_file))
+        return [], -1
 
     # Check that we have access to the GRIB retrieval scripts...
     scriptNames = ['get_anc_iapp_grib1_gdas_gfs.csh']
@@ -201,65 +222,80 @@ def retrieve_NCEP_grib_files(Level1D_obj, run_dir):
                                  Level1D_obj.timeObj_mid.strftime("%H%M")
                                  )
     LOG.debug('Script args: {}'.format(script_args))
-    LOG.debug('JPSS_REMOTE_ANC_DIR: {}'.format(JPSS_REMOTE_ANC_DIR))
-
-    gribFiles = []
-
-    current_dir = os.getcwd()
-
-    try:
-        # Call the retrieval script, writing the logging output to a file
-        LOG.info('Retrieving NCEP files for {} ...'.format(Level1D_obj.pass_mid_str))
-        cmdStr = '{} {}'.format(scriptPath, script_args)
-        LOG.debug('\t{}'.format(cmdStr))
-        args = shlex.split(cmdStr)
-
-        # Contruct a dictionary of error conditions which should be logged.
-        error_keys = ['FAILURE', 'failure', 'FAILED', 'failed', 'FAIL', 'fail',
-                      'ERROR', 'error', 'ERR', 'err',
-                      'ABORTING', 'aborting', 'ABORT', 'abort']
-        error_dict = {x: {'pattern': x, 'count_only': False, 'count': 0, 'max_count': None,
-                      'log_str': ''} for x in error_keys}
-        error_dict['error_keys'] = error_keys
-
-        os.chdir(run_dir)
-        env_vars = {'CSPP_EDR_ANC_CACHE_DIR': CSPP_RT_ANC_CACHE_DIR,
-                    'CSPP_RT_HOME': CSPP_RT_HOME,
-                    'JPSS_REMOTE_ANC_DIR': JPSS_REMOTE_ANC_DIR}
-        rc_grib_ret, exe_out = execute_binary_captured_inject_io(
-                run_dir, cmdStr, error_dict,
-                log_execution=False, log_stdout=False, log_stderr=False,
-                **env_vars)
-
-        # output the binary logging to a log file.
-        d = datetime.now()
-        timestamp = d.isoformat()
-        timestamp = timestamp.replace(":", "")
-        logname = "iapp_grib_retrieval_{}.log".format(timestamp)
-        logpath = path.join(run_dir, logname)
-        logfile_obj = open(logpath, 'w')
-
-        for line in exe_out.splitlines():
-            line = string.replace(line, '(ERROR)', '(INFO)')
-            logfile_obj.write(line+"\n")
-            if "GDAS/GFS file" in line:
-                line = string.split(line," ")[-1]
-                gribFiles.append(line)
-
-        logfile_obj.close()
-
-        os.chdir(current_dir)
-
-    except Exception, err:
-        LOG.warn("{}".format(str(err)))
-        LOG.debug(traceback.format_exc())
-
-    # Uniqify the list of GRIB files
-    gribFiles = list(set(gribFiles))
-    gribFiles.sort()
-
-    for gribFile in gribFiles:
-        LOG.info('Retrieved GRIB file: {}'.format(gribFile))
+    LOG.debug('JPSS_REMOTE_ANC_DIR: {}'.format(config.JPSS_REMOTE_ANC_DIR))
+
+    # Only one process runs the retrieval script for a valid time; any others
+    # wait for it, and then find its file in the cache index.
+    valid_time = (gfs_valid_time if allow_forecast else gdas_valid_time)(Level1D_obj.timeObj_mid)
+    with single_flight(config.CSPP_RT_ANC_CACHE_DIR,
+                       'grib_{}'.format(valid_time.strftime('%Y%m%d%H'))):
+
+        if cache_index is not None:
+            record = cache_index.lookup(Level1D_obj.timeObj_mid, allow_forecast=allow_forecast)
+            if record is not None:
+                LOG.info('Found GDAS/GFS file in the ancillary cache: {}'.format(record['grib_file']))
+                return [record['grib_file']], 0
+
+        gribFiles = []
+        rc_grib_ret = -1
+
+        current_dir = os.getcwd()
+
+        try:
+            # Call the retrieval script, writing the logging output to a file
+            LOG.info('Retrieving NCEP files for {} ...'.format(Level1D_obj.pass_mid_str))
+            cmdStr = '{} {}'.format(scriptPath, script_args)
+            LOG.debug('\t{}'.format(cmdStr))
+            args = shlex.split(cmdStr)
+
+            # Contruct a dictionary of error conditions which should be logged.
+            error_keys = ['FAILURE', 'failure', 'FAILED', 'failed', 'FAIL', 'fail',
+                          'ERROR', 'error', 'ERR', 'err',
+                          'ABORTING', 'aborting', 'ABORT', 'abort']
+            error_dict = {x: {'pattern': x, 'count_only': False, 'count': 0, 'max_count': None,
+                          'log_str': ''} for x in error_keys}
+            error_dict['error_keys'] = error_keys
+
+            os.chdir(run_dir)
+            env_vars = {'CSPP_EDR_ANC_CACHE_DIR': config.CSPP_RT_ANC_CACHE_DIR,
+                        'CSPP_RT_HOME': config.CSPP_RT_HOME,
+                        'JPSS_REMOTE_ANC_DIR': config.JPSS_REMOTE_ANC_DIR}
+            rc_grib_ret, exe_out = execute_binary_captured_inject_io(
+                    run_dir, cmdStr, error_dict,
+                    log_execution=False, log_stdout=False, log_stderr=False,
+                    **env_vars)
+
+            # output the binary logging to a log file.
+            d = datetime.now()
+            timestamp = d.isoformat()
+            timestamp = timestamp.replace(":", "")
+            logname = "iapp_grib_retrieval_{}.log".format(timestamp)
+            logpath = path.join(run_dir, logname)
+            logfile_obj = open(logpath, 'w')
+
+            for line in exe_out.splitlines():
+                line = string.replace(line, '(ERROR)', '(INFO)')
+                logfile_obj.write(line+"\n")
+                if "GDAS/GFS file" in line:
+                    line = string.split(line," ")[-1]
+                    gribFiles.append(line)
+
+            logfile_obj.close()
+
+            os.chdir(current_dir)
+
+        except Exception, err:
+            LOG.warn("{}".format(str(err)))
+            LOG.debug(traceback.format_exc())
+
+        # Uniqify the list of GRIB files
+        gribFiles = list(set(gribFiles))
+        gribFiles.sort()
+
+        for gribFile in gribFiles:
+            LOG.info('Retrieved GRIB file: {}'.format(gribFile))
+            if cache_index is not None and rc_grib_ret == 0:
+                cache_index.insert(gribFile)
 
     return gribFiles, rc_grib_ret
 
@@ -269,28 +305,43 @@ def transcode_NCEP_grib_files(grib1_file, run_dir):
     Transcode the retrieved GRIB file to NetCDF.
     '''
 
-    IAPP_DECODERS_PATH = path.abspath(path.join(IAPP_HOME, 'decoders'))
+    config = get_config()
+    IAPP_DECODERS_PATH = path.abspath(path.join(config.IAPP_HOME, 'decoders'))
     LOG.debug('IAPP_DECODERS_PATH : {}'.format(IAPP_DECODERS_PATH))
 
-    IAPP_SCRIPTS_PATH = path.join(CSPP_RT_HOME, 'scripts', 'ANC')
+    IAPP_SCRIPTS_PATH = path.join(config.CSPP_RT_HOME, 'scripts', 'ANC')
     LOG.debug('IAPP_SCRIPTS_PATH : {}'.format(IAPP_SCRIPTS_PATH))
 
-    IAPP_FILES_PATH = path.abspath(path.join(IAPP_HOME, 'decoders', 'files'))
+    IAPP_FILES_PATH = path.abspath(path.join(config.IAPP_HOME, 'decoders', 'files'))
     LOG.debug('IAPP_FILES_PATH : {}'.format(IAPP_FILES_PATH))
 
-    NCGEN_PATH = path.abspath(path.join(CSPP_RT_HOME, 'common', 'ShellB3', 'bin'))
+    NCGEN_PATH = path.abspath(path.join(config.CSPP_RT_HOME, 'common', 'ShellB3', 'bin'))
     LOG.debug('NCGEN_PATH : {}'.format(NCGEN_PATH))
 
     GRIB_FILE_PATH = path.abspath(path.dirname(grib1_file))
     LOG.debug('GRIB_FILE_PATH : {}'.format(GRIB_FILE_PATH))
 
+    # Use the NetCDF file in the ancillary cache, if this GRIB file has already
+    # been transcoded.
+    try:
+        cache_index = get_cache_index(config.CSPP_RT_ANC_CACHE_DIR)
+        grib_netcdf_remote_file = cache_index.netcdf_file_of(grib1_file)
+        if grib_netcdf_remote_file is not None:
+            LOG.info('Found transcoded NetCDF file in the ancillary cache: {}'
+                     .format(grib_netcdf_remote_file))
+            return grib_netcdf_remote_file, 0
+    except Exception, err:
+        cache_index = None
+        LOG.warn("{}".format(str(err)))
+        LOG.debug(traceback.format_exc())
+
     # Check that we have access to the k-shell...
     ksh_exe = 'ksh'
     #_ = check_exe(ksh_exe)
     if check_exe2(ksh_exe) is None:
         LOG.error("Required executable '{}' is not in the path or is not installed..."
                   .format(ksh_exe))
-        return -1
+        return None, -1
 
     # Check that we have access to the transcoding script...
     scriptNames = ['iapp_grib1_to_netcdf.ksh']
@@ -300,151 +351,302 @@ def transcode_NCEP_grib_files(grib1_file, run_dir):
         if not path.exists(scriptPath):
             LOG.error('GRIB transcoding script {} can not be found, aborting.'
                       .format(scriptPath))
-            return -1
-
-    current_dir = os.getcwd()
-
-    script_args = '{} {}/iapp_ancillary.cdl'.format(grib1_file, IAPP_FILES_PATH)
-
-    try:
-        # Call the transcoding script, writing the logging output to a file
-        LOG.info('Transcoding NCEP file {} to NetCDF...'.format(grib1_file))
-        cmdStr = '{} {}'.format(scriptPath, script_args)
-        LOG.debug('\t{}'.format(cmdStr))
-        args = shlex.split(cmdStr)
-
-        # Contruct a dictionary of error conditions which should be logged.
-        error_keys = ['FAILURE', 'failure', 'FAILED', 'failed', 'FAIL', 'fail',
-                      'ERROR', 'error', 'ERR', 'err',
-                      'ABORTING', 'aborting', 'ABORT','abort']
-        error_dict = {x:{'pattern':x, 'count_only':False, 'count':0, 'max_count':None, 'log_str':''}
-                for x in error_keys}
-        error_dict['error_keys'] = error_keys
-
-        os.chdir(run_dir)
-        env_vars = {'IAPP_DECODERS_PATH':IAPP_DECODERS_PATH,
-                    'NCGEN_PATH':NCGEN_PATH}
-        rc_grib_netcdf, exe_out = execute_binary_captured_inject_io(
-                run_dir, cmdStr, error_dict,
-                log_execution=False, log_stdout=False, log_stderr=False,
-                **env_vars)
-
-
-        # output the binary logging to a log file.
-        d = datetime.now()
-        timestamp = d.isoformat()
-        timestamp = timestamp.replace(":", "")
-        logname = "iapp_grib2nc_{}.log".format(timestamp)
-        logpath = path.join(run_dir, logname)
-        logfile_obj = open(logpath, 'w')
-
-        search_str = "Successfully transcoded to NetCDF file: "
-        for line in exe_out.splitlines():
-            logfile_obj.write(line+"\n")
-            if search_str in line:
-                LOG.debug('New NetCDF file: {}'.format(line))
-                line = string.split(line," ")[-1]
-                #line = string.replace(line, search_str, '')
-                #line = string.replace(line, '\n', '')
-                grib_netcdf_file = line
-                break
-
-        logfile_obj.close()
+            return None, -1
+
+    # Only one process transcodes a GRIB file; any others wait for it, and
+    # then find its NetCDF file in the cache index.
+    with single_flight(config.CSPP_RT_ANC_CACHE_DIR,
+                       'grib2nc_{}'.format(path.basename(grib1_file))):
+
+        if cache_index is not None:
+            grib_netcdf_remote_file = cache_index.netcdf_file_of(grib1_file)
+            if grib_netcdf_remote_file is not None:
+                LOG.info('Found transcoded NetCDF file in the ancillary cache: {}'
+                         .format(grib_netcdf_remote_file))
+                return grib_netcdf_remote_file, 0
+
+        current_dir = os.getcwd()
+        grib_netcdf_remote_file = None
+        rc_grib_netcdf = -1
+
+        script_args = '{} {}/iapp_ancillary.cdl'.format(grib1_file, IAPP_FILES_PATH)
+
+        try:
+            # Call the transcoding script, writing the logging output to a file
+            LOG.info('Transcoding NCEP file {} to NetCDF...'.format(grib1_file))
+            cmdStr = '{} {}'.format(scriptPath, script_args)
+            LOG.debug('\t{}'.format(cmdStr))
+            args = shlex.split(cmdStr)
+
+            # Contruct a dictionary of error conditions which should be logged.
+            error_keys = ['FAILURE', 'failure', 'FAILED', 'failed', 'FAIL', 'fail',
+                          'ERROR', 'error', 'ERR', 'err',
+                          'ABORTING', 'aborting', 'ABORT','abort']
+            error_dict = {x:{'pattern':x, 'count_only':False, 'count':0, 'max_count':None, 'log_str':''}
+                    for x in error_keys}
+            error_dict['error_keys'] = error_keys
+
+            os.chdir(run_dir)
+            env_vars = {'IAPP_DECODERS_PATH':IAPP_DECODERS_PATH,
+                        'NCGEN_PATH':NCGEN_PATH}
+            rc_grib_netcdf, exe_out = execute_binary_captured_inject_io(
+                    run_dir, cmdStr, error_dict,
+                    log_execution=False, log_stdout=False, log_stderr=False,
+                    **env_vars)
+
+
+            # output the binary logging to a log file.
+            d = datetime.now()
+            timestamp = d.isoformat()
+            timestamp = timestamp.replace(":", "")
+            logname = "iapp_grib2nc_{}.log".format(timestamp)
+            logpath = path.join(run_dir, logname)
+            logfile_obj = open(logpath, 'w')
+
+            search_str = "Successfully transcoded to NetCDF file: "
+            for line in exe_out.splitlines():
+                logfile_obj.write(line+"\n")
+                if search_str in line:
+                    LOG.debug('New NetCDF file: {}'.format(line))
+                    line = string.split(line," ")[-1]
+                    #line = string.replace(line, search_str, '')
+                    #line = string.replace(line, '\n', '')
+                    grib_netcdf_file = line
+                    break
+
+            logfile_obj.close()
+
+            os.chdir(current_dir)
+
+            grib_netcdf_local_file = path.join(run_dir, grib_netcdf_file)
+            grib_netcdf_remote_file = path.join(GRIB_FILE_PATH, grib_netcdf_file)
+
+            LOG.debug('New NetCDF file successfully created: {}'.format(grib_netcdf_local_file))
+
+            # Move the new NetCDF file to the ancillary cache...
+            if not path.exists(grib_netcdf_local_file):
+                LOG.error('New NetCDF file {} does not exist...'.format(grib_netcdf_local_file))
+                LOG.error('New NetCDF file creation failed, aborting...')
+                return None, -1
+            else:
+                LOG.debug('New local NetCDF file {} exists'.format(grib_netcdf_local_file))
 
-        os.chdir(current_dir)
+            # Move the new NetCDF file to the ancillary cache. Any existing
+            # file is replaced atomically rather than removed first, since it
+            # may be in use by another process.
+            LOG.debug('Moving {} to {}...'.format(grib_netcdf_local_file, grib_netcdf_remote_file))
+            publish_file(grib_netcdf_local_file, grib_netcdf_remote_file)
 
-        grib_netcdf_local_file = path.join(run_dir, grib_netcdf_file)
-        grib_netcdf_remote_file = path.join(GRIB_FILE_PATH, grib_netcdf_file)
+            if cache_index is not None:
+                cache_index.insert(grib1_file, grib_netcdf_remote_file)
 
-        LOG.debug('New NetCDF file successfully created: {}'.format(grib_netcdf_local_file))
+            # Remove the temporary NetCDF generation files
+            for files in ['ancillary.data', 'ancillary.info', 'gribparm.lis']:
+                temp_file = path.join(run_dir, files)
+                if path.exists(temp_file):
+                    LOG.debug('Removing temporary NetCDF generation file {}'.format(temp_file))
+                    os.unlink(temp_file)
 
-        # Move the new NetCDF file to the ancillary cache...
-        if not path.exists(grib_netcdf_local_file):
-            LOG.error('New NetCDF file {} does not exist...'.format(grib_netcdf_local_file))
-            LOG.error('New NetCDF file creation failed, aborting...')
-            return -1
-        else:
-            LOG.debug('New local NetCDF file {} exists'.format(grib_netcdf_local_file))
+        except Exception, err:
+            LOG.warn("{}".format(str(err)))
+            LOG.debug(traceback.format_exc())
 
-        # Check for remote NetCDF file, and remove if it exists
-        if path.exists(grib_netcdf_remote_file):
-            LOG.debug('Remote NetCDF file {} exists, removing...'.format(grib_netcdf_remote_file))
-            os.unlink(grib_netcdf_remote_file)
+    return grib_netcdf_remote_file, rc_grib_netcdf
 
-        # Move the new NetCDF file to the ancillary cache
-        LOG.debug('Moving {} to {}...'.format(grib_netcdf_local_file, grib_netcdf_remote_file))
-        move(grib_netcdf_local_file, grib_netcdf_remote_file)
 
-        # Remove the temporary NetCDF generation files
-        for files in ['ancillary.data', 'ancillary.info', 'gribparm.lis']:
-            temp_file = path.join(run_dir, files)
-            if path.exists(temp_file):
-                LOG.debug('Removing temporary NetCDF generation file {}'.format(temp_file))
-                os.unlink(temp_file)
+def metar_bulletin_times(time_obj):
+    '''
+    The times of the hourly METAR bulletins to use for time_obj, in order of
+    preference: the nearest hour, then the other hour either side of time_obj.
+    '''
+    hour_obj = datetime(time_obj.year, time_obj.month, time_obj.day, time_obj.hour)
+    if time_obj - hour_obj < timedelta(minutes=30):
+        return [hour_obj, hour_obj + timedelta(hours=1)]
+    return [hour_obj + timedelta(hours=1), hour_obj]
 
-    except Exception, err:
-        LOG.warn("{}".format(str(err)))
-        LOG.debug(traceback.format_exc())
 
-    return grib_netcdf_remote_file, rc_grib_netcdf
+def metar_bulletin_key(metar_file):
+    '''
+    Return the (year/jday, UTC) key of a METAR bulletin, e.g. ('15063', '1200')
+    for METAR.15063.1200
+    '''
+    file_parts = string.split(path.basename(metar_file), '.')
+    return file_parts[1], file_parts[2]
 
 
 def retrieve_METAR_files(Level1D_obj, GRIB_FILE_PATH):
     '''
     Retrieve the METAR Surface Observation ancillary data which cover the dates of the geolocation
-    files.
+    files. Only the hourly bulletins either side of the pass mid time are looked
+    for, the closest first.
     '''
 
     LOG.info('Retrieving METAR Surface Observation ancillary data for {}...'.format(Level1D_obj.input_file))
 
-    # Get the time stamp for the input file
-    dateStamp = Level1D_obj.timeObj_start.strftime("%Y%m%d")
-
-    timeObj = datetime.utcnow()
-    now_time_stamp = datetime.utcnow().strftime("%Y%m%d%H%M%S%f")
+    LOG.debug('JPSS_REMOTE_ANC_DIR: {}'.format(get_config().JPSS_REMOTE_ANC_DIR))
 
-    LOG.debug('JPSS_REMOTE_ANC_DIR: {}'.format(JPSS_REMOTE_ANC_DIR))
+    metarFiles = []
 
     try:
         LOG.info('Retrieving METAR files for {} ...'.format(Level1D_obj.pass_mid_str))
-        metarFiles = glob(path.join(GRIB_FILE_PATH, 'METAR*'))
+        for metar_timeObj in metar_bulletin_times(Level1D_obj.timeObj_mid):
+            metar_year_jday_str = metar_timeObj.strftime("%y%j")
+            metar_UTC_str = metar_timeObj.strftime("%H%M")
+
+            metar_file = path.join(GRIB_FILE_PATH, 'METAR.{}.{}'.format(
+                metar_year_jday_str, metar_UTC_str))
+            if path.exists(metar_file):
+                metarFiles.append(metar_file)
+                continue
+
+            # Fall back to differently prefixed bulletins for the same hour
+            metar_glob = path.join(GRIB_FILE_PATH, 'METAR*.{}.{}*'.format(
+                metar_year_jday_str, metar_UTC_str))
+            metarFiles += sorted([metar_file for metar_file in glob(metar_glob)
+                                  if not metar_file.endswith('.nc')])
 
     except Exception, err:
         LOG.warn("{}".format(str(err)))
         LOG.debug(traceback.format_exc())
 
-    # Uniqify the list of METAR files
-    metarFiles = list(set(metarFiles))
-    metarFiles.sort()
-
     for metarFile in metarFiles:
-        LOG.info('Retrieved METAR file: {}'.format(metarFiles))
+        LOG.info('Retrieved METAR file: {}'.format(metarFile))
 
     if metarFiles == []:
-        LOG.error('No METAR surface observation files retrieved for date {}, aborting.'
-                  .format(Level1D_obj.pass_mid_str))
-        sys.exit(1)
+        raise AncillaryError('No METAR surface observation files retrieved for date {}'
+                             .format(Level1D_obj.pass_mid_str))
 
     return metarFiles
 
 
+# Parsed METAR station tables, keyed by file name, with the file mtime.
+_STATION_TABLES = {}
+
+
+def read_station_table(station_ident_file):
+    '''
+    Return a dictionary of the stations in a GEMPAK station table (e.g.
+    sfmetar_sa.tbl), mapping the station ID to its (lat, lon, elevation). The
+    table is parsed once per process, unless the file changes.
+    '''
+    mtime = os.stat(station_ident_file).st_mtime
+    if station_ident_file in _STATION_TABLES:
+        table_mtime, station_dict = _STATION_TABLES[station_ident_file]
+        if table_mtime == mtime:
+            return station_dict
+
+    LOG.debug('Reading station table {}'.format(station_ident_file))
+
+    station_dict = {}
+    table_obj = open(station_ident_file, 'r')
+    for line in table_obj:
+        if line.startswith('!') or len(line) < 73:
+            continue
+        try:
+            # GEMPAK fixed columns: STID, STNM, NAME, ST, CO, LAT, LON, ELV, PRI
+            station_id = line[0:8].strip()
+            lat = int(line[55:60]) / 100.
+            lon = int(line[61:67]) / 100.
+            elevation = int(line[68:73])
+        except ValueError:
+            continue
+        if station_id:
+            station_dict[station_id] = (lat, lon, elevation)
+    table_obj.close()
+
+    LOG.debug('{} stations in {}'.format(len(station_dict), station_ident_file))
+
+    _STATION_TABLES[station_ident_file] = (mtime, station_dict)
+
+    return station_dict
+
+
+def count_METAR_stations(metar_file, station_dict):
+    '''
+    Return the number of stations in the station table which report in a METAR
+    bulletin.
+    '''
+    stations = set()
+
+    metar_obj = open(metar_file, 'r')
+    for line in metar_obj:
+        tokens = line.split()
+        if len(tokens) > 1 and tokens[0] in ['METAR', 'SPECI']:
+            tokens = tokens[1:]
+        if tokens and tokens[0] in station_dict:
+            stations.add(tokens[0])
+    metar_obj.close()
+
+    return len(stations)
+
+
 def transcode_METAR_files(metar_file, work_dir):
     '''
     Transcode the retrieved METAR file to NetCDF.
+
+    The NetCDF file is created in work_dir and then published beside the
+    bulletin in the ancillary cache, so that each hourly bulletin is only
+    transcoded once and all of the passes in that hour reuse it.
     '''
 
-    IAPP_DECODERS_PATH = path.abspath(path.join(IAPP_HOME, 'decoders', 'bin'))
+    config = get_config()
+    IAPP_DECODERS_PATH = path.abspath(path.join(config.IAPP_HOME, 'decoders', 'bin'))
     LOG.debug('IAPP_DECODERS_PATH : {}'.format(IAPP_DECODERS_PATH))
 
-    IAPP_FILES_PATH = path.abspath(path.join(IAPP_HOME, 'decoders', 'files'))
+    IAPP_FILES_PATH = path.abspath(path.join(config.IAPP_HOME, 'decoders', 'files'))
     LOG.debug('IAPP_FILES_PATH : {}'.format(IAPP_FILES_PATH))
 
-    NCGEN_PATH = path.abspath(path.join(CSPP_RT_HOME, 'common', 'ShellB3', 'bin'))
+    NCGEN_PATH = path.abspath(path.join(config.CSPP_RT_HOME, 'common', 'ShellB3', 'bin'))
     LOG.debug('NCGEN_PATH : {}'.format(NCGEN_PATH))
 
     METAR_FILE_PATH = path.abspath(path.dirname(metar_file))
     LOG.debug('METAR_FILE_PATH : {}'.format(METAR_FILE_PATH))
 
+    # Reuse the cached NetCDF file for this bulletin, if it is up to date.
+    metar_netcdf_remote_file = "{}.nc".format(path.abspath(metar_file))
+    if path.exists(metar_netcdf_remote_file) and \
+            os.stat(metar_netcdf_remote_file).st_mtime >= os.stat(metar_file).st_mtime:
+        LOG.info('Found METAR NetCDF file in the ancillary cache: {}'
+                 .format(metar_netcdf_remote_file))
+        return metar_netcdf_remote_file
+
+    # Check that we have access to the NetCDF generation and METAR decoding exes,
+    # and the station table. The surface observations are optional, so their
+    # absence is an ancillary problem rather than an installation error.
+    station_ident_file = path.join(IAPP_FILES_PATH, 'sfmetar_sa.tbl')
+    for required_file in ["{}/ncgen".format(NCGEN_PATH), "{}/drvmetar".format(IAPP_DECODERS_PATH),
+                          station_ident_file]:
+        if not path.exists(required_file):
+            raise AncillaryError('{} can not be found, unable to transcode METAR data'
+                                 .format(required_file))
+
+    # Check that the bulletin has reports from some of the known stations, so
+    # that ncgen and drvmetar aren't run for a bulletin which would give an
+    # empty NetCDF file.
+    station_dict = read_station_table(station_ident_file)
+    station_count = count_METAR_stations(metar_file, station_dict)
+    LOG.debug('{} known stations report in {}'.format(station_count, metar_file))
+    if station_count == 0:
+        raise AncillaryError('No known stations report in METAR file {}'.format(metar_file))
+
+    # Get the METAR time information
+    metar_year_jday_str, metar_UTC_str = metar_bulletin_key(metar_file)
+    LOG.debug('metar_year_jday_str : {}'.format(metar_year_jday_str))
+    LOG.debug('metar_UTC_str : {}'.format(metar_UTC_str))
+
+    metar_timeObj = datetime.strptime(
+        "{}.{}".format(metar_year_jday_str, metar_UTC_str),
+        '%y%j.%H%M')
+
+    metar_time_str = metar_timeObj.strftime("%Y-%m-%d %H:%M:%S.%f")
+    LOG.debug("metar_time_str: {}".format(metar_time_str))
+
+    metar_year_str = metar_timeObj.strftime("%y")
+    LOG.debug('metar_year_str : {}'.format(metar_year_str))
+
+    metar_month_str = metar_timeObj.strftime("%m")
+    LOG.debug('metar_month_str : {}'.format(metar_month_str))
+
     # Set up the logging
     d = datetime.now()
     timestamp = d.isoformat()
@@ -454,112 +656,182 @@ def transcode_METAR_files(metar_file, work_dir):
     logfile_obj = open(logpath, 'w')
 
     current_dir = os.getcwd()
-    os.chdir(work_dir)
-
-    # Check that we have access to the NetCDF generation exe...
-    scriptPath = "{}/ncgen".format(NCGEN_PATH)
-    if not path.exists(scriptPath):
-        LOG.error('{} can not be found, aborting.'.format(scriptPath))
-        sys.exit(1)
 
-    # Construct the command line args to ncgen
-    metar_netcdf_file = "{}.nc".format(metar_file)
-    script_args = '-b {}/metar_grid.cdl -o {}'.format(IAPP_FILES_PATH, metar_netcdf_file)
+    # Link the bulletin into the work dir, so that the NetCDF file is created there.
+    metar_local_file = path.join(work_dir, path.basename(metar_file))
+    metar_netcdf_local_file = "{}.nc".format(metar_local_file)
 
     try:
-        # Check for existing METAR NetCDF file, and remove if it exists
-        if path.exists(metar_netcdf_file):
-            LOG.debug(' METAR NetCDF file {} exists, removing...'.format(metar_netcdf_file))
-            os.unlink(metar_netcdf_file)
-
-        # Call the NetCDF template generation exe, writing the logging output to a file
-        LOG.info('Creating NetCDF template file {} ...'.format(metar_netcdf_file))
-        cmdStr = '{} {}'.format(scriptPath, script_args)
-        LOG.debug('\t{}'.format(cmdStr))
-        args = shlex.split(cmdStr)
-
-        procRetVal = 0
-        procObj = subprocess.Popen(args,
-                                   env=env(NCGEN_PATH=NCGEN_PATH),
-                                   bufsize=0, stdout=logfile_obj, stderr=subprocess.STDOUT)
-        procObj.wait()
-        procRetVal = procObj.returncode
-
-        # TODO : On error, jump to a cleanup routine
-        if not (procRetVal == 0):
-            LOG.error('Creating NetCDF template file {} failed, aborting...'.format(metar_netcdf_file))
-            sys.exit(procRetVal)
-
-        LOG.info('New NetCDF file successfully created: {}'.format(metar_netcdf_file))
+        os.chdir(work_dir)
+
+        if not path.exists(metar_local_file):
+            os.symlink(path.abspath(metar_file), metar_local_file)
+        if path.exists(metar_netcdf_local_file):
+            os.unlink(metar_netcdf_local_file)
+
+        # Call the NetCDF template generation exe, and then the METAR to NetCDF
+        # transcoding exe, writing the logging output to a file
+        commands = [
+            ("{}/ncgen".format(NCGEN_PATH),
+             '-b {}/metar_grid.cdl -o {}'.format(IAPP_FILES_PATH, metar_netcdf_local_file),
+             {'NCGEN_PATH': NCGEN_PATH}),
+            ("{}/drvmetar".format(IAPP_DECODERS_PATH),
+             '{} {} {} {}'.format(metar_local_file, metar_year_str, metar_month_str,
+                                  station_ident_file),
+             {'IAPP_DECODERS_PATH': IAPP_DECODERS_PATH})
+        ]
+
+        LOG.info('Creating METAR NetCDF file {} ...'.format(metar_netcdf_local_file))
+        for scriptPath, script_args, env_vars in commands:
+            cmdStr = '{} {}'.format(scriptPath, script_args)
+            LOG.debug('\t{}'.format(cmdStr))
+            args = shlex.split(cmdStr)
+
+            procObj = subprocess.Popen(args, env=env(**env_vars),
+                                       bufsize=0, stdout=logfile_obj, stderr=subprocess.STDOUT)
+            procObj.wait()
+            procRetVal = procObj.returncode
+
+            if not (procRetVal == 0):
+                LOG.error('{} failed for {}'
+                          .format(path.basename(scriptPath), metar_netcdf_local_file))
+                raise AncillaryError('Creating METAR NetCDF file {} failed'
+                                     .format(metar_netcdf_local_file))
+
+        # Publish the new NetCDF file to the ancillary cache, or use it in place
+        # if the cache is read-only.
+        LOG.debug('Moving {} to {}...'.format(metar_netcdf_local_file, metar_netcdf_remote_file))
+        try:
+            publish_file(metar_netcdf_local_file, metar_netcdf_remote_file)
+        except (IOError, OSError), err:
+            LOG.warn('Unable to cache {}: {}'.format(metar_netcdf_local_file, str(err)))
+            metar_netcdf_remote_file = metar_netcdf_local_file
+
+        LOG.info('New NetCDF file successfully created: {}'.format(metar_netcdf_remote_file))
+
+    except AncillaryError:
+        raise
 
     except Exception, err:
         LOG.warn("{}".format(str(err)))
         LOG.debug(traceback.format_exc())
+        raise AncillaryError('Creating METAR NetCDF file {} failed'.format(metar_netcdf_local_file))
 
+    finally:
+        logfile_obj.close()
+        os.chdir(current_dir)
+        if path.islink(metar_local_file):
+            os.unlink(metar_local_file)
 
-    # Get the METAR time information
-    metar_year_jday_str = string.split(path.basename(metar_netcdf_file), '.')[1]
-    LOG.debug('metar_year_jday_str : {}'.format(metar_year_jday_str))
+    return metar_netcdf_remote_file
 
-    metar_UTC_str = string.split(path.basename(metar_netcdf_file), '.')[2]
-    LOG.debug('metar_UTC_str : {}'.format(metar_UTC_str))
 
-    metar_timeObj = datetime.strptime(
-        "{}.{}".format(metar_year_jday_str, metar_UTC_str),
-        '%y%j.%H%M')
+def retrieve_radiosonde_file(Level1D_obj, radiosonde_dir, run_dir, bounds=None, time_window=10800.):
+    '''
+    Select the soundings in the radiosonde archive radiosonde_dir which were
+    launched within time_window seconds of the pass, and inside bounds (lat_min,
+    lat_max, lon_min, lon_max) if given (otherwise anywhere: the pass footprint
+    isn't known from the level-1D header), and write them to a sounding file in
+    run_dir.
+    '''
+    LOG.info('Retrieving radiosonde ancillary data for {}...'.format(Level1D_obj.input_file))
 
-    metar_time_str = metar_timeObj.strftime("%Y-%m-%d %H:%M:%S.%f")
-    LOG.debug("metar_time_str: {}".format(metar_time_str))
+    cache_dir = path.join(get_config().CSPP_RT_ANC_CACHE_DIR, 'raob')
 
-    metar_year_str = metar_timeObj.strftime("%y")
-    LOG.debug('metar_year_str : {}'.format(metar_year_str))
+    try:
+        archive = get_radiosonde_archive(radiosonde_dir, cache_dir)
+        window = timedelta(seconds=time_window)
+        soundings = archive.select(Level1D_obj.timeObj_start - window,
+                                   Level1D_obj.timeObj_end + window, bounds)
+    except Exception, err:
+        LOG.debug(traceback.format_exc())
+        raise AncillaryError('Unable to read the radiosonde archive {}: {}'
+                             .format(radiosonde_dir, str(err)))
 
-    metar_month_str = metar_timeObj.strftime("%m")
-    LOG.debug('metar_month_str : {}'.format(metar_month_str))
+    if soundings == []:
+        raise AncillaryError('No radiosonde soundings found for date {}'
+                             .format(Level1D_obj.pass_mid_str))
 
-    # Check that we have access to the NetCDF generation exe...
-    scriptPath = "{}/drvmetar".format(IAPP_DECODERS_PATH)
-    if not path.exists(scriptPath):
-        LOG.error('{} can not be found, aborting.'.format(scriptPath))
-        sys.exit(1)
+    LOG.info('Selected {} radiosonde soundings'.format(len(soundings)))
+    for sounding in soundings:
+        LOG.debug('Sounding {} ({}) at {}'.format(sounding['station'], sounding['wmo_id'],
+                                                  sounding['time']))
 
-    # Construct the command line args to drvmetar
-    station_ident_file = path.join(IAPP_FILES_PATH, 'sfmetar_sa.tbl')
-    script_args = '{} {} {} {}'.format(
-        metar_file,
-        metar_year_str,
-        metar_month_str,
-        station_ident_file
-    )
+    raob_file = path.join(run_dir, 'RAOB.{}.{}'.format(
+        Level1D_obj.timeObj_mid.strftime("%y%j"), Level1D_obj.timeObj_mid.strftime("%H%M")))
 
-    try:
-        # Call the METAR to NetCDF transcoding exe, writing the logging output to a file
-        LOG.info('Creating METAR NetCDF file {} ...'.format(metar_netcdf_file))
-        cmdStr = '{} {}'.format(scriptPath, script_args)
-        LOG.debug('\t{}'.format(cmdStr))
-        args = shlex.split(cmdStr)
+    return write_fsl_file(soundings, raob_file)
+
+
+def transcode_radiosonde_file(raob_file, work_dir):
+    '''
+    Transcode the selected soundings to an IAPP radiosonde NetCDF file, using
+    the raob decoder of the IAPP installation.
+    '''
+
+    config = get_config()
+    IAPP_DECODERS_PATH = path.abspath(path.join(config.IAPP_HOME, 'decoders', 'bin'))
+    IAPP_FILES_PATH = path.abspath(path.join(config.IAPP_HOME, 'decoders', 'files'))
+    NCGEN_PATH = path.abspath(path.join(config.CSPP_RT_HOME, 'common', 'ShellB3', 'bin'))
+
+    ncgen_exe = "{}/ncgen".format(NCGEN_PATH)
+    drvraob_exe = "{}/drvraob".format(IAPP_DECODERS_PATH)
+    raob_cdl_file = "{}/raob_grid.cdl".format(IAPP_FILES_PATH)
+    for required_file in [ncgen_exe, drvraob_exe, raob_cdl_file]:
+        if not path.exists(required_file):
+            raise AncillaryError('{} can not be found, unable to transcode radiosonde data'
+                                 .format(required_file))
+
+    raob_netcdf_file = "{}.nc".format(raob_file)
+    raob_timeObj = datetime.strptime('.'.join(string.split(path.basename(raob_file), '.')[1:3]),
+                                     '%y%j.%H%M')
+
+    d = datetime.now()
+    timestamp = d.isoformat()
+    timestamp = timestamp.replace(":", "")
+    logpath = path.join(work_dir, "iapp_raob_to_nc." + timestamp + ".log")
+    logfile_obj = open(logpath, 'w')
+
+    commands = [
+        (ncgen_exe, '-b {} -o {}'.format(raob_cdl_file, raob_netcdf_file),
+         {'NCGEN_PATH': NCGEN_PATH}),
+        (drvraob_exe, '{} {} {}'.format(raob_file, raob_timeObj.strftime("%y"),
+                                        raob_timeObj.strftime("%m")),
+         {'IAPP_DECODERS_PATH': IAPP_DECODERS_PATH})
+    ]
+
+    current_dir = os.getcwd()
 
+    try:
         os.chdir(work_dir)
 
-        procRetVal = 0
-        procObj = subprocess.Popen(args, env=env(IAPP_DECODERS_PATH=IAPP_DECODERS_PATH),
-                                   bufsize=0, stdout=logfile_obj, stderr=subprocess.STDOUT)
-        procObj.wait()
-        procRetVal = procObj.returncode
+        LOG.info('Creating radiosonde NetCDF file {} ...'.format(raob_netcdf_file))
+        for scriptPath, script_args, env_vars in commands:
+            cmdStr = '{} {}'.format(scriptPath, script_args)
+            LOG.debug('\t{}'.format(cmdStr))
+            args = shlex.split(cmdStr)
+
+            procObj = subprocess.Popen(args, env=env(**env_vars),
+                                       bufsize=0, stdout=logfile_obj, stderr=subprocess.STDOUT)
+            procObj.wait()
 
-        # TODO : On error, jump to a cleanup routine
-        if not (procRetVal == 0):
-            LOG.error('Creating NetCDF template file {} failed, aborting...'.format(metar_netcdf_file))
-            sys.exit(procRetVal)
+            if not (procObj.returncode == 0):
+                LOG.error('{} failed for {}'.format(path.basename(scriptPath), raob_netcdf_file))
+                raise AncillaryError('Creating radiosonde NetCDF file {} failed'
+                                     .format(raob_netcdf_file))
 
-        LOG.info('New NetCDF file successfully created: {}'.format(metar_netcdf_file))
+    except AncillaryError:
+        raise
 
     except Exception, err:
         LOG.warn("{}".format(str(err)))
         LOG.debug(traceback.format_exc())
+        raise AncillaryError('Creating radiosonde NetCDF file {} failed'.format(raob_netcdf_file))
 
-    logfile_obj.close()
+    finally:
+        logfile_obj.close()
+        os.chdir(current_dir)
 
-    os.chdir(current_dir)
+    LOG.info('New NetCDF file successfully created: {}'.format(raob_netcdf_file))
 
-    return metar_netcdf_file
+    return raob_netcdf_file
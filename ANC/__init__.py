@@ -10,3 +10,5 @@ from Utils import retrieve_NCEP_grib_files
 from Utils import transcode_NCEP_grib_files
 from Utils import retrieve_METAR_files
 from Utils import transcode_METAR_files
+from Utils import retrieve_radiosonde_file
+from Utils import transcode_radiosonde_file
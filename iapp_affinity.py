@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+iapp_affinity.py
+
+Purpose: Pin concurrent iapp_main processes to CPUs on a single NUMA node, so
+         that the kernel doesn't migrate them across sockets, away from their
+         memory and caches.
+
+The NUMA topology is read from /sys/devices/system/node/node*/cpulist; on a
+machine without it, all online CPUs are taken to be one node. Each run claims
+CPUs through fcntl locks on per-CPU files in a lock directory, so that the runs
+of every IAPP process of this user on the node (e.g. several lease workers) get
+disjoint CPUs, and the claims of a process which dies are dropped by the
+kernel. Pin modes:
+
+    none:  no pinning.
+    cpus:  the run is pinned to the cpus_per_run CPUs it has claimed, all on
+           the same node.
+    node:  the run claims cpus_per_run CPUs on a node, and is pinned to all the
+           CPUs of that node, leaving the scheduler free to balance within it.
+
+Runs are placed on the node with the most unclaimed CPUs. If no node has
+enough, the run is not pinned. Memory placement follows, since Linux
+allocates memory on the node of the CPU which first touches it.
+
+The affinity is set in the child between fork and exec, with
+os.sched_setaffinity where available (Python 3.3+) and sched_setaffinity(2)
+through ctypes otherwise.
+
+Run as a script to compare the throughput of concurrent runs, pinned and
+unpinned, on this machine:
+
+    python iapp_affinity.py [--workers N] [--repeats R] [--mode cpus|node] [COMMAND ...]
+
+where COMMAND is a command to run (e.g. iapp_main in a prepared run directory),
+or a built-in memory-bound workload by default.
+
+Copyright (c) 2014 University of Wisconsin Regents.
+Licensed under GNU GPLv3.
+"""
+
+import os
+import sys
+import glob
+import fcntl
+import errno
+import ctypes
+import logging
+import tempfile
+import traceback
+from os import path
+from threading import Lock
+
+LOG = logging.getLogger(__name__)
+
+PIN_MODES = ['none', 'cpus', 'node']
+
+
+def parse_cpulist(cpulist):
+    '''The CPUs of a /sys cpulist string, e.g. "0-3,8-11".'''
+    cpus = []
+    for field in cpulist.strip().split(','):
+        if not field:
+            continue
+        if '-' in field:
+            first, last = field.split('-')
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(field))
+    return cpus
+
+
+def _read_cpulist(file_name):
+    file_obj = open(file_name, 'r')
+    try:
+        return parse_cpulist(file_obj.read())
+    finally:
+        file_obj.close()
+
+
+def numa_nodes(sys_dir='/sys/devices/system'):
+    '''A dictionary of the CPUs of each NUMA node of this machine.'''
+    nodes = {}
+    for node_dir in glob.glob(path.join(sys_dir, 'node', 'node[0-9]*')):
+        try:
+            cpus = _read_cpulist(path.join(node_dir, 'cpulist'))
+        except (IOError, ValueError):
+            continue
+        if cpus:
+            nodes[int(path.basename(node_dir)[4:])] = cpus
+
+    if not nodes:
+        try:
+            nodes[0] = _read_cpulist(path.join(sys_dir, 'cpu', 'online'))
+        except (IOError, ValueError):
+            import multiprocessing
+            nodes[0] = range(multiprocessing.cpu_count())
+
+    return nodes
+
+
+def _affinity_setter():
+    '''A function setting the CPU affinity of this process, or None if unavailable.'''
+    if hasattr(os, 'sched_setaffinity'):
+        return lambda cpus: os.sched_setaffinity(0, cpus)
+
+    try:
+        libc = ctypes.CDLL('libc.so.6', use_errno=True)
+        sched_setaffinity = libc.sched_setaffinity
+    except (OSError, AttributeError):
+        return None
+
+    def _set_affinity(cpus):
+        mask_size = max(128, (max(cpus) // 64 + 1) * 8)
+        mask = (ctypes.c_ubyte * mask_size)()
+        for cpu in cpus:
+            mask[cpu // 8] |= 1 << (cpu % 8)
+        if sched_setaffinity(0, mask_size, mask) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    return _set_affinity
+
+
+def pinned_preexec_fn(preexec_fn, cpus):
+    '''
+    Wrap preexec_fn (or None) to also pin the child to cpus. The setter is
+    looked up here, since nothing should be loaded between fork and exec.
+    '''
+    set_affinity = _affinity_setter() if cpus else None
+    if set_affinity is None:
+        return preexec_fn
+
+    def _preexec():
+        if preexec_fn is not None:
+            preexec_fn()
+        set_affinity(cpus)
+
+    return _preexec
+
+
+class CpuClaim(object):
+    '''The CPUs claimed by a run, and those it is pinned to.'''
+
+    def __init__(self, node, claimed, cpus, fds):
+        self.node = node
+        self.claimed = claimed
+        self.cpus = cpus
+        self.fds = fds
+
+    def __repr__(self):
+        return "CpuClaim(node={}, cpus={})".format(self.node, self.cpus)
+
+
+# fcntl locks don't exclude the other threads of this process (and closing any
+# descriptor of a lock file drops the process's lock on it), so the CPUs claimed
+# by this process are also kept here, per lock directory, shared by all the
+# allocators using it.
+_HELD = {}
+_HELD_LOCK = Lock()
+
+
+def _held_cpus(lock_dir):
+    '''Return the set of CPUs this process has claimed in lock_dir, and its lock.'''
+    lock_dir = path.abspath(lock_dir)
+    with _HELD_LOCK:
+        if lock_dir not in _HELD:
+            _HELD[lock_dir] = (set(), Lock())
+        return _HELD[lock_dir]
+
+
+class CpuAllocator(object):
+    '''
+    Hands out CPUs to runs, in pin mode (see PIN_MODES), claiming cpus_per_run
+    CPUs for each run through lock files in lock_dir.
+    '''
+
+    def __init__(self, mode='cpus', cpus_per_run=1, lock_dir=None, nodes=None):
+        if mode not in PIN_MODES:
+            raise ValueError("Unknown pin mode '{}', choose from {}".format(mode, PIN_MODES))
+        self.mode = mode
+        self.cpus_per_run = cpus_per_run
+        self.nodes = numa_nodes() if nodes is None else nodes
+        if lock_dir is None:
+            lock_dir = path.join(tempfile.gettempdir(), 'iapp_cpu_locks_{}'.format(os.getuid()))
+        self.lock_dir = lock_dir
+
+        self._held, self._lock = _held_cpus(self.lock_dir)
+
+        try:
+            os.makedirs(self.lock_dir)
+        except OSError, err:
+            if err.errno != errno.EEXIST:
+                raise
+
+    def _try_claim(self, cpu):
+        '''Lock cpu, returning the lock file descriptor, or None if it is taken.'''
+        if cpu in self._held:
+            return None
+        fd = os.open(path.join(self.lock_dir, 'cpu{}.lock'.format(cpu)), os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, err:
+            os.close(fd)
+            if err.errno not in (errno.EACCES, errno.EAGAIN):
+                raise
+            return None
+        self._held.add(cpu)
+        return fd
+
+    def _unclaim(self, cpu, fd):
+        self._held.discard(cpu)
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    def _free_count(self, node):
+        '''The number of CPUs of node which are unclaimed (at the moment).'''
+        count = 0
+        for cpu in self.nodes[node]:
+            fd = self._try_claim(cpu)
+            if fd is not None:
+                self._unclaim(cpu, fd)
+                count += 1
+        return count
+
+    def acquire(self):
+        '''Return a CpuClaim for a run, or None if the run is not to be pinned.'''
+        if self.mode == 'none':
+            return None
+
+        with self._lock:
+            try:
+                free = [(self._free_count(node), node) for node in self.nodes]
+                for free_count, node in sorted(free, reverse=True):
+                    if free_count < self.cpus_per_run:
+                        break
+                    claimed = []
+                    for cpu in self.nodes[node]:
+                        fd = self._try_claim(cpu)
+                        if fd is not None:
+                            claimed.append((cpu, fd))
+                        if len(claimed) == self.cpus_per_run:
+                            break
+                    if len(claimed) == self.cpus_per_run:
+                        cpus = [cpu for cpu, fd in claimed]
+                        if self.mode == 'node':
+                            cpus = list(self.nodes[node])
+                        return CpuClaim(node, [cpu for cpu, fd in claimed], cpus,
+                                        [fd for cpu, fd in claimed])
+                    # Another process took some of the node's CPUs meanwhile
+                    for cpu, fd in claimed:
+                        self._unclaim(cpu, fd)
+            except (IOError, OSError), err:
+                LOG.warn("Unable to claim CPUs in {}: {}".format(self.lock_dir, str(err)))
+                LOG.debug(traceback.format_exc())
+                return None
+
+        LOG.debug("No NUMA node has {} unclaimed CPUs, not pinning the run"
+                  .format(self.cpus_per_run))
+        return None
+
+    def release(self, claim):
+        if claim is None:
+            return
+        with self._lock:
+            for cpu, fd in zip(claim.claimed, claim.fds):
+                self._unclaim(cpu, fd)
+
+
+# One allocator per process for each pin mode and run size, shared by the
+# region threads
+_ALLOCATORS = {}
+_ALLOCATORS_LOCK = Lock()
+
+
+def get_cpu_allocator(mode, cpus_per_run=1):
+    '''Return the (per-process) CPU allocator of mode and cpus_per_run.'''
+    with _ALLOCATORS_LOCK:
+        if (mode, cpus_per_run) not in _ALLOCATORS:
+            _ALLOCATORS[(mode, cpus_per_run)] = CpuAllocator(mode, cpus_per_run)
+        return _ALLOCATORS[(mode, cpus_per_run)]
+
+
+# A memory-bound workload for the benchmark: repeated passes over a buffer
+# larger than the caches.
+BENCHMARK_WORKLOAD = [sys.executable, '-c',
+                      'import array\n'
+                      'a = array.array("d", [1.0]) * (1024 * 1024)\n'
+                      'for n in range(5):\n'
+                      '    a = array.array("d", [x * 1.0000001 for x in a])\n']
+
+
+def _run_batch(command, workers, repeats, allocator):
+    '''Run command repeats times on each of workers concurrent lanes, returning the wall time.'''
+    import subprocess
+    from time import time
+    from threading import Thread
+
+    def _lane():
+        for repeat in range(repeats):
+            claim = None if allocator is None else allocator.acquire()
+            try:
+                preexec_fn = None if claim is None else pinned_preexec_fn(None, claim.cpus)
+                subprocess.call(command, preexec_fn=preexec_fn, close_fds=True)
+            finally:
+                if allocator is not None:
+                    allocator.release(claim)
+
+    t_start = time()
+    lanes = [Thread(target=_lane) for worker in range(workers)]
+    for lane in lanes:
+        lane.start()
+    for lane in lanes:
+        lane.join()
+
+    return time() - t_start
+
+
+def main():
+    '''Compare the throughput of concurrent runs of a command, pinned and unpinned.'''
+    import argparse
+
+    nodes = numa_nodes()
+    cpu_count = sum([len(cpus) for cpus in nodes.values()])
+
+    parser = argparse.ArgumentParser(
+        description='Compare the throughput of concurrent runs, pinned and unpinned.')
+    parser.add_argument('--workers', action="store", dest="workers", type=int,
+                        default=cpu_count,
+                        help='''The number of concurrent runs. [default: {}]'''.format(cpu_count))
+    parser.add_argument('--repeats', action="store", dest="repeats", type=int, default=3,
+                        help='''The number of runs in each lane. [default: 3]''')
+    parser.add_argument('--mode', action="store", dest="mode", default='cpus',
+                        choices=PIN_MODES[1:],
+                        help='''The pin mode. [default: cpus]''')
+    parser.add_argument('--cpus_per_run', action="store", dest="cpus_per_run", type=int,
+                        default=1,
+                        help='''The number of CPUs claimed by each run. [default: 1]''')
+    parser.add_argument('command', nargs=argparse.REMAINDER,
+                        help='''The command to run. [default: a memory-bound workload]''')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    command = args.command
+    if command and command[0] == '--':
+        command = command[1:]
+    command = command or BENCHMARK_WORKLOAD
+    runs = args.workers * args.repeats
+    print "NUMA nodes: {}".format(', '.join(["{}: {}".format(node, nodes[node])
+                                             for node in sorted(nodes)]))
+    print "{} runs on {} concurrent lanes".format(runs, args.workers)
+
+    # The lock directory is private to the benchmark, so that it neither waits
+    # for nor holds up any processing on the machine.
+    allocator = CpuAllocator(args.mode, args.cpus_per_run,
+                             lock_dir=tempfile.mkdtemp(prefix='iapp_affinity_'))
+    try:
+        t_unpinned = _run_batch(command, args.workers, args.repeats, None)
+        print "unpinned: {:8.2f} s, {:6.3f} runs/s".format(t_unpinned, runs / t_unpinned)
+        t_pinned = _run_batch(command, args.workers, args.repeats, allocator)
+        print "pinned:   {:8.2f} s, {:6.3f} runs/s".format(t_pinned, runs / t_pinned)
+        print "speedup from pinning: {:.2f}x".format(t_unpinned / t_pinned)
+    finally:
+        for file_name in glob.glob(path.join(allocator.lock_dir, '*')):
+            os.unlink(file_name)
+        os.rmdir(allocator.lock_dir)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
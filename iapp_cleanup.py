@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+iapp_cleanup.py
+
+Purpose: Background removal of finished IAPP run directories, and retention of
+         the crashed and debug run directories.
+
+Removing a run directory can take a long time on a slow or network filesystem.
+CleanupWorker.discard() instead renames the directory into a trash directory
+beside it (a cheap rename on the same filesystem), and a low priority thread
+deletes the trash while the next granule is processed. Trash left behind by an
+interrupted run is removed the next time that trash directory is used.
+
+Copyright (c) 2014 University of Wisconsin Regents.
+Licensed under GNU GPLv3.
+"""
+
+import os
+import uuid
+import atexit
+import logging
+import traceback
+from os import path
+from shutil import rmtree
+from threading import Thread, Lock
+from Queue import Queue
+
+LOG = logging.getLogger(__name__)
+
+TRASH_DIR_NAME = '.iapp_trash'
+WRECKAGE_SUFFIXES = ('_crashed', '_debug')
+
+
+def free_space_percent(dir_name):
+    '''
+    Return the percentage of the filesystem containing dir_name which is
+    available to unprivileged users.
+    '''
+    st = os.statvfs(dir_name)
+    if st.f_blocks == 0:
+        return 100.
+
+    return 100. * st.f_bavail / st.f_blocks
+
+
+def list_wreckage_dirs(dir_name):
+    '''
+    Return the crashed and debug run directories in dir_name, oldest first.
+    '''
+    wreckage_dirs = []
+
+    for entry in os.listdir(dir_name):
+        if not entry.endswith(WRECKAGE_SUFFIXES):
+            continue
+        entry = path.join(dir_name, entry)
+        if path.isdir(entry) and not path.islink(entry):
+            wreckage_dirs.append((os.stat(entry).st_mtime, entry))
+
+    wreckage_dirs.sort()
+
+    return [entry for mtime, entry in wreckage_dirs]
+
+
+class CleanupWorker(object):
+    '''
+    Removes discarded run directories on a background thread.
+
+    max_wreckage:   the maximum number of crashed/debug run directories to keep
+                    in a directory, None for no limit.
+    min_free_space: the percentage of free space to maintain on the filesystem
+                    holding the crashed/debug run directories, None for no limit.
+    '''
+
+    def __init__(self, max_wreckage=None, min_free_space=None):
+        self.max_wreckage = max_wreckage
+        self.min_free_space = min_free_space
+
+        self.queue = Queue()
+        self.trash_dirs = set()
+        self.lock = Lock()
+        self.closed = False
+
+        self.thread = Thread(target=self._remove_queued, name='iapp_cleanup')
+        self.thread.daemon = True
+        self.thread.start()
+
+        atexit.register(self.close)
+
+    def _remove_queued(self):
+        '''Delete queued directories until the None sentinel arrives.'''
+        try:
+            # On Linux the niceness applies to this thread only.
+            os.nice(10)
+        except (OSError, AttributeError):
+            pass
+
+        while True:
+            trash_item = self.queue.get()
+            try:
+                if trash_item is None:
+                    break
+                LOG.debug('Removing directory: {}'.format(trash_item))
+                if path.isdir(trash_item) and not path.islink(trash_item):
+                    rmtree(trash_item)
+                elif path.lexists(trash_item):
+                    os.unlink(trash_item)
+            except Exception:
+                LOG.warn(traceback.format_exc())
+            finally:
+                self.queue.task_done()
+
+    def _trash_dir_for(self, dir_name):
+        '''
+        Return the trash directory beside dir_name, creating it if necessary.
+        The first time a trash directory is used, anything left in it by an
+        earlier process is queued for removal.
+        '''
+        trash_dir = path.join(path.dirname(dir_name), TRASH_DIR_NAME)
+
+        with self.lock:
+            if trash_dir not in self.trash_dirs:
+                if not path.isdir(trash_dir):
+                    try:
+                        os.makedirs(trash_dir)
+                    except OSError:
+                        if not path.isdir(trash_dir):
+                            raise
+                else:
+                    for leftover in os.listdir(trash_dir):
+                        self.queue.put(path.join(trash_dir, leftover))
+                self.trash_dirs.add(trash_dir)
+
+        return trash_dir
+
+    def discard(self, dir_name):
+        '''
+        Move dir_name into the trash and queue it for removal. If it can't be
+        renamed, it is removed in place by the worker thread.
+        '''
+        if self.closed:
+            raise RuntimeError('CleanupWorker has been closed')
+
+        dir_name = path.abspath(dir_name)
+        trash_item = dir_name
+
+        try:
+            trash_dir = self._trash_dir_for(dir_name)
+            trash_item = path.join(trash_dir, "{}.{}.{}".format(
+                path.basename(dir_name), os.getpid(), uuid.uuid4().hex[:8]))
+            os.rename(dir_name, trash_item)
+            LOG.debug('Moved {} to {}'.format(dir_name, trash_item))
+        except OSError, err:
+            LOG.debug("Unable to move {} to the trash: {}".format(dir_name, str(err)))
+            trash_item = dir_name
+
+        self.queue.put(trash_item)
+
+    def enforce_retention(self, dir_name):
+        '''
+        Discard the oldest crashed/debug run directories in dir_name until there
+        are no more than max_wreckage of them, and the filesystem has at least
+        min_free_space percent free. Returns the discarded directories.
+        '''
+        if self.max_wreckage is None and self.min_free_space is None:
+            return []
+
+        wreckage_dirs = list_wreckage_dirs(dir_name)
+        discarded = []
+
+        while wreckage_dirs:
+            too_many = (self.max_wreckage is not None
+                        and len(wreckage_dirs) > self.max_wreckage)
+            too_full = (self.min_free_space is not None
+                        and free_space_percent(dir_name) < self.min_free_space)
+            if not (too_many or too_full):
+                break
+
+            oldest = wreckage_dirs.pop(0)
+            LOG.info('Retention policy, removing {}'.format(oldest))
+            self.discard(oldest)
+            discarded.append(oldest)
+
+            # Freeing space requires the deletion to actually happen.
+            if too_full and not too_many:
+                self.queue.join()
+
+        return discarded
+
+    def close(self, wait=True):
+        '''Stop accepting work and, if wait is True, finish the queued deletions.'''
+        if self.closed:
+            return
+        self.closed = True
+
+        self.queue.put(None)
+        if wait:
+            self.thread.join()
@@ -0,0 +1,501 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+iapp_composite.py
+
+Purpose: Build daily and six-hourly gridded composites of the IAPP retrievals
+         of all passes, for temperature and moisture at standard pressure
+         levels and total precipitable water, from the *_L2_*_iapp.nc outputs.
+
+The retrieved fields of regard (FORs) of each output are binned onto a regular
+lat/lon grid with numpy.bincount. For each field, level and time window, the
+composite holds, in each grid cell:
+
+    mean:   the mean of the FORs in the cell.
+    latest: the value of the most recent FOR in the cell.
+    count:  the number of FORs in the cell.
+
+The FOR times are interpolated along the pass from the start and end times in
+the output file name (see iapp_export.read_for_table()); a FOR is composited in
+the window containing its time.
+
+Files are binned in parallel into partial grids (sums, counts, latest values
+and their times), which merge exactly. The partial grid of each window is kept
+in a state file, <composite_dir>/<period>/<window>.state.npz, together with the
+passes it includes, so a new pass is added to a window without re-reading the
+others; a pass which is already included (by satellite and pass times, so
+re-runs don't count twice) is skipped. Each update rewrites the window's
+NetCDF composite, <composite_dir>/iapp_composite_<period>_<window>.nc.
+
+Requires numpy and netCDF4 (both shipped in ShellB3).
+
+Usage:
+
+    python iapp_composite.py [options] COMPOSITE_DIR OUTPUT_FILE_OR_DIR ...
+
+Copyright (c) 2014 University of Wisconsin Regents.
+Licensed under GNU GPLv3.
+"""
+
+import os
+import sys
+import glob
+import fcntl
+import logging
+import traceback
+from os import path
+from datetime import datetime, timedelta
+
+from iapp_export import read_for_table, pass_of, EPOCH
+
+LOG = logging.getLogger(__name__)
+
+# The length in hours of the composite windows of each period
+PERIODS = {'daily': 24, '6hourly': 6}
+
+# The fields composited: profiles at STANDARD_LEVELS, and single level fields
+PROFILE_FIELDS = ['Temperature_Retrieval', 'Dewpoint_Retrieval', 'Mixing_Ratio_Retrieval']
+SURFACE_FIELDS = ['Total_Precipitable_Water']
+STANDARD_LEVELS = [850., 700., 500., 300.]
+
+# The names of the pressure coordinate of the profiles, in hPa
+PRESSURE_FIELDS = ['Pressure_Levels', 'Pressure', 'pressure', 'Level', 'level']
+
+DEFAULT_RESOLUTION = 1.
+DEFAULT_BOUNDS = (-90., 90., -180., 180.)
+
+STATE_SUFFIX = '.state.npz'
+
+class Grid(object):
+    '''A regular lat/lon grid of cells of resolution degrees, covering bounds.'''
+
+    def __init__(self, resolution=DEFAULT_RESOLUTION, bounds=DEFAULT_BOUNDS):
+        self.resolution = float(resolution)
+        self.bounds = tuple([float(x) for x in bounds])
+        lat_min, lat_max, lon_min, lon_max = self.bounds
+        self.lat_count = int(round((lat_max - lat_min) / self.resolution))
+        self.lon_count = int(round((lon_max - lon_min) / self.resolution))
+        self.size = self.lat_count * self.lon_count
+
+    def cell_index(self, np, lat, lon):
+        '''The flat cell index of each location, -1 for those outside the grid.'''
+        lat_min, lat_max, lon_min, lon_max = self.bounds
+        row = np.floor((lat - lat_min) / self.resolution).astype(np.int64)
+        col = np.floor((lon - lon_min) / self.resolution).astype(np.int64)
+        inside = (row >= 0) & (row < self.lat_count) & (col >= 0) & (col < self.lon_count)
+        return np.where(inside, row * self.lon_count + col, -1)
+
+    def centres(self, np):
+        lat_min, lat_max, lon_min, lon_max = self.bounds
+        lats = lat_min + self.resolution * (np.arange(self.lat_count) + 0.5)
+        lons = lon_min + self.resolution * (np.arange(self.lon_count) + 0.5)
+        return lats, lons
+
+
+def _pressure_levels(np, nc_file, level_count):
+    '''The pressure of each profile level of nc_file, or None if it has none.'''
+    from netCDF4 import Dataset
+
+    nc_obj = Dataset(nc_file, 'r')
+    try:
+        for name in PRESSURE_FIELDS:
+            if name in nc_obj.variables and nc_obj.variables[name].size == level_count:
+                return np.asarray(nc_obj.variables[name][:], dtype=np.float64).reshape(-1)
+    finally:
+        nc_obj.close()
+    return None
+
+
+def composite_columns(np, nc_file, table, levels):
+    '''
+    Return a dictionary of composite variable name and the per-FOR values of
+    the table of nc_file: each profile field at each of levels (the nearest
+    level of the file, within 5%), and the surface fields.
+    '''
+    columns = {}
+    for field in SURFACE_FIELDS:
+        if field in table:
+            columns[field] = table[field]
+
+    pressures = None
+    for field in PROFILE_FIELDS:
+        if field not in table or table[field].ndim != 2:
+            continue
+        if pressures is None:
+            pressures = _pressure_levels(np, nc_file, table[field].shape[1])
+            if pressures is None:
+                LOG.warn('{} has no pressure levels, skipping its profiles'.format(nc_file))
+                break
+        for level in levels:
+            index = int(np.argmin(np.abs(pressures - level)))
+            if abs(pressures[index] - level) > 0.05 * level:
+                continue
+            columns['{}_{:g}hPa'.format(field, level)] = table[field][:, index]
+
+    return columns
+
+
+def new_partial(np, grid):
+    return {'sum': np.zeros(grid.size, dtype=np.float64),
+            'count': np.zeros(grid.size, dtype=np.int32),
+            'latest': np.full(grid.size, np.nan, dtype=np.float32),
+            'latest_time': np.full(grid.size, -1, dtype=np.int64)}
+
+
+def bin_values(np, grid, cells, times, values):
+    '''Return the partial grid of values at cells (-1 outside) with times.'''
+    partial = new_partial(np, grid)
+    valid = (cells >= 0) & ~np.isnan(values)
+    if not valid.any():
+        return partial
+    cells, times, values = cells[valid], times[valid], values[valid]
+
+    partial['sum'] = np.bincount(cells, weights=values, minlength=grid.size)
+    partial['count'] = np.bincount(cells, minlength=grid.size).astype(np.int32)
+
+    # The latest value in each cell: the last of each cell after sorting by
+    # cell and then time.
+    order = np.lexsort((times, cells))
+    sorted_cells = cells[order]
+    last = np.append(sorted_cells[1:] != sorted_cells[:-1], True)
+    partial['latest'][sorted_cells[last]] = values[order][last]
+    partial['latest_time'][sorted_cells[last]] = times[order][last]
+
+    return partial
+
+
+def merge_partials(np, partial, other):
+    '''Add the partial grid other to partial, in place, and return it.'''
+    newer = other['latest_time'] > partial['latest_time']
+    partial['sum'] += other['sum']
+    partial['count'] += other['count']
+    partial['latest'] = np.where(newer, other['latest'], partial['latest'])
+    partial['latest_time'] = np.maximum(partial['latest_time'], other['latest_time'])
+    return partial
+
+
+def window_start(time_us, hours):
+    '''The start of the window of hours length containing time_us (microseconds).'''
+    window_us = hours * 3600 * 1000000
+    return time_us - time_us % window_us
+
+
+def bin_file(nc_file, grid, periods, levels):
+    '''
+    Return the partial grids of nc_file, as a dictionary keyed on (period,
+    window start) of dictionaries of variable name and partial grid, and its
+    pass id.
+    '''
+    import numpy as np
+
+    pass_id, start_time, end_time = pass_of(nc_file)
+    table = read_for_table(nc_file, start_time, end_time)
+    if table is None or table['time'].size == 0:
+        return pass_id, {}
+
+    columns = composite_columns(np, nc_file, table, levels)
+    cells = grid.cell_index(np, table['latitude'].astype(np.float64),
+                            table['longitude'].astype(np.float64))
+
+    partials = {}
+    for period in periods:
+        starts = window_start(table['time'], PERIODS[period])
+        for start in np.unique(starts):
+            rows = starts == start
+            partials[(period, int(start))] = dict(
+                [(name, bin_values(np, grid, cells[rows], table['time'][rows], values[rows]))
+                 for name, values in columns.items()])
+
+    return pass_id, partials
+
+
+def _bin_file_job(args):
+    '''bin_file() for a worker process, returning the error rather than raising.'''
+    nc_file = args[0]
+    try:
+        return nc_file, bin_file(*args), None
+    except Exception, err:
+        LOG.debug(traceback.format_exc())
+        return nc_file, None, str(err)
+
+
+def _window_name(start_us):
+    return (EPOCH + timedelta(microseconds=start_us)).strftime('%Y%m%d%H')
+
+
+def _state_file(composite_dir, period, start_us):
+    return path.join(composite_dir, period, _window_name(start_us) + STATE_SUFFIX)
+
+
+def load_state(np, state_file, grid):
+    '''Return (partial grids, pass ids) of a window's state file, empty if there is none.'''
+    if not path.exists(state_file):
+        return {}, set()
+
+    npz_obj = np.load(state_file)
+    try:
+        if tuple(npz_obj['grid']) != (grid.resolution,) + grid.bounds:
+            raise ValueError('{} is for a different grid'.format(state_file))
+        partials = {}
+        for key in npz_obj.files:
+            if '/' not in key:
+                continue
+            name, array_name = key.rsplit('/', 1)
+            partials.setdefault(name, {})[array_name] = npz_obj[key]
+        pass_ids = set([str(x) for x in npz_obj['passes']])
+    finally:
+        npz_obj.close()
+
+    return partials, pass_ids
+
+
+def save_state(np, state_file, grid, partials, pass_ids):
+    arrays = {'grid': np.array((grid.resolution,) + grid.bounds),
+              'passes': np.array(sorted(pass_ids))}
+    for name, partial in partials.items():
+        for array_name, array in partial.items():
+            arrays['{}/{}'.format(name, array_name)] = array
+
+    tmp_file = '{}.{}.part.npz'.format(state_file[:-len('.npz')], os.getpid())
+    np.savez_compressed(tmp_file, **arrays)
+    os.rename(tmp_file, state_file)
+
+
+def write_composite(np, nc_file, grid, partials, period, start_us, pass_ids):
+    '''Write the mean, latest and count grids of a window to the NetCDF file nc_file.'''
+    from netCDF4 import Dataset
+
+    lats, lons = grid.centres(np)
+    tmp_file = path.join(path.dirname(nc_file),
+                         '.{}.{}.part'.format(path.basename(nc_file), os.getpid()))
+    nc_obj = Dataset(tmp_file, 'w')
+    try:
+        window_start_obj = EPOCH + timedelta(microseconds=start_us)
+        nc_obj.period = period
+        nc_obj.window_start = window_start_obj.strftime('%Y-%m-%dT%H:%M:%SZ')
+        nc_obj.window_end = (window_start_obj + timedelta(hours=PERIODS[period])) \
+            .strftime('%Y-%m-%dT%H:%M:%SZ')
+        nc_obj.pass_count = len(pass_ids)
+        nc_obj.createDimension('lat', grid.lat_count)
+        nc_obj.createDimension('lon', grid.lon_count)
+        lat_var = nc_obj.createVariable('lat', 'f4', ('lat',))
+        lat_var[:] = lats
+        lat_var.units = 'degrees_north'
+        lon_var = nc_obj.createVariable('lon', 'f4', ('lon',))
+        lon_var[:] = lons
+        lon_var.units = 'degrees_east'
+
+        shape = (grid.lat_count, grid.lon_count)
+        for name in sorted(partials.keys()):
+            partial = partials[name]
+            count = partial['count']
+            mean = np.full(grid.size, np.nan, dtype=np.float32)
+            mean[count > 0] = partial['sum'][count > 0] / count[count > 0]
+
+            for suffix, data, dtype in [('mean', mean, 'f4'),
+                                        ('latest', partial['latest'], 'f4'),
+                                        ('count', count, 'i4')]:
+                fill_value = -9999. if dtype == 'f4' else None
+                var = nc_obj.createVariable('{}_{}'.format(name, suffix), dtype, ('lat', 'lon'),
+                                            zlib=True, fill_value=fill_value)
+                if dtype == 'f4':
+                    data = np.where(np.isnan(data), fill_value, data)
+                var[:] = data.reshape(shape)
+    finally:
+        nc_obj.close()
+
+    os.rename(tmp_file, nc_file)
+
+
+def update_composites(composite_dir, output_files, grid=None, periods=None, levels=None,
+                      workers=1):
+    '''
+    Add the retrievals in output_files to the composites in composite_dir,
+    binning the files with workers processes. Returns the composite files
+    written.
+    '''
+    import numpy as np
+
+    grid = Grid() if grid is None else grid
+    periods = sorted(PERIODS.keys()) if periods is None else periods
+    levels = STANDARD_LEVELS if levels is None else levels
+
+    # Bin the files, merging the partial grids by window
+    jobs = [(nc_file, grid, periods, levels) for nc_file in output_files]
+    if workers > 1 and len(jobs) > 1:
+        from multiprocessing import Pool
+        pool = Pool(min(workers, len(jobs)))
+        try:
+            results = pool.imap_unordered(_bin_file_job, jobs)
+            merged = _merge_results(np, results)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        merged = _merge_results(np, (_bin_file_job(job) for job in jobs))
+
+    # Fold each window into its state, under a lock so that concurrent updates
+    # of a window don't lose each other's passes.
+    composite_files = []
+    for (period, start_us), (partials, pass_ids) in sorted(merged.items()):
+        state_file = _state_file(composite_dir, period, start_us)
+        if not path.isdir(path.dirname(state_file)):
+            try:
+                os.makedirs(path.dirname(state_file))
+            except OSError:
+                if not path.isdir(path.dirname(state_file)):
+                    raise
+
+        lock_obj = open(state_file[:-len(STATE_SUFFIX)] + '.lock', 'a')
+        try:
+            fcntl.lockf(lock_obj, fcntl.LOCK_EX)
+            state_partials, state_pass_ids = load_state(np, state_file, grid)
+
+            new_pass_ids = set([x for x in pass_ids if x not in state_pass_ids])
+            if not new_pass_ids:
+                LOG.debug('All passes are already in the {} composite for {}'
+                          .format(period, _window_name(start_us)))
+                continue
+            for pass_id, partial_by_name in partials.items():
+                if pass_id not in new_pass_ids:
+                    continue
+                for name, partial in partial_by_name.items():
+                    if name in state_partials:
+                        merge_partials(np, state_partials[name], partial)
+                    else:
+                        state_partials[name] = partial
+
+            state_pass_ids.update(new_pass_ids)
+            save_state(np, state_file, grid, state_partials, state_pass_ids)
+
+            composite_file = path.join(composite_dir, 'iapp_composite_{}_{}.nc'.format(
+                period, _window_name(start_us)))
+            write_composite(np, composite_file, grid, state_partials, period, start_us,
+                            state_pass_ids)
+            composite_files.append(composite_file)
+            LOG.info('Added {} passes to {}'.format(len(new_pass_ids), composite_file))
+        finally:
+            lock_obj.close()
+
+    return composite_files
+
+
+def _merge_results(np, results):
+    '''
+    Merge the partial grids of the results of _bin_file_job() into a
+    dictionary keyed on (period, window start) of (partial grids by pass id,
+    pass ids). A pass found twice (e.g. re-runs) is only binned once.
+    '''
+    merged = {}
+    seen = set()
+    for nc_file, result, error in results:
+        if error is not None:
+            LOG.warn('Unable to composite {}: {}'.format(nc_file, error))
+            continue
+        pass_id, partials = result
+        if pass_id in seen:
+            LOG.debug('Skipping {}, a re-run of pass {}'.format(nc_file, pass_id))
+            continue
+        seen.add(pass_id)
+        for window, partial_by_name in partials.items():
+            window_partials, window_pass_ids = merged.setdefault(window, ({}, set()))
+            window_partials[pass_id] = partial_by_name
+            window_pass_ids.add(pass_id)
+
+    return merged
+
+
+def composite_outputs(options, granule_dict):
+    '''
+    Add the outputs of a processed granule (each region's, with regions) to the
+    composites in options.composite_dir. A failed update is logged, but doesn't
+    fail the granule.
+    '''
+    outputs = []
+    if granule_dict.get('regions'):
+        for name, region_dict in sorted(granule_dict['regions'].items()):
+            if region_dict['error'] is None:
+                outputs.append(region_dict['output_file'])
+    elif granule_dict.get('output_file') is not None:
+        outputs.append(granule_dict['output_file'])
+
+    if not outputs:
+        return
+
+    try:
+        import numpy
+    except ImportError:
+        LOG.warn('numpy is unavailable, not compositing {}'.format(', '.join(outputs)))
+        return
+
+    try:
+        update_composites(options.composite_dir, outputs)
+    except Exception, err:
+        LOG.warn('Unable to composite {}: {}'.format(', '.join(outputs), str(err)))
+        LOG.debug(traceback.format_exc())
+
+
+def _argparse():
+    '''Parse the command line options of the compositing tool.'''
+    import argparse
+
+    def bounds_type(value):
+        try:
+            bounds = [float(x) for x in value.split(',')]
+        except ValueError:
+            raise argparse.ArgumentTypeError("bounds must be LAT_MIN,LAT_MAX,LON_MIN,LON_MAX")
+        if len(bounds) != 4 or bounds[0] >= bounds[1] or bounds[2] >= bounds[3]:
+            raise argparse.ArgumentTypeError("bounds must be LAT_MIN,LAT_MAX,LON_MIN,LON_MAX")
+        return tuple(bounds)
+
+    parser = argparse.ArgumentParser(
+        description='Composite IAPP retrievals onto daily and six-hourly lat/lon grids.')
+
+    parser.add_argument('composite_dir', action="store",
+                        help='''The directory of the composites and their state.''')
+    parser.add_argument('inputs', action="store", nargs='+',
+                        help='''IAPP output files, or directories of them.''')
+    parser.add_argument('--resolution', action="store", dest="resolution", type=float,
+                        default=DEFAULT_RESOLUTION,
+                        help='''The grid resolution in degrees. [default: {}]'''
+                        .format(DEFAULT_RESOLUTION))
+    parser.add_argument('--bounds', action="store", dest="bounds", type=bounds_type,
+                        default=DEFAULT_BOUNDS,
+                        help='''The grid bounds LAT_MIN,LAT_MAX,LON_MIN,LON_MAX.
+                        [default: {}]'''.format(','.join(['{:g}'.format(x) for x in DEFAULT_BOUNDS])))
+    parser.add_argument('--period', action="append", dest="periods",
+                        choices=sorted(PERIODS.keys()),
+                        help='''The composite period, may be repeated. [default: all]''')
+    parser.add_argument('--levels', action="store", dest="levels",
+                        type=lambda x: [float(y) for y in x.split(',')],
+                        default=STANDARD_LEVELS,
+                        help='''The pressure levels (hPa) of the profiles. [default: {}]'''
+                        .format(','.join(['{:g}'.format(x) for x in STANDARD_LEVELS])))
+    parser.add_argument('--workers', action="store", dest="workers", type=int, default=1,
+                        help='''The number of processes binning files. [default: 1]''')
+    parser.add_argument('-v', '--verbose', action="count", dest='verbosity', default=1,
+                        help='''each occurrence increases verbosity 1 level from INFO''')
+
+    return parser.parse_args()
+
+
+def main():
+    args = _argparse()
+    logging.basicConfig(level=logging.DEBUG if args.verbosity > 1 else logging.INFO)
+
+    output_files = []
+    for input in args.inputs:
+        if path.isdir(input):
+            output_files.extend(sorted(glob.glob(path.join(input, '*_L2_*_iapp.nc'))))
+        else:
+            output_files.append(input)
+
+    update_composites(args.composite_dir, output_files,
+                      grid=Grid(args.resolution, args.bounds), periods=args.periods,
+                      levels=args.levels, workers=args.workers)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+iapp_compression.py
+
+Purpose: Read gzip, bzip2 and xz compressed level-1D files. Headers are read
+         from the start of the compressed stream, and the data is decompressed
+         in fixed size chunks, so memory use doesn't depend on the file size.
+
+xz files are read with the lzma module (or backports.lzma) if it can be
+imported, and otherwise through the xz command.
+
+Copyright (c) 2014 University of Wisconsin Regents.
+Licensed under GNU GPLv3.
+"""
+
+import os
+import bz2
+import gzip
+import shutil
+import logging
+import subprocess
+from os import path
+
+LOG = logging.getLogger(__name__)
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+COMPRESSION_SUFFIXES = ['.gz', '.bz2', '.xz']
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class _PipeReader(object):
+    '''A read-only file object on the output of a decompression command.'''
+
+    def __init__(self, args):
+        self.args = args
+        self.eof = False
+        self.pop = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                    stderr=open(os.devnull, 'w'))
+
+    def read(self, size=-1):
+        data = self.pop.stdout.read(size)
+        if not data:
+            self.eof = True
+        return data
+
+    def close(self):
+        self.pop.stdout.close()
+        if not self.eof:
+            # Reading stopped early, e.g. after the header
+            if self.pop.poll() is None:
+                self.pop.terminate()
+            self.pop.wait()
+        elif self.pop.wait() != 0:
+            raise IOError("'{}' returned {}".format(' '.join(self.args), self.pop.returncode))
+
+
+def compression_of(file_name):
+    '''The compression suffix of file_name, or None if it isn't compressed.'''
+    suffix = path.splitext(file_name)[1]
+    return suffix if suffix in COMPRESSION_SUFFIXES else None
+
+
+def uncompressed_name(file_name):
+    '''The name of file_name without any compression suffix.'''
+    if compression_of(file_name) is None:
+        return file_name
+    return path.splitext(file_name)[0]
+
+
+def open_compressed(file_name):
+    '''Open a possibly compressed file for reading its uncompressed bytes.'''
+    suffix = compression_of(file_name)
+
+    if suffix is None:
+        return open(file_name, 'rb')
+    if suffix == '.gz':
+        return gzip.GzipFile(file_name, 'rb')
+    if suffix == '.bz2':
+        return bz2.BZ2File(file_name, 'rb')
+    if lzma is not None:
+        return lzma.LZMAFile(file_name, 'rb')
+
+    return _PipeReader(['xz', '--decompress', '--stdout', file_name])
+
+
+def decompress_file(file_name, out_dir):
+    '''
+    Decompress file_name into out_dir, via a temporary file so that a partly
+    written file is never left under the final name. Returns the path of the
+    decompressed file.
+    '''
+    out_file = path.join(out_dir, path.basename(uncompressed_name(file_name)))
+    tmp_file = path.join(out_dir, '.{}.{}.part'.format(path.basename(out_file), os.getpid()))
+
+    LOG.info('Decompressing {} to {}'.format(file_name, out_file))
+
+    try:
+        in_obj = open_compressed(file_name)
+        out_obj = open(tmp_file, 'wb')
+        try:
+            shutil.copyfileobj(in_obj, out_obj, CHUNK_SIZE)
+        finally:
+            out_obj.close()
+        in_obj.close()
+    except Exception:
+        if path.exists(tmp_file):
+            os.unlink(tmp_file)
+        raise
+
+    os.rename(tmp_file, out_file)
+
+    return out_file
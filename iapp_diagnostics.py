@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+iapp_diagnostics.py
+
+Purpose: Keep per-FOR quality records of each IAPP run in a small columnar
+         sidecar beside the retrieval output, so that failure patterns can be
+         queried across many passes without searching the text logs.
+
+The per-FOR records come from the retrieval output, which is the only place
+where the IAPP results are located by FOR: for each field of regard, its
+scanline and FOV (field of view position along the scanline), latitude and
+longitude, whether it has a retrieval, and the values of any per-FOR quality
+flag variables in the output (as exported by iapp_export.py).
+
+The iapp_main output is parsed as it runs for the data quality check messages
+("HIRS_Data_Flag fails data quality check" and "AMSUA_Data_Flag fails data
+quality check"), each of which is recorded with its line number in the output.
+These messages don't say which FOR they refer to, so they can only be counted
+per run. Other output, including the retrieval printouts of --print_retrieval,
+is not parsed, since its format isn't specified; it remains in the log.
+
+The sidecar, <output>.diag.npz, holds the per-FOR columns 'scanline', 'fov',
+'latitude', 'longitude', 'retrieved' and the quality variables, and the
+message columns 'message_kind' and 'message_line', with 'kind_names' to decode
+'message_kind'. Requires numpy, and netCDF4 for the per-FOR columns (both
+shipped in ShellB3); without numpy no sidecar is written.
+
+Run as a script to summarise a set of sidecars:
+
+    python iapp_diagnostics.py WORK_DIR/*.diag.npz
+
+Copyright (c) 2014 University of Wisconsin Regents.
+Licensed under GNU GPLv3.
+"""
+
+import os
+import sys
+import logging
+import traceback
+from os import path
+from array import array
+
+from iapp_qa import (_import_netcdf, _read_with_mask, _for_view, _first_present,
+                     RETRIEVAL_FIELD, LATITUDE_FIELDS, LONGITUDE_FIELDS)
+from iapp_export import QUALITY_FIELDS
+
+LOG = logging.getLogger(__name__)
+
+DIAG_SUFFIX = '.diag.npz'
+
+# (kind, message) of the diagnostics recognised in the iapp_main output
+DIAGNOSTIC_KINDS = [
+    ('hirs_quality', 'HIRS_Data_Flag fails data quality check'),
+    ('amsua_quality', 'AMSUA_Data_Flag fails data quality check'),
+]
+KIND_NAMES = [kind for kind, message in DIAGNOSTIC_KINDS]
+
+
+class DiagnosticParser(object):
+    '''
+    Accumulates the diagnostic messages of an iapp_main run from its stdout,
+    one line at a time (e.g. as the line_func of
+    execute_binary_captured_inject_io()).
+    '''
+
+    def __init__(self):
+        self.columns = {'kind': array('b'),
+                        'line': array('i')}
+        self.line_count = 0
+
+    def feed(self, line):
+        self.line_count += 1
+        for kind, (name, message) in enumerate(DIAGNOSTIC_KINDS):
+            if message in line:
+                break
+        else:
+            return
+
+        self.columns['kind'].append(kind)
+        self.columns['line'].append(self.line_count)
+
+    def __len__(self):
+        return len(self.columns['kind'])
+
+    def counts(self):
+        '''The number of messages of each kind.'''
+        counts = dict.fromkeys(KIND_NAMES, 0)
+        for kind in self.columns['kind']:
+            counts[KIND_NAMES[kind]] += 1
+        return counts
+
+
+def read_for_quality(nc_file):
+    '''
+    Return the per-FOR quality columns of the retrieval output nc_file, as a
+    dictionary of numpy arrays, or None if it can't be read.
+    '''
+    np, Dataset, default_fillvals = _import_netcdf()
+    if np is None:
+        LOG.debug('numpy/netCDF4 are not available, no per-FOR records of {}'.format(nc_file))
+        return None
+
+    try:
+        nc_obj = Dataset(nc_file, 'r')
+    except Exception:
+        LOG.warn('Unable to open {} for per-FOR records'.format(nc_file))
+        LOG.debug(traceback.format_exc())
+        return None
+
+    try:
+        lat_name = _first_present(nc_obj, LATITUDE_FIELDS)
+        lon_name = _first_present(nc_obj, LONGITUDE_FIELDS)
+        if RETRIEVAL_FIELD not in nc_obj.variables or lat_name is None or lon_name is None:
+            LOG.warn('{} lacks {} or the latitude/longitude, no per-FOR records'
+                     .format(nc_file, RETRIEVAL_FIELD))
+            return None
+
+        lat, lat_fill = _read_with_mask(np, default_fillvals, nc_obj.variables[lat_name])
+        lon, lon_fill = _read_with_mask(np, default_fillvals, nc_obj.variables[lon_name])
+        for_shape = lat.shape
+        for_count = lat.size
+
+        # Scanline and FOV of each FOR, for (scanline, fov) shaped locations
+        if len(for_shape) == 2:
+            scanline, fov = np.indices(for_shape)
+        else:
+            scanline = np.arange(for_count)
+            fov = np.full(for_count, -1)
+
+        data, is_fill = _read_with_mask(np, default_fillvals, nc_obj.variables[RETRIEVAL_FIELD])
+        lat = lat.reshape(-1).astype(np.float32)
+        lon = lon.reshape(-1).astype(np.float32)
+        lat[lat_fill.reshape(-1)] = np.nan
+        lon[lon_fill.reshape(-1)] = np.nan
+
+        columns = {'scanline': scanline.reshape(-1).astype(np.int32),
+                   'fov': fov.reshape(-1).astype(np.int32),
+                   'latitude': lat,
+                   'longitude': lon,
+                   'retrieved': ~_for_view(is_fill).all(axis=1)}
+
+        quality_names = [name for name in nc_obj.variables
+                         if [x for x in QUALITY_FIELDS if x in name]]
+        for name in sorted(quality_names):
+            if name in columns:
+                continue
+            data = nc_obj.variables[name]
+            data.set_auto_maskandscale(False)
+            data = data[:]
+            if data.size % for_count != 0:
+                LOG.debug('{} is not per FOR, not recording it'.format(name))
+                continue
+            data = data.reshape(for_count, -1)
+            columns[name] = data[:, 0] if data.shape[1] == 1 else data
+
+    except Exception:
+        LOG.warn('Unable to read the per-FOR records of {}'.format(nc_file))
+        LOG.debug(traceback.format_exc())
+        return None
+    finally:
+        nc_obj.close()
+
+    return columns
+
+
+def diagnostics_sidecar_name(nc_file):
+    '''The name of the diagnostics sidecar of nc_file.'''
+    return "{}{}".format(path.splitext(nc_file)[0], DIAG_SUFFIX)
+
+
+def write_diagnostics_sidecar(parser, sidecar_file, nc_file=None):
+    '''
+    Write the messages of parser, and the per-FOR records of the retrieval
+    output nc_file (if given), to sidecar_file, via a temporary file so the
+    sidecar appears complete or not at all. Returns the sidecar file name, or
+    None if it couldn't be written.
+    '''
+    try:
+        import numpy as np
+    except ImportError:
+        LOG.debug('numpy is unavailable, not writing {}'.format(sidecar_file))
+        return None
+
+    columns = {}
+    if nc_file is not None:
+        columns = read_for_quality(nc_file) or {}
+
+    columns['message_kind'] = np.array(parser.columns['kind'], dtype=np.int8)
+    columns['message_line'] = np.array(parser.columns['line'], dtype=np.int32)
+    columns['kind_names'] = np.array(KIND_NAMES)
+
+    # np.savez adds .npz to names without it, so keep the suffix on the temporary name
+    tmp_file = path.join(path.dirname(sidecar_file),
+                         '.{}.{}.part.npz'.format(path.basename(sidecar_file), os.getpid()))
+    try:
+        np.savez_compressed(tmp_file, **columns)
+        os.rename(tmp_file, sidecar_file)
+    except (IOError, OSError), err:
+        LOG.warn('Unable to write {}: {}'.format(sidecar_file, str(err)))
+        LOG.debug(traceback.format_exc())
+        if path.exists(tmp_file):
+            os.unlink(tmp_file)
+        return None
+
+    LOG.debug('Wrote {} FOR records and {} messages to {}'.format(
+        len(columns.get('retrieved', [])), len(parser), sidecar_file))
+
+    return sidecar_file
+
+
+def read_diagnostics_sidecar(sidecar_file):
+    '''Return the columns of sidecar_file as a dictionary of numpy arrays.'''
+    import numpy as np
+
+    npz_obj = np.load(sidecar_file)
+    try:
+        return dict([(name, npz_obj[name]) for name in npz_obj.files])
+    finally:
+        npz_obj.close()
+
+
+def main():
+    '''
+    Print the number of messages of each kind, and the fraction of FORs without
+    a retrieval at each FOV, in the given sidecars.
+    '''
+    import numpy as np
+
+    totals = dict.fromkeys(KIND_NAMES, 0)
+    fov_counts = {}
+    for sidecar_file in sys.argv[1:]:
+        columns = read_diagnostics_sidecar(sidecar_file)
+        kind_names = [str(x) for x in columns['kind_names']]
+        counts = np.bincount(columns['message_kind'].astype(np.int32),
+                             minlength=len(kind_names))
+        for kind, count in enumerate(counts):
+            totals[kind_names[kind]] = totals.get(kind_names[kind], 0) + int(count)
+
+        if 'retrieved' not in columns:
+            continue
+        for fov in np.unique(columns['fov']):
+            retrieved = columns['retrieved'][columns['fov'] == fov]
+            total, failed = fov_counts.get(fov, (0, 0))
+            fov_counts[fov] = (total + retrieved.size, failed + int((~retrieved).sum()))
+
+    print "{} files".format(len(sys.argv) - 1)
+    for kind in sorted(totals):
+        print "{:16s} {}".format(kind, totals[kind])
+
+    if fov_counts:
+        print "Fraction of FORs without a retrieval, by FOV (-1 is unknown):"
+        for fov in sorted(fov_counts):
+            total, failed = fov_counts[fov]
+            print "{:8d} {:.3f} of {}".format(fov, failed / float(total), total)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
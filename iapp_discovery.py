@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+iapp_discovery.py
+
+Purpose: Find the level-1D files to process, in directory trees, lists of files
+         on the command line and manifest files, as a lazy stream, so that
+         processing can start before a large archive has been walked.
+
+Files are selected by shell-style include/exclude patterns on their base names
+and, optionally, by a time range. The time of a file is taken from its name if
+it matches one of NAME_TIME_PATTERNS, and otherwise from its header (if a
+header_func is given); a file is selected if its time overlaps the range. Each
+file is produced at most once, and a compressed file is skipped if the
+uncompressed file is beside it.
+
+Directories are read with os.scandir (Python 3.5+) or the scandir package if
+either is available, since they avoid a stat() per entry, and with os.listdir
+otherwise.
+
+Copyright (c) 2014 University of Wisconsin Regents.
+Licensed under GNU GPLv3.
+"""
+
+import os
+import re
+import sys
+import fnmatch
+import logging
+import traceback
+from os import path
+from datetime import datetime, timedelta
+
+from iapp_compression import COMPRESSION_SUFFIXES, compression_of, uncompressed_name
+
+LOG = logging.getLogger(__name__)
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+DEFAULT_INCLUDE = ['*.l1d'] + ['*.l1d{}'.format(suffix) for suffix in COMPRESSION_SUFFIXES]
+
+# Date/time fields recognised in level-1D file names, most specific first,
+# e.g. hirsl1d_noaa19_20150304_0100_31234.l1d or ..._d20150304_t0100000_...
+# with the length of time which each may be the start of.
+NAME_TIME_PATTERNS = [
+    (re.compile(r'(?<!\d)d?(\d{8})_t?(\d{4})(?!\d{3})'), '%Y%m%d%H%M', timedelta(minutes=1)),
+    (re.compile(r'(?<!\d)d(\d{8})_t(\d{6})'), '%Y%m%d%H%M%S', timedelta(seconds=1)),
+    (re.compile(r'(?<!\d)(\d{8})(?!\d)'), '%Y%m%d', timedelta(days=1)),
+]
+
+
+def time_range_from_name(file_name):
+    '''
+    The (start, end) of the time given in the base name of file_name, e.g. the
+    whole day for a date, or None if there is no time in the name.
+    '''
+    file_name = path.basename(file_name)
+    for pattern, time_format, resolution in NAME_TIME_PATTERNS:
+        match = pattern.search(file_name)
+        if match is None:
+            continue
+        try:
+            time_obj = datetime.strptime(''.join(match.groups()), time_format)
+        except ValueError:
+            continue
+        return time_obj, time_obj + resolution
+
+    return None
+
+
+def _list_dir(dir_name):
+    '''Yield (entry path, is a directory) for the entries of dir_name.'''
+    if scandir is not None:
+        for entry in scandir(dir_name):
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            yield entry.path, is_dir
+        return
+
+    for entry in os.listdir(dir_name):
+        entry = path.join(dir_name, entry)
+        yield entry, path.isdir(entry)
+
+
+def walk_files(top, recursive=False):
+    '''
+    Yield the files in the directory top (and in its subdirectories, if
+    recursive), sorted by name within each directory.
+    '''
+    dir_stack = [top]
+    while dir_stack:
+        dir_name = dir_stack.pop()
+        try:
+            entries = sorted(_list_dir(dir_name))
+        except OSError, err:
+            LOG.warn("Unable to read directory {}: {}".format(dir_name, str(err)))
+            continue
+
+        sub_dirs = []
+        for entry, is_dir in entries:
+            if is_dir:
+                sub_dirs.append(entry)
+            else:
+                yield entry
+
+        if recursive:
+            dir_stack.extend(reversed(sub_dirs))
+
+
+def read_manifest(manifest):
+    '''Yield the file names listed in manifest, a file name or '-' for stdin.'''
+    manifest_obj = sys.stdin if manifest == '-' else open(manifest, 'r')
+    try:
+        for line in manifest_obj:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                yield line
+    finally:
+        if manifest_obj is not sys.stdin:
+            manifest_obj.close()
+
+
+class FileFilter(object):
+    '''
+    Selects level-1D files by name and time.
+
+    include, exclude:     lists of shell-style patterns matched against the
+                          base name; a file must match an include pattern, and
+                          no exclude pattern.
+    start_time, end_time: the time range of the files to select, None for no
+                          limit.
+    header_func:          callable returning an object with timeObj_start and
+                          timeObj_end attributes for a file (e.g.
+                          iapp_level2.Level1D), used for files with no time in
+                          their name.
+    '''
+
+    def __init__(self, include=None, exclude=None, start_time=None, end_time=None,
+                 header_func=None):
+        self.include = DEFAULT_INCLUDE if not include else include
+        self.exclude = [] if exclude is None else exclude
+        self.start_time = start_time
+        self.end_time = end_time
+        self.header_func = header_func
+
+    def match_name(self, file_name):
+        base_name = path.basename(file_name)
+        if not [x for x in self.include if fnmatch.fnmatch(base_name, x)]:
+            return False
+        if [x for x in self.exclude if fnmatch.fnmatch(base_name, x)]:
+            return False
+        return True
+
+    def file_time_range(self, file_name):
+        time_range = time_range_from_name(file_name)
+        if time_range is None and self.header_func is not None:
+            try:
+                header_obj = self.header_func(file_name)
+                time_range = (header_obj.timeObj_start, header_obj.timeObj_end)
+            except Exception:
+                LOG.debug(traceback.format_exc())
+        return time_range
+
+    def match_time(self, file_name):
+        if self.start_time is None and self.end_time is None:
+            return True
+
+        time_range = self.file_time_range(file_name)
+        if time_range is None:
+            LOG.warn("Unable to find the time of {}, skipping".format(file_name))
+            return False
+
+        # Select the file if any part of its time range overlaps ours
+        file_start, file_end = time_range
+        if self.start_time is not None and file_end < self.start_time:
+            return False
+        if self.end_time is not None and file_start > self.end_time:
+            return False
+        return True
+
+
+def discover_files(inputs, manifests=None, recursive=False, file_filter=None):
+    '''
+    Yield the absolute paths of the level-1D files in inputs (file and
+    directory names) and in the manifest files, filtered by file_filter.
+    Files named explicitly (on the command line or in a manifest) are only
+    subject to the time filter.
+    '''
+    file_filter = FileFilter() if file_filter is None else file_filter
+    seen = set()
+    debug_enabled = LOG.isEnabledFor(logging.DEBUG)
+
+    def _sources():
+        for input in inputs:
+            yield input
+        for manifest in (manifests or []):
+            for input in read_manifest(manifest):
+                yield input
+
+    for input in _sources():
+
+        input = path.abspath(path.expanduser(input))
+        LOG.debug("input = {}".format(input))
+
+        if path.isdir(input):
+            LOG.debug("Input {} is a directory containing the files...".format(input))
+            candidates = (x for x in walk_files(input, recursive) if file_filter.match_name(x))
+        elif path.isfile(input):
+            LOG.debug("Input {} is a file.".format(input))
+            candidates = [input]
+        else:
+            LOG.warn("The input {} is neither a file or a directory".format(input))
+            continue
+
+        for hirs_file in candidates:
+            if hirs_file in seen:
+                continue
+            seen.add(hirs_file)
+
+            # Don't process a compressed file if the uncompressed file is also present
+            if compression_of(hirs_file) is not None and path.exists(uncompressed_name(hirs_file)):
+                if debug_enabled:
+                    LOG.debug("Skipping {}, since it is also present uncompressed".format(hirs_file))
+                continue
+
+            if not file_filter.match_time(hirs_file):
+                if debug_enabled:
+                    LOG.debug("Skipping {}, outside the time range".format(hirs_file))
+                continue
+
+            if debug_enabled:
+                LOG.debug("\tfile: {}".format(hirs_file))
+            yield hirs_file
@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+iapp_export.py
+
+Purpose: Flatten the retrieved fields of regard (FORs) of IAPP outputs into a
+         columnar table, partitioned by date and satellite, so that analyses
+         over months of passes read only the partitions and columns they need,
+         rather than opening every retrieval file.
+
+Each exported row is one FOR with a retrieval and a valid location, with the
+columns:
+
+    time:            microseconds since 1970-01-01 UTC, interpolated along the
+                     pass from the level-1D start and end times by scanline.
+    latitude, longitude, scanline, fov
+    satellite, region ('' if none)
+    granule:         the output file name, less its creation time
+    retrieved:       True (rows are only written for retrieved FORs)
+    EXPORT_FIELDS:   the retrieval fields present in the output; profiles are
+                     fixed-length arrays with one value per level. Fill values
+                     become NaN.
+    QUALITY_FIELDS:  the per-FOR quality flag variables present in the output.
+
+The table of a granule is written to
+<export_dir>/date=YYYY-MM-DD/satellite=<satellite>/<granule>.<format>, split
+by date if the pass crosses midnight. Granules are appended as they finish by
+adding files, and a re-run granule replaces its own files. The (Hive-style)
+directory names let Parquet/Arrow dataset readers prune partitions;
+partition_files() does the same for any format.
+
+Formats, in order of preference: Parquet (pyarrow.parquet), Arrow IPC
+(pyarrow) and NumPy .npz (numpy only). Requires numpy and netCDF4.
+
+Copyright (c) 2014 University of Wisconsin Regents.
+Licensed under GNU GPLv3.
+"""
+
+import os
+import re
+import glob
+import logging
+import traceback
+from os import path
+from datetime import datetime, timedelta
+
+from iapp_qa import (_import_netcdf, _read_with_mask, _for_view, _first_present,
+                     RETRIEVAL_FIELD, LATITUDE_FIELDS, LONGITUDE_FIELDS)
+
+LOG = logging.getLogger(__name__)
+
+EXPORT_FORMATS = ['parquet', 'arrow', 'npz']
+FORMAT_SUFFIXES = {'parquet': '.parquet', 'arrow': '.arrow', 'npz': '.npz'}
+
+# The retrieval fields exported, if present in the output file
+EXPORT_FIELDS = ['Temperature_Retrieval',
+                 'Dewpoint_Retrieval',
+                 'Mixing_Ratio_Retrieval',
+                 'Total_Precipitable_Water',
+                 'Total_Ozone',
+                 'Skin_Temperature',
+                 'Surface_Pressure']
+
+# Substrings of the names of the per-FOR quality variables exported
+QUALITY_FIELDS = ['Flag', 'Quality']
+
+EPOCH = datetime(1970, 1, 1)
+
+# satellite, start date and time, and end time of an output file name, e.g.
+# noaa19_L2_d20150304_t0100000_e0105000_c20150304013412345678_iapp.nc
+OUTPUT_NAME_PATTERN = re.compile(
+    r'^(?P<satellite>[^_]+)_L2_d(?P<date>\d{8})_t(?P<start>\d{6})(?P<start_ds>\d)'
+    r'_e(?P<end>\d{6})(?P<end_ds>\d)_c\d+(?P<region>_.+)?_iapp\.nc$')
+
+
+def pass_of(output_file):
+    '''
+    Return (pass id, start time, end time) from the name of output_file. The
+    pass id identifies the pass and region, without the creation time.
+    '''
+    match = OUTPUT_NAME_PATTERN.match(path.basename(output_file))
+    if match is None:
+        raise ValueError('{} is not an IAPP output file name'.format(output_file))
+
+    start_time = datetime.strptime(match.group('date') + match.group('start'), '%Y%m%d%H%M%S')
+    start_time += timedelta(seconds=0.1 * int(match.group('start_ds')))
+    end_time = datetime.strptime(match.group('date') + match.group('end'), '%Y%m%d%H%M%S')
+    end_time += timedelta(seconds=0.1 * int(match.group('end_ds')))
+    if end_time < start_time:
+        end_time += timedelta(days=1)
+
+    pass_id = '{}_d{}_t{}{}_e{}{}{}'.format(
+        match.group('satellite'), match.group('date'), match.group('start'),
+        match.group('start_ds'), match.group('end'), match.group('end_ds'),
+        match.group('region') or '')
+
+    return pass_id, start_time, end_time
+
+
+def available_formats():
+    '''The export formats which can be written with the installed libraries.'''
+    formats = []
+    try:
+        import pyarrow
+        try:
+            import pyarrow.parquet
+            formats.append('parquet')
+        except ImportError:
+            pass
+        formats.append('arrow')
+    except ImportError:
+        pass
+    try:
+        import numpy
+        formats.append('npz')
+    except ImportError:
+        pass
+    return formats
+
+
+def _microseconds(time_obj):
+    delta = time_obj - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def read_for_table(nc_file, start_time, end_time):
+    '''
+    Return the table of the retrieved FORs in nc_file, as a dictionary of
+    column name and numpy array (without the satellite, granule and region
+    columns), or None if nothing could be read. start_time and end_time are
+    the pass start and end, for the FOR times.
+    '''
+    np, Dataset, default_fillvals = _import_netcdf()
+    if np is None:
+        LOG.debug('numpy/netCDF4 are not available, not exporting {}'.format(nc_file))
+        return None
+
+    nc_obj = Dataset(nc_file, 'r')
+    try:
+        lat_name = _first_present(nc_obj, LATITUDE_FIELDS)
+        lon_name = _first_present(nc_obj, LONGITUDE_FIELDS)
+        if RETRIEVAL_FIELD not in nc_obj.variables or lat_name is None or lon_name is None:
+            LOG.warn('{} lacks {} or the latitude/longitude, not exporting it'
+                     .format(nc_file, RETRIEVAL_FIELD))
+            return None
+
+        lat, lat_fill = _read_with_mask(np, default_fillvals, nc_obj.variables[lat_name])
+        lon, lon_fill = _read_with_mask(np, default_fillvals, nc_obj.variables[lon_name])
+        for_shape = lat.shape
+        for_count = lat.size
+
+        # Scanline and FOV of each FOR, for (scanline, fov) shaped locations
+        if len(for_shape) == 2:
+            scanline, fov = np.indices(for_shape)
+            scanline_count = for_shape[0]
+        else:
+            scanline = np.arange(for_count)
+            fov = np.full(for_count, -1)
+            scanline_count = for_count
+        scanline = scanline.reshape(-1).astype(np.int32)
+        fov = fov.reshape(-1).astype(np.int32)
+
+        data, is_fill = _read_with_mask(np, default_fillvals, nc_obj.variables[RETRIEVAL_FIELD])
+        retrieved = ~_for_view(is_fill).all(axis=1)
+        valid = retrieved & ~(lat_fill.reshape(-1) | lon_fill.reshape(-1))
+
+        # Interpolate the times of the scanlines along the pass
+        start_us = _microseconds(start_time)
+        span_us = _microseconds(end_time) - start_us
+        fraction = scanline.astype(np.float64) / max(scanline_count - 1, 1)
+
+        table = {'time': (start_us + np.round(fraction * span_us)).astype(np.int64)[valid],
+                 'latitude': lat.reshape(-1).astype(np.float32)[valid],
+                 'longitude': lon.reshape(-1).astype(np.float32)[valid],
+                 'scanline': scanline[valid],
+                 'fov': fov[valid],
+                 'retrieved': retrieved[valid]}
+
+        quality_names = [name for name in nc_obj.variables
+                         if [x for x in QUALITY_FIELDS if x in name]]
+        for name in EXPORT_FIELDS + sorted(quality_names):
+            if name not in nc_obj.variables or name in table:
+                continue
+            data, is_fill = _read_with_mask(np, default_fillvals, nc_obj.variables[name])
+            if data.size % for_count != 0:
+                LOG.debug('{} is not per FOR, not exporting it'.format(name))
+                continue
+            data = data.reshape(for_count, -1)
+            is_fill = is_fill.reshape(for_count, -1)
+            if name in EXPORT_FIELDS:
+                data = data.astype(np.float32)
+                data[is_fill] = np.nan
+            if data.shape[1] == 1:
+                data = data[:, 0]
+            table[name] = data[valid]
+
+    finally:
+        nc_obj.close()
+
+    return table
+
+
+def _write_npz(table, file_name):
+    import numpy as np
+    np.savez_compressed(file_name, **table)
+
+
+def _pyarrow_table(table):
+    import pyarrow as pa
+
+    names = sorted(table.keys())
+    arrays = []
+    for name in names:
+        data = table[name]
+        if data.ndim == 2:
+            values = pa.array(data.reshape(-1))
+            arrays.append(pa.FixedSizeListArray.from_arrays(values, data.shape[1]))
+        else:
+            arrays.append(pa.array(data))
+
+    return pa.Table.from_arrays(arrays, names=names)
+
+
+def _write_parquet(table, file_name):
+    import pyarrow.parquet as pq
+    pq.write_table(_pyarrow_table(table), file_name)
+
+
+def _write_arrow(table, file_name):
+    import pyarrow as pa
+    arrow_table = _pyarrow_table(table)
+    sink = pa.OSFile(file_name, 'wb')
+    try:
+        writer = pa.ipc.new_file(sink, arrow_table.schema)
+        writer.write_table(arrow_table)
+        writer.close()
+    finally:
+        sink.close()
+
+
+_WRITERS = {'parquet': _write_parquet, 'arrow': _write_arrow, 'npz': _write_npz}
+
+
+def partition_dir(export_dir, date_obj, satellite):
+    return path.join(export_dir, 'date={}'.format(date_obj.strftime('%Y-%m-%d')),
+                     'satellite={}'.format(satellite))
+
+
+def export_granule(nc_file, export_dir, satellite, start_time, end_time, region=None,
+                   export_format=None):
+    '''
+    Export the retrieved FORs of the IAPP output nc_file to its date/satellite
+    partitions of export_dir, in export_format (the most preferred available
+    format if None). Returns the list of files written.
+    '''
+    formats = available_formats()
+    if export_format is None:
+        if not formats:
+            LOG.warn('No export format is available, not exporting {}'.format(nc_file))
+            return []
+        export_format = formats[0]
+    elif export_format not in formats:
+        raise ValueError("Export format '{}' is unavailable, choose from {}"
+                         .format(export_format, formats))
+
+    table = read_for_table(nc_file, start_time, end_time)
+    if table is None:
+        return []
+
+    import numpy as np
+
+    # Files are named by the pass rather than the output, whose name includes
+    # the creation time, so that a re-run granule replaces its own files.
+    try:
+        granule = pass_of(nc_file)[0]
+    except ValueError:
+        granule = path.splitext(path.basename(nc_file))[0]
+    row_count = table['time'].size
+    table['satellite'] = np.array([satellite] * row_count)
+    table['granule'] = np.array([granule] * row_count)
+    table['region'] = np.array(['' if region is None else region] * row_count)
+
+    # Split the rows by the date of each FOR
+    day_us = 86400 * 1000000
+    days = table['time'] // day_us
+
+    files_written = []
+    for day in np.unique(days):
+        date_obj = EPOCH + timedelta(days=int(day))
+        rows = days == day
+        out_dir = partition_dir(export_dir, date_obj, satellite)
+        if not path.isdir(out_dir):
+            try:
+                os.makedirs(out_dir)
+            except OSError:
+                if not path.isdir(out_dir):
+                    raise
+
+        # Write under a temporary name, so readers never see a partial file
+        suffix = FORMAT_SUFFIXES[export_format]
+        out_file = path.join(out_dir, granule + suffix)
+        tmp_file = path.join(out_dir, '.{}.{}.part{}'.format(granule, os.getpid(), suffix))
+        try:
+            _WRITERS[export_format](dict([(name, data[rows]) for name, data in table.items()]),
+                                    tmp_file)
+            os.rename(tmp_file, out_file)
+        except Exception:
+            if path.exists(tmp_file):
+                os.unlink(tmp_file)
+            raise
+
+        files_written.append(out_file)
+        LOG.debug('Exported {} FORs of {} to {}'.format(int(rows.sum()), nc_file, out_file))
+
+    return files_written
+
+
+def partition_files(export_dir, start_date=None, end_date=None, satellites=None):
+    '''
+    Return the exported files in the partitions of export_dir between the
+    dates start_date and end_date (inclusive, None for no limit) and for the
+    given satellites (None for all), reading only those partition directories.
+    '''
+    files = []
+    for date_dir in sorted(glob.glob(path.join(export_dir, 'date=*'))):
+        try:
+            date_obj = datetime.strptime(path.basename(date_dir)[5:], '%Y-%m-%d').date()
+        except ValueError:
+            continue
+        if start_date is not None and date_obj < start_date:
+            continue
+        if end_date is not None and date_obj > end_date:
+            continue
+        for sat_dir in sorted(glob.glob(path.join(date_dir, 'satellite=*'))):
+            if satellites is not None and path.basename(sat_dir)[10:] not in satellites:
+                continue
+            files.extend(sorted([x for x in glob.glob(path.join(sat_dir, '*'))
+                                 if not path.basename(x).startswith('.')]))
+    return files
+
+
+def read_npz_partitions(export_dir, columns, start_date=None, end_date=None, satellites=None):
+    '''
+    Return the given columns of the .npz exports in the selected partitions
+    (see partition_files()), concatenated, as a dictionary of numpy arrays.
+    Only the requested columns are decompressed.
+    '''
+    import numpy as np
+
+    parts = dict([(name, []) for name in columns])
+    for file_name in partition_files(export_dir, start_date, end_date, satellites):
+        if not file_name.endswith(FORMAT_SUFFIXES['npz']):
+            continue
+        npz_obj = np.load(file_name)
+        try:
+            for name in columns:
+                parts[name].append(npz_obj[name])
+        finally:
+            npz_obj.close()
+
+    return dict([(name, np.concatenate(parts[name]) if parts[name] else np.array([]))
+                 for name in columns])
+
+
+def export_outputs(options, Level1D_obj, granule_dict):
+    '''
+    Export the outputs of a processed granule (each region's, with regions) to
+    options.export_dir. A failed export is logged, but doesn't fail the granule.
+    '''
+    outputs = []
+    if granule_dict.get('regions'):
+        for name, region_dict in sorted(granule_dict['regions'].items()):
+            if region_dict['error'] is None:
+                outputs.append((region_dict['output_file'], name))
+    elif granule_dict.get('output_file') is not None:
+        outputs.append((granule_dict['output_file'], None))
+
+    for output_file, region in outputs:
+        try:
+            export_granule(output_file, options.export_dir, options.satellite,
+                           Level1D_obj.timeObj_start, Level1D_obj.timeObj_end, region,
+                           options.export_format)
+        except Exception, err:
+            LOG.warn('Unable to export {}: {}'.format(output_file, str(err)))
+            LOG.debug(traceback.format_exc())
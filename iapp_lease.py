@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+iapp_lease.py
+
+Purpose: Share the granules of a batch between several IAPP processes, on one
+         or more nodes, through lease files in a directory on a shared
+         filesystem.
+
+A process claims a granule by creating <lease_dir>/<granule>.lease, and works
+on the granule only if the claim succeeds. The lease file is written under a
+unique temporary name and hard linked to the lease name, which is atomic even
+on NFS, where O_EXCL may not be. While the granule is processed, a background
+thread refreshes the modification time of the lease every heartbeat seconds.
+A lease which hasn't been refreshed for lease_timeout seconds belongs to a
+process which has died, and may be reclaimed by another. When a granule is
+finished, the lease is replaced by <granule>.done, recording the outcome, so
+that no other process runs it again. claimed() claims the granules of a
+batch in turn, and once the batch is exhausted, waits for those held by other
+workers, so that a granule whose worker dies is reclaimed rather than left
+unprocessed.
+
+Granules are identified by their base names, so the nodes may mount the input
+tree at different paths.
+
+Copyright (c) 2014 University of Wisconsin Regents.
+Licensed under GNU GPLv3.
+"""
+
+import os
+import json
+import errno
+import socket
+import logging
+import traceback
+from os import path
+from time import time, sleep
+from threading import Thread, Event, Lock
+
+LOG = logging.getLogger(__name__)
+
+LEASE_SUFFIX = '.lease'
+DONE_SUFFIX = '.done'
+
+
+def default_worker_id():
+    '''A worker id which is unique across the nodes: the host name and pid.'''
+    return "{}-{}".format(socket.gethostname().split('.')[0], os.getpid())
+
+
+class LeaseManager(object):
+    '''
+    Claims granules through lease files in lease_dir.
+
+    worker_id:     the name of this worker, recorded in its leases.
+    lease_timeout: seconds after the last heartbeat at which a lease expires.
+    heartbeat:     seconds between refreshes of the held leases.
+    '''
+
+    def __init__(self, lease_dir, worker_id=None, lease_timeout=600., heartbeat=60.):
+        self.lease_dir = path.abspath(lease_dir)
+        self.worker_id = default_worker_id() if worker_id is None else worker_id
+        self.lease_timeout = lease_timeout
+        self.heartbeat = heartbeat
+
+        try:
+            os.makedirs(self.lease_dir)
+        except OSError, err:
+            if err.errno != errno.EEXIST:
+                raise
+
+        self._held = set()
+        self._lock = Lock()
+        self._stop = Event()
+        self._thread = Thread(target=self._heartbeat, name='LeaseHeartbeat')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _lease_file(self, l1d_file):
+        return path.join(self.lease_dir, path.basename(l1d_file) + LEASE_SUFFIX)
+
+    def _done_file(self, l1d_file):
+        return path.join(self.lease_dir, path.basename(l1d_file) + DONE_SUFFIX)
+
+    def _write_unique(self, record):
+        '''Write record as JSON to a new file with a unique name, returning the name.'''
+        tmp_file = path.join(self.lease_dir, '.{}.{}.{}.part'.format(
+            self.worker_id, os.getpid(), int(time() * 1e6)))
+        tmp_obj = open(tmp_file, 'w')
+        json.dump(record, tmp_obj)
+        tmp_obj.close()
+        return tmp_file
+
+    def _is_expired(self, lease_file):
+        try:
+            return time() - os.stat(lease_file).st_mtime > self.lease_timeout
+        except OSError:
+            return False
+
+    def _reclaim(self, lease_file):
+        '''
+        Remove the expired lease_file, returning True if this worker removed
+        it. Renaming is atomic, so only one worker can reclaim a lease.
+        '''
+        stale_file = '{}.{}.stale'.format(lease_file, self.worker_id)
+        try:
+            os.rename(lease_file, stale_file)
+        except OSError:
+            return False
+
+        # Another worker may have reclaimed and renewed the lease since it was
+        # found to be expired; if so, put it back.
+        if not self._is_expired(stale_file):
+            try:
+                os.link(stale_file, lease_file)
+            except OSError:
+                pass
+            os.unlink(stale_file)
+            return False
+
+        try:
+            stale_obj = open(stale_file, 'r')
+            LOG.warn("Reclaiming the expired lease {} of {}".format(
+                path.basename(lease_file), json.load(stale_obj).get('worker')))
+            stale_obj.close()
+        except (IOError, ValueError):
+            LOG.debug(traceback.format_exc())
+        os.unlink(stale_file)
+
+        return True
+
+    def is_done(self, l1d_file):
+        '''Return True if l1d_file has been processed by any worker.'''
+        return path.exists(self._done_file(l1d_file))
+
+    def claim(self, l1d_file):
+        '''Return True if this worker now holds the lease on l1d_file.'''
+        lease_file = self._lease_file(l1d_file)
+        done_file = self._done_file(l1d_file)
+
+        if self.is_done(l1d_file):
+            LOG.debug("{} has already been processed".format(l1d_file))
+            return False
+
+        if path.exists(lease_file):
+            if not self._is_expired(lease_file) or not self._reclaim(lease_file):
+                LOG.debug("{} is claimed by another worker".format(l1d_file))
+                return False
+
+        tmp_file = self._write_unique({'worker': self.worker_id,
+                                       'input_file': path.abspath(l1d_file),
+                                       'claimed': time()})
+        try:
+            os.link(tmp_file, lease_file)
+        except OSError, err:
+            if err.errno != errno.EEXIST:
+                raise
+            LOG.debug("{} was claimed by another worker".format(l1d_file))
+            return False
+        finally:
+            os.unlink(tmp_file)
+
+        # The granule may have been finished between the checks and the claim
+        if path.exists(done_file):
+            os.unlink(lease_file)
+            return False
+
+        with self._lock:
+            self._held.add(lease_file)
+        LOG.debug("Claimed {}".format(lease_file))
+
+        return True
+
+    def claimed(self, l1d_files, poll=None):
+        '''
+        Yield the files of the iterable l1d_files which this worker claims.
+        Files held by other workers are tried again, every poll seconds (the
+        heartbeat by default) once l1d_files is exhausted, until each has been
+        processed or is claimed here, e.g. after its lease expired.
+        '''
+        poll = self.heartbeat if poll is None else poll
+
+        held_elsewhere = []
+        for l1d_file in l1d_files:
+            if self.claim(l1d_file):
+                yield l1d_file
+            elif not self.is_done(l1d_file):
+                held_elsewhere.append(l1d_file)
+
+        waiting_count = 0
+        while held_elsewhere:
+            if len(held_elsewhere) != waiting_count:
+                waiting_count = len(held_elsewhere)
+                LOG.info("Waiting for {} granules held by other workers...".format(waiting_count))
+            sleep(poll)
+            waiting = []
+            for l1d_file in held_elsewhere:
+                if self.claim(l1d_file):
+                    yield l1d_file
+                elif not self.is_done(l1d_file):
+                    waiting.append(l1d_file)
+            held_elsewhere = waiting
+
+    def finish(self, l1d_file, status):
+        '''Record that l1d_file has been processed, with status, and drop its lease.'''
+        lease_file = self._lease_file(l1d_file)
+        with self._lock:
+            self._held.discard(lease_file)
+
+        tmp_file = self._write_unique({'worker': self.worker_id,
+                                       'input_file': path.abspath(l1d_file),
+                                       'status': status,
+                                       'finished': time()})
+        os.rename(tmp_file, self._done_file(l1d_file))
+
+        try:
+            os.unlink(lease_file)
+        except OSError:
+            pass
+
+    def release(self, l1d_file):
+        '''Drop the lease on l1d_file without finishing it, so it may be claimed again.'''
+        lease_file = self._lease_file(l1d_file)
+        with self._lock:
+            self._held.discard(lease_file)
+        try:
+            os.unlink(lease_file)
+        except OSError:
+            pass
+
+    def _heartbeat(self):
+        while not self._stop.wait(self.heartbeat):
+            with self._lock:
+                held = list(self._held)
+            for lease_file in held:
+                try:
+                    os.utime(lease_file, None)
+                except OSError:
+                    LOG.warn("Lost the lease {}, another worker may be processing it"
+                             .format(path.basename(lease_file)))
+                    with self._lock:
+                        self._held.discard(lease_file)
+
+    def close(self):
+        '''Stop the heartbeat, releasing any leases still held.'''
+        self._stop.set()
+        self._thread.join()
+        with self._lock:
+            held = list(self._held)
+            self._held.clear()
+        for lease_file in held:
+            try:
+                os.unlink(lease_file)
+            except OSError:
+                pass
@@ -41,28 +41,46 @@ Copyright (c) 2014-2014 University of Wisconsin Regents. All rights reserved.
 
 import os
 import sys
+import errno
 import logging
 import traceback
 from os import path, environ
 import struct
 import shlex
 import subprocess
-from shutil import rmtree, move
-from glob import glob
+from shutil import rmtree, move, copyfile
 from time import time, sleep
 from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
 
 from iapp_utils import sh, env, execute_binary_captured_inject_io
 from iapp_utils import check_and_convert_path, check_existing_env_var
 from iapp_utils import CsppEnvironment, check_and_convert_env_var
-from iapp_utils import CSPP_RT_HOME, CSPP_RT_ANC_PATH, CSPP_RT_ANC_CACHE_DIR
-from iapp_utils import IAPP_HOME
+from iapp_utils import IappError, AncillaryError, IappCrash, RetrievalProblem, InvalidLevel1D
+from iapp_utils import get_config, publish_file
+
+from iapp_cleanup import CleanupWorker, WRECKAGE_SUFFIXES, TRASH_DIR_NAME
+from iapp_lease import LeaseManager, default_worker_id
+from iapp_limits import resource_limits, get_memory_admission, GIB
+from iapp_affinity import get_cpu_allocator, PIN_MODES
+from iapp_export import export_outputs, EXPORT_FORMATS
+from iapp_composite import composite_outputs
+from iapp_overlap import OverlapFilter, trim_level1d, DEDUP_MODES
+from iapp_stitch import stitch_inputs
+from iapp_qa import compute_qa_summary, write_qa_sidecar, qa_sidecar_name, read_qa_sidecar
+from iapp_diagnostics import DiagnosticParser, write_diagnostics_sidecar, diagnostics_sidecar_name
+from iapp_store import get_result_store, inputs_digest, result_key, copy_file
+from iapp_scheduler import GranuleScheduler, SCHEDULE_POLICIES
+from iapp_validate import validate_level1d, check_level1d_size, VALIDATION_MODES, HEADER_SIZE
+from iapp_compression import compression_of, open_compressed, decompress_file
+from iapp_discovery import FileFilter, discover_files, DEFAULT_INCLUDE
 
 from ANC import retrieve_NCEP_grib_files, transcode_NCEP_grib_files
-#from ANC import retrieve_METAR_files, transcode_METAR_files
+from ANC import retrieve_METAR_files, transcode_METAR_files
+from ANC import retrieve_radiosonde_file, transcode_radiosonde_file
 
 # every module should have a LOG object
-from iapp_utils import configure_logging
+from iapp_utils import configure_logging, set_log_context, add_context_log_file
 LOG = logging.getLogger(__name__)
 
 ###################################################
@@ -72,42 +90,92 @@ LOG = logging.getLogger(__name__)
 environ['TZ'] = 'UTC'
 hexPat = '[\\dA-Fa-f]'
 
-
-def create_hirs_file_list(options):
+# Default values of the processing options, shared by the command line and the
+# embeddable API in iapp_pipeline.py
+DEFAULT_OPTIONS = {'work_dir': '.',
+                   'topography_file': 'topography.nc',
+                   'forecast_model_file': None,
+                   'surface_obsv_file': None,
+                   'radiosonde_data_file': None,
+                   'radiosonde_dir': None,
+                   'radiosonde_window': 10800.,
+                   'retrieval_method': 1,
+                   'print_retrieval': False,
+                   'print_l1d_header': False,
+                   'instrument_combo': 4,
+                   'lower_latitude': 0.,
+                   'upper_latitude': 0.,
+                   'left_longitude': 0.,
+                   'right_longitude': 0.,
+                   'scratch_dir': None,
+                   'keep_wreckage': None,
+                   'min_free_space': None,
+                   'schedule': 'name',
+                   'latency_budget': 3600.,
+                   'realtime_window': None,
+                   'scanline_timeout': None,
+                   'min_timeout': 300.,
+                   'stall_timeout': None,
+                   'max_retries': 0,
+                   'fallback_instrument_combo': None,
+                   'validate_l1d': 'reject',
+                   'l1d_record_length': None,
+                   'result_store': None,
+                   'result_store_size': 10.,
+                   'lease_dir': None,
+                   'worker_id': None,
+                   'lease_timeout': 600.,
+                   'lease_heartbeat': 60.,
+                   'regions': None,
+                   'manifest': None,
+                   'recursive': False,
+                   'include': None,
+                   'exclude': None,
+                   'start_time': None,
+                   'end_time': None,
+                   'region_workers': None,
+                   'limit_memory': None,
+                   'limit_cpu': None,
+                   'limit_core': None,
+                   'limit_files': None,
+                   'run_memory': None,
+                   'admission_timeout': 1800.,
+                   'pin_cpus': 'none',
+                   'export_dir': None,
+                   'export_format': None,
+                   'composite_dir': None,
+                   'dedup': 'none',
+                   'dedup_scanline_times': False,
+                   'overlap_tolerance': 3.,
+                   'min_new_scanlines': 10,
+                   'stitch_segments': False,
+                   'max_segment_gap': 20.,
+                   'cpus_per_run': 1,
+                   'async_logging': False,
+                   'cspp_debug': False
+                   }
+
+
+def iter_hirs_files(options):
     '''
-    Takes the input file glob and creates a list of channel-1 area files
+    Yield the level-1D files given by the input files/directories and
+    manifests, as they are found, selected by the include/exclude patterns and
+    time range.
     '''
-    # TODO: Add listing of all area files associated with primary area file.
-    inputs = options.input_file
-    hirs_files = []
-
-    for input in inputs:
-
-        input = os.path.abspath(os.path.expanduser(input))
+    file_filter = FileFilter(include=options.include, exclude=options.exclude,
+                             start_time=options.start_time, end_time=options.end_time,
+                             header_func=Level1D)
 
-        LOG.debug("input = {}".format(input))
+    return discover_files(options.input_file, manifests=options.manifest,
+                          recursive=options.recursive, file_filter=file_filter)
 
-        # Construct a general file glob for the input hirs files.
-        hirs_glob = '*.l1d'
-
-        if os.path.isdir(input):
-            # Input file glob is of form "/path/to/files"
-            LOG.debug("Input {} is a directory containing the files...".format(input))
-            hirs_glob = os.path.join(input, hirs_glob)
-            temp_hirs_files = glob(hirs_glob)
-            temp_hirs_files.sort()
-            hirs_files = hirs_files + temp_hirs_files
-            for files in temp_hirs_files:
-                LOG.debug("\tfile: {}".format(files))
-
-        elif os.path.isfile(input):
-            # Input file glob is of form "/path/to/files/hirsl1d*.l1d"
-            LOG.debug("Input {} is a file.".format(input))
-            hirs_files.append(input)
-        else:
-            LOG.warn("The input {} is neither a file or a directory".format(input))
 
-    hirs_files = list(set(hirs_files))
+def create_hirs_file_list(options):
+    '''
+    Takes the input files/directories and manifests, and creates a sorted list
+    of the level-1D files.
+    '''
+    hirs_files = list(iter_hirs_files(options))
     hirs_files.sort()
 
     return hirs_files
@@ -133,18 +201,30 @@ def cleanup(objs_to_remove):
             LOG.warn(traceback.format_exc())
 
 
-def __crash_cleanup(work_dir):
+def _move_run_dir(run_dir, wreckage_dir):
+    '''
+    Rename the run directory, copying it if it is on another filesystem (e.g.
+    moving wreckage from a scratch disk back to the work directory).
+    '''
+    if path.dirname(run_dir) == path.dirname(wreckage_dir):
+        os.rename(run_dir, wreckage_dir)
+    else:
+        move(run_dir, wreckage_dir)
+
+
+def __crash_cleanup(work_dir, dest_dir=None):
     '''
-    After a crash, rename the run directory.
+    After a crash, rename the run directory, placing it in dest_dir if given.
     '''
 
     # Create a log directory to contain the wreckage...
-    wreckage_dir = "{}_crashed".format(work_dir)
+    wreckage_dir = path.join(dest_dir or path.dirname(work_dir),
+                             "{}_crashed".format(path.basename(work_dir)))
     LOG.warn('There was a problem running IAPP, moving run files to {}'.format(wreckage_dir))
 
     ret_val = 0
     try:
-        os.rename(work_dir, wreckage_dir)
+        _move_run_dir(work_dir, wreckage_dir)
     except Exception, err:
         LOG.warn("{}".format(str(err)))
         ret_val = 1
@@ -152,18 +232,19 @@ def __crash_cleanup(work_dir):
     return ret_val
 
 
-def __debug_cleanup(work_dir):
+def __debug_cleanup(work_dir, dest_dir=None):
     '''
-    In debug mode, rename the run directory.
+    In debug mode, rename the run directory, placing it in dest_dir if given.
     '''
 
     # Create a log directory to contain the wreckage...
-    wreckage_dir = "{}_debug".format(work_dir)
+    wreckage_dir = path.join(dest_dir or path.dirname(work_dir),
+                             "{}_debug".format(path.basename(work_dir)))
     LOG.info('Debugging mode, moving run files to {}'.format(wreckage_dir))
 
     ret_val = 0
     try:
-        os.rename(work_dir, wreckage_dir)
+        _move_run_dir(work_dir, wreckage_dir)
     except Exception, err:
         LOG.warn("{}".format(str(err)))
         ret_val = 1
@@ -267,8 +348,9 @@ class Level1D():
         self.header_field_size['ATOVPP_Version_Number'] = 4
         self.header_field_size['Instruments'] = 4
 
-        # Open the data file for reading
-        self.file_obj = open(file_name, 'rb')
+        # Open the data file for reading, decompressing just the header if the
+        # file is compressed
+        self.file_obj = open_compressed(file_name)
 
         self.header_field_data = {}
 
@@ -296,15 +378,24 @@ class Level1D():
     def read_header(self, datasets, format_str):
         ''' Sequentially reads binary chunks from the data file.'''
 
+        # Headers are read for every file found, so skip formatting the fields
+        # unless they will be logged.
+        debug_enabled = LOG.isEnabledFor(logging.DEBUG)
+
         for dataset in datasets:
             data = self.file_obj.read(self.header_field_size[dataset])
+            if len(data) != self.header_field_size[dataset]:
+                self.file_obj.close()
+                raise InvalidLevel1D('{} is shorter than the {} byte level-1D header'
+                                     .format(self.input_file, HEADER_SIZE))
 
             # Only unpack non-char data.
             if format_str is not None:
                 data = struct.unpack(format_str, data)[0]
 
             self.header_field_data[dataset] = data
-            LOG.debug("{} : {}".format(self.header_field_comments[dataset], self.header_field_data[dataset]))
+            if debug_enabled:
+                LOG.debug("{} : {}".format(self.header_field_comments[dataset], data))
 
         return data
 
@@ -404,7 +495,7 @@ def check_exe(exeName):
     except CalledProcessError:
         LOG.error("Required executable {} is not in the path or is not installed, aborting."
                   .format(exeName))
-        sys.exit(1)
+        raise CsppEnvironment("Required executable {} is not in the path".format(exeName))
 
 
 def link_run_files(files_to_link, work_dir):
@@ -437,14 +528,19 @@ def link_run_files(files_to_link, work_dir):
 def link_iapp_coeffs(work_dir):
     '''Link the IAPP coefficients dir into the dir above the work dir'''
 
-    IAPP_COEFFS_DIR = path.abspath(path.join(IAPP_HOME, 'iapp', 'iapp_coefs'))
+    IAPP_COEFFS_DIR = path.abspath(path.join(get_config().IAPP_HOME, 'iapp', 'iapp_coefs'))
     LOCAL_COEFFS_DIR = path.abspath(path.join(path.dirname(work_dir), 'iapp_coefs'))
     LOG.debug("Remote IAPP coeffs directory: {}".format(IAPP_COEFFS_DIR))
     LOG.debug("Local IAPP coeffs directory: {}".format(LOCAL_COEFFS_DIR))
 
     if not path.exists(LOCAL_COEFFS_DIR):
         LOG.debug("Creating the link {} -> {}".format(LOCAL_COEFFS_DIR, IAPP_COEFFS_DIR))
-        os.symlink(IAPP_COEFFS_DIR, LOCAL_COEFFS_DIR)
+        try:
+            os.symlink(IAPP_COEFFS_DIR, LOCAL_COEFFS_DIR)
+        except OSError, err:
+            # Another process may have created it first
+            if err.errno != errno.EEXIST:
+                raise
     else:
         LOG.debug('{} already exists; continuing'.format(LOCAL_COEFFS_DIR))
 
@@ -454,8 +550,9 @@ def link_iapp_coeffs(work_dir):
 def create_retrieval_netcdf_template(work_dir):
     '''Create the template NetCDF file uwretrievals.nc'''
 
-    NCGEN_PATH = path.abspath(path.join(CSPP_RT_HOME, 'common', 'ShellB3', 'bin'))
-    CDL_FILES_PATH = path.abspath(path.join(IAPP_HOME, 'iapp', 'cdlfiles'))
+    config = get_config()
+    NCGEN_PATH = path.abspath(path.join(config.CSPP_RT_HOME, 'common', 'ShellB3', 'bin'))
+    CDL_FILES_PATH = path.abspath(path.join(config.IAPP_HOME, 'iapp', 'cdlfiles'))
 
     # Check that we have access to the NetCDF generation exe...
     scriptPath = "{}/ncgen".format(NCGEN_PATH)
@@ -485,7 +582,7 @@ def create_retrieval_netcdf_template(work_dir):
 
         procRetVal = 0
         procObj = subprocess.Popen(args,
-                                   env=env(CSPP_RT_HOME=CSPP_RT_HOME, NCGEN_PATH=NCGEN_PATH),
+                                   env=env(CSPP_RT_HOME=config.CSPP_RT_HOME, NCGEN_PATH=NCGEN_PATH),
                                    bufsize=0, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
         procObj.wait()
         procRetVal = procObj.returncode
@@ -521,28 +618,116 @@ def create_retrieval_netcdf_template(work_dir):
     return 0
 
 
-def run_iapp_exe(options, Level1D_obj, work_dir, run_dir):
-    '''Run the IAPP executable'''
+def iapp_timeout(options, Level1D_obj):
+    '''
+    The wall-clock time limit of iapp_main for a granule, in seconds: the
+    scanline timeout times the number of scanlines, but no less than the minimum
+    timeout. Returns None if there is no limit.
+    '''
+    if options.scanline_timeout is None:
+        return None
+
+    scanlines = Level1D_obj.header_field_data['Number_of_Scanlines']
+
+    return max(options.min_timeout, options.scanline_timeout * scanlines)
+
+
+def iapp_output_name(options, Level1D_obj, region=None):
+    '''
+    The name of the IAPP output file for a pass, stamped with the current time.
+    If region is given, its name is included.
+    '''
+    timeObj = Level1D_obj.timeObj_start
+    dateStamp = timeObj.strftime("%Y%m%d")
+    seconds = repr(int(round(timeObj.second + float(timeObj.microsecond) / 1000000.)))
+    deciSeconds = int(round(float(timeObj.microsecond) / 100000.))
+    deciSeconds = repr(0 if deciSeconds > 9 else deciSeconds)
+    startTimeStamp = "%s%s" % (timeObj.strftime("%H%M%S"), deciSeconds)
+
+    timeObj = Level1D_obj.timeObj_end
+    seconds = repr(int(round(timeObj.second + float(timeObj.microsecond) / 1000000.)))
+    deciSeconds = int(round(float(timeObj.microsecond) / 100000.))
+    deciSeconds = repr(0 if deciSeconds > 9 else deciSeconds)
+    endTimeStamp = "%s%s" % (timeObj.strftime("%H%M%S"), deciSeconds)
+
+    timeObj = datetime.utcnow()
+    creationTimeStamp = timeObj.strftime("%Y%m%d%H%M%S%f")
+
+    return "{}_L2_d{}_t{}_e{}_c{}{}_iapp.nc".format(
+        options.satellite,
+        dateStamp,
+        startTimeStamp,
+        endTimeStamp,
+        creationTimeStamp,
+        "" if region is None else "_{}".format(region))
+
+
+def reuse_stored_result(options, Level1D_obj, work_dir, meta, region=None):
+    '''
+    Materialize a stored IAPP output (see iapp_store) in work_dir, under a new
+    creation stamp, returning the output file and an rc_dict like that of
+    run_iapp_exe(). Raises IOError/OSError if the stored result has gone, e.g.
+    evicted by another process since it was looked up.
+    '''
+    iapp_retrieval_netcdf = path.join(work_dir, iapp_output_name(options, Level1D_obj, region))
+    LOG.info('Reusing the stored output {} for identical inputs and options'
+             .format(meta['output_file']))
+
+    # Write the QA sidecar before the output file appears in the work dir
+    qa_file = None
+    qa_dict = read_qa_sidecar(meta['output_file'])
+    if qa_dict is not None:
+        qa_dict['file'] = path.basename(iapp_retrieval_netcdf)
+        qa_dict['input_file'] = Level1D_obj.input_file
+        qa_file = write_qa_sidecar(qa_dict, qa_sidecar_name(iapp_retrieval_netcdf))
+
+    try:
+        copy_file(meta['output_file'], iapp_retrieval_netcdf)
+    except (IOError, OSError):
+        if qa_file is not None and path.exists(qa_file):
+            os.unlink(qa_file)
+        raise
+
+    rc_dict = {'rc_iapp':0, 'rc_no_retrievals':0,
+               'qa_file':qa_file, 'qa_summary':qa_dict, 'killed':None,
+               'elapsed':0., 'reused':meta['output_file'], 'attempts':[],
+               'diag_file':None, 'diagnostics':None}
+
+    return iapp_retrieval_netcdf, rc_dict
+
+
+def run_iapp_exe(options, Level1D_obj, work_dir, run_dir, region=None):
+    '''
+    Run the IAPP executable. If region is given, its name is included in the
+    name of the output file. The output is left in run_dir, to be published
+    with publish_iapp_output(); returns the name it is to be published under,
+    the rc_dict, and the DiagnosticParser of the run.
+    '''
 
-    IAPP_EXE_PATH = path.abspath(path.join(IAPP_HOME, 'iapp', 'bin'))
+    config = get_config()
+    IAPP_EXE_PATH = path.abspath(path.join(config.IAPP_HOME, 'iapp', 'bin'))
 
     # Check that we have access to the IAPP main exe...
     scriptPath = "{}/iapp_main".format(IAPP_EXE_PATH)
     if not path.exists(scriptPath):
         LOG.error('{} can not be found, aborting.'.format(scriptPath))
-        sys.exit(1)
+        raise CsppEnvironment('{} can not be found'.format(scriptPath))
 
     netcdf_template_file = '{}/uwretrievals.nc'.format(run_dir)
     if not path.exists(netcdf_template_file):
         LOG.error('{} can not be found, aborting.'.format(netcdf_template_file))
-        sys.exit(1)
+        raise IappError('{} can not be found'.format(netcdf_template_file))
+
+    rc_iapp = -1
+    killed = None
+
+    # Collects the data quality messages from the iapp_main output as it runs
+    diagnostic_parser = DiagnosticParser()
 
     # Get the size of the template file
     template_size = os.stat(netcdf_template_file).st_size
     LOG.debug("Size of uwretrievals.nc is {}".format(template_size))
 
-    current_dir = os.getcwd()
-
     t1 = time()
 
     try:
@@ -573,12 +758,34 @@ def run_iapp_exe(options, Level1D_obj, work_dir, run_dir):
                 'max_count':5,
                 'log_str':'{} AMSU-A fields of regard failed data quality check.'}
 
-        os.chdir(run_dir)
-        env_vars = {'CSPP_RT_HOME':CSPP_RT_HOME, 'IAPP_EXE_PATH':IAPP_EXE_PATH}
-        rc_iapp, exe_out = execute_binary_captured_inject_io(
-                run_dir, cmdStr, error_dict,
-                log_execution=False, log_stdout=False, log_stderr=False,
-                **env_vars)
+        timeout = iapp_timeout(options, Level1D_obj)
+        if timeout is not None or options.stall_timeout is not None:
+            LOG.debug("iapp_main timeout = {} s, stall timeout = {} s".format(
+                timeout, options.stall_timeout))
+
+        # Pin iapp_main to CPUs of a single NUMA node
+        cpu_allocator = None
+        cpu_claim = None
+        if options.pin_cpus != 'none':
+            cpu_allocator = get_cpu_allocator(options.pin_cpus, options.cpus_per_run)
+            cpu_claim = cpu_allocator.acquire()
+            if cpu_claim is not None:
+                LOG.debug("Pinning iapp_main to CPUs {} of NUMA node {}"
+                          .format(cpu_claim.cpus, cpu_claim.node))
+
+        env_vars = {'CSPP_RT_HOME':config.CSPP_RT_HOME, 'IAPP_EXE_PATH':IAPP_EXE_PATH}
+        try:
+            rc_iapp, exe_out = execute_binary_captured_inject_io(
+                    run_dir, cmdStr, error_dict,
+                    log_execution=False, log_stdout=False, log_stderr=False,
+                    timeout=timeout, stall_timeout=options.stall_timeout,
+                    line_func=diagnostic_parser.feed, rlimits=resource_limits(options),
+                    cpus=None if cpu_claim is None else cpu_claim.cpus,
+                    **env_vars)
+        finally:
+            if cpu_allocator is not None:
+                cpu_allocator.release(cpu_claim)
+        killed = error_dict['killed']
 
         for error_key in ['Bad_HIRS_Data','Bad_AMSUA_Data']:
             msg_count = error_dict[error_key]['count']
@@ -593,12 +800,16 @@ def run_iapp_exe(options, Level1D_obj, work_dir, run_dir):
         logpath = path.join(run_dir, logname)
         logfile_obj = open(logpath, 'w')
 
-        for line in exe_out.splitlines():
-            logfile_obj.write(line+"\n")
+        logfile_obj.write(exe_out)
+        if exe_out and not exe_out.endswith("\n"):
+            logfile_obj.write("\n")
 
         logfile_obj.close()
 
-        os.chdir(current_dir)
+        # Publish the log to the work dir, if running on scratch.
+        if path.dirname(logpath) != work_dir:
+            publish_file(logpath, path.join(work_dir, path.basename(logpath)))
+
 
     except Exception, err:
         LOG.warn("{}".format(str(err)))
@@ -607,61 +818,74 @@ def run_iapp_exe(options, Level1D_obj, work_dir, run_dir):
     t2 = time()
     LOG.info("iapp_main ran in {} seconds.".format(t2 - t1))
 
-    # Rename the output NetCDF file
-    timeObj = Level1D_obj.timeObj_start
-    dateStamp = timeObj.strftime("%Y%m%d")
-    seconds = repr(int(round(timeObj.second + float(timeObj.microsecond) / 1000000.)))
-    deciSeconds = int(round(float(timeObj.microsecond) / 100000.))
-    deciSeconds = repr(0 if deciSeconds > 9 else deciSeconds)
-    startTimeStamp = "%s%s" % (timeObj.strftime("%H%M%S"), deciSeconds)
+    # The name of the output NetCDF file
+    iapp_retrieval_netcdf = path.join(work_dir, iapp_output_name(options, Level1D_obj, region))
 
-    timeObj = Level1D_obj.timeObj_end
-    seconds = repr(int(round(timeObj.second + float(timeObj.microsecond) / 1000000.)))
-    deciSeconds = int(round(float(timeObj.microsecond) / 100000.))
-    deciSeconds = repr(0 if deciSeconds > 9 else deciSeconds)
-    endTimeStamp = "%s%s" % (timeObj.strftime("%H%M%S"), deciSeconds)
+    # Summarise the retrievals
+    qa_dict = compute_qa_summary(netcdf_template_file)
+    if qa_dict is not None:
+        qa_dict['file'] = path.basename(iapp_retrieval_netcdf)
+        qa_dict['input_file'] = Level1D_obj.input_file
+        qa_dict['satellite'] = options.satellite
+        qa_dict['rc_iapp'] = rc_iapp
+        LOG.info("{} of {} fields of regard were retrieved.".format(
+            qa_dict['retrieved_for_count'], qa_dict['total_for_count']))
 
-    timeObj = datetime.utcnow()
-    creationTimeStamp = timeObj.strftime("%Y%m%d%H%M%S%f")
+    # Get the size of the retrieval file
+    retrieval_size = os.stat(netcdf_template_file).st_size
+    LOG.debug("Size of {} is {}".format(netcdf_template_file, retrieval_size))
+
+    # Check that there are some retrievals in the output file. Without a QA
+    # summary, fall back to the size: if it is the same as the template,
+    # something failed.
+    rc_no_retrievals = 0
+    if qa_dict is not None:
+        if qa_dict['retrieved_for_count'] == 0:
+            LOG.warning("{} contains no retrieved fields of regard, possible IAPP failure."
+                        .format(iapp_retrieval_netcdf))
+            rc_no_retrievals = 1
+    elif retrieval_size == template_size:
+        LOG.warning("{} has same size ({} bytes) as {}, possible IAPP failure.".format(
+            iapp_retrieval_netcdf, retrieval_size,
+            path.basename(netcdf_template_file)))
+        rc_no_retrievals = 1
 
-    iapp_retrieval_netcdf = "{}_L2_d{}_t{}_e{}_c{}_iapp.nc".format(
-        options.satellite,
-        dateStamp,
-        startTimeStamp,
-        endTimeStamp,
-        creationTimeStamp)
+    rc_dict = {'rc_iapp':rc_iapp, 'rc_no_retrievals':rc_no_retrievals,
+               'qa_file':None, 'qa_summary':qa_dict, 'killed':killed,
+               'elapsed':t2 - t1, 'diag_file':None,
+               'diagnostics':diagnostic_parser.counts()}
 
-    iapp_retrieval_netcdf = path.join(work_dir, path.basename(iapp_retrieval_netcdf))
+    return iapp_retrieval_netcdf, rc_dict, diagnostic_parser
 
-    LOG.debug('Moving {} to {}...'.format(netcdf_template_file, iapp_retrieval_netcdf))
-    move(netcdf_template_file, iapp_retrieval_netcdf)
 
-    # Get the size of the retrieval file
-    retrieval_size = os.stat(iapp_retrieval_netcdf).st_size
-    LOG.debug("Size of {} is {}".format(iapp_retrieval_netcdf, retrieval_size))
+def publish_iapp_output(run_dir, iapp_retrieval_netcdf, rc_dict, diagnostic_parser):
+    '''
+    Publish the output of the last IAPP run in run_dir as iapp_retrieval_netcdf,
+    after its QA and diagnostics sidecars, so that the output appears complete
+    and with its sidecars. Sets the sidecar names in rc_dict.
+    '''
+    netcdf_template_file = '{}/uwretrievals.nc'.format(run_dir)
 
-    # Check the size of the output file. If it has the same size as the template, something failed.
-    rc_retrieval_size = 0
-    if retrieval_size == template_size:
-        LOG.warning("{} has same size ({} bytes) as {}, possible IAPP failure.".format(
-            iapp_retrieval_netcdf, retrieval_size,
-            path.basename(netcdf_template_file)))
-        rc_retrieval_size = 1
+    if rc_dict['qa_summary'] is not None:
+        rc_dict['qa_file'] = write_qa_sidecar(rc_dict['qa_summary'],
+                                              qa_sidecar_name(iapp_retrieval_netcdf))
 
-    rc_dict = {'rc_iapp':rc_iapp, 'rc_retrieval_size':rc_retrieval_size}
+    rc_dict['diag_file'] = write_diagnostics_sidecar(
+        diagnostic_parser, diagnostics_sidecar_name(iapp_retrieval_netcdf), netcdf_template_file)
 
-    return iapp_retrieval_netcdf, rc_dict
+    LOG.debug('Moving {} to {}...'.format(netcdf_template_file, iapp_retrieval_netcdf))
+    publish_file(netcdf_template_file, iapp_retrieval_netcdf)
 
 
 def run_iapp_exe_dummy(options, Level1D_obj, work_dir, run_dir):
     '''Pretend to run the IAPP executable'''
 
-    IAPP_EXE_PATH = path.abspath(path.join(IAPP_HOME, 'iapp', 'bin'))
+    IAPP_EXE_PATH = path.abspath(path.join(get_config().IAPP_HOME, 'iapp', 'bin'))
 
     netcdf_template_file = '{}/uwretrievals.nc'.format(work_dir)
     if not path.exists(netcdf_template_file):
         LOG.error('{} can not be found, aborting.'.format(netcdf_template_file))
-        sys.exit(1)
+        raise IappError('{} can not be found'.format(netcdf_template_file))
 
     # Get the size of the template file
     template_size = os.stat(netcdf_template_file).st_size
@@ -735,184 +959,690 @@ def run_iapp_exe_dummy(options, Level1D_obj, work_dir, run_dir):
     return iapp_retrieval_netcdf
 
 
-def hirs_to_L2(work_dir, options):
+def worker_id(options):
+    '''The name of this worker, when granules are claimed through leases.'''
+    if options.worker_id is not None:
+        return options.worker_id
+    return default_worker_id()
 
-    attempted_runs = []
-    successful_runs = []
-    crashed_runs = []
-    problem_runs = []
 
-    files_to_remove = []
-    #dirs_to_remove = []
-    #files_to_move = []
-    #dirs_to_move = []
+def run_root_dir(work_dir, options):
+    '''
+    The directory in which the run directories are created: the scratch dir if
+    one was given, otherwise the work dir. With leases, each worker has its own
+    directory within that, so that the workers' IAPP coefficient links and run
+    directories are kept apart.
+    '''
+    if options.scratch_dir is None:
+        root_dir = work_dir
+    else:
+        root_dir = path.abspath(path.expanduser(options.scratch_dir))
+
+    if options.lease_dir is not None:
+        root_dir = path.join(root_dir, 'iapp_worker_{}'.format(worker_id(options)))
+
+    return root_dir
+
+
+def format_retrieval_bounds(lower_latitude, upper_latitude, left_longitude, right_longitude):
+    '''The retrieval bounds as written in the IAPP runfile.'''
+    return " {:1.0f}. {:1.0f}. {:1.0f}. {:1.0f}.".format(
+        lower_latitude, upper_latitude, left_longitude, right_longitude)
+
+
+def run_iapp_with_retries(options, Level1D_obj, work_dir, run_dir, template_dict,
+                          region=None, template_file=None, result_store=None,
+                          granule_digest=None):
+    '''
+    Write the runfile and NetCDF template, and run the IAPP executable,
+    retrying if it crashes or is killed. Retries use the fallback instrument
+    combination, if there is one. If template_file is given, it is copied
+    rather than creating the NetCDF template with ncgen. If result_store is
+    given, an output stored for the same granule_digest, template_dict and
+    retry options is reused rather than running IAPP, and a successful output
+    is stored.
+    '''
+    template_dict = dict(template_dict)
+
+    # The key is of the requested settings, since retries change template_dict
+    if result_store is not None:
+        store_key = result_key(granule_digest, dict(
+            template_dict, fallback_instrument_combo=options.fallback_instrument_combo,
+            max_retries=options.max_retries))
+        meta = result_store.lookup(store_key)
+        if meta is not None:
+            try:
+                return reuse_stored_result(options, Level1D_obj, work_dir, meta, region)
+            except (IOError, OSError), err:
+                LOG.warn('Unable to reuse the stored output {}, running IAPP: {}'
+                         .format(meta['output_file'], str(err)))
+                LOG.debug(traceback.format_exc())
+
+    attempts = []
+    for attempt in range(1 + options.max_retries):
+
+        if attempt > 0 and options.fallback_instrument_combo is not None:
+            template_dict['instrument_combo'] = options.fallback_instrument_combo
+
+        generate_iapp_runfile(run_dir, **template_dict)
+
+        # Generate template netcdf retrieval file
+        if template_file is not None:
+            copyfile(template_file, path.join(run_dir, 'uwretrievals.nc'))
+        elif create_retrieval_netcdf_template(run_dir) != 0:
+            raise IappError('There was a problem creating NetCDF template file.')
+
+        # Wait until the run fits in the memory of the node
+        admission = None
+        if options.run_memory is not None:
+            admission = get_memory_admission()
+            reserved = admission.admit(int(options.run_memory * GIB), options.admission_timeout)
+
+        # iapp_retrieval_netcdf = run_iapp_exe_dummy(options, Level1D_obj, work_dir, run_dir)
+        try:
+            iapp_retrieval_netcdf, rc_dict, diagnostic_parser = run_iapp_exe(
+                options, Level1D_obj, work_dir, run_dir, region)
+        finally:
+            if admission is not None:
+                admission.release(reserved)
+        attempts.append({'instrument_combo': template_dict['instrument_combo'],
+                         'rc_iapp': rc_dict['rc_iapp'],
+                         'killed': rc_dict['killed'],
+                         'elapsed': rc_dict['elapsed']})
+        rc_dict['attempts'] = attempts
+
+        if rc_dict['rc_iapp'] == 0 or attempt == options.max_retries:
+            break
+
+        retry_combo = template_dict['instrument_combo']
+        if options.fallback_instrument_combo is not None:
+            retry_combo = options.fallback_instrument_combo
+        LOG.warn("iapp_main failed on attempt {} of {}, retrying with instrument combo {}..."
+                 .format(attempt + 1, 1 + options.max_retries, retry_combo))
+
+        # Only the last attempt is published; keep the output of this one in
+        # the run dir, with the wreckage.
+        attempt_file = path.join(run_dir, 'uwretrievals.attempt{}.nc'.format(attempt + 1))
+        os.rename(path.join(run_dir, 'uwretrievals.nc'), attempt_file)
+
+    publish_iapp_output(run_dir, iapp_retrieval_netcdf, rc_dict, diagnostic_parser)
+
+    if result_store is not None and rc_dict['rc_iapp'] == 0 and rc_dict['killed'] is None \
+            and not rc_dict['rc_no_retrievals']:
+        result_store.insert(store_key,
+                            iapp_retrieval_netcdf, rc_dict['qa_file'],
+                            meta={'input_file': Level1D_obj.input_file,
+                                  'template_dict': template_dict})
+
+    return iapp_retrieval_netcdf, rc_dict
+
+
+def check_iapp_rc(rc_dict, iapp_retrieval_netcdf):
+    '''Raise IappCrash or RetrievalProblem if the IAPP run failed.'''
+    if rc_dict['killed'] in ['memory_limit', 'cpu_limit']:
+        raise IappCrash('iapp_main was stopped by its resource limits ({}).'
+                        .format(rc_dict['killed']))
+    if rc_dict['killed'] is not None:
+        raise IappCrash('iapp_main was killed ({}), possible hang.'.format(rc_dict['killed']))
+    if not rc_dict['rc_iapp'] == 0:
+        raise IappCrash('iapp_main returned a non-zero return value, possible crash.')
+    if rc_dict['rc_no_retrievals']:
+        raise RetrievalProblem('No valid retrievals in {}, possible bad l1d file.'
+                .format(iapp_retrieval_netcdf))
+
+
+def run_regions(options, Level1D_obj, work_dir, run_dir, files_to_link, template_dict,
+                result_store=None, granule_digest=None):
+    '''
+    Run IAPP for each of options.regions concurrently, each in its own
+    directory inside run_dir, sharing the ancillary data, NetCDF template and
+    coefficient link prepared in run_dir. Returns a dictionary, keyed by region
+    name, of dictionaries holding the region run dir, output file, rc_dict and
+    error (None on success).
+    '''
+    # Shared preparation: the NetCDF template and the coefficient link
+    if create_retrieval_netcdf_template(run_dir) != 0:
+        raise IappError('There was a problem creating NetCDF template file.')
+    template_file = path.join(run_dir, 'uwretrievals.nc')
+
+    region_dicts = {}
+    for region in options.regions:
+        name = region[0]
+        region_dir = path.join(run_dir, "{}_{}".format(path.basename(run_dir), name))
+        os.makedirs(region_dir)
+        if not region_dicts:
+            link_iapp_coeffs(region_dir)
+        region_dicts[name] = {'run_dir': region_dir, 'output_file': None,
+                              'rc_dict': {}, 'error': None}
+
+    def _run_region(region):
+        name, lower_latitude, upper_latitude, left_longitude, right_longitude = region
+        region_dict = region_dicts[name]
+        region_dir = region_dict['run_dir']
+
+        # Each region is also logged to a file of its own
+        set_log_context(name)
+        add_context_log_file(name)
+        try:
+            LOG.info('Running IAPP for region {}...'.format(name))
+            region_template_dict = dict(template_dict)
+            region_template_dict.update(link_run_files(dict(files_to_link), region_dir))
+            region_template_dict['retrieval_bounds'] = format_retrieval_bounds(
+                lower_latitude, upper_latitude, left_longitude, right_longitude)
+
+            output_file, rc_dict = run_iapp_with_retries(
+                options, Level1D_obj, work_dir, region_dir, region_template_dict,
+                region=name, template_file=template_file, result_store=result_store,
+                granule_digest=granule_digest)
+            region_dict['output_file'] = output_file
+            region_dict['rc_dict'] = rc_dict
+
+            check_iapp_rc(rc_dict, output_file)
+            LOG.info('IAPP completed successfully for region {}, creating: {}'
+                     .format(name, output_file))
+
+        except Exception, err:
+            LOG.warn("Region {}: {}".format(name, str(err)))
+            LOG.debug(traceback.format_exc())
+            region_dict['error'] = err
+        finally:
+            set_log_context(None)
+
+    workers = options.region_workers or len(options.regions)
+    pool = ThreadPool(min(workers, len(options.regions)))
+    try:
+        pool.map(_run_region, options.regions)
+    finally:
+        pool.close()
+        pool.join()
+
+    return region_dicts
+
+
+def retrieval_bounds(options):
+    '''
+    The retrieval lat/lon bounds as (lat_min, lat_max, lon_min, lon_max), or
+    None if the whole pass is retrieved (all bounds zero).
+    '''
+    bounds = (options.lower_latitude, options.upper_latitude,
+              options.left_longitude, options.right_longitude)
+    if bounds == (0., 0., 0., 0.):
+        return None
 
-    hirs_files = create_hirs_file_list(options)
+    return bounds
 
-    if hirs_files:
 
-        for hirs_file in hirs_files:
+def process_granule(hirs_file, work_dir, options, cleanup_worker=None, trim=None):
+    '''
+    Run IAPP on a single level-1D file, returning a dictionary describing the
+    run. Failures are raised as IappError subclasses (or CsppEnvironment), after
+    the run directory has been renamed to preserve the wreckage. If a
+    CleanupWorker is given, the finished run directory is handed to it rather
+    than being removed before returning. If trim is an OverlapFilter 'trim'
+    decision, only its range of scanlines is processed.
+    '''
 
-            LOG.info("\n\n>>> Processing hirs file {}\n".format(hirs_file))
-            LOG.debug("work_dir = {}".format(work_dir))
+    LOG.info("\n\n>>> Processing hirs file {}\n".format(hirs_file))
+    LOG.debug("work_dir = {}".format(work_dir))
+
+    t1 = time()
+    linked_files = {}
 
-            linked_files = {}
-            cleanup_required = True
-            ret_val = 0
+    # Setting the input dir
+    hirs_dir = os.path.dirname(hirs_file)
+    hirs_file = os.path.basename(hirs_file)
+
+    granule_dict = {'input_file': path.join(hirs_dir, hirs_file),
+                    'run_dir': None,
+                    'output_file': None,
+                    'coeff_dir': None,
+                    'rc_dict': {}}
+
+    # Parse the level 1D file header, and check the structure of the file
+    # before anything expensive is done with it
+    try:
+        Level1D_obj = Level1D(path.join(hirs_dir, hirs_file))
+        granule_dict['Level1D_obj'] = Level1D_obj
+
+        instrument_combo = options.instrument_combo
+        if options.validate_l1d != 'none':
+            instrument_combo = validate_level1d(Level1D_obj.input_file,
+                                                Level1D_obj.header_field_data,
+                                                instrument_combo,
+                                                record_length=options.l1d_record_length,
+                                                auto_combo=(options.validate_l1d == 'auto'))
+        granule_dict['instrument_combo'] = instrument_combo
 
-            # Setting the input dir
-            hirs_dir = os.path.dirname(hirs_file)
-            hirs_file = os.path.basename(hirs_file)
-            attempted_runs.append(hirs_file)
+    except Exception, err:
+        LOG.warn("{}".format(str(err)))
+        LOG.debug(traceback.format_exc())
+        if isinstance(err, IappError):
+            err.granule_dict = granule_dict
+        raise
+
+    # Create the run dir for this area file, on the scratch disk if we have one.
+    # Creating the directory is the atomic test of whether the name is free;
+    # with leases, the worker id keeps the names of the workers apart.
+    run_root = run_root_dir(work_dir, options)
+    if not path.isdir(run_root):
+        try:
+            os.makedirs(run_root)
+        except OSError, err:
+            if err.errno != errno.EEXIST:
+                raise
+    run_prefix = "iapp_l2_{}".format(hirs_file)
+    if options.lease_dir is not None:
+        run_prefix = "{}_{}".format(run_prefix, worker_id(options))
+    log_idx = 0
+    while True:
+        run_name = "{}_run_{}".format(run_prefix, log_idx)
+        run_dir = os.path.join(run_root, run_name)
+        wreckage_dirs = [path.join(work_dir, run_name + suffix) for suffix in WRECKAGE_SUFFIXES]
+        if not filter(path.exists, wreckage_dirs):
+            try:
+                os.mkdir(run_dir)
+                LOG.debug("Created run dir {}".format(run_dir))
+                break
+            except OSError, err:
+                if err.errno != errno.EEXIST:
+                    raise
+                log_idx += 1
+        else:
+            log_idx += 1
 
-            # Create the run dir for this area file
-            log_idx = 0
-            while True:
-                run_dir = os.path.join(work_dir, "iapp_l2_{}_run_{}".format(hirs_file, log_idx))
-                if not os.path.exists(run_dir):
-                    LOG.debug("Creating run dir {}".format(run_dir))
-                    os.makedirs(run_dir)
-                    break
-                else:
-                    log_idx += 1
+    granule_dict['run_dir'] = run_dir
 
-                LOG.debug("doing a thing")
+    try:
 
+        # Decompress a compressed level 1D file into the run dir
+        level1d_file = path.join(hirs_dir, hirs_file)
+        if compression_of(level1d_file) is not None:
             try:
+                level1d_file = decompress_file(level1d_file, run_dir)
+            except (IOError, EOFError), err:
+                raise InvalidLevel1D('Unable to decompress {}: {}'.format(level1d_file, str(err)))
+            if options.validate_l1d != 'none':
+                check_level1d_size(level1d_file, Level1D_obj.header_field_data,
+                                   options.l1d_record_length)
 
-                # Parse the level 1D file header
-                Level1D_obj = Level1D(path.join(hirs_dir, hirs_file))
-
-                if options.print_l1d_header:
-                    return 0
+        # Cut a partly overlapping pass down to its new scanlines
+        if trim is not None:
+            level1d_file = trim_level1d(level1d_file, run_dir, Level1D_obj.header_field_data,
+                                        trim['first'], trim['last'], trim['times'],
+                                        options.l1d_record_length)
+            Level1D_obj = Level1D(level1d_file)
+            granule_dict['Level1D_obj'] = Level1D_obj
 
-                # Specify the GRIB1 GDAS/GFS ancillary file
-                if options.forecast_model_file is None:
+        # Specify the GRIB1 GDAS/GFS ancillary file
+        if options.forecast_model_file is None:
 
-                    # Retrieve the required GRIB1 GDAS/GFS ancillary data...
-                    gribFiles, rc_grib_ret = retrieve_NCEP_grib_files(Level1D_obj, run_dir)
-
-                    if not (rc_grib_ret == 0) or gribFiles == [] :
-                        problem_runs.append(hirs_file)
-                        raise RuntimeError('Retrieval of GFS files failed')
-
-                    LOG.debug('Retrieved GFS files: {}'.format(gribFiles))
-
-                    # Transcode GRIB1 GDAS/GFS ancillary data to NetCDF
-                    grib_netcdf_file, rc_grib_netcdf = transcode_NCEP_grib_files(gribFiles[0], run_dir)
-
-                    # If IAPP failed, remove the link to the coefficients, and set the debug option
-                    # to preserve the wreckage...
-                    if not (rc_grib_netcdf == 0):
-                        problem_runs.append(hirs_file)
-                        raise RuntimeError('Transcoding GDAS/GFS to NetCDF failed')
-
-                    LOG.info('Transcoded GDAS/GFS NetCDF file: {}'.format(grib_netcdf_file))
-
-                else:
-                    grib_netcdf_file = options.forecast_model_file
-
-                GRIB_FILE_PATH = path.abspath(path.dirname(grib_netcdf_file))
-                LOG.debug('GRIB_FILE_PATH : {}'.format(GRIB_FILE_PATH))
-
-                # Specify the METAR surface observation file
-                if options.surface_obsv_file is None:
-
-                    metar_netcdf_file = ""
-
-                    # Retrieve the METAR Surface Observation ancillary data...
-                    # metarFiles = retrieve_METAR_files(Level1D_obj, GRIB_FILE_PATH)
-                    # LOG.info('Retrieved METAR files: {}'.format(metarFiles))
-
-                    # Transcode METAR ancillary data to NetCDF
-                    # metar_netcdf_file = transcode_METAR_files(metarFiles[0], work_dir
-                    # LOG.info('Transcoded METAR NetCDF file: {}'.format(metar_netcdf_file))
-
-                else:
-                    metar_netcdf_file = options.surface_obsv_file
-
-                # Set up some path variables
-                LOG.debug('VENDOR Location: {}'.format(IAPP_HOME))
-                NETCDF_FILES_PATH = path.abspath(path.join(IAPP_HOME, 'iapp', 'netcdf_files'))
-                LOG.debug('NETCDF_FILES_PATH : {}'.format(NETCDF_FILES_PATH))
-
-                # Create a list of files to link into the work directory, and link them...
-                files_to_link = {
-                    'gdas_gfs_netcdf_file': grib_netcdf_file,
-                    'metar_file': metar_netcdf_file,
-                    'topography_file': path.join(NETCDF_FILES_PATH, 'topography.nc'),
-                    'level1d_file': path.join(hirs_dir, hirs_file)
-                }
-                linked_files.update(link_run_files(files_to_link, run_dir))
-
-                # Create the runfile
-                template_dict = {}
-                template_dict['level1d_file'] = linked_files['level1d_file']
-                template_dict['topography_file'] = linked_files['topography_file']
-                template_dict['gdas_gfs_netcdf_file'] = linked_files['gdas_gfs_netcdf_file']
-                template_dict['metar_file'] = linked_files['metar_file']
-                template_dict['radiosonde_file'] = ''
-                template_dict['retrieval_method'] = options.retrieval_method
-                template_dict['print_option'] = 1 if options.print_retrieval else 0
-                template_dict['satellite_name'] = options.satellite
-                template_dict['instrument_combo'] = options.instrument_combo
-                template_dict['retrieval_bounds'] = " {:1.0f}. {:1.0f}. {:1.0f}. {:1.0f}.".format(
-                    options.lower_latitude, options.upper_latitude,
-                    options.left_longitude, options.right_longitude)
-
-                generate_iapp_runfile(run_dir, **template_dict)
-
-                # Generate template netcdf retrieval file
-                if create_retrieval_netcdf_template(run_dir) != 0:
-                    raise RuntimeError('There was a problem creating NetCDF template file.')
-
-                # Create  link to the IAPP coefficient dir
-                coeff_dir = link_iapp_coeffs(run_dir)
-                files_to_remove.append(coeff_dir)
-
-                # Run the IAPP executable
-                # iapp_retrieval_netcdf = run_iapp_exe_dummy(options, Level1D_obj, work_dir, run_dir)
-                iapp_retrieval_netcdf, rc_dict = run_iapp_exe(options, Level1D_obj, work_dir, run_dir)
-
-                # If IAPP failed, remove the link to the coefficients, and set the debug option
-                # to preserve the wreckage...
-                if not rc_dict['rc_iapp'] == 0:
-                    crashed_runs.append(hirs_file)
-                    raise RuntimeError('iapp_main returned a non-zero return value, possible crash.')
-                if rc_dict['rc_retrieval_size']:
-                    problem_runs.append(hirs_file)
-                    raise RuntimeError('No valid retrievals in {}, possible bad l1d file.'
-                            .format(iapp_retrieval_netcdf))
-
-                LOG.info('IAPP completed successfully, creating: {}'.format(iapp_retrieval_netcdf))
-
-                successful_runs.append(hirs_file)
-                return_value = 0
-
-                if options.cspp_debug:
-                    LOG.info('Performing debugging cleanup of working directory...')
-                    _ = __debug_cleanup(run_dir)
-                else:
-                    cleanup([run_dir])
+            # Retrieve the required GRIB1 GDAS/GFS ancillary data...
+            gribFiles, rc_grib_ret = retrieve_NCEP_grib_files(Level1D_obj, run_dir)
 
-            except Exception, err:
+            if not (rc_grib_ret == 0) or gribFiles == [] :
+                raise AncillaryError('Retrieval of GFS files failed')
 
-                LOG.warn("{}".format(str(err)))
-                LOG.debug(traceback.format_exc())
+            LOG.debug('Retrieved GFS files: {}'.format(gribFiles))
+
+            # Transcode GRIB1 GDAS/GFS ancillary data to NetCDF
+            grib_netcdf_file, rc_grib_netcdf = transcode_NCEP_grib_files(gribFiles[0], run_dir)
+
+            # If IAPP failed, remove the link to the coefficients, and set the debug option
+            # to preserve the wreckage...
+            if not (rc_grib_netcdf == 0):
+                raise AncillaryError('Transcoding GDAS/GFS to NetCDF failed')
+
+            LOG.info('Transcoded GDAS/GFS NetCDF file: {}'.format(grib_netcdf_file))
+
+        else:
+            grib_netcdf_file = options.forecast_model_file
 
-                __crash_cleanup(run_dir)
-                cleanup_required = False
+        GRIB_FILE_PATH = path.abspath(path.dirname(grib_netcdf_file))
+        LOG.debug('GRIB_FILE_PATH : {}'.format(GRIB_FILE_PATH))
 
-                return_value = 1
+        # Specify the METAR surface observation file
+        if options.surface_obsv_file is None:
+
+            metar_netcdf_file = ""
+
+            # The surface observations are optional, so IAPP runs without them
+            # if there are none for this pass.
+            try:
+                # Retrieve the METAR Surface Observation ancillary data...
+                metarFiles = retrieve_METAR_files(Level1D_obj, GRIB_FILE_PATH)
+                LOG.debug('Retrieved METAR files: {}'.format(metarFiles))
+
+                # Transcode METAR ancillary data to NetCDF, or reuse the NetCDF
+                # file from an earlier pass in the same hour.
+                for metar_file in metarFiles:
+                    try:
+                        metar_netcdf_file = transcode_METAR_files(metar_file, run_dir)
+                        break
+                    except AncillaryError, err:
+                        LOG.warn("{}".format(str(err)))
+
+                if metar_netcdf_file:
+                    LOG.info('Transcoded METAR NetCDF file: {}'.format(metar_netcdf_file))
+
+            except AncillaryError, err:
+                LOG.warn("{}, continuing without surface observations.".format(str(err)))
+
+        else:
+            metar_netcdf_file = options.surface_obsv_file
+
+        # Specify the radiosonde file, selecting the soundings for this pass
+        # from the radiosonde archive if there is one.
+        raob_netcdf_file = ""
+        if options.radiosonde_data_file is not None:
+            raob_netcdf_file = options.radiosonde_data_file
+
+        elif options.radiosonde_dir is not None:
+            # With several regions, the soundings of the whole pass are shared.
+            # Without retrieval bounds, every sounding in the time window is
+            # selected: the scanline locations of the pass aren't read from the
+            # level-1D file, so its footprint isn't known here.
+            bounds = None if options.regions else retrieval_bounds(options)
+            try:
+                raob_file = retrieve_radiosonde_file(Level1D_obj, options.radiosonde_dir, run_dir,
+                                                     bounds,
+                                                     options.radiosonde_window)
+                raob_netcdf_file = transcode_radiosonde_file(raob_file, run_dir)
+                LOG.info('Transcoded radiosonde NetCDF file: {}'.format(raob_netcdf_file))
+
+            except AncillaryError, err:
+                LOG.warn("{}, continuing without radiosonde data.".format(str(err)))
+
+        # Set up some path variables
+        IAPP_HOME = get_config().IAPP_HOME
+        LOG.debug('VENDOR Location: {}'.format(IAPP_HOME))
+        NETCDF_FILES_PATH = path.abspath(path.join(IAPP_HOME, 'iapp', 'netcdf_files'))
+        LOG.debug('NETCDF_FILES_PATH : {}'.format(NETCDF_FILES_PATH))
+
+        # Create a list of files to link into the work directory, and link them...
+        files_to_link = {
+            'gdas_gfs_netcdf_file': grib_netcdf_file,
+            'metar_file': metar_netcdf_file,
+            'radiosonde_file': raob_netcdf_file,
+            'topography_file': path.join(NETCDF_FILES_PATH, 'topography.nc'),
+            'level1d_file': level1d_file
+        }
+        # Outputs of earlier runs with identical inputs and options are reused
+        result_store = None
+        granule_digest = None
+        if options.result_store is not None:
+            result_store = get_result_store(options.result_store,
+                                            options.result_store_size * 2**30)
+            granule_digest = inputs_digest(files_to_link,
+                                           [path.join(IAPP_HOME, 'iapp', 'iapp_coefs'),
+                                            path.join(IAPP_HOME, 'iapp', 'bin')])
+
+        # The runfile settings common to all regions
+        template_dict = {}
+        template_dict['retrieval_method'] = options.retrieval_method
+        template_dict['print_option'] = 1 if options.print_retrieval else 0
+        template_dict['satellite_name'] = options.satellite
+        template_dict['instrument_combo'] = instrument_combo
+
+        if not options.regions:
+            linked_files.update(link_run_files(dict(files_to_link), run_dir))
+            template_dict.update(linked_files)
+            template_dict['retrieval_bounds'] = format_retrieval_bounds(
+                options.lower_latitude, options.upper_latitude,
+                options.left_longitude, options.right_longitude)
+
+            # Create  link to the IAPP coefficient dir
+            granule_dict['coeff_dir'] = link_iapp_coeffs(run_dir)
+
+            # Run the IAPP executable
+            iapp_retrieval_netcdf, rc_dict = run_iapp_with_retries(
+                options, Level1D_obj, work_dir, run_dir, template_dict,
+                result_store=result_store, granule_digest=granule_digest)
+            granule_dict['output_file'] = iapp_retrieval_netcdf
+            granule_dict['rc_dict'] = rc_dict
+
+            # If IAPP failed, remove the link to the coefficients, and set the debug option
+            # to preserve the wreckage...
+            check_iapp_rc(rc_dict, iapp_retrieval_netcdf)
+
+            LOG.info('IAPP completed successfully, creating: {}'.format(iapp_retrieval_netcdf))
+
+        else:
+            # Run IAPP for each region, sharing the ancillary data
+            region_dicts = run_regions(options, Level1D_obj, work_dir, run_dir,
+                                       files_to_link, template_dict,
+                                       result_store, granule_digest)
+            granule_dict['regions'] = region_dicts
+            granule_dict['coeff_dir'] = path.join(run_dir, 'iapp_coefs')
+            granule_dict['rc_dict'] = {'attempts': [
+                dict(attempt, region=name) for name in sorted(region_dicts.keys())
+                for attempt in region_dicts[name]['rc_dict'].get('attempts', [])]}
+
+            region_errors = [region_dict['error'] for region_dict in region_dicts.values()
+                             if region_dict['error'] is not None]
+            crashes = [err for err in region_errors if not isinstance(err, RetrievalProblem)]
+            if crashes:
+                raise crashes[0]
+            if len(region_errors) == len(region_dicts):
+                raise RetrievalProblem('No valid retrievals in any region, possible bad l1d file.')
+
+            LOG.info('IAPP completed successfully for regions {}'.format(
+                [name for name in sorted(region_dicts.keys())
+                 if region_dicts[name]['error'] is None]))
+
+        if options.cspp_debug:
+            LOG.info('Performing debugging cleanup of working directory...')
+            _ = __debug_cleanup(run_dir, work_dir)
+        elif cleanup_worker is not None:
+            cleanup_worker.discard(run_dir)
+        else:
+            cleanup([run_dir])
+
+    except Exception, err:
+
+        LOG.warn("{}".format(str(err)))
+        LOG.debug(traceback.format_exc())
+
+        if __crash_cleanup(run_dir, work_dir) == 0:
+            granule_dict['run_dir'] = path.join(work_dir, "{}_crashed".format(path.basename(run_dir)))
+
+        if isinstance(err, IappError):
+            err.run_dir = granule_dict['run_dir']
+            err.granule_dict = granule_dict
+        raise
+
+    # Add the retrieved FORs to the columnar export
+    if options.export_dir is not None:
+        export_outputs(options, Level1D_obj, granule_dict)
+
+    # Add the retrievals to the daily and six-hourly gridded composites
+    if options.composite_dir is not None:
+        composite_outputs(options, granule_dict)
+
+    granule_dict['elapsed'] = time() - t1
+
+    return granule_dict
+
+
+def hirs_to_L2(work_dir, options):
+
+    attempted_runs = []
+    successful_runs = []
+    crashed_runs = []
+    problem_runs = []
+    killed_runs = []
+    retried_runs = []
+    limited_runs = []
+    skipped_runs = []
+
+    files_to_remove = []
+    #dirs_to_remove = []
+    #files_to_move = []
+    #dirs_to_move = []
+
+    # Order the granules by the scheduling policy. The inputs are searched in
+    # the background, so that (except with the sorted policy) processing starts
+    # with the first granule found.
+    scheduler = GranuleScheduler(options.schedule, header_func=Level1D,
+                                 latency_budget=options.latency_budget,
+                                 realtime_window=options.realtime_window)
+    hirs_files = iter_hirs_files(options)
+
+    # Join passes delivered in several segments, so each pass is one run. This
+    # needs all the inputs, so processing starts once they have been found.
+    # With leases every worker joins every pass, in its own run root, since the
+    # stitched files of one worker are removed while others may be using theirs
+    # (the leases go by file name, so the workers still share the passes).
+    stitched = {}
+    stitch_dir = path.join(run_root_dir(work_dir, options), 'stitched')
+    failed_stitched = set()
+    if options.stitch_segments and not options.print_l1d_header:
+        hirs_files, stitched = stitch_inputs(hirs_files, stitch_dir, Level1D,
+                                             max_gap=options.max_segment_gap,
+                                             record_length=options.l1d_record_length)
+
+    scheduler.feed(hirs_files)
+
+    # Finished run directories are removed in the background
+    cleanup_worker = CleanupWorker(max_wreckage=options.keep_wreckage,
+                                   min_free_space=options.min_free_space)
+
+    # Share the granules with other workers, if there is a lease directory
+    lease_manager = None
+    if options.lease_dir is not None and not options.print_l1d_header:
+        lease_manager = LeaseManager(options.lease_dir, worker_id(options),
+                                     lease_timeout=options.lease_timeout,
+                                     heartbeat=options.lease_heartbeat)
+        LOG.info("Claiming granules in {} as worker {}".format(
+            options.lease_dir, lease_manager.worker_id))
+
+    # Skip or trim passes which repeat the scanlines of those already processed
+    overlap_filter = None
+    if options.dedup != 'none':
+        overlap_filter = OverlapFilter(options.dedup, tolerance=options.overlap_tolerance,
+                                       min_scanlines=options.min_new_scanlines,
+                                       scanline_times=options.dedup_scanline_times,
+                                       record_length=options.l1d_record_length)
+
+    # With leases, granules held by other workers are waited for at the end, so
+    # that those of a worker which dies are reclaimed and processed here.
+    granules = scheduler
+    if lease_manager is not None:
+        granules = lease_manager.claimed(scheduler)
+
+    for hirs_file in granules:
+
+        if options.print_l1d_header:
+            # Parse and log the level 1D file header, and move on
+            Level1D(hirs_file)
+            continue
+
+        trim = None
+        if overlap_filter is not None:
+            try:
+                decision = overlap_filter.check(
+                    Level1D(hirs_file), hirs_file if compression_of(hirs_file) is None else None)
+            except Exception, err:
+                # An unreadable file is reported by process_granule()
+                LOG.debug(traceback.format_exc())
+                decision = {'action': 'process', 'reason': None}
+            if decision['action'] == 'skip':
+                LOG.info("Skipping {}, {}".format(path.basename(hirs_file), decision['reason']))
+                skipped_runs.append("{} ({})".format(path.basename(hirs_file), decision['reason']))
+                if lease_manager is not None:
+                    lease_manager.finish(hirs_file, 'skipped')
+                continue
+            if decision['reason'] is not None:
+                LOG.info("{} {}".format(path.basename(hirs_file), decision['reason']))
+            if decision['action'] == 'trim':
+                trim = decision
+
+        attempted_runs.append(path.basename(hirs_file))
+
+        rc_dict = {}
+        status = 'failed'
+        try:
+            granule_dict = process_granule(hirs_file, work_dir, options, cleanup_worker, trim)
+            rc_dict = granule_dict['rc_dict']
+            successful_runs.append(path.basename(hirs_file))
+            status = 'success'
+            if overlap_filter is not None:
+                overlap_filter.add(granule_dict['Level1D_obj'])
+
+        except IappCrash, err:
+            rc_dict = getattr(err, 'granule_dict', {}).get('rc_dict', {})
+            # Runs stopped by their resource limits are reported apart from crashes
+            if rc_dict.get('killed') in ['memory_limit', 'cpu_limit']:
+                limited_runs.append("{} ({})".format(path.basename(hirs_file), rc_dict['killed']))
+                status = rc_dict['killed']
+            else:
+                crashed_runs.append(path.basename(hirs_file))
+                status = 'crashed'
+        except (AncillaryError, RetrievalProblem, InvalidLevel1D), err:
+            rc_dict = getattr(err, 'granule_dict', {}).get('rc_dict', {})
+            problem_runs.append(path.basename(hirs_file))
+            status = 'problem'
+        except Exception, err:
+            # Already logged by process_granule()
+            pass
+        except KeyboardInterrupt:
+            if lease_manager is not None:
+                lease_manager.release(hirs_file)
+                lease_manager.close()
+            raise
+
+        if lease_manager is not None:
+            lease_manager.finish(hirs_file, status)
+
+        # Keep a stitched file which failed, to go with the wreckage
+        if hirs_file in stitched and status != 'success':
+            failed_stitched.add(hirs_file)
+
+        # Record granules where iapp_main was killed or retried
+        attempts = rc_dict.get('attempts', [])
+        for attempt in attempts:
+            if attempt['killed'] is not None:
+                killed_runs.append("{} ({})".format(path.basename(hirs_file), attempt['killed']))
+        if len(attempts) > 1:
+            retried_runs.append("{} ({} attempts)".format(path.basename(hirs_file), len(attempts)))
+
+        cleanup_worker.enforce_retention(work_dir)
 
     attempted_runs = list(set(attempted_runs))
     successful_runs = list(set(successful_runs))
     crashed_runs = list(set(crashed_runs))
     problem_runs = list(set(problem_runs))
 
+    # Remove the link to the IAPP coefficient dir
+    coeff_dir = path.join(run_root_dir(work_dir, options), 'iapp_coefs')
+    if path.islink(coeff_dir):
+        files_to_remove.append(coeff_dir)
+
+    # Remove the stitched files, except those which failed here, including
+    # those skipped or processed by other workers
+    files_to_remove.extend([x for x in stitched if x not in failed_stitched])
+
     cleanup(files_to_remove)
+    if stitched:
+        try:
+            os.rmdir(stitch_dir)
+        except OSError:
+            pass
+
+    LOG.debug('Waiting for the removal of finished run directories...')
+    cleanup_worker.close()
+
+    if lease_manager is not None:
+        lease_manager.close()
+        # Remove this worker's (now empty) run root
+        for dir_name in [path.join(run_root_dir(work_dir, options), TRASH_DIR_NAME),
+                         run_root_dir(work_dir, options)]:
+            try:
+                os.rmdir(dir_name)
+            except OSError:
+                pass
 
-    return attempted_runs, successful_runs, crashed_runs, problem_runs
+    return attempted_runs, successful_runs, crashed_runs, problem_runs, killed_runs, \
+        retried_runs, limited_runs, skipped_runs
 
 
 def _argparse():
@@ -929,21 +1659,35 @@ def _argparse():
                          3: '(AMSU-A & MHS only)', 4: '(HIRS, AMSU-A & MHS)'}
     retrievalMethodChoices = {0: 'fixed', 1: 'dynamic'}
 
-    defaults = {'work_dir': '.',
-                'topography_file': 'topography.nc',
-                'forecast_model_file': None,
-                'surface_obsv_file': None,
-                'radiosonde_data_file': None,
-                'retrieval_method': 1,
-                'print_retrieval': False,
-                'print_l1d_header': False,
-                'instrument_combo': 4,
-                'lower_latitude': 0.,
-                'upper_latitude': 0.,
-                'left_longitude': 0.,
-                'right_longitude': 0.,
-                'cspp_debug': False
-                }
+    def region_type(region_str):
+        '''Parse a region given as NAME,LOWER_LAT,UPPER_LAT,LEFT_LON,RIGHT_LON'''
+        fields = region_str.split(',')
+        if len(fields) != 5 or not fields[0].strip():
+            raise argparse.ArgumentTypeError(
+                "region '{}' is not of the form NAME,LOWER_LAT,UPPER_LAT,LEFT_LON,RIGHT_LON"
+                .format(region_str))
+        name = fields[0].strip()
+        if not all([c.isalnum() or c in '-' for c in name]):
+            raise argparse.ArgumentTypeError(
+                "region name '{}' may only contain letters, digits and '-'".format(name))
+        try:
+            bounds = tuple([float(field) for field in fields[1:]])
+        except ValueError:
+            raise argparse.ArgumentTypeError(
+                "region '{}' has a non-numeric bound".format(region_str))
+        return (name,) + bounds
+
+    def time_type(time_str):
+        '''Parse a time given as YYYYMMDD[HH[MM[SS]]]'''
+        for time_format in ['%Y%m%d%H%M%S', '%Y%m%d%H%M', '%Y%m%d%H', '%Y%m%d']:
+            try:
+                return datetime.strptime(time_str, time_format)
+            except ValueError:
+                pass
+        raise argparse.ArgumentTypeError(
+            "time '{}' is not of the form YYYYMMDD[HH[MM[SS]]]".format(time_str))
+
+    defaults = DEFAULT_OPTIONS
 
     description = '''Run the IAPP package on level-1d files to generate level-2 files.'''
 
@@ -959,6 +1703,71 @@ def _argparse():
         help='''The fully qualified path to the input files. May be a directory or a file glob.'''
     )
 
+    parser.add_argument(
+        '--manifest',
+        action="append",
+        dest="manifest",
+        default=defaults['manifest'],
+        type=str,
+        help='''A file listing input files or directories, one per line, or
+        '-' to read the list from stdin. May be given more than once.
+        [default: {}]'''.format(defaults['manifest'])
+    )
+
+    parser.add_argument(
+        '--recursive',
+        action="store_true",
+        dest="recursive",
+        default=defaults['recursive'],
+        help='''Search input directories recursively.
+        [default: {}]'''.format(defaults['recursive'])
+    )
+
+    parser.add_argument(
+        '--include',
+        action="append",
+        dest="include",
+        default=defaults['include'],
+        type=str,
+        help='''A shell-style pattern for the names of the level-1D files in
+        input directories. May be given more than once.
+        [default: {}]'''.format(DEFAULT_INCLUDE)
+    )
+
+    parser.add_argument(
+        '--exclude',
+        action="append",
+        dest="exclude",
+        default=defaults['exclude'],
+        type=str,
+        help='''A shell-style pattern for the names of files in input
+        directories to skip. May be given more than once.
+        [default: {}]'''.format(defaults['exclude'])
+    )
+
+    parser.add_argument(
+        '--start_time',
+        action="store",
+        dest="start_time",
+        default=defaults['start_time'],
+        type=time_type,
+        help='''Only process the input files from this time on, as
+        YYYYMMDD[HH[MM[SS]]]. The time of a file is taken from its name, or
+        from its header if there is no time in the name.
+        [default: {}]'''.format(defaults['start_time'])
+    )
+
+    parser.add_argument(
+        '--end_time',
+        action="store",
+        dest="end_time",
+        default=defaults['end_time'],
+        type=time_type,
+        help='''Only process the input files up to this time, as
+        YYYYMMDD[HH[MM[SS]]].
+        [default: {}]'''.format(defaults['end_time'])
+    )
+
     parser.add_argument(
         action="store",
         dest="satellite",
@@ -983,6 +1792,244 @@ def _argparse():
         [default: {}]'''.format(defaults['work_dir'])
     )
 
+    parser.add_argument(
+        '--scratch_dir',
+        action="store",
+        dest="scratch_dir",
+        type=str,
+        default=defaults['scratch_dir'],
+        help='''A directory on fast local storage (e.g. /dev/shm) in which to
+        create the run directories. Only the output NetCDF files and logs are
+        copied to the work directory, along with any crashed run directories.
+        [default: {}]'''.format(defaults['scratch_dir'])
+    )
+
+    parser.add_argument(
+        '--keep_wreckage',
+        action="store",
+        dest="keep_wreckage",
+        type=int,
+        default=defaults['keep_wreckage'],
+        help='''The maximum number of crashed and debug run directories to keep
+        in the work directory, removing the oldest first.
+        [default: {}]'''.format(defaults['keep_wreckage'])
+    )
+
+    parser.add_argument(
+        '--min_free_space',
+        action="store",
+        dest="min_free_space",
+        type=float,
+        default=defaults['min_free_space'],
+        help='''Remove the oldest crashed and debug run directories while the
+        work directory filesystem has less than this percentage free.
+        [default: {}]'''.format(defaults['min_free_space'])
+    )
+
+    parser.add_argument(
+        '--result_store',
+        action="store",
+        dest="result_store",
+        type=str,
+        default=defaults['result_store'],
+        help='''A directory in which to keep IAPP outputs, so that a granule
+        run again with identical level-1D and ancillary files, coefficients and
+        options reuses its earlier output rather than running iapp_main.
+        [default: {}]'''.format(defaults['result_store'])
+    )
+
+    parser.add_argument(
+        '--result_store_size',
+        action="store",
+        dest="result_store_size",
+        type=float,
+        default=defaults['result_store_size'],
+        help='''The maximum size of the result store in GiB; the least
+        recently used outputs are removed beyond this.
+        [default: {}]'''.format(defaults['result_store_size'])
+    )
+
+    parser.add_argument(
+        '--export_dir',
+        action="store",
+        dest="export_dir",
+        type=str,
+        default=defaults['export_dir'],
+        help='''Also export the retrieved fields of regard of each output to a
+        columnar table in this directory, partitioned by date and satellite.
+        [default: {}]'''.format(defaults['export_dir'])
+    )
+
+    parser.add_argument(
+        '--export_format',
+        action="store",
+        dest="export_format",
+        default=defaults['export_format'],
+        choices=EXPORT_FORMATS,
+        help='''The format of the export with --export_dir.
+        [default: the first available of {}]'''.format(', '.join(EXPORT_FORMATS))
+    )
+
+    parser.add_argument(
+        '--composite_dir',
+        action="store",
+        dest="composite_dir",
+        type=str,
+        default=defaults['composite_dir'],
+        help='''Also add the retrievals of each output to the daily and
+        six-hourly gridded composites in this directory (see iapp_composite.py).
+        [default: {}]'''.format(defaults['composite_dir'])
+    )
+
+    parser.add_argument(
+        '--dedup',
+        action="store",
+        dest="dedup",
+        default=defaults['dedup'],
+        choices=DEDUP_MODES,
+        help='''How to treat passes which repeat the scanlines of passes already
+        processed (e.g. the same orbit received by several antennas), judged by
+        the satellite, orbit numbers and scanline times:
+        'none' processes every pass; 'skip' skips duplicate and contained
+        passes; 'trim' also trims partly overlapping passes to their new
+        scanlines. [default: {}]'''.format(defaults['dedup'])
+    )
+
+    parser.add_argument(
+        '--dedup_scanline_times',
+        action="store_true",
+        dest="dedup_scanline_times",
+        default=defaults['dedup_scanline_times'],
+        help='''With --dedup, read the scanline times from the scanline records of
+        uncompressed files, rather than interpolating them from the header.'''
+    )
+
+    parser.add_argument(
+        '--overlap_tolerance',
+        action="store",
+        dest="overlap_tolerance",
+        type=float,
+        default=defaults['overlap_tolerance'],
+        help='''With --dedup, the seconds by which the times of the same scanline
+        may differ between passes. [default: {}]'''.format(defaults['overlap_tolerance'])
+    )
+
+    parser.add_argument(
+        '--min_new_scanlines',
+        action="store",
+        dest="min_new_scanlines",
+        type=int,
+        default=defaults['min_new_scanlines'],
+        help='''With --dedup, passes with fewer scanlines than this which are not
+        in passes already processed are skipped. [default: {}]'''.format(defaults['min_new_scanlines'])
+    )
+
+    parser.add_argument(
+        '--stitch_segments',
+        action="store_true",
+        dest="stitch_segments",
+        default=defaults['stitch_segments'],
+        help='''Join the level-1D segments of a pass (of the same satellite,
+        continuing the orbit and in time) into a single file in the work
+        directory (or that of the worker, with --lease_dir), and process that
+        as one granule. Processing starts once all
+        the inputs have been found.'''
+    )
+
+    parser.add_argument(
+        '--max_segment_gap',
+        action="store",
+        dest="max_segment_gap",
+        type=float,
+        default=defaults['max_segment_gap'],
+        help='''With --stitch_segments, the longest time in seconds between the
+        end of a segment and the start of the next for them to be joined.
+        [default: {}]'''.format(defaults['max_segment_gap'])
+    )
+
+    parser.add_argument(
+        '--lease_dir',
+        action="store",
+        dest="lease_dir",
+        type=str,
+        default=defaults['lease_dir'],
+        help='''A directory on a filesystem shared by several workers (on one
+        or more nodes) processing the same inputs, through which each granule is
+        claimed by a single worker. A worker waits for the granules held by
+        others, and exits once all of them have been processed.
+        [default: {}]'''.format(defaults['lease_dir'])
+    )
+
+    parser.add_argument(
+        '--worker_id',
+        action="store",
+        dest="worker_id",
+        type=str,
+        default=defaults['worker_id'],
+        help='''The name of this worker, with --lease_dir.
+        [default: HOST-PID]'''
+    )
+
+    parser.add_argument(
+        '--lease_timeout',
+        action="store",
+        dest="lease_timeout",
+        type=float,
+        default=defaults['lease_timeout'],
+        help='''The number of seconds without a heartbeat after which the
+        lease of a worker on a granule expires, and the granule may be claimed
+        by another worker.
+        [default: {}]'''.format(defaults['lease_timeout'])
+    )
+
+    parser.add_argument(
+        '--lease_heartbeat',
+        action="store",
+        dest="lease_heartbeat",
+        type=float,
+        default=defaults['lease_heartbeat'],
+        help='''The number of seconds between heartbeats of the leases held.
+        [default: {}]'''.format(defaults['lease_heartbeat'])
+    )
+
+    parser.add_argument(
+        '--schedule',
+        action="store",
+        dest="schedule",
+        type=str,
+        choices=SCHEDULE_POLICIES,
+        default=defaults['schedule'],
+        help='''The order in which to process the input files: as they are
+        found (by name within each directory), or sorted by path name once all
+        of them have been found, or (starting with those found so far) newest
+        pass first, or earliest deadline (pass end time plus --latency_budget)
+        first. Possible values are...
+        {}. [default: {}]'''.format(SCHEDULE_POLICIES.__str__()[1:-1],
+                                    defaults['schedule'])
+    )
+
+    parser.add_argument(
+        '--latency_budget',
+        action="store",
+        dest="latency_budget",
+        type=float,
+        default=defaults['latency_budget'],
+        help='''The number of seconds after the end of a pass by which it should
+        be processed, for the deadline schedule.
+        [default: {}]'''.format(defaults['latency_budget'])
+    )
+
+    parser.add_argument(
+        '--realtime_window',
+        action="store",
+        dest="realtime_window",
+        type=float,
+        default=defaults['realtime_window'],
+        help='''Process passes which ended less than this many seconds ago
+        before all others, whatever the schedule.
+        [default: {}]'''.format(defaults['realtime_window'])
+    )
+
     parser.add_argument(
         '-t', '--topography_file',
         action="store",
@@ -1013,6 +2060,32 @@ def _argparse():
         [default: {}]'''.format(defaults['radiosonde_data_file'])
     )
 
+    parser.add_argument(
+        '--radiosonde_dir',
+        action="store",
+        dest="radiosonde_dir",
+        type=str,
+        default=defaults['radiosonde_dir'],
+        help='''A directory of radiosonde soundings (NOAA/ESRL text format), from
+        which the soundings for each pass are selected: those inside the
+        retrieval bounds (--lower_lat etc.), or, without bounds or with
+        --region, all soundings in the time window, since the pass footprint
+        is not known before iapp_main has geolocated it. Ignored if
+        --radiosonde_file is given.
+        [default: {}]'''.format(defaults['radiosonde_dir'])
+    )
+
+    parser.add_argument(
+        '--radiosonde_window',
+        action="store",
+        dest="radiosonde_window",
+        type=float,
+        default=defaults['radiosonde_window'],
+        help='''Select soundings launched up to this many seconds before the
+        start or after the end of the pass.
+        [default: {}]'''.format(defaults['radiosonde_window'])
+    )
+
     parser.add_argument(
         '-s', '--surface_obs_file',
         action="store",
@@ -1037,6 +2110,177 @@ def _argparse():
              '''.format(instrumentChoices.__str__()[1:-1], defaults['instrument_combo'])
     )
 
+    parser.add_argument(
+        '--validate_l1d',
+        action="store",
+        dest="validate_l1d",
+        default=defaults['validate_l1d'],
+        type=str,
+        choices=VALIDATION_MODES,
+        help='''Check the size, instruments and times of each level-1D file
+        before processing it. 'reject' skips files which fail, 'auto' also
+        switches to an instrument combination the file supports, if
+        --instrument_combo isn't one.
+        [default: {}]'''.format(defaults['validate_l1d'])
+    )
+
+    parser.add_argument(
+        '--l1d_record_length',
+        action="store",
+        dest="l1d_record_length",
+        default=defaults['l1d_record_length'],
+        type=int,
+        help='''The record length in bytes of the level-1D files, used to
+        check the file size. If not given, the file size need only be a whole
+        number of records.
+        [default: {}]'''.format(defaults['l1d_record_length'])
+    )
+
+    parser.add_argument(
+        '--fallback_instrument_combo',
+        action="store",
+        dest="fallback_instrument_combo",
+        default=defaults['fallback_instrument_combo'],
+        type=int,
+        choices=instrumentChoices.keys(),
+        help='''Instrument combination to use when retrying a granule on which
+                iapp_main crashed or was killed (see --max_retries).
+                [default: {}]
+             '''.format(defaults['fallback_instrument_combo'])
+    )
+
+    parser.add_argument(
+        '--max_retries',
+        action="store",
+        dest="max_retries",
+        default=defaults['max_retries'],
+        type=int,
+        help='''The number of times to rerun iapp_main on a granule after it
+        crashes or is killed.
+        [default: {}]'''.format(defaults['max_retries'])
+    )
+
+    parser.add_argument(
+        '--scanline_timeout',
+        action="store",
+        dest="scanline_timeout",
+        default=defaults['scanline_timeout'],
+        type=float,
+        help='''Kill iapp_main if it runs for longer than this many seconds
+        per scanline of the input file (but see --min_timeout).
+        [default: {}]'''.format(defaults['scanline_timeout'])
+    )
+
+    parser.add_argument(
+        '--min_timeout',
+        action="store",
+        dest="min_timeout",
+        default=defaults['min_timeout'],
+        type=float,
+        help='''The minimum time in seconds allowed for iapp_main, when
+        --scanline_timeout is given.
+        [default: {}]'''.format(defaults['min_timeout'])
+    )
+
+    parser.add_argument(
+        '--stall_timeout',
+        action="store",
+        dest="stall_timeout",
+        default=defaults['stall_timeout'],
+        type=float,
+        help='''Kill iapp_main if it writes nothing to stdout for this many
+        seconds.
+        [default: {}]'''.format(defaults['stall_timeout'])
+    )
+
+    parser.add_argument(
+        '--limit_memory',
+        action="store",
+        dest="limit_memory",
+        default=defaults['limit_memory'],
+        type=float,
+        help='''The largest address space of iapp_main, in GiB. A run which
+        exceeds it is reported as killed (memory_limit).
+        [default: {}]'''.format(defaults['limit_memory'])
+    )
+
+    parser.add_argument(
+        '--limit_cpu',
+        action="store",
+        dest="limit_cpu",
+        default=defaults['limit_cpu'],
+        type=float,
+        help='''The most CPU time of iapp_main, in seconds. A run which exceeds
+        it is reported as killed (cpu_limit).
+        [default: {}]'''.format(defaults['limit_cpu'])
+    )
+
+    parser.add_argument(
+        '--limit_core',
+        action="store",
+        dest="limit_core",
+        default=defaults['limit_core'],
+        type=float,
+        help='''The largest core file of iapp_main, in GiB; 0 for none.
+        [default: {}]'''.format(defaults['limit_core'])
+    )
+
+    parser.add_argument(
+        '--limit_files',
+        action="store",
+        dest="limit_files",
+        default=defaults['limit_files'],
+        type=int,
+        help='''The most open files of iapp_main.
+        [default: {}]'''.format(defaults['limit_files'])
+    )
+
+    parser.add_argument(
+        '--pin_cpus',
+        action="store",
+        dest="pin_cpus",
+        default=defaults['pin_cpus'],
+        choices=PIN_MODES,
+        help='''Pin each iapp_main to CPUs of a single NUMA node, shared out
+        between the concurrent runs on the node: 'cpus' pins a run to the
+        --cpus_per_run CPUs it claims, 'node' to all the CPUs of the node of
+        its claim.
+        [default: {}]'''.format(defaults['pin_cpus'])
+    )
+
+    parser.add_argument(
+        '--cpus_per_run',
+        action="store",
+        dest="cpus_per_run",
+        default=defaults['cpus_per_run'],
+        type=int,
+        help='''The number of CPUs claimed by each iapp_main, with --pin_cpus.
+        [default: {}]'''.format(defaults['cpus_per_run'])
+    )
+
+    parser.add_argument(
+        '--run_memory',
+        action="store",
+        dest="run_memory",
+        default=defaults['run_memory'],
+        type=float,
+        help='''The projected memory of an iapp_main run, in GiB. If given, a
+        run is only started when this much memory (or the peak of the earlier
+        runs, if larger) is available on the node.
+        [default: {}]'''.format(defaults['run_memory'])
+    )
+
+    parser.add_argument(
+        '--admission_timeout',
+        action="store",
+        dest="admission_timeout",
+        default=defaults['admission_timeout'],
+        type=float,
+        help='''The most seconds to wait for memory with --run_memory, after
+        which the run is started anyway.
+        [default: {}]'''.format(defaults['admission_timeout'])
+    )
+
     parser.add_argument(
         '--retrieval_method',
         action="store",
@@ -1091,6 +2335,34 @@ def _argparse():
         [default: {}]'''.format(defaults['right_longitude'])
     )
 
+    parser.add_argument(
+        '--region',
+        action="append",
+        dest="regions",
+        default=defaults['regions'],
+        type=region_type,
+        metavar='NAME,LOWER_LAT,UPPER_LAT,LEFT_LON,RIGHT_LON',
+        help='''Retrieve the named region. May be given more than once, in
+        which case the ancillary data for each granule is prepared once, and
+        IAPP is run concurrently for each region, with the region name added to
+        the output file name. Overrides the --lower_lat, --upper_lat, --left_lon
+        and --right_lon options.
+        [default: {}]'''.format(defaults['regions'])
+    )
+
+    parser.add_argument(
+        '--region_workers',
+        action="store",
+        dest="region_workers",
+        default=defaults['region_workers'],
+        type=int,
+        help='''The maximum number of regions to run concurrently, if
+        --region is given. By default all regions of a granule are run at once.
+        The log of each region is also written to its own file, beside the main
+        log file, with the region name added to its name.
+        [default: {}]'''.format(defaults['region_workers'])
+    )
+
     parser.add_argument(
         '--print_retrieval',
         action="store_true",
@@ -1109,6 +2381,16 @@ def _argparse():
         [default: {}]'''.format(defaults['print_l1d_header'])
     )
 
+    parser.add_argument(
+        '--async_logging',
+        action="store_true",
+        dest="async_logging",
+        default=defaults['async_logging'],
+        help='''Write the log messages on a background thread, so that logging
+        never holds up the processing.
+        [default: {}]'''.format(defaults['async_logging'])
+    )
+
     parser.add_argument(
         '--debug',
         action="store_true",
@@ -1147,6 +2429,11 @@ def _argparse():
 
     args = parser.parse_args()
 
+    if args.regions:
+        region_names = [region[0] for region in args.regions]
+        if len(set(region_names)) != len(region_names):
+            parser.error("region names must be unique: {}".format(region_names))
+
     levels = [logging.ERROR, logging.WARN, logging.INFO, logging.DEBUG]
     verbosity = 0 if args.quiet else args.verbosity
     level = levels[verbosity if verbosity < 4 else 3]
@@ -1154,9 +2441,13 @@ def _argparse():
     d = datetime.now()
     timestamp = d.isoformat()
     timestamp = timestamp.replace(":", "")
-    logname = "iapp_level2." + timestamp + ".log"
+    # Workers sharing a work dir through leases each have their own log file
+    if args.lease_dir is not None:
+        logname = "iapp_level2.{}.{}.log".format(worker_id(args), timestamp)
+    else:
+        logname = "iapp_level2." + timestamp + ".log"
     logfile = path.join(work_dir, logname)
-    configure_logging(level, FILE=logfile)
+    configure_logging(level, FILE=logfile, asynchronous=args.async_logging)
 
     # create work directory
     if not path.isdir(work_dir):
@@ -1176,7 +2467,11 @@ def main():
     """
 
     # Read in the command line options
-    options, work_dir, docleanup = _argparse()
+    try:
+        options, work_dir, docleanup = _argparse()
+    except CsppEnvironment as e:
+        print >>sys.stderr, "ERROR: {}".format(e.value)
+        return 2
 
     # Check various paths and environment variables.
     try:
@@ -1186,6 +2481,12 @@ def main():
                                               default_value=os.path.join(cspp_iapp_home, 'anc/cache'))
         ver = check_existing_env_var('DPE_VER')
 
+        config = get_config()
+        LOG.debug("CSPP_RT_HOME:          {}".format(config.CSPP_RT_HOME))
+        LOG.debug("CSPP_RT_ANC_PATH:      {}".format(config.CSPP_RT_ANC_PATH))
+        LOG.debug("CSPP_RT_ANC_CACHE_DIR: {}".format(config.CSPP_RT_ANC_CACHE_DIR))
+        LOG.debug("IAPP_HOME:             {}".format(config.IAPP_HOME))
+
     except CsppEnvironment as e:
         LOG.error(e.value)
         LOG.error('Installation error, Make sure all software components were installed.')
@@ -1193,21 +2494,21 @@ def main():
 
     LOG.info("Starting CSPP IAPP ...")
 
-    # Expand any user specifiers in the various paths
-    LOG.debug("CSPP_RT_HOME:          {}".format(CSPP_RT_HOME))
-    LOG.debug("CSPP_RT_ANC_PATH:      {}".format(CSPP_RT_ANC_PATH))
-    LOG.debug("CSPP_RT_ANC_CACHE_DIR: {}".format(CSPP_RT_ANC_CACHE_DIR))
-
     return_value = 0
     try:
 
-        attempted_runs, successful_runs, crashed_runs, problem_runs = hirs_to_L2(work_dir, options)
+        attempted_runs, successful_runs, crashed_runs, problem_runs, killed_runs, retried_runs, \
+            limited_runs, skipped_runs = hirs_to_L2(work_dir, options)
 
         print ""
         LOG.info('attempted_runs    {}'.format(attempted_runs))
         LOG.info('successful_runs   {}'.format(successful_runs))
         LOG.info('crashed_runs      {}'.format(crashed_runs))
         LOG.info('problem_runs      {}'.format(problem_runs))
+        LOG.info('killed_runs       {}'.format(killed_runs))
+        LOG.info('retried_runs      {}'.format(retried_runs))
+        LOG.info('limited_runs      {}'.format(limited_runs))
+        LOG.info('skipped_runs      {}'.format(skipped_runs))
 
     except Exception:
         LOG.error(traceback.format_exc())
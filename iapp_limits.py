@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+iapp_limits.py
+
+Purpose: Keep one iapp_main from taking down a node shared by many concurrent
+         retrievals, through per-process resource limits and a memory
+         admission controller.
+
+Limits are applied with setrlimit() in the child, between fork and exec, so
+they cover the executable and anything it starts, but not this process. They
+override the unlimited settings of cspp_iapp_runtime.sh:
+
+    memory: the address space (RLIMIT_AS), in bytes. An allocation beyond it
+            fails, which iapp_main reports on its output before exiting.
+    cpu:    CPU seconds (RLIMIT_CPU). The process gets SIGXCPU at the limit,
+            and SIGKILL CPU_GRACE seconds later.
+    core:   the largest core file (RLIMIT_CORE), in bytes; 0 for none.
+    files:  the number of open files (RLIMIT_NOFILE).
+
+limit_kill_reason() tells a run stopped by the memory or CPU limit (reported
+as 'memory_limit' or 'cpu_limit') from an ordinary crash.
+
+The MemoryAdmission controller holds back the start of a run until the memory
+available on the node (MemAvailable in /proc/meminfo, less the part of the
+projections of the runs this process has running which they have yet to grow
+into) exceeds the projected memory of a run: the larger of a configured size
+and the peak resident size of the children of this process so far.
+
+Copyright (c) 2014 University of Wisconsin Regents.
+Licensed under GNU GPLv3.
+"""
+
+import os
+import signal
+import logging
+from time import time, sleep
+from threading import Lock
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+LOG = logging.getLogger(__name__)
+
+GIB = 1024. ** 3
+
+# Seconds between the SIGXCPU at the soft CPU limit and the SIGKILL at the hard limit
+CPU_GRACE = 10
+
+# Messages of failed allocations, from the Fortran and C runtimes
+MEMORY_ERROR_PATTERNS = ['Allocation would exceed memory limit',
+                         'Cannot allocate memory',
+                         'Out of memory',
+                         'out of memory',
+                         'insufficient virtual memory',
+                         'std::bad_alloc']
+
+
+def resource_limits(options):
+    '''
+    The resource limits given by options, as a dictionary of limit name and
+    value, with only the limits which have been set.
+    '''
+    limits = {}
+    if options.limit_memory is not None:
+        limits['memory'] = int(options.limit_memory * GIB)
+    if options.limit_cpu is not None:
+        limits['cpu'] = int(options.limit_cpu)
+    if options.limit_core is not None:
+        limits['core'] = int(options.limit_core * GIB)
+    if options.limit_files is not None:
+        limits['files'] = int(options.limit_files)
+    return limits
+
+
+def make_preexec_fn(limits):
+    '''
+    A function to run in the child before exec: it starts a new session (so the
+    supervisor can kill the process group), and applies limits.
+    '''
+    def _preexec():
+        os.setsid()
+        if resource is None or not limits:
+            return
+        if 'memory' in limits:
+            resource.setrlimit(resource.RLIMIT_AS, (limits['memory'], limits['memory']))
+        if 'cpu' in limits:
+            resource.setrlimit(resource.RLIMIT_CPU, (limits['cpu'], limits['cpu'] + CPU_GRACE))
+        if 'core' in limits:
+            resource.setrlimit(resource.RLIMIT_CORE, (limits['core'], limits['core']))
+        if 'files' in limits:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (limits['files'], limits['files']))
+
+    return _preexec
+
+
+def _signal_of(rc):
+    '''The signal which ended a process run through the shell, or None.'''
+    if rc is None:
+        return None
+    if rc < 0:
+        return -rc
+    if rc > 128:
+        return rc - 128
+    return None
+
+
+def limit_kill_reason(rc, limits, output, elapsed):
+    '''
+    Return 'cpu_limit' or 'memory_limit' if a process run with limits, which
+    exited with rc after elapsed seconds and wrote output, was stopped by one
+    of them, otherwise None.
+    '''
+    if not limits:
+        return None
+
+    # A SIGKILL is only from the hard CPU limit if the process could have used
+    # that much CPU time (e.g. not from the kernel's OOM killer).
+    sig = _signal_of(rc)
+    if 'cpu' in limits:
+        if sig == signal.SIGXCPU or (sig == signal.SIGKILL and elapsed >= limits['cpu']):
+            return 'cpu_limit'
+
+    if 'memory' in limits and rc != 0:
+        for pattern in MEMORY_ERROR_PATTERNS:
+            if pattern in output:
+                return 'memory_limit'
+
+    return None
+
+
+def mem_available():
+    '''The memory available for new processes on this node, in bytes, or None if unknown.'''
+    try:
+        meminfo_obj = open('/proc/meminfo', 'r')
+        try:
+            for line in meminfo_obj:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+        finally:
+            meminfo_obj.close()
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+def children_peak_memory():
+    '''The largest peak resident size of the finished children of this process, in bytes.'''
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+
+
+def descendants_rss():
+    '''
+    The resident size of the running descendants of this process (e.g.
+    iapp_main, started through the shell), in bytes, or None if unknown.
+    '''
+    page_size = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+    children = {}
+    rss = {}
+    try:
+        pids = [x for x in os.listdir('/proc') if x.isdigit()]
+    except OSError:
+        return None
+
+    for pid in pids:
+        try:
+            stat_obj = open('/proc/{}/stat'.format(pid), 'r')
+            try:
+                stat = stat_obj.read()
+            finally:
+                stat_obj.close()
+        except IOError:
+            # The process has exited
+            continue
+        # The command name may contain spaces, so split after its closing bracket
+        fields = stat[stat.rfind(')') + 2:].split()
+        children.setdefault(int(fields[1]), []).append(int(pid))
+        rss[int(pid)] = int(fields[21]) * page_size
+
+    total = 0
+    pending = list(children.get(os.getpid(), []))
+    while pending:
+        pid = pending.pop()
+        total += rss.get(pid, 0)
+        pending.extend(children.get(pid, []))
+
+    return total
+
+
+class MemoryAdmission(object):
+    '''
+    Admits runs while the projected memory of a run fits in the memory
+    available on the node.
+
+    run_memory:    the default projected memory of a run, in bytes; the peak
+                   seen in earlier runs is used instead if it is larger.
+    max_wait:      the default seconds to hold back a run, after which it is
+                   started anyway (None to wait indefinitely).
+    poll_interval: seconds between checks of the available memory.
+
+    The memory reserved for the admitted runs, less what their processes
+    already hold (which MemAvailable no longer includes), is counted as used.
+    '''
+
+    def __init__(self, run_memory=0, max_wait=None, poll_interval=5.):
+        self.run_memory = run_memory
+        self.max_wait = max_wait
+        self.poll_interval = poll_interval
+        self._reserved = 0
+        self._lock = Lock()
+
+    def projected_memory(self, run_memory=None):
+        run_memory = self.run_memory if run_memory is None else run_memory
+        return max(run_memory, children_peak_memory())
+
+    def _outstanding(self):
+        '''The memory reserved for the admitted runs which they have yet to use.'''
+        if self._reserved <= 0:
+            return 0
+        resident = descendants_rss()
+        if resident is None:
+            return self._reserved
+        return max(0, self._reserved - resident)
+
+    def _try_reserve(self, needed):
+        available = mem_available()
+        with self._lock:
+            if available is None or available - self._outstanding() >= needed:
+                self._reserved += needed
+                return True
+            return False
+
+    def admit(self, run_memory=None, max_wait=None):
+        '''
+        Wait until a run of run_memory bytes (the default if None) fits, for at
+        most max_wait seconds (the default if None), returning the memory
+        reserved for it, which is to be passed to release() when the run has
+        finished.
+        '''
+        needed = self.projected_memory(run_memory)
+        max_wait = self.max_wait if max_wait is None else max_wait
+        t_start = time()
+        waiting = False
+        while not self._try_reserve(needed):
+            if max_wait is not None and time() - t_start > max_wait:
+                LOG.warn("Starting a run after waiting {} seconds for {:.1f} GiB of memory"
+                         .format(max_wait, needed / GIB))
+                with self._lock:
+                    self._reserved += needed
+                break
+            if not waiting:
+                LOG.info("Waiting for {:.1f} GiB of memory to become available..."
+                         .format(needed / GIB))
+                waiting = True
+            sleep(self.poll_interval)
+
+        return needed
+
+    def release(self, reserved):
+        with self._lock:
+            self._reserved -= reserved
+
+
+# One controller per process, shared by the region threads (and pipeline
+# calls), so that all of their runs are accounted for together. The run memory
+# and wait of each run are passed to admit().
+_ADMISSION = None
+_ADMISSION_LOCK = Lock()
+
+
+def get_memory_admission():
+    '''Return the (per-process) memory admission controller.'''
+    global _ADMISSION
+    with _ADMISSION_LOCK:
+        if _ADMISSION is None:
+            _ADMISSION = MemoryAdmission()
+        return _ADMISSION
@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+iapp_overlap.py
+
+Purpose: Detect level-1D files which repeat scanlines already retrieved, as
+         when the same orbit is received by several antennas, so that
+         duplicate and contained passes are skipped, and partly overlapping
+         passes are trimmed to their new scanlines, before iapp_main is run.
+
+An OverlapFilter keeps the time coverage of the passes processed so far, by
+Satellite_ID. The scanline times of a new pass are compared with it:
+
+    duplicate: the pass has the same start and end times (within the
+               tolerance) as a processed pass.
+    contained: fewer than min_scanlines of its scanlines are not covered.
+    overlap:   some of its scanlines are covered; with the 'trim' mode, the
+               pass is cut to the range of its uncovered scanlines. If covered
+               scanlines lie between uncovered ones, the whole range is kept.
+
+Passes are only compared if their orbit numbers (Start_Orbit_Number to
+End_Orbit_Number, when set) overlap. Scanline times are interpolated between
+the header start and end times, or, optionally, read from the start of each
+scanline record (SCANLINE_TIME_FIELDS), falling back to the interpolation if
+those are implausible. A trimmed pass is written as a new level-1D file with
+the header scanline count and start/end times updated (see write_level1d()).
+
+The coverage is per process; passes processed by other workers aren't seen.
+
+Copyright (c) 2014 University of Wisconsin Regents.
+Licensed under GNU GPLv3.
+"""
+
+import os
+import struct
+import logging
+from os import path
+from datetime import datetime, timedelta
+
+from iapp_utils import InvalidLevel1D
+from iapp_validate import check_size, HEADER_SIZE
+
+LOG = logging.getLogger(__name__)
+
+DEDUP_MODES = ['none', 'skip', 'trim']
+
+# Name, struct format and size of the level-1D header fields, in file order
+# (see iapp_level2.Level1D)
+HEADER_LAYOUT = [('Dataset_Creation_Site', None, 3),
+                 ('Filler_1', None, 1),
+                 ('Creation_1BSite', None, 3),
+                 ('Filler_2', None, 1)] + \
+    [(name, 'i', 4) for name in ['Header_Version_Number', 'Header_Version_Year',
+                                 'Header_Version_DOY', 'Number_of_Header_Records',
+                                 'Satellite_ID', 'Inst_Grid_Code', 'Satellite_Altitude',
+                                 'Nominal_Orbit_Period', 'Start_Orbit_Number',
+                                 'Start_Data_Set_Year', 'Start_Data_Set_DOY',
+                                 'Start_Data_Set_UTC_Time', 'End_Orbit_Number',
+                                 'End_Data_Set_Year', 'End_Data_Set_DOY',
+                                 'End_Data_Set_UTC_Time', 'Number_of_Scanlines',
+                                 'Missing_Scanlines', 'ATOVPP_Version_Number', 'Instruments']]
+
+HEADER_OFFSETS = {}
+_offset = 0
+for _name, _format, _size in HEADER_LAYOUT:
+    HEADER_OFFSETS[_name] = _offset
+    _offset += _size
+del _offset, _name, _format, _size
+
+# Offsets of the (integer) year, day of year and UTC time (ms) at the start of
+# each scanline record, after the scanline number
+SCANLINE_TIME_FIELDS = (4, 8, 12)
+
+
+def record_length_of(l1d_file, header_data, record_length=None):
+    '''
+    The record length of the (uncompressed) l1d_file: record_length if given,
+    otherwise inferred from the file size. Raises InvalidLevel1D if the size
+    doesn't agree with the header.
+    '''
+    file_size = os.stat(l1d_file).st_size
+    problems = check_size(file_size, header_data, record_length)
+    if problems:
+        raise InvalidLevel1D('{}: {}'.format(path.basename(l1d_file), '; '.join(problems)))
+    if record_length is not None:
+        return record_length
+    return file_size / (header_data['Number_of_Header_Records'] +
+                        header_data['Number_of_Scanlines'])
+
+
+def header_time_fields(time_obj):
+    '''The (year, day of year, UTC time in ms) header fields of time_obj.'''
+    midnight = datetime(time_obj.year, time_obj.month, time_obj.day)
+    delta = time_obj - midnight
+    time_ms = (delta.seconds * 1000) + delta.microseconds / 1000
+    return time_obj.year, time_obj.timetuple().tm_yday, time_ms
+
+
+def interpolated_times(start_time, end_time, scanlines):
+    '''Scanline times evenly spaced from start_time to end_time.'''
+    if scanlines < 2:
+        return [start_time] * scanlines
+    step = (end_time - start_time) / (scanlines - 1)
+    return [start_time + step * idx for idx in range(scanlines)]
+
+
+def read_scanline_times(l1d_file, header_data, record_length, start_time, end_time,
+                        tolerance=timedelta(seconds=60)):
+    '''
+    Return the times read from the scanline records of l1d_file, or None if
+    any is unreadable, out of order, or outside the header start and end
+    times (by more than tolerance).
+    '''
+    header_records = header_data['Number_of_Header_Records']
+    scanlines = header_data['Number_of_Scanlines']
+    year_offset, doy_offset, ms_offset = SCANLINE_TIME_FIELDS
+
+    times = []
+    file_obj = open(l1d_file, 'rb')
+    try:
+        for idx in range(scanlines):
+            file_obj.seek((header_records + idx) * record_length)
+            data = file_obj.read(ms_offset + 4)
+            if len(data) != ms_offset + 4:
+                return None
+            year = struct.unpack('i', data[year_offset:year_offset + 4])[0]
+            day_of_year = struct.unpack('i', data[doy_offset:doy_offset + 4])[0]
+            time_ms = struct.unpack('i', data[ms_offset:ms_offset + 4])[0]
+            if not (1 <= day_of_year <= 366 and 0 <= time_ms < 86400000):
+                return None
+            try:
+                time_obj = datetime.strptime("{}-{}".format(year, day_of_year), '%Y-%j')
+            except ValueError:
+                return None
+            time_obj += timedelta(milliseconds=time_ms)
+            if time_obj < start_time - tolerance or time_obj > end_time + tolerance:
+                return None
+            if times and time_obj < times[-1]:
+                return None
+            times.append(time_obj)
+    finally:
+        file_obj.close()
+
+    return times
+
+
+def write_level1d(out_file, header_source, header_updates, sources):
+    '''
+    Write a level-1D file with the header records of header_source, with the
+    fields in the dictionary header_updates replaced, followed by the scanline
+    records of sources, a list of (l1d_file, record_length, header_records,
+    first scanline, last scanline). The file is written under a temporary name
+    and renamed into place.
+    '''
+    l1d_file, record_length, header_records = header_source[:3]
+    file_obj = open(l1d_file, 'rb')
+    try:
+        header = bytearray(file_obj.read(header_records * record_length))
+    finally:
+        file_obj.close()
+    if len(header) < max(HEADER_SIZE, header_records * record_length):
+        raise InvalidLevel1D('{} is shorter than its header records'.format(l1d_file))
+
+    for name, format_str, size in HEADER_LAYOUT:
+        if name in header_updates:
+            struct.pack_into(format_str, header, HEADER_OFFSETS[name], header_updates[name])
+
+    tmp_file = path.join(path.dirname(out_file),
+                         '.{}.{}.part'.format(path.basename(out_file), os.getpid()))
+    try:
+        out_obj = open(tmp_file, 'wb')
+        try:
+            out_obj.write(header)
+            for l1d_file, record_length, header_records, first, last in sources:
+                in_obj = open(l1d_file, 'rb')
+                try:
+                    in_obj.seek((header_records + first) * record_length)
+                    size = (last - first + 1) * record_length
+                    data = in_obj.read(size)
+                    if len(data) != size:
+                        raise InvalidLevel1D('{} is shorter than its header records'
+                                             .format(l1d_file))
+                    out_obj.write(data)
+                finally:
+                    in_obj.close()
+        finally:
+            out_obj.close()
+    except Exception:
+        if path.exists(tmp_file):
+            os.unlink(tmp_file)
+        raise
+
+    os.rename(tmp_file, out_file)
+
+    return out_file
+
+
+def trim_level1d(l1d_file, out_dir, header_data, first, last, times, record_length=None):
+    '''
+    Write the scanlines first to last (inclusive) of l1d_file, with their
+    times, to a new level-1D file in out_dir, returning its name.
+    '''
+    record_length = record_length_of(l1d_file, header_data, record_length)
+    out_file = path.join(out_dir, 'trimmed_{}'.format(path.basename(l1d_file)))
+
+    header_updates = {'Number_of_Scanlines': last - first + 1,
+                      'Missing_Scanlines': min(header_data['Missing_Scanlines'],
+                                               last - first + 1)}
+    for prefix, time_obj in [('Start', times[first]), ('End', times[last])]:
+        year, day_of_year, time_ms = header_time_fields(time_obj)
+        header_updates['{}_Data_Set_Year'.format(prefix)] = year
+        header_updates['{}_Data_Set_DOY'.format(prefix)] = day_of_year
+        header_updates['{}_Data_Set_UTC_Time'.format(prefix)] = time_ms
+
+    LOG.info('Trimming {} to scanlines {} to {} of {}'.format(
+        path.basename(l1d_file), first, last, header_data['Number_of_Scanlines']))
+
+    header_records = header_data['Number_of_Header_Records']
+    return write_level1d(out_file, (l1d_file, record_length, header_records), header_updates,
+                         [(l1d_file, record_length, header_records, first, last)])
+
+
+class OverlapFilter(object):
+    '''
+    Decides whether level-1D passes repeat scanlines of the passes processed
+    so far.
+
+    mode:           'skip' to skip duplicate and contained passes, 'trim' to
+                    also trim partly overlapping passes.
+    tolerance:      seconds by which scanline times may differ and still be the
+                    same scanline.
+    min_scanlines:  passes with fewer uncovered scanlines than this are skipped.
+    scanline_times: read the scanline times from the records, rather than
+                    interpolating them from the header.
+    record_length:  the level-1D record length, inferred from the file size if
+                    None.
+    '''
+
+    def __init__(self, mode, tolerance=3., min_scanlines=10, scanline_times=False,
+                 record_length=None):
+        if mode not in DEDUP_MODES:
+            raise ValueError("Unknown de-duplication mode '{}', choose from {}"
+                             .format(mode, DEDUP_MODES))
+        self.mode = mode
+        self.tolerance = timedelta(seconds=tolerance)
+        self.min_scanlines = min_scanlines
+        self.scanline_times = scanline_times
+        self.record_length = record_length
+        self._passes = {}
+
+    def _orbits(self, header_data):
+        start_orbit = header_data['Start_Orbit_Number']
+        end_orbit = max(header_data['End_Orbit_Number'], start_orbit)
+        return start_orbit, end_orbit
+
+    def _candidates(self, Level1D_obj):
+        '''The processed passes of the same satellite which may overlap Level1D_obj.'''
+        header_data = Level1D_obj.header_field_data
+        start_orbit, end_orbit = self._orbits(header_data)
+        candidates = []
+        for other in self._passes.get(header_data['Satellite_ID'], []):
+            if start_orbit > 0 and other['start_orbit'] > 0 and \
+                    (start_orbit > other['end_orbit'] or end_orbit < other['start_orbit']):
+                continue
+            if Level1D_obj.timeObj_start > other['end'] + self.tolerance or \
+                    Level1D_obj.timeObj_end < other['start'] - self.tolerance:
+                continue
+            candidates.append(other)
+        return candidates
+
+    def times_of(self, Level1D_obj, l1d_file=None):
+        '''
+        The scanline times of Level1D_obj, read from the records of the
+        (uncompressed) l1d_file if enabled and possible.
+        '''
+        header_data = Level1D_obj.header_field_data
+        times = None
+        if self.scanline_times and l1d_file is not None:
+            try:
+                record_length = record_length_of(l1d_file, header_data, self.record_length)
+                times = read_scanline_times(l1d_file, header_data, record_length,
+                                            Level1D_obj.timeObj_start, Level1D_obj.timeObj_end)
+            except (IOError, OSError, InvalidLevel1D), err:
+                LOG.debug('Unable to read the scanline times of {}: {}'.format(l1d_file, err))
+            if times is None:
+                LOG.warn('Scanline times of {} are unusable, interpolating them from the header'
+                         .format(path.basename(l1d_file)))
+        if times is None:
+            times = interpolated_times(Level1D_obj.timeObj_start, Level1D_obj.timeObj_end,
+                                       header_data['Number_of_Scanlines'])
+        return times
+
+    def check(self, Level1D_obj, l1d_file=None):
+        '''
+        Return a dictionary with the 'action' for the pass of Level1D_obj:
+        'process', 'skip' or 'trim', with the 'reason', and, for 'trim', the
+        'first' and 'last' scanlines to keep and their 'times'.
+        '''
+        decision = {'action': 'process', 'reason': None, 'first': None, 'last': None,
+                    'times': None}
+        if self.mode == 'none':
+            return decision
+
+        candidates = self._candidates(Level1D_obj)
+        if not candidates:
+            return decision
+
+        for other in candidates:
+            if abs(Level1D_obj.timeObj_start - other['start']) <= self.tolerance and \
+                    abs(Level1D_obj.timeObj_end - other['end']) <= self.tolerance:
+                decision['action'] = 'skip'
+                decision['reason'] = 'duplicate of {}'.format(other['name'])
+                return decision
+
+        times = self.times_of(Level1D_obj, l1d_file)
+        uncovered = [idx for idx, time_obj in enumerate(times)
+                     if not [x for x in candidates
+                             if x['start'] - self.tolerance <= time_obj <= x['end'] + self.tolerance]]
+        names = ', '.join([x['name'] for x in candidates])
+
+        if len(uncovered) < min(self.min_scanlines, len(times)) or not uncovered:
+            decision['action'] = 'skip'
+            decision['reason'] = 'contained in {}, {} new scanlines'.format(names, len(uncovered))
+        elif len(uncovered) < len(times):
+            decision['reason'] = 'overlaps {}, {} of {} scanlines are new'.format(
+                names, len(uncovered), len(times))
+            if self.mode == 'trim':
+                decision['action'] = 'trim'
+                decision['first'] = uncovered[0]
+                decision['last'] = uncovered[-1]
+                decision['times'] = times
+
+        return decision
+
+    def add(self, Level1D_obj):
+        '''Add the pass of Level1D_obj to the coverage.'''
+        header_data = Level1D_obj.header_field_data
+        start_orbit, end_orbit = self._orbits(header_data)
+        self._passes.setdefault(header_data['Satellite_ID'], []).append(
+            {'name': path.basename(Level1D_obj.input_file),
+             'start': Level1D_obj.timeObj_start,
+             'end': Level1D_obj.timeObj_end,
+             'start_orbit': start_orbit,
+             'end_orbit': end_orbit})
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+iapp_pipeline.py
+
+Purpose: Library interface for running IAPP retrievals from a long-lived Python
+         process, without going through the iapp_level2.py command line.
+
+Example:
+
+    from iapp_pipeline import IappPipeline
+    from iapp_utils import IappError
+
+    with IappPipeline('/data/work', instrument_combo=4) as pipeline:
+        try:
+            result = pipeline.run_granule('/data/in/hirsl1d_noaa19.l1d', 'noaa19')
+            print result.output_file
+        except IappError as err:
+            print err, err.run_dir
+
+The pipeline never configures logging; messages go to the 'iapp_level2',
+'iapp_utils' and 'ANC.Utils' loggers, to be handled as the host application
+sees fit. The pipeline changes the working directory while the ancillary data
+is prepared, so a process should only drive one granule at a time (the regions
+option runs the retrievals of a granule concurrently, once that is done).
+
+Copyright (c) 2014 University of Wisconsin Regents.
+Licensed under GNU GPLv3.
+"""
+
+import os
+import logging
+import argparse
+from os import path
+from time import time
+
+from iapp_utils import IappError, IappCrash, AncillaryError, RetrievalProblem, InvalidLevel1D
+from iapp_utils import CsppEnvironment, set_config
+from iapp_level2 import DEFAULT_OPTIONS, process_granule, cleanup, run_root_dir
+from iapp_cleanup import CleanupWorker
+
+LOG = logging.getLogger(__name__)
+
+
+def default_options(**kwargs):
+    '''
+    Return an options namespace, equivalent to that produced by the
+    iapp_level2.py command line, with the default values updated from kwargs.
+    '''
+    options = dict(DEFAULT_OPTIONS)
+    options.update({'input_file': [], 'satellite': None})
+
+    for key in kwargs.keys():
+        if key not in options:
+            raise ValueError("Unknown IAPP option '{}'".format(key))
+
+    options.update(kwargs)
+
+    return argparse.Namespace(**options)
+
+
+class GranuleResult(object):
+    '''
+    The outcome of running IAPP on a single level-1D file.
+
+    status is one of 'success', 'problem' (an invalid level-1D file, no usable
+    ancillary data or no valid retrievals), 'crashed' (iapp_main failed),
+    'memory_limit' or 'cpu_limit' (iapp_main was stopped by its resource limits)
+    or 'failed' (anything else).
+
+    If the regions option was given, output_file is None and regions maps each
+    region name onto a dictionary holding its output_file, rc_dict and error.
+    '''
+
+    def __init__(self, input_file, satellite, status, output_file=None, run_dir=None,
+                 rc_dict=None, error=None, elapsed=0., regions=None):
+        self.input_file = input_file
+        self.satellite = satellite
+        self.status = status
+        self.output_file = output_file
+        self.run_dir = run_dir
+        self.rc_dict = {} if rc_dict is None else rc_dict
+        self.error = error
+        self.elapsed = elapsed
+        self.regions = {} if regions is None else regions
+
+    @property
+    def ok(self):
+        return self.status == 'success'
+
+    def __repr__(self):
+        return "GranuleResult({!r}, status={!r}, output_file={!r})".format(
+            path.basename(self.input_file), self.status, self.output_file)
+
+
+def _status_of(err):
+    '''Map a processing exception onto a GranuleResult status.'''
+    if isinstance(err, IappCrash):
+        # Runs stopped by their resource limits ('memory_limit', 'cpu_limit')
+        killed = getattr(err, 'granule_dict', {}).get('rc_dict', {}).get('killed')
+        if killed in ['memory_limit', 'cpu_limit']:
+            return killed
+        return 'crashed'
+    if isinstance(err, (AncillaryError, RetrievalProblem, InvalidLevel1D)):
+        return 'problem'
+    return 'failed'
+
+
+class IappPipeline(object):
+    '''
+    Runs IAPP retrievals in-process, writing outputs to work_dir.
+
+    Keyword arguments are processing options, with the same names as the
+    destinations of the iapp_level2.py command line options (e.g.
+    instrument_combo, retrieval_method, lower_latitude, forecast_model_file).
+    If config is given, it replaces the process-wide CsppConfig.
+    '''
+
+    def __init__(self, work_dir, config=None, **options):
+        self.work_dir = path.abspath(path.expanduser(work_dir))
+        self.options = vars(default_options(**options))
+
+        if config is not None:
+            set_config(config)
+
+        if not path.isdir(self.work_dir):
+            LOG.info('creating directory {}'.format(self.work_dir))
+            os.makedirs(self.work_dir)
+
+        self.cleanup_worker = CleanupWorker(max_wreckage=self.options['keep_wreckage'],
+                                            min_free_space=self.options['min_free_space'])
+
+    def _options_for(self, satellite, overrides):
+        options = dict(self.options)
+        options.update(overrides)
+        if satellite is not None:
+            options['satellite'] = satellite
+
+        if options['satellite'] is None:
+            raise ValueError("A satellite name must be given")
+
+        return default_options(**options)
+
+    def run_granule(self, l1d_path, satellite=None, **options):
+        '''
+        Run IAPP on a single level-1D file, returning a GranuleResult.
+
+        Raises an IappError subclass if the granule could not be processed
+        (InvalidLevel1D, AncillaryError, IappCrash, RetrievalProblem), or
+        CsppEnvironment if the installation is incomplete.
+        '''
+        options = self._options_for(satellite, options)
+        l1d_path = path.abspath(path.expanduser(l1d_path))
+        options.input_file = [l1d_path]
+
+        try:
+            granule_dict = process_granule(l1d_path, self.work_dir, options,
+                                           self.cleanup_worker)
+        finally:
+            self.cleanup_worker.enforce_retention(self.work_dir)
+
+        return GranuleResult(l1d_path, options.satellite, 'success',
+                             output_file=granule_dict['output_file'],
+                             run_dir=granule_dict['run_dir'],
+                             rc_dict=granule_dict['rc_dict'],
+                             elapsed=granule_dict['elapsed'],
+                             regions=granule_dict.get('regions'))
+
+    def run_granules(self, l1d_paths, satellite=None, **options):
+        '''
+        Run IAPP on each of the level-1D files, returning a list of
+        GranuleResult objects. Granule failures are recorded in the results
+        rather than raised; CsppEnvironment is still raised, since no further
+        granule could succeed.
+
+        l1d_paths may be any iterable, including an iapp_scheduler.GranuleScheduler,
+        to which files can be pushed while it is being run.
+        '''
+        results = []
+        satellite = self.options['satellite'] if satellite is None else satellite
+
+        for l1d_path in l1d_paths:
+            t1 = time()
+            try:
+                results.append(self.run_granule(l1d_path, satellite, **options))
+            except CsppEnvironment:
+                raise
+            except Exception, err:
+                run_dir = getattr(err, 'run_dir', None)
+                granule_dict = getattr(err, 'granule_dict', {})
+                results.append(GranuleResult(path.abspath(l1d_path), satellite,
+                                             _status_of(err),
+                                             output_file=granule_dict.get('output_file'),
+                                             run_dir=run_dir,
+                                             rc_dict=granule_dict.get('rc_dict'),
+                                             error=err, elapsed=time() - t1,
+                                             regions=granule_dict.get('regions')))
+
+        return results
+
+    def close(self):
+        '''
+        Remove the IAPP coefficient link from the run directory area, and wait
+        for the removal of finished run directories.
+        '''
+        coeff_dir = path.join(run_root_dir(self.work_dir, default_options(**self.options)),
+                              'iapp_coefs')
+        if path.islink(coeff_dir):
+            cleanup([coeff_dir])
+
+        self.cleanup_worker.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        return False
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+iapp_qa.py
+
+Purpose: Quality summary of an IAPP retrieval NetCDF file, written as a small
+         JSON sidecar beside the output so that downstream users need not open
+         the retrieval file to find out what is in it.
+
+The summary contains the number of fields of regard (FORs) with a temperature
+retrieval, the fraction of fill values in each of the key retrieval fields, the
+lat/lon bounding box of the retrieved FORs, and the min/max of the key fields.
+Only the latitude, longitude and key retrieval variables are read.
+
+Requires numpy and netCDF4 (both shipped in ShellB3); if they can't be imported
+compute_qa_summary() returns None and the caller falls back to other checks.
+
+Copyright (c) 2014 University of Wisconsin Regents.
+Licensed under GNU GPLv3.
+"""
+
+import os
+import json
+import logging
+import traceback
+from os import path
+
+LOG = logging.getLogger(__name__)
+
+QA_SUFFIX = '.qa.json'
+
+# The variable deciding whether a FOR was retrieved, and the variables which
+# are summarised if they are present in the output file.
+RETRIEVAL_FIELD = 'Temperature_Retrieval'
+LATITUDE_FIELDS = ['Latitude', 'latitude', 'lat']
+LONGITUDE_FIELDS = ['Longitude', 'longitude', 'lon']
+KEY_FIELDS = ['Temperature_Retrieval',
+              'Dewpoint_Retrieval',
+              'Mixing_Ratio_Retrieval',
+              'Total_Precipitable_Water',
+              'Total_Ozone',
+              'Skin_Temperature',
+              'Surface_Pressure']
+
+
+def _import_netcdf():
+    try:
+        import numpy as np
+        from netCDF4 import Dataset, default_fillvals
+    except ImportError:
+        return None, None, None
+
+    return np, Dataset, default_fillvals
+
+
+def _first_present(nc_obj, names):
+    for name in names:
+        if name in nc_obj.variables:
+            return name
+    return None
+
+
+def _read_with_mask(np, default_fillvals, var_obj):
+    '''
+    Read a variable without automatic masking, returning the data and a boolean
+    array which is True where the data is fill.
+    '''
+    var_obj.set_auto_maskandscale(False)
+    data = var_obj[:]
+
+    fill_values = []
+    for attr in ['_FillValue', 'missing_value']:
+        if attr in var_obj.ncattrs():
+            fill_values.append(getattr(var_obj, attr))
+    if not fill_values:
+        fill_key = data.dtype.str[1:]
+        if fill_key in default_fillvals:
+            fill_values.append(default_fillvals[fill_key])
+
+    is_fill = np.zeros(data.shape, dtype=bool)
+    for fill_value in fill_values:
+        is_fill |= (data == np.array(fill_value, dtype=data.dtype))
+
+    if data.dtype.kind == 'f':
+        is_fill |= ~np.isfinite(data)
+
+    return data, is_fill
+
+
+def _for_view(array):
+    '''
+    Reshape an array so that the first axis is the FOR, collapsing any per-FOR
+    (e.g. level) dimensions into the second axis.
+    '''
+    if array.ndim <= 1:
+        return array.reshape(-1, 1)
+    return array.reshape(-1, array.shape[-1])
+
+
+def compute_qa_summary(nc_file):
+    '''
+    Return a dictionary summarising the retrievals in nc_file, or None if
+    numpy/netCDF4 are unavailable or the file can't be read.
+    '''
+    np, Dataset, default_fillvals = _import_netcdf()
+    if np is None:
+        LOG.debug('numpy/netCDF4 are not available, skipping QA summary')
+        return None
+
+    try:
+        nc_obj = Dataset(nc_file, 'r')
+    except Exception:
+        LOG.warn('Unable to open {} for QA summary'.format(nc_file))
+        LOG.debug(traceback.format_exc())
+        return None
+
+    try:
+        qa_dict = {'file': path.basename(nc_file),
+                   'total_for_count': 0,
+                   'retrieved_for_count': 0,
+                   'fill_fraction': {},
+                   'min': {},
+                   'max': {},
+                   'bounding_box': None}
+
+        # Decide which FORs have a retrieval.
+        if RETRIEVAL_FIELD not in nc_obj.variables:
+            LOG.warn('{} not found in {}'.format(RETRIEVAL_FIELD, nc_file))
+            return qa_dict
+
+        data, is_fill = _read_with_mask(np, default_fillvals, nc_obj.variables[RETRIEVAL_FIELD])
+        for_fill = _for_view(is_fill)
+        retrieved = ~for_fill.all(axis=1)
+        qa_dict['total_for_count'] = int(retrieved.size)
+        qa_dict['retrieved_for_count'] = int(retrieved.sum())
+
+        # Statistics of the key retrieval fields.
+        for field in KEY_FIELDS:
+            if field not in nc_obj.variables:
+                continue
+            if field != RETRIEVAL_FIELD:
+                data, is_fill = _read_with_mask(np, default_fillvals, nc_obj.variables[field])
+            qa_dict['fill_fraction'][field] = float(is_fill.mean()) if is_fill.size else 1.
+            valid_data = data[~is_fill]
+            if valid_data.size:
+                qa_dict['min'][field] = float(valid_data.min())
+                qa_dict['max'][field] = float(valid_data.max())
+            else:
+                qa_dict['min'][field] = None
+                qa_dict['max'][field] = None
+
+        # Bounding box of the retrieved FORs.
+        lat_name = _first_present(nc_obj, LATITUDE_FIELDS)
+        lon_name = _first_present(nc_obj, LONGITUDE_FIELDS)
+        if lat_name is not None and lon_name is not None:
+            lat, lat_fill = _read_with_mask(np, default_fillvals, nc_obj.variables[lat_name])
+            lon, lon_fill = _read_with_mask(np, default_fillvals, nc_obj.variables[lon_name])
+            lat, lon = lat.reshape(-1), lon.reshape(-1)
+            valid = ~(lat_fill.reshape(-1) | lon_fill.reshape(-1))
+            if valid.size == retrieved.size:
+                valid &= retrieved
+            if valid.any():
+                qa_dict['bounding_box'] = {'lat_min': float(lat[valid].min()),
+                                           'lat_max': float(lat[valid].max()),
+                                           'lon_min': float(lon[valid].min()),
+                                           'lon_max': float(lon[valid].max())}
+    except Exception:
+        LOG.warn('Unable to compute QA summary of {}'.format(nc_file))
+        LOG.debug(traceback.format_exc())
+        return None
+    finally:
+        nc_obj.close()
+
+    return qa_dict
+
+
+def qa_sidecar_name(nc_file):
+    '''The name of the QA sidecar of nc_file.'''
+    return "{}{}".format(path.splitext(nc_file)[0], QA_SUFFIX)
+
+
+def write_qa_sidecar(qa_dict, sidecar_file):
+    '''
+    Write the QA summary as JSON, via a temporary file so the sidecar appears
+    complete or not at all.
+    '''
+    tmp_file = path.join(path.dirname(sidecar_file),
+                         '.{}.{}.part'.format(path.basename(sidecar_file), os.getpid()))
+    tmp_obj = open(tmp_file, 'w')
+    json.dump(qa_dict, tmp_obj, indent=2, sort_keys=True)
+    tmp_obj.close()
+    os.rename(tmp_file, sidecar_file)
+
+    LOG.debug('Wrote QA summary {}'.format(sidecar_file))
+
+    return sidecar_file
+
+
+def read_qa_sidecar(nc_file):
+    '''Return the QA summary of nc_file, or None if it has no sidecar.'''
+    sidecar_file = qa_sidecar_name(nc_file)
+    if not path.exists(sidecar_file):
+        return None
+
+    sidecar_obj = open(sidecar_file, 'r')
+    qa_dict = json.load(sidecar_obj)
+    sidecar_obj.close()
+
+    return qa_dict
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+iapp_scheduler.py
+
+Purpose: Order level-1D granules for processing, so that fresh passes are not
+         held up behind a backlog of old ones.
+
+Policies:
+
+    name:     in the order the inputs are found, which is by name within each
+              directory of a walk (see iapp_discovery.walk_files()), and the
+              given order for listed files and manifests. Processing starts
+              with the first file found.
+    sorted:   sort all of the inputs by path name (the historical behaviour).
+              Processing waits until all the inputs have been found.
+    newest:   most recent pass end time first.
+    deadline: earliest deadline first, where the deadline is the pass end time
+              plus a latency budget. Granules which have already missed their
+              deadline are processed after those which can still meet it.
+
+Independently of the policy, granules whose pass ended less than
+realtime_window seconds ago go into a real-time lane, which is always served
+before the backlog lane. Granules may be pushed while the scheduler is being
+iterated (e.g. by a directory watcher in a long-running service); the next pop
+returns the highest priority granule at that time, so a new real-time pass
+preempts the backlog at the next granule boundary. feed() pushes the files from
+an iterable (e.g. a walk of an archive tree) on a background thread, and
+iteration waits for it to finish rather than stopping when the queue is empty.
+Except under the sorted policy, iteration starts with the files found so far,
+so the order is only by priority among the files which have been found.
+
+Copyright (c) 2014 University of Wisconsin Regents.
+Licensed under GNU GPLv3.
+"""
+
+import logging
+import heapq
+import itertools
+import traceback
+from os import path
+from datetime import datetime, timedelta
+from threading import Thread, Condition
+
+LOG = logging.getLogger(__name__)
+
+SCHEDULE_POLICIES = ['name', 'sorted', 'newest', 'deadline']
+
+REALTIME_LANE = 0
+BACKLOG_LANE = 1
+
+
+class GranuleScheduler(object):
+    '''
+    A priority queue of level-1D files.
+
+    header_func:     callable returning an object with timeObj_start/timeObj_end
+                     attributes for a level-1D file (e.g. iapp_level2.Level1D).
+    latency_budget:  seconds after the pass end time by which a granule should
+                     be processed, for the deadline policy.
+    realtime_window: granules whose pass ended less than this many seconds ago
+                     are placed in the real-time lane; None disables the lane.
+    '''
+
+    def __init__(self, policy='name', header_func=None, latency_budget=3600.,
+                 realtime_window=None, now_func=datetime.utcnow):
+        if policy not in SCHEDULE_POLICIES:
+            raise ValueError("Unknown schedule policy '{}', choose from {}"
+                             .format(policy, SCHEDULE_POLICIES))
+        self.policy = policy
+        self.header_func = header_func
+        self.latency_budget = timedelta(seconds=latency_budget)
+        self.realtime_window = None if realtime_window is None \
+            else timedelta(seconds=realtime_window)
+        self.now_func = now_func
+
+        if self._needs_times() and header_func is None:
+            raise ValueError("Schedule policy '{}' requires a header_func".format(policy))
+
+        self._heap = []
+        self._queued = set()
+        self._counter = itertools.count()
+        self._lock = Condition()
+        self._feeders = 0
+
+    def _read_times(self, l1d_file):
+        '''Return the pass start and end times, or (None, None) if unreadable.'''
+        try:
+            header_obj = self.header_func(l1d_file)
+            return header_obj.timeObj_start, header_obj.timeObj_end
+        except Exception:
+            LOG.warn("Unable to read the header of {}, scheduling it last".format(l1d_file))
+            LOG.debug(traceback.format_exc())
+            return None, None
+
+    def _needs_times(self):
+        return self.policy not in ('name', 'sorted') or self.realtime_window is not None
+
+    def priority(self, l1d_file, times):
+        '''
+        Return the sort key of l1d_file, given its pass (start, end) times:
+        lower sorts first.
+        '''
+        # Files of the same priority are popped in the order they were pushed
+        if not self._needs_times():
+            return (BACKLOG_LANE, 0, l1d_file) if self.policy == 'sorted' else (BACKLOG_LANE, 0)
+
+        start_time, end_time = times
+        if end_time is None:
+            return (BACKLOG_LANE, 2, l1d_file)
+
+        now = self.now_func()
+        lane = BACKLOG_LANE
+        if self.realtime_window is not None and now - end_time <= self.realtime_window:
+            lane = REALTIME_LANE
+
+        if self.policy == 'newest':
+            key = (0, -_seconds(end_time))
+        elif self.policy == 'deadline':
+            deadline = end_time + self.latency_budget
+            missed = 1 if deadline < now else 0
+            if missed:
+                # Of the late granules, the least late are the most useful
+                key = (missed, -_seconds(deadline))
+            else:
+                key = (missed, _seconds(deadline))
+        elif self.policy == 'sorted':
+            key = (0, l1d_file)
+        else:
+            key = (0,)
+
+        return (lane,) + key
+
+    def push(self, l1d_file, times=None):
+        '''
+        Queue a level-1D file; a file already in the queue is ignored. times may
+        be the pass (start, end) times, to avoid reading the header.
+        '''
+        l1d_file = path.abspath(l1d_file)
+        if times is None:
+            times = self._read_times(l1d_file) if self._needs_times() else (None, None)
+        priority = self.priority(l1d_file, times)
+
+        with self._lock:
+            if l1d_file in self._queued:
+                return
+            self._queued.add(l1d_file)
+            heapq.heappush(self._heap, (priority, next(self._counter), l1d_file, times))
+            self._lock.notify_all()
+
+        LOG.debug("Scheduled {} with priority {}".format(l1d_file, priority))
+
+    def extend(self, l1d_files):
+        for l1d_file in l1d_files:
+            self.push(l1d_file)
+
+    def feed(self, l1d_files):
+        '''
+        Push the files of the iterable l1d_files on a background thread,
+        returning the thread. Iteration continues until all feeds are done.
+        '''
+        def _feed():
+            try:
+                self.extend(l1d_files)
+            except Exception:
+                LOG.error("Unable to list all of the input files")
+                LOG.debug(traceback.format_exc())
+            finally:
+                with self._lock:
+                    self._feeders -= 1
+                    self._lock.notify_all()
+
+        with self._lock:
+            self._feeders += 1
+
+        feed_thread = Thread(target=_feed, name='GranuleFeed')
+        feed_thread.daemon = True
+        feed_thread.start()
+
+        return feed_thread
+
+    def pop(self):
+        '''Return the highest priority file, or None if the queue is empty.'''
+        with self._lock:
+            if not self._heap:
+                return None
+            priority, _, l1d_file, _ = heapq.heappop(self._heap)
+            self._queued.discard(l1d_file)
+
+        if priority[0] == REALTIME_LANE:
+            LOG.info("Real-time granule {}".format(path.basename(l1d_file)))
+
+        return l1d_file
+
+    def reprioritize(self):
+        '''
+        Recompute all priorities against the current time, e.g. so that
+        granules age out of the real-time lane in a long-running process.
+        '''
+        with self._lock:
+            entries = [(self.priority(l1d_file, times), count, l1d_file, times)
+                       for _, count, l1d_file, times in self._heap]
+            heapq.heapify(entries)
+            self._heap = entries
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __iter__(self):
+        if self.policy == 'sorted':
+            # Sort all of the inputs before starting
+            with self._lock:
+                while self._feeders:
+                    self._lock.wait(1.)
+
+        while True:
+            l1d_file = self.pop()
+            if l1d_file is not None:
+                yield l1d_file
+                continue
+
+            with self._lock:
+                if not self._heap:
+                    if not self._feeders:
+                        return
+                    self._lock.wait(1.)
+
+
+def _seconds(time_obj):
+    '''Seconds since the epoch of a naive UTC datetime.'''
+    return (time_obj - datetime(1970, 1, 1)).total_seconds()
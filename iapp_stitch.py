@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+iapp_stitch.py
+
+Purpose: Join passes delivered as several short level-1D segments into one
+         level-1D file per pass, so that the fixed cost of a run (ancillary
+         retrieval and transcoding, ncgen, linking and the start of iapp_main)
+         is paid once per pass rather than once per segment.
+
+Segments are joined when they are of the same satellite, instrument grid,
+instruments and header layout, continue the orbit (the Start_Orbit_Number of a
+segment is the End_Orbit_Number of the one before it, or the next orbit), and
+continue in time: a segment starts no earlier than the end of the one before
+it, and no more than max_gap seconds later. A joined pass is no longer than
+MAX_PASS_LENGTH. Overlapping segments are not joined; see iapp_overlap.py.
+
+The joined file has the header records of the first segment, with the
+Number_of_Scanlines and Missing_Scanlines of all the segments, and the end
+orbit and time of the last, followed by the scanline records of each segment
+in turn. Compressed segments are decompressed first. Segments which can't be
+joined (e.g. of different record lengths, or with unreadable headers) are
+processed on their own.
+
+Copyright (c) 2014 University of Wisconsin Regents.
+Licensed under GNU GPLv3.
+"""
+
+import os
+import logging
+import traceback
+from os import path
+from datetime import timedelta
+
+from iapp_utils import InvalidLevel1D
+from iapp_validate import MAX_PASS_LENGTH
+from iapp_compression import compression_of, uncompressed_name, decompress_file
+from iapp_overlap import record_length_of, write_level1d
+
+LOG = logging.getLogger(__name__)
+
+# Header fields which must agree for segments to be joined
+MATCHING_FIELDS = ['Satellite_ID', 'Inst_Grid_Code', 'Instruments', 'Number_of_Header_Records',
+                   'Header_Version_Number']
+
+
+def continues(previous, segment, max_gap):
+    '''Whether the Level1D segment continues the Level1D previous.'''
+    previous_data = previous.header_field_data
+    segment_data = segment.header_field_data
+
+    for name in MATCHING_FIELDS:
+        if previous_data[name] != segment_data[name]:
+            return False
+
+    end_orbit = previous_data['End_Orbit_Number']
+    start_orbit = segment_data['Start_Orbit_Number']
+    if end_orbit > 0 and start_orbit > 0 and start_orbit - end_orbit not in [0, 1]:
+        return False
+
+    gap = segment.timeObj_start - previous.timeObj_end
+    return timedelta(0) <= gap <= timedelta(seconds=max_gap)
+
+
+def group_segments(segments, max_gap=20.):
+    '''
+    Return the Level1D objects segments as a list of groups of contiguous
+    segments, each in time order.
+    '''
+    segments = sorted(segments, key=lambda x: (x.header_field_data['Satellite_ID'],
+                                               x.timeObj_start))
+    groups = []
+    for segment in segments:
+        if groups and continues(groups[-1][-1], segment, max_gap) and \
+                segment.timeObj_end - groups[-1][0].timeObj_start <= MAX_PASS_LENGTH:
+            groups[-1].append(segment)
+        else:
+            groups.append([segment])
+
+    return groups
+
+
+def stitch_segments(group, out_dir, record_length=None):
+    '''
+    Join the Level1D objects of group into a single level-1D file in out_dir,
+    returning its name. Raises InvalidLevel1D if they can't be joined.
+    '''
+    last_data = group[-1].header_field_data
+    out_file = path.join(out_dir, 'stitched_{}'.format(
+        path.basename(uncompressed_name(group[0].input_file))))
+
+    decompressed = []
+    try:
+        sources = []
+        for segment in group:
+            l1d_file = segment.input_file
+            if compression_of(l1d_file) is not None:
+                l1d_file = decompress_file(l1d_file, out_dir)
+                decompressed.append(l1d_file)
+            header_data = segment.header_field_data
+            sources.append((l1d_file, record_length_of(l1d_file, header_data, record_length),
+                            header_data['Number_of_Header_Records'], 0,
+                            header_data['Number_of_Scanlines'] - 1))
+
+        if len(set([x[1] for x in sources])) != 1:
+            raise InvalidLevel1D('the segments have different record lengths ({})'.format(
+                ', '.join([str(x[1]) for x in sources])))
+
+        header_updates = {
+            'Number_of_Scanlines': sum([x.header_field_data['Number_of_Scanlines'] for x in group]),
+            'Missing_Scanlines': sum([x.header_field_data['Missing_Scanlines'] for x in group])}
+        for name in ['End_Orbit_Number', 'End_Data_Set_Year', 'End_Data_Set_DOY',
+                     'End_Data_Set_UTC_Time']:
+            header_updates[name] = last_data[name]
+
+        write_level1d(out_file, sources[0], header_updates, sources)
+
+    finally:
+        for l1d_file in decompressed:
+            os.unlink(l1d_file)
+
+    LOG.info('Stitched {} segments ({} scanlines) into {}'.format(
+        len(group), header_updates['Number_of_Scanlines'], out_file))
+    LOG.debug('Stitched segments: {}'.format(', '.join([x.input_file for x in group])))
+
+    return out_file
+
+
+def stitch_inputs(l1d_files, out_dir, header_func, max_gap=20., record_length=None):
+    '''
+    Join the contiguous segments among l1d_files into files in out_dir.
+    header_func returns the Level1D object of a file. Returns the list of
+    files to process, and a dictionary of each joined file and its segments.
+    '''
+    files = []
+    segments = []
+    for l1d_file in l1d_files:
+        try:
+            segments.append(header_func(l1d_file))
+        except Exception:
+            # Left to fail (and be reported) when it is processed
+            LOG.debug(traceback.format_exc())
+            files.append(l1d_file)
+
+    stitched = {}
+    for group in group_segments(segments, max_gap):
+        if len(group) == 1:
+            files.append(group[0].input_file)
+            continue
+
+        if not path.isdir(out_dir):
+            os.makedirs(out_dir)
+        try:
+            stitched_file = stitch_segments(group, out_dir, record_length)
+        except (InvalidLevel1D, IOError, OSError, EOFError), err:
+            LOG.warn('Unable to stitch {}: {}, processing them separately'.format(
+                ', '.join([path.basename(x.input_file) for x in group]), str(err)))
+            LOG.debug(traceback.format_exc())
+            files.extend([x.input_file for x in group])
+            continue
+
+        files.append(stitched_file)
+        stitched[stitched_file] = [x.input_file for x in group]
+
+    return files, stitched
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+iapp_store.py
+
+Purpose: A content-addressed store of IAPP retrieval outputs, so that a granule
+         which is re-run with the same inputs and options reuses the earlier
+         output rather than running iapp_main again.
+
+The key of a result is the SHA-1 of the contents of the level-1D and ancillary
+files, a signature (names, sizes and modification times) of the IAPP
+coefficient directory and executable, and the runfile settings. Each result is
+kept in its own directory, <store>/<key[:2]>/<key>/, holding the output file,
+its QA sidecar and a small JSON metadata file, whose modification time records
+when the result was last used. When the store is larger than its size limit,
+the least recently used results are removed.
+
+Outputs are copied into and out of the store, rather than hard linked, so that
+changes to a published output (e.g. by later processing) can't alter the stored
+result, nor the other outputs reused from it.
+
+Copyright (c) 2014 University of Wisconsin Regents.
+Licensed under GNU GPLv3.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+import traceback
+from os import path
+from shutil import rmtree
+from threading import Lock
+
+LOG = logging.getLogger(__name__)
+
+META_FILE_NAME = 'meta.json'
+STORE_VERSION = 1
+
+CHUNK_SIZE = 1024 * 1024
+
+# Digests of files, keyed on (path, size, mtime), so that the ancillary files
+# shared by many granules are only read once per process.
+_DIGESTS = {}
+_DIGESTS_LOCK = Lock()
+
+
+def file_digest(file_name):
+    '''The SHA-1 hex digest of the contents of file_name.'''
+    file_name = path.realpath(file_name)
+    st = os.stat(file_name)
+    digest_key = (file_name, st.st_size, st.st_mtime)
+
+    with _DIGESTS_LOCK:
+        if digest_key in _DIGESTS:
+            return _DIGESTS[digest_key]
+
+    sha1 = hashlib.sha1()
+    file_obj = open(file_name, 'rb')
+    try:
+        while True:
+            data = file_obj.read(CHUNK_SIZE)
+            if not data:
+                break
+            sha1.update(data)
+    finally:
+        file_obj.close()
+
+    with _DIGESTS_LOCK:
+        _DIGESTS[digest_key] = sha1.hexdigest()
+
+    return _DIGESTS[digest_key]
+
+
+def tree_signature(paths):
+    '''
+    A SHA-1 hex digest of the names, sizes and modification times of the files
+    in paths, descending into directories (and following links).
+    '''
+    entries = []
+    for top in paths:
+        top = path.realpath(top)
+        if not path.isdir(top):
+            st = os.stat(top)
+            entries.append((path.basename(top), st.st_size, st.st_mtime))
+            continue
+        for dir_name, dir_names, file_names in os.walk(top, followlinks=True):
+            dir_names.sort()
+            for file_name in sorted(file_names):
+                file_name = path.join(dir_name, file_name)
+                st = os.stat(file_name)
+                entries.append((path.relpath(file_name, path.dirname(top)),
+                                st.st_size, st.st_mtime))
+
+    return hashlib.sha1(json.dumps(entries)).hexdigest()
+
+
+def inputs_digest(input_files, code_paths):
+    '''
+    The digest of the inputs shared by all runs of a granule: the contents of
+    input_files (a dictionary of file paths, '' for none) and the signature of
+    code_paths.
+    '''
+    inputs = {}
+    for file_key, file_name in input_files.items():
+        inputs[file_key] = file_digest(file_name) if file_name else ''
+
+    return hashlib.sha1(json.dumps({'version': STORE_VERSION,
+                                    'inputs': inputs,
+                                    'code': tree_signature(code_paths)},
+                                   sort_keys=True)).hexdigest()
+
+
+def result_key(granule_digest, settings):
+    '''
+    The store key of a run with the settings dictionary, which holds the
+    runfile settings and anything else which may change the output (e.g. the
+    retry options).
+    '''
+    return hashlib.sha1(json.dumps({'inputs': granule_digest,
+                                    'template_dict': settings},
+                                   sort_keys=True)).hexdigest()
+
+
+def copy_file(src_path, dst_path):
+    '''
+    Copy src_path to dst_path, via a temporary name so that dst_path is never
+    partially written.
+    '''
+    dst_dir, dst_name = path.split(dst_path)
+    tmp_path = path.join(dst_dir, '.{}.{}.part'.format(dst_name, os.getpid()))
+
+    try:
+        shutil.copyfile(src_path, tmp_path)
+        os.rename(tmp_path, dst_path)
+    except Exception:
+        if path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+    return dst_path
+
+
+class ResultStore(object):
+    '''
+    The store of IAPP outputs in store_dir, holding at most max_size bytes
+    (None for no limit).
+    '''
+
+    def __init__(self, store_dir, max_size=None):
+        self.store_dir = path.abspath(store_dir)
+        self.max_size = max_size
+        self._lock = Lock()
+
+        if not path.isdir(self.store_dir):
+            LOG.info('creating directory {}'.format(self.store_dir))
+            os.makedirs(self.store_dir)
+
+    def _entry_dir(self, key):
+        return path.join(self.store_dir, key[:2], key)
+
+    def lookup(self, key):
+        '''
+        Return the metadata of the result with this key, or None on a miss.
+        The metadata holds the stored 'output_file' and 'qa_file' (or None).
+        '''
+        entry_dir = self._entry_dir(key)
+        meta_file = path.join(entry_dir, META_FILE_NAME)
+        try:
+            meta_obj = open(meta_file, 'r')
+            meta = json.load(meta_obj)
+            meta_obj.close()
+        except (IOError, OSError, ValueError):
+            return None
+
+        meta['output_file'] = path.join(entry_dir, str(meta['output_file']))
+        if meta['qa_file'] is not None:
+            meta['qa_file'] = path.join(entry_dir, str(meta['qa_file']))
+        if not path.exists(meta['output_file']):
+            return None
+
+        # Mark the result as recently used
+        try:
+            os.utime(meta_file, None)
+        except OSError:
+            pass
+
+        return meta
+
+    def insert(self, key, output_file, qa_file=None, meta=None):
+        '''
+        Add output_file (and its QA sidecar qa_file) to the store under key.
+        meta is a dictionary of further details to record with the result.
+        '''
+        entry_dir = self._entry_dir(key)
+        if path.exists(entry_dir):
+            return
+
+        parent_dir = path.dirname(entry_dir)
+        tmp_dir = path.join(parent_dir, '.{}.{}.part'.format(key, os.getpid()))
+        try:
+            if not path.isdir(parent_dir):
+                os.makedirs(parent_dir)
+            if path.exists(tmp_dir):
+                rmtree(tmp_dir)
+            os.makedirs(tmp_dir)
+
+            meta = {} if meta is None else dict(meta)
+            meta['output_file'] = path.basename(output_file)
+            meta['qa_file'] = None
+            copy_file(output_file, path.join(tmp_dir, meta['output_file']))
+            if qa_file is not None and path.exists(qa_file):
+                meta['qa_file'] = path.basename(qa_file)
+                copy_file(qa_file, path.join(tmp_dir, meta['qa_file']))
+
+            meta_obj = open(path.join(tmp_dir, META_FILE_NAME), 'w')
+            json.dump(meta, meta_obj, indent=2, sort_keys=True)
+            meta_obj.close()
+
+            os.rename(tmp_dir, entry_dir)
+            LOG.debug('Stored {} as {}'.format(output_file, key))
+
+        except (IOError, OSError), err:
+            # Another process may have stored the same result first
+            LOG.warn('Unable to store {}: {}'.format(output_file, str(err)))
+            LOG.debug(traceback.format_exc())
+            if path.exists(tmp_dir):
+                rmtree(tmp_dir, ignore_errors=True)
+            return
+
+        self.evict()
+
+    def entries(self):
+        '''Return (last used time, size, entry dir) of each result, oldest first.'''
+        entries = []
+        for prefix in os.listdir(self.store_dir):
+            prefix_dir = path.join(self.store_dir, prefix)
+            if len(prefix) != 2 or not path.isdir(prefix_dir):
+                continue
+            for key in os.listdir(prefix_dir):
+                entry_dir = path.join(prefix_dir, key)
+                if key.startswith('.'):
+                    continue
+                try:
+                    size = 0
+                    for file_name in os.listdir(entry_dir):
+                        size += os.stat(path.join(entry_dir, file_name)).st_size
+                    mtime = os.stat(path.join(entry_dir, META_FILE_NAME)).st_mtime
+                except OSError:
+                    continue
+                entries.append((mtime, size, entry_dir))
+
+        entries.sort()
+
+        return entries
+
+    def evict(self):
+        '''Remove the least recently used results until the store fits in max_size.'''
+        if self.max_size is None:
+            return
+
+        with self._lock:
+            entries = self.entries()
+            total_size = sum([size for mtime, size, entry_dir in entries])
+            for mtime, size, entry_dir in entries:
+                if total_size <= self.max_size:
+                    break
+                LOG.debug('Evicting {} from the result store'.format(entry_dir))
+                rmtree(entry_dir, ignore_errors=True)
+                total_size -= size
+
+
+# One store per store directory in each process
+_STORES = {}
+_STORES_LOCK = Lock()
+
+
+def get_result_store(store_dir, max_size=None):
+    '''Return the (per-process) result store in store_dir.'''
+    store_dir = path.abspath(store_dir)
+    with _STORES_LOCK:
+        if store_dir not in _STORES:
+            _STORES[store_dir] = ResultStore(store_dir, max_size)
+        return _STORES[store_dir]
@@ -17,10 +17,19 @@ import glob
 import traceback
 import time
 import types
+import errno
+import shutil
+import signal
 import fileinput
+import atexit
 
 from subprocess import Popen, CalledProcessError, call, PIPE
 from datetime import datetime
+from threading import Thread, Event, Lock, local
+from Queue import Queue, Empty
+
+from iapp_limits import make_preexec_fn, limit_kill_reason
+from iapp_affinity import pinned_preexec_fn
 
 LOG = logging.getLogger('iapp_utils')
 
@@ -43,6 +52,119 @@ class SingleLevelFilter(logging.Filter):
             return (record.levelno in self.passlevels)
 
 
+# The log context of each thread (e.g. the region it runs), see set_log_context()
+_log_context = local()
+
+
+def set_log_context(name):
+    '''Set the log context of the records logged by this thread, None for none.'''
+    _log_context.name = name
+
+
+class ContextFilter(logging.Filter):
+    '''
+    Passes the records logged in the log context name. Records are stamped
+    with their context when queued (see QueueHandler), as they are written on
+    another thread; otherwise the context is that of the writing thread.
+    '''
+    def __init__(self, name):
+        logging.Filter.__init__(self)
+        self.context = name
+
+    def filter(self, record):
+        if hasattr(record, 'log_context'):
+            return record.log_context == self.context
+        return getattr(_log_context, 'name', None) == self.context
+
+
+class CachingFormatter(logging.Formatter):
+    '''
+    A Formatter which formats the date and time of the records to the second
+    once per second, rather than calling strftime() for every record. The
+    milliseconds come from %(msecs) in the format string.
+    '''
+    def __init__(self, fmt=None, datefmt=None):
+        logging.Formatter.__init__(self, fmt, datefmt)
+        self._cached = (None, None)
+
+    def formatTime(self, record, datefmt=None):
+        second = int(record.created)
+        cached_second, cached_str = self._cached
+        if second != cached_second:
+            cached_str = logging.Formatter.formatTime(self, record, datefmt)
+            self._cached = (second, cached_str)
+        return cached_str
+
+
+class QueueHandler(logging.Handler):
+    '''
+    Puts log records on a queue, to be written out by a QueueListener on its
+    own thread, so that the logging thread never waits on the I/O (as
+    logging.handlers.QueueHandler in Python 3).
+    '''
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def prepare(self, record):
+        # Merge the message with its arguments, and render any traceback now,
+        # since they may have changed by the time the record is written.
+        record.msg = record.getMessage()
+        record.args = None
+        record.log_context = getattr(_log_context, 'name', None)
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(object):
+    '''
+    Writes the log records put on queue by a QueueHandler to handlers, on a
+    background thread.
+    '''
+    _sentinel = None
+
+    def __init__(self, queue, *handlers):
+        self.queue = queue
+        self.handlers = list(handlers)
+        self._thread = None
+
+    def add_handler(self, handler):
+        # Replace the list rather than changing it, as the thread may be using it
+        self.handlers = self.handlers + [handler]
+
+    def start(self):
+        self._thread = Thread(target=self._monitor, name='LogListener')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def handle(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def _monitor(self):
+        while True:
+            record = self.queue.get()
+            if record is self._sentinel:
+                break
+            self.handle(record)
+
+    def stop(self):
+        '''Write out the records still on the queue, and stop the thread.'''
+        if self._thread is not None:
+            self.queue.put(self._sentinel)
+            self._thread.join()
+            self._thread = None
+
+
 def _ldd_verify(exe):
     "check that a program is ready to run"
     rc = call(['ldd', exe], stdout=os.tmpfile(), stderr=os.tmpfile())
@@ -101,6 +223,39 @@ class CsppEnvironment(Exception):
         return repr(self.value)
 
 
+class IappError(Exception):
+    '''
+    Base class for failures while processing a single granule. The run_dir
+    attribute holds the location of the (renamed) run directory, if any.
+    '''
+    def __init__(self, value, run_dir=None):
+        self.value = value
+        self.run_dir = run_dir
+
+    def __str__(self):
+        return str(self.value)
+
+
+class AncillaryError(IappError):
+    '''The dynamic ancillary data could not be retrieved or transcoded.'''
+    pass
+
+
+class IappCrash(IappError):
+    '''iapp_main returned a non-zero return value.'''
+    pass
+
+
+class RetrievalProblem(IappError):
+    '''iapp_main ran, but the output contains no valid retrievals.'''
+    pass
+
+
+class InvalidLevel1D(IappError):
+    '''The level-1D file is truncated, corrupt or unsuitable for the options.'''
+    pass
+
+
 def check_and_convert_path(key, a_path, check_write=False):
     """
     Make sure the path or paths specified exist
@@ -118,7 +273,7 @@ def check_and_convert_path(key, a_path, check_write=False):
         if not os.path.exists(path):
             LOG.error("Environment variable {} refers to a path that does not exists.  {}={}".format(key, key, path))
             LOG.error("Make sure package HOME variable is set and the package home environment script is sourced.")
-            sys.exit(2)
+            raise CsppEnvironment("{}={} does not exist".format(key, path))
         else:
             LOG.debug("Found: {} at {} {}".format(key, path, os.path.abspath(path)))
             abs_locations.append(os.path.abspath(path))
@@ -126,7 +281,7 @@ def check_and_convert_path(key, a_path, check_write=False):
         if check_write is True:
             if not os.access(path, os.W_OK):
                 LOG.error("Path exists but is not writable {}={}".format(key, path))
-                sys.exit(2)
+                raise CsppEnvironment("{}={} is not writable".format(key, path))
 
     # return a string if only one and an array if more
     if len(abs_locations) == 1:
@@ -149,9 +304,8 @@ def check_existing_env_var(varname, default_value=None):
         if default_value is not None:
             value = default_value
         else:
-            print >>sys.stderr, "ERROR: %s is not set, please update environment and re-try" % varname
             LOG.error("Environment variable missing. {}".format(varname))
-            sys.exit(9)
+            raise CsppEnvironment("{} is not set, please update environment and re-try".format(varname))
 
     return value
 
@@ -163,11 +317,11 @@ def check_and_convert_env_var(varname, check_write=False, default_value=None):
 
 
 def what_package_am_i():
-    file_path = sys.argv[0]
-    LOG.debug("Script location is {}".format(file_path))
+    file_path = os.path.abspath(__file__)
+    LOG.debug("Module location is {}".format(file_path))
 
-    cspp_x = file_path.split("/scripts/iapp_level2.py")
-    cspp_x_home = cspp_x[0]
+    # This module lives in $CSPP_IAPP_HOME/scripts
+    cspp_x_home = os.path.dirname(os.path.dirname(file_path))
     LOG.debug("capp_x_home path is {}".format(cspp_x_home))
 
     return cspp_x_home
@@ -180,63 +334,110 @@ DDS_PRODUCT_FILE=None
 #ADL_HOME=None
 
 
-IAPP_VARS={}
-IAPP_HOME=None
+class CsppConfig(object):
+    """
+    Lazily resolved CSPP/IAPP path configuration.
+
+    Each path is looked up the first time it is accessed (override, then the
+    environment, then the package default), checked for existence, and cached.
+    Nothing is resolved, and os.environ is never modified, when the object is
+    created, so importing a module which holds a CsppConfig is cheap. A missing
+    variable or path raises CsppEnvironment.
+
+    Keyword arguments override the environment, e.g.
+
+        set_config(CsppConfig(IAPP_HOME='/opt/iapp', CSPP_RT_HOME='/opt/cspp'))
+    """
+
+    def __init__(self, environ=None, **overrides):
+        self.environ = os.environ if environ is None else environ
+        self.overrides = overrides
+        self._cache = {}
+
+    def _lookup(self, varname, default_func, check_path=True):
+        if varname not in self._cache:
+            if varname in self.overrides:
+                value = self.overrides[varname]
+            elif varname in self.environ:
+                value = self.environ[varname]
+            else:
+                value = default_func()
+
+            if check_path:
+                value = check_and_convert_path(varname, value)
+            self._cache[varname] = value
+
+        return self._cache[varname]
+
+    def reset(self):
+        """Forget all resolved values, they will be looked up again on next use."""
+        self._cache.clear()
 
+    @property
+    def CSPP_RT_HOME(self):
+        # This should be the same as CSPP_IAPP_HOME
+        return self._lookup('CSPP_RT_HOME', what_package_am_i)
 
-def initialize_IAPP_variables(cspp_xdr_home):
-    global IAPP_HOME
-    global DDS_PRODUCT_FILE
-    global IAPP_VARS
+    @property
+    def CSPP_RT_ANC_CACHE_DIR(self):
+        return self._lookup('CSPP_RT_ANC_CACHE_DIR',
+                            lambda: os.path.join(self.CSPP_RT_HOME, "anc/cache"))
 
-    default = os.path.join(cspp_xdr_home, "common", "IAPP_VENDOR")
-    IAPP_HOME = check_and_convert_env_var('IAPP_HOME', check_write=False, default_value=default)
-    IAPP_VARS['IAPP_HOME'] = IAPP_HOME
+    @property
+    def CSPP_RT_ANC_PATH(self):
+        return self._lookup('CSPP_RT_ANC_PATH',
+                            lambda: os.path.join(self.CSPP_RT_HOME, "anc/cache/luts"))
 
-    for key in IAPP_VARS.iterkeys():
-        os.environ[key] = IAPP_VARS[key]
-        LOG.info("Var " + os.environ[key])
+    @property
+    def CSPP_RT_ANC_HOME(self):
+        return self._lookup('CSPP_RT_ANC_HOME',
+                            lambda: os.path.join(self.CSPP_RT_HOME, "anc/static"))
 
+    @property
+    def CSPP_RT_ANC_TILE_PATH(self):
+        return self._lookup('CSPP_RT_ANC_TILE_PATH',
+                            lambda: os.path.join(self.CSPP_RT_HOME, "anc", "static"))
 
-CSPP_RT_ANC_CACHE_DIR = None
-CSPP_RT_ANC_PATH = None
-CSPP_RT_ANC_HOME = None
-CSPP_RT_ANC_TILE_PATH = None
-JPSS_REMOTE_ANC_DIR = None
+    @property
+    def JPSS_REMOTE_ANC_DIR(self):
+        # default="http://jpssdb.ssec.wisc.edu/cspp_v_2_0/ancillary"
+        return self._lookup('JPSS_REMOTE_ANC_DIR',
+                            lambda: "ftp://ftp.ssec.wisc.edu/pub/eosdb/ancillary",
+                            check_path=False)
 
-CSPP_PATHS = {}
+    @property
+    def IAPP_HOME(self):
+        return self._lookup('IAPP_HOME',
+                            lambda: os.path.join(self.CSPP_RT_HOME, "common", "IAPP_VENDOR"))
 
-def check_anc_cache(check_write=True):
-    default = os.path.join(CSPP_RT_HOME, "anc/cache")
-    CSPP_RT_ANC_CACHE_DIR = check_and_convert_env_var('CSPP_RT_ANC_CACHE_DIR', check_write=check_write, default_value=default)
+    def exported_vars(self):
+        """
+        Variables which child processes expect to find in their environment.
+        """
+        return {'IAPP_HOME': self.IAPP_HOME}
 
 
-def initialize_cspp_variables(cspp_home):
-    global CSPP_RT_ANC_TILE_PATH
-    global CSPP_RT_ANC_CACHE_DIR
-    global CSPP_RT_ANC_PATH
-    global CSPP_RT_ANC_HOME
-    global NAGG
-    global REPACK
-    global JPSS_REMOTE_ANC_DIR
+_CONFIG = CsppConfig()
 
-    global CSPP_PATHS
-    global EXTERNAL_BINARY
 
-    default = os.path.join(cspp_home, "anc/cache")
-    CSPP_RT_ANC_CACHE_DIR = check_and_convert_env_var('CSPP_RT_ANC_CACHE_DIR', check_write=False, default_value=default)
+def get_config():
+    """
+    Return the process-wide CsppConfig.
+    """
+    return _CONFIG
 
-    default = os.path.join(cspp_home, "anc/cache/luts")
-    CSPP_RT_ANC_PATH = check_and_convert_env_var('CSPP_RT_ANC_PATH', check_write=False, default_value=default)
 
-    default = os.path.join(cspp_home, "anc/static")
-    CSPP_RT_ANC_HOME = check_and_convert_env_var('CSPP_RT_ANC_HOME', check_write=False, default_value=default)
-    default = os.path.join(cspp_home, "anc", "static")
-    CSPP_RT_ANC_TILE_PATH = check_and_convert_env_var('CSPP_RT_ANC_TILE_PATH', check_write=False, default_value=default)
+def set_config(config):
+    """
+    Replace the process-wide CsppConfig (for tests, or when embedding IAPP in
+    a long-running service), returning the previous one.
+    """
+    global _CONFIG
+
+    old_config = _CONFIG
+    _CONFIG = config
 
-    # default="http://jpssdb.ssec.wisc.edu/cspp_v_2_0/ancillary"
-    default = "ftp://ftp.ssec.wisc.edu/pub/eosdb/ancillary"
-    JPSS_REMOTE_ANC_DIR = check_existing_env_var("JPSS_REMOTE_ANC_DIR", default_value=default)
+    return old_config
 
 
 def check_env(work_dir):
@@ -250,13 +451,21 @@ def check_env(work_dir):
 
 
 logging_configured = False
+_log_listener = None
+_log_file = None
+_log_formatter = None
+_context_handlers = {}
+_context_handlers_lock = Lock()
 
 
-def configure_logging(level=logging.WARNING, FILE=None):
+def configure_logging(level=logging.WARNING, FILE=None, asynchronous=False):
     '''
     route logging INFO and DEBUG to stdout instead of stderr, affects entire application
+
+    If asynchronous is True, records are only queued by the logging thread,
+    and are formatted and written by a background thread; see stop_logging().
     '''
-    global logging_configured
+    global logging_configured, _log_listener, _log_file, _log_formatter
 
     # create a formatter to be used across everything
     #if level == logging.ERROR : print "logging is ERROR"
@@ -265,11 +474,11 @@ def configure_logging(level=logging.WARNING, FILE=None):
     #if level == logging.DEBUG : print "logging is DEBUG"
 
     if level == logging.DEBUG:
-        fm = logging.Formatter(
+        fm = CachingFormatter(
             '%(asctime)s.%(msecs)03d (%(levelname)s) : %(filename)s : %(funcName)s : %(lineno)d:%(message)s',
             datefmt='%Y-%m-%d %H:%M:%S')
     else:
-        fm = logging.Formatter(
+        fm = CachingFormatter(
             '%(asctime)s.%(msecs)03d (%(levelname)s) : %(message)s',
             datefmt='%Y-%m-%d %H:%M:%S')
 
@@ -290,8 +499,16 @@ def configure_logging(level=logging.WARNING, FILE=None):
         f2 = SingleLevelFilter([logging.INFO, logging.DEBUG], True)
         h2.addFilter(f2)
         h2.setFormatter(fm)
-        rootLogger.addHandler(h1)
-        rootLogger.addHandler(h2)
+
+        if asynchronous:
+            log_queue = Queue()
+            _log_listener = QueueListener(log_queue, h1, h2)
+            _log_listener.start()
+            atexit.register(stop_logging)
+            rootLogger.addHandler(QueueHandler(log_queue))
+        else:
+            rootLogger.addHandler(h1)
+            rootLogger.addHandler(h2)
 
     h3 = None
     if FILE is not None:
@@ -301,11 +518,52 @@ def configure_logging(level=logging.WARNING, FILE=None):
 #        f3 = SingleLevelFilter([logging.INFO, logging.DEBUG], False)
 #        h3.addFilter(f3)
         h3.setFormatter(fm)
-        rootLogger.addHandler(h3)
+        if _log_listener is not None:
+            _log_listener.add_handler(h3)
+        else:
+            rootLogger.addHandler(h3)
+        _log_file = FILE
+    _log_formatter = fm
 
     rootLogger.setLevel(level)
 
 
+def add_context_log_file(name):
+    '''
+    Also write the records of log context name (see set_log_context()) to a
+    log file of their own beside the log file given to configure_logging(),
+    e.g. iapp_level2.<time>.<name>.log, so that the records of concurrent
+    threads can be read apart. The file is opened on the first call for name,
+    and kept open. Returns the file name, or None if there is no log file.
+    '''
+    if _log_file is None:
+        return None
+
+    with _context_handlers_lock:
+        if name not in _context_handlers:
+            context_file = "{}.{}.log".format(os.path.splitext(_log_file)[0], name)
+            handler = logging.FileHandler(filename=context_file)
+            handler.addFilter(ContextFilter(name))
+            handler.setFormatter(_log_formatter)
+            if _log_listener is not None:
+                _log_listener.add_handler(handler)
+            else:
+                logging.getLogger().addHandler(handler)
+            _context_handlers[name] = handler
+
+        return _context_handlers[name].baseFilename
+
+
+def stop_logging():
+    '''
+    With asynchronous logging, write out the queued records and stop the
+    background thread. Called at exit.
+    '''
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+
+
 def _test_logging():
     LOG.debug('debug message')
     LOG.info('info message')
@@ -326,6 +584,7 @@ def env(**kv):
     augment environment with new values
     '''
     zult = dict(os.environ)
+    zult.update(get_config().exported_vars())
     zult.update(kv)
 
     return zult
@@ -441,6 +700,44 @@ def link_ancillary_to_work_dir(work_dir, anc_path_seq):
             raise
 
 
+def publish_file(src_path, dst_path):
+    """
+    Move src_path to dst_path so that dst_path is either absent or complete,
+    never partially written. Within a filesystem this is a rename; across
+    filesystems the file is copied to a temporary name beside dst_path,
+    flushed to disk, and then renamed into place.
+    """
+    try:
+        os.rename(src_path, dst_path)
+        return dst_path
+    except OSError as err:
+        if err.errno != errno.EXDEV:
+            raise
+
+    dst_dir, dst_name = os.path.split(dst_path)
+    tmp_path = os.path.join(dst_dir, '.{}.{}.part'.format(dst_name, os.getpid()))
+    LOG.debug('Publishing {} to {} via {}'.format(src_path, dst_path, tmp_path))
+
+    try:
+        src_obj = open(src_path, 'rb')
+        tmp_obj = open(tmp_path, 'wb')
+        shutil.copyfileobj(src_obj, tmp_obj, 1024 * 1024)
+        src_obj.close()
+        tmp_obj.flush()
+        os.fsync(tmp_obj.fileno())
+        tmp_obj.close()
+        shutil.copystat(src_path, tmp_path)
+        os.rename(tmp_path, dst_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+    os.unlink(src_path)
+
+    return dst_path
+
+
 def get_return_code(num_unpacking_problems, num_xml_files_to_process,
                     num_no_output_runs, noncritical_problem, environment_error):
     """
@@ -489,20 +786,25 @@ def make_time_stamp_d(timeObj):
     return "{} {}".format(dateStamp,timeStamp)
 
 
+# The last (second, formatted date and time) of make_time_stamp_m()
+_time_stamp_cache = (None, None)
+
+
 def make_time_stamp_m(timeObj):
     """
-    Returns a timestamp ending in milliseconds
+    Returns a timestamp ending in milliseconds. The date and time to the second
+    are only formatted when the second changes, as this is called for every
+    line of output of the executables.
     """
-    dateStamp = timeObj.strftime("%Y-%m-%d")
-    seconds = repr(int(round(timeObj.second + float(timeObj.microsecond)/1000000.)))
+    global _time_stamp_cache
+    second = timeObj.replace(microsecond=0)
+    cached_second, cached_stamp = _time_stamp_cache
+    if second != cached_second:
+        cached_stamp = second.strftime("%Y-%m-%d %H:%M:%S")
+        _time_stamp_cache = (second, cached_stamp)
     milliseconds = int(round(float(timeObj.microsecond)/1000.))
-    milliseconds = repr(000 if milliseconds > 999 else milliseconds)
-    timeStamp = "{}.{}".format(timeObj.strftime("%H:%M:%S"),str(milliseconds).zfill(3))
-    return "{} {}".format(dateStamp,timeStamp)
-
-import threading
-from threading import Thread, Event
-from Queue import Queue, Empty
+    milliseconds = 0 if milliseconds > 999 else milliseconds
+    return "{}.{:03d}".format(cached_stamp, milliseconds)
 
 class NonBlockingStreamReader:
     """
@@ -555,11 +857,46 @@ class UnexpectedEndOfStream(Exception):
     pass
 
 
+def kill_process_group(pop, grace_period=10.):
+    """
+    Terminate the process group led by pop (started with preexec_fn=os.setsid),
+    so that the shell and everything it started goes. Processes still running
+    after grace_period seconds are killed.
+    """
+    for sig in [signal.SIGTERM, signal.SIGKILL]:
+        try:
+            os.killpg(pop.pid, sig)
+        except OSError, err:
+            if err.errno != errno.ESRCH:
+                raise
+            break
+
+        if sig == signal.SIGKILL:
+            break
+
+        deadline = time.time() + grace_period
+        while pop.poll() is None and time.time() < deadline:
+            time.sleep(0.1)
+        if pop.poll() is not None:
+            break
+
+    pop.wait()
+
+
 def execute_binary_captured_inject_io(work_dir, cmd, err_dict, log_execution=True, log_stdout=True,
-        log_stderr=True, **kv):
+        log_stderr=True, timeout=None, stall_timeout=None, line_func=None, rlimits=None,
+        cpus=None, **kv):
     """
     Execute an external script, capturing stdout and stderr without blocking the
-    called script.
+    called script. If line_func is given, it is called with each line of stdout
+    as it arrives. rlimits is a dictionary of resource limits for the script
+    (see iapp_limits.resource_limits()), and cpus a list of CPUs to pin it to.
+
+    If the script runs for more than timeout seconds, or writes nothing to stdout
+    for stall_timeout seconds, its process group is killed. The reason ('timeout'
+    or 'stall') is stored in err_dict['killed'], which is None otherwise. If the
+    script was stopped by its memory or CPU limit, the reason is 'memory_limit'
+    or 'cpu_limit'.
     """
 
     LOG.debug('executing {} with kv={}'.format(cmd, kv))
@@ -570,7 +907,12 @@ def execute_binary_captured_inject_io(work_dir, cmd, err_dict, log_execution=Tru
                 stdin=PIPE,
                 stdout=PIPE,
                 stderr=PIPE,
-                close_fds=True)
+                close_fds=True,
+                preexec_fn=pinned_preexec_fn(make_preexec_fn(rlimits), cpus))
+
+    t_start = time.time()
+    t_last_stdout = t_start
+    err_dict['killed'] = None
 
     # wrap pop.std* streams with NonBlockingStreamReader objects:
     nbsr_stdout = NonBlockingStreamReader(pop.stdout)
@@ -579,8 +921,9 @@ def execute_binary_captured_inject_io(work_dir, cmd, err_dict, log_execution=Tru
     error_keys = err_dict['error_keys']
     del(err_dict['error_keys'])
 
-    # get the output
-    out_str = ""
+    # get the output, as a list of lines which is joined at the end, since
+    # repeatedly appending to a string is quadratic in the length of the output
+    out_lines = []
     while pop.poll()==None and nbsr_stdout.thread.is_alive() and nbsr_stderr.thread.is_alive():
 
         '''
@@ -590,10 +933,15 @@ def execute_binary_captured_inject_io(work_dir, cmd, err_dict, log_execution=Tru
 
         if output_stdout is not None:
 
+            t_last_stdout = time.time()
+
+            if line_func is not None:
+                line_func(output_stdout)
+
             # Gather the stdout stream for output to a log file.
             time_obj = datetime.utcnow()
             time_stamp = make_time_stamp_m(time_obj)
-            out_str += "{} (INFO)  : {}".format(time_stamp,output_stdout)
+            out_lines.append("{} (INFO)  : {}".format(time_stamp,output_stdout))
 
             # Search stdout for exe error strings and pass them to the logger.
             for error_key in error_keys:
@@ -623,7 +971,27 @@ def execute_binary_captured_inject_io(work_dir, cmd, err_dict, log_execution=Tru
             # Gather the stderr stream for output to a log file.
             time_obj = datetime.utcnow()
             time_stamp = make_time_stamp_m(time_obj)
-            out_str += "{} (WARNING) : {}".format(time_stamp,output_stderr)
+            out_lines.append("{} (WARNING) : {}".format(time_stamp,output_stderr))
+
+        '''
+        Kill the process if it has run too long, or has stopped producing output
+        '''
+        t_now = time.time()
+        if timeout is not None and t_now - t_start > timeout:
+            err_dict['killed'] = 'timeout'
+            LOG.error("{} has run for more than {} seconds, killing it."
+                      .format(cmd.split(" ")[-1], timeout))
+        elif stall_timeout is not None and t_now - t_last_stdout > stall_timeout:
+            err_dict['killed'] = 'stall'
+            LOG.error("{} has produced no output for {} seconds, killing it."
+                      .format(cmd.split(" ")[-1], stall_timeout))
+
+        if err_dict['killed'] is not None:
+            time_stamp = make_time_stamp_m(datetime.utcnow())
+            out_lines.append("{} (ERROR) : Killed by the supervisor ({})\n".format(
+                time_stamp, err_dict['killed']))
+            kill_process_group(pop)
+            break
 
         '''
         Check to see if the stdout and stderr streams are ended
@@ -642,16 +1010,19 @@ def execute_binary_captured_inject_io(work_dir, cmd, err_dict, log_execution=Tru
             if output_stdout is not None or output_stderr is not None:
 
                 if output_stdout is not None:
+                    if line_func is not None:
+                        line_func(output_stdout)
+
                     # Gather the stdout stream for output to a log file.
                     time_obj = datetime.utcnow()
                     time_stamp = make_time_stamp_m(time_obj)
-                    out_str += "{} (INFO)  : {}".format(time_stamp,output_stdout)
+                    out_lines.append("{} (INFO)  : {}".format(time_stamp,output_stdout))
 
                 if output_stderr is not None:
                     # Gather the stderr stream for output to a log file.
                     time_obj = datetime.utcnow()
                     time_stamp = make_time_stamp_m(time_obj)
-                    out_str += "{} (WARNING)  : {}".format(time_stamp,output_stderr)
+                    out_lines.append("{} (WARNING)  : {}".format(time_stamp,output_stderr))
             else:
                 break
 
@@ -681,13 +1052,12 @@ def execute_binary_captured_inject_io(work_dir, cmd, err_dict, log_execution=Tru
 
     LOG.debug("{}: rc = {}".format(cmd,rc))
 
-    return rc, out_str
-
-# paths for IAPP and ancillary are set to default values based on relative location to this module.
-cspp_x_home = what_package_am_i()
+    out_str = "".join(out_lines)
 
-# This should be the same as CSPP_IAPP_HOME
-CSPP_RT_HOME = check_and_convert_env_var("CSPP_RT_HOME", check_write=False, default_value=cspp_x_home)
+    if err_dict['killed'] is None:
+        err_dict['killed'] = limit_kill_reason(rc, rlimits, out_str, time.time() - t_start)
+        if err_dict['killed'] is not None:
+            LOG.error("{} was stopped by its resource limits ({})."
+                      .format(cmd.split(" ")[-1], err_dict['killed']))
 
-initialize_cspp_variables(CSPP_RT_HOME)
-initialize_IAPP_variables(CSPP_RT_HOME)
+    return rc, out_str
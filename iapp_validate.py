@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+iapp_validate.py
+
+Purpose: Fast structural checks of a level-1D file, using only its header and
+         size, so that truncated, still-being-written or mismatched files are
+         rejected before any ancillary data is retrieved or iapp_main is run.
+
+Checks:
+
+    size:        the file holds Number_of_Header_Records + Number_of_Scanlines
+                 whole records. If the record length isn't given, it is inferred
+                 from the file size, which must then divide evenly.
+    instruments: the Instruments bits include every instrument used by the
+                 instrument combination, and the Inst_Grid_Code is a known grid
+                 (the HIRS grid, for combinations which include HIRS).
+    times:       the start and end year/day/time fields are in range, the end is
+                 not before the start, the pass is not implausibly long, and it
+                 is not in the future.
+
+Copyright (c) 2014 University of Wisconsin Regents.
+Licensed under GNU GPLv3.
+"""
+
+import os
+import logging
+from datetime import datetime, timedelta
+
+from iapp_utils import InvalidLevel1D
+from iapp_compression import compression_of
+
+LOG = logging.getLogger(__name__)
+
+# Size in bytes of the header fields read by iapp_level2.Level1D
+HEADER_SIZE = 88
+
+VALIDATION_MODES = ['none', 'reject', 'auto']
+
+INSTRUMENT_BITS = {'HIRS': 1 << 0,
+                   'MSU': 1 << 1,
+                   'AMSU-A': 1 << 3,
+                   'MHS': 1 << 4,
+                   'AVHRR': 1 << 5}
+
+GRID_CODES = {5: 'HIRS', 6: 'MSU', 10: 'AMSU-A', 11: 'MHS'}
+
+COMBO_INSTRUMENTS = {1: ['HIRS', 'AMSU-A'],
+                     2: ['AMSU-A'],
+                     3: ['AMSU-A', 'MHS'],
+                     4: ['HIRS', 'AMSU-A', 'MHS']}
+
+# The order in which instrument combinations are tried when auto-selecting
+COMBO_PREFERENCE = [4, 1, 3, 2]
+
+FIRST_YEAR = 1978
+MAX_PASS_LENGTH = timedelta(hours=2)
+MAX_CLOCK_SKEW = timedelta(hours=1)
+
+
+def check_size(file_size, header_data, record_length=None):
+    '''Return a list of problems with the size of the file.'''
+    problems = []
+
+    header_records = header_data['Number_of_Header_Records']
+    scanlines = header_data['Number_of_Scanlines']
+    if header_records < 1:
+        problems.append('Number_of_Header_Records is {}'.format(header_records))
+    if scanlines < 1:
+        problems.append('Number_of_Scanlines is {}'.format(scanlines))
+    if problems:
+        return problems
+
+    records = header_records + scanlines
+    if record_length is not None:
+        expected_size = records * record_length
+        if file_size != expected_size:
+            problems.append('file size is {} bytes, expected {} ({} records of {} bytes)'
+                            .format(file_size, expected_size, records, record_length))
+    elif file_size % records != 0 or file_size / records < HEADER_SIZE:
+        problems.append('file size of {} bytes is not a whole number of {} records'
+                        .format(file_size, records))
+
+    return problems
+
+
+def check_instruments(header_data, instrument_combo):
+    '''Return a list of problems with using instrument_combo on the file.'''
+    problems = []
+
+    grid_code = header_data['Inst_Grid_Code']
+    instruments = header_data['Instruments']
+
+    if grid_code not in GRID_CODES:
+        problems.append('unknown Inst_Grid_Code {}'.format(grid_code))
+    elif 'HIRS' in COMBO_INSTRUMENTS[instrument_combo] and GRID_CODES[grid_code] != 'HIRS':
+        problems.append('instrument combo {} requires the HIRS grid, not {}'
+                        .format(instrument_combo, GRID_CODES[grid_code]))
+
+    missing = [name for name in COMBO_INSTRUMENTS[instrument_combo]
+               if not instruments & INSTRUMENT_BITS[name]]
+    if missing:
+        problems.append('instrument combo {} requires {}, missing from Instruments ({:#b})'
+                        .format(instrument_combo, ', '.join(missing), instruments))
+
+    return problems
+
+
+def supported_combos(header_data):
+    '''The instrument combinations usable with the file, most preferred first.'''
+    return [combo for combo in COMBO_PREFERENCE
+            if not check_instruments(header_data, combo)]
+
+
+def _header_time(header_data, prefix):
+    year = header_data['{}_Data_Set_Year'.format(prefix)]
+    day_of_year = header_data['{}_Data_Set_DOY'.format(prefix)]
+    time_ms = header_data['{}_Data_Set_UTC_Time'.format(prefix)]
+
+    if not 0 <= time_ms < 86400000:
+        raise ValueError('{} time of {} ms is out of range'.format(prefix, time_ms))
+
+    try:
+        time_obj = datetime.strptime("{}-{}".format(year, day_of_year), '%Y-%j')
+    except ValueError:
+        raise ValueError('{} year/day {}/{} is invalid'.format(prefix, year, day_of_year))
+
+    return time_obj + timedelta(milliseconds=time_ms)
+
+
+def check_times(header_data, now=None):
+    '''Return a list of problems with the pass start and end times.'''
+    now = datetime.utcnow() if now is None else now
+    problems = []
+
+    times = []
+    for prefix in ['Start', 'End']:
+        try:
+            time_obj = _header_time(header_data, prefix)
+        except ValueError, err:
+            problems.append(str(err))
+            continue
+        if time_obj.year < FIRST_YEAR or time_obj > now + MAX_CLOCK_SKEW:
+            problems.append('{} time {} is implausible'.format(prefix, time_obj))
+        times.append(time_obj)
+
+    if len(times) == 2:
+        start_time, end_time = times
+        if end_time < start_time:
+            problems.append('end time {} is before start time {}'.format(end_time, start_time))
+        elif end_time - start_time > MAX_PASS_LENGTH:
+            problems.append('pass length {} is longer than {}'
+                            .format(end_time - start_time, MAX_PASS_LENGTH))
+
+    return problems
+
+
+def validate_level1d(l1d_file, header_data, instrument_combo, record_length=None,
+                     auto_combo=False, now=None):
+    '''
+    Check the structure of a level-1D file, given its parsed header, returning
+    the instrument combination to use. If the file does not support
+    instrument_combo and auto_combo is True, the most preferred combination the
+    file does support is returned instead. Raises InvalidLevel1D if the file
+    fails any check. The size of a compressed file is not checked, since that
+    would mean decompressing it; see check_level1d_size().
+    '''
+    problems = []
+    if compression_of(l1d_file) is None:
+        problems += check_size(os.stat(l1d_file).st_size, header_data, record_length)
+    problems += check_times(header_data, now)
+
+    combo_problems = check_instruments(header_data, instrument_combo)
+    if combo_problems and auto_combo:
+        combos = supported_combos(header_data)
+        if combos:
+            LOG.warn("{}, using instrument combo {} instead of {}".format(
+                '; '.join(combo_problems), combos[0], instrument_combo))
+            instrument_combo = combos[0]
+            combo_problems = []
+    problems += combo_problems
+
+    if problems:
+        raise InvalidLevel1D('{} failed validation: {}'.format(
+            os.path.basename(l1d_file), '; '.join(problems)))
+
+    LOG.debug('{} passed validation'.format(l1d_file))
+
+    return instrument_combo
+
+
+def check_level1d_size(l1d_file, header_data, record_length=None):
+    '''Raise InvalidLevel1D if the (uncompressed) l1d_file has the wrong size.'''
+    problems = check_size(os.stat(l1d_file).st_size, header_data, record_length)
+    if problems:
+        raise InvalidLevel1D('{} failed validation: {}'.format(
+            os.path.basename(l1d_file), '; '.join(problems)))
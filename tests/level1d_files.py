@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+level1d_files.py
+
+Synthetic level-1D files for the tests of the modules which read and write
+them, and a test case which checks them by reading them back with
+iapp_level2.Level1D.
+
+Copyright (c) 2014 University of Wisconsin Regents.
+Licensed under GNU GPLv3.
+"""
+
+import os
+import struct
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from iapp_level2 import Level1D
+from iapp_validate import check_size
+from iapp_overlap import HEADER_LAYOUT, header_time_fields, read_scanline_times
+
+RECORD_LENGTH = 1000
+SCANLINE_INTERVAL = timedelta(milliseconds=6400)
+
+
+def make_level1d(l1d_file, start_time, scanlines, orbit=1000, record_length=RECORD_LENGTH):
+    '''
+    Write a level-1D file of one header record and scanlines scanline records,
+    6.4 seconds apart from start_time. Each scanline record starts with its
+    number (from 1) and time, and is filled with its number.
+    '''
+    end_time = start_time + SCANLINE_INTERVAL * (scanlines - 1)
+    start_year, start_day_of_year, start_ms = header_time_fields(start_time)
+    end_year, end_day_of_year, end_ms = header_time_fields(end_time)
+    header_data = {'Dataset_Creation_Site': 'CSP', 'Filler_1': ' ',
+                   'Creation_1BSite': 'CSP', 'Filler_2': ' ',
+                   'Header_Version_Number': 5, 'Header_Version_Year': 2000,
+                   'Header_Version_DOY': 1, 'Number_of_Header_Records': 1,
+                   'Satellite_ID': 19, 'Inst_Grid_Code': 5, 'Satellite_Altitude': 8700,
+                   'Nominal_Orbit_Period': 6120, 'Start_Orbit_Number': orbit,
+                   'Start_Data_Set_Year': start_year, 'Start_Data_Set_DOY': start_day_of_year,
+                   'Start_Data_Set_UTC_Time': start_ms, 'End_Orbit_Number': orbit,
+                   'End_Data_Set_Year': end_year, 'End_Data_Set_DOY': end_day_of_year,
+                   'End_Data_Set_UTC_Time': end_ms, 'Number_of_Scanlines': scanlines,
+                   'Missing_Scanlines': 0, 'ATOVPP_Version_Number': 1, 'Instruments': 25}
+
+    header = ''
+    for name, format_str, size in HEADER_LAYOUT:
+        if format_str is None:
+            header += header_data[name]
+        else:
+            header += struct.pack(format_str, header_data[name])
+
+    file_obj = open(l1d_file, 'wb')
+    file_obj.write(header.ljust(record_length, '\0'))
+    for idx in range(scanlines):
+        year, day_of_year, time_ms = header_time_fields(start_time + SCANLINE_INTERVAL * idx)
+        record = struct.pack('4i', idx + 1, year, day_of_year, time_ms)
+        file_obj.write(record.ljust(record_length, chr((idx + 1) % 256)))
+    file_obj.close()
+
+    return l1d_file
+
+
+def scanline_numbers(l1d_file, record_length=RECORD_LENGTH):
+    '''The numbers at the start of the scanline records of l1d_file.'''
+    header_data = Level1D(l1d_file).header_field_data
+    numbers = []
+    file_obj = open(l1d_file, 'rb')
+    for idx in range(header_data['Number_of_Scanlines']):
+        file_obj.seek((header_data['Number_of_Header_Records'] + idx) * record_length)
+        numbers.append(struct.unpack('i', file_obj.read(4))[0])
+    file_obj.close()
+    return numbers
+
+
+class Level1DFileTestCase(unittest.TestCase):
+    '''A test case with a work directory, and checks of the level-1D files in it.'''
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.start_time = datetime(2015, 3, 4, 10, 0, 0)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def check_file(self, l1d_file, scanlines, start_time, end_time):
+        '''Check the header, size and scanline times of l1d_file.'''
+        l1d_obj = Level1D(l1d_file)
+        header_data = l1d_obj.header_field_data
+        self.assertEqual(header_data['Number_of_Scanlines'], scanlines)
+        self.assertEqual(l1d_obj.timeObj_start, start_time)
+        self.assertEqual(l1d_obj.timeObj_end, end_time)
+        self.assertEqual(check_size(os.stat(l1d_file).st_size, header_data, RECORD_LENGTH), [])
+        self.assertEqual(check_size(os.stat(l1d_file).st_size, header_data), [])
+
+        times = read_scanline_times(l1d_file, header_data, RECORD_LENGTH, start_time, end_time)
+        self.assertEqual(len(times), scanlines)
+        self.assertEqual((times[0], times[-1]), (start_time, end_time))
+
+        return l1d_obj
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+retrieval_files.py
+
+Synthetic IAPP retrieval outputs, for the tests of the modules which read
+them. These need numpy and netCDF4; netcdf_unavailable() says whether the
+tests which use them are to be skipped.
+
+Copyright (c) 2014 University of Wisconsin Regents.
+Licensed under GNU GPLv3.
+"""
+
+FILL_VALUE = -9999.
+
+
+def netcdf_unavailable():
+    '''True if numpy or netCDF4 can't be imported.'''
+    try:
+        import numpy
+        import netCDF4
+    except ImportError:
+        return True
+    return False
+
+
+def make_retrieval(nc_file, scanlines=3, fovs=4, levels=5, retrieved=5,
+                   latitudes=(40., 50.), longitudes=(-100., -90.), water=20.):
+    '''
+    Write an IAPP output with scanlines x fovs FORs, the first retrieved of
+    which have a temperature profile of 250 K and a total precipitable water
+    of water, and with a HIRS_Data_Flag of 1 on every other FOR. The latitudes and longitudes increase linearly over the FORs, in
+    scanline order, over the given ranges. Returns nc_file.
+    '''
+    import numpy as np
+    from netCDF4 import Dataset
+
+    nc_obj = Dataset(nc_file, 'w', format='NETCDF3_CLASSIC')
+    nc_obj.createDimension('Number_of_scanlines', scanlines)
+    nc_obj.createDimension('FOV', fovs)
+    nc_obj.createDimension('Level', levels)
+
+    shape = (scanlines, fovs)
+    for name, (first, last) in [('Latitude', latitudes), ('Longitude', longitudes)]:
+        variable = nc_obj.createVariable(name, 'f4', ('Number_of_scanlines', 'FOV'))
+        variable[:] = np.linspace(first, last, scanlines * fovs).reshape(shape)
+
+    temperature = np.full((scanlines * fovs, levels), FILL_VALUE, 'f4')
+    temperature[:retrieved] = 250.
+    variable = nc_obj.createVariable('Temperature_Retrieval', 'f4',
+                                     ('Number_of_scanlines', 'FOV', 'Level'),
+                                     fill_value=FILL_VALUE)
+    variable[:] = temperature.reshape(shape + (levels,))
+
+    tpw = np.full(scanlines * fovs, FILL_VALUE, 'f4')
+    tpw[:retrieved] = water
+    variable = nc_obj.createVariable('Total_Precipitable_Water', 'f4',
+                                     ('Number_of_scanlines', 'FOV'), fill_value=FILL_VALUE)
+    variable[:] = tpw.reshape(shape)
+
+    variable = nc_obj.createVariable('HIRS_Data_Flag', 'i2', ('Number_of_scanlines', 'FOV'))
+    variable[:] = (np.arange(scanlines * fovs) % 2).reshape(shape)
+
+    nc_obj.close()
+
+    return nc_file
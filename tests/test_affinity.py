@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_affinity.py
+
+Tests of the NUMA topology and CPU claims of iapp_affinity.py, on a given
+topology, with the lock files in a temporary directory.
+
+Copyright (c) 2014 University of Wisconsin Regents.
+Licensed under GNU GPLv3.
+"""
+
+import os
+import sys
+import shutil
+import logging
+import tempfile
+import unittest
+import subprocess
+from os import path
+
+from iapp_affinity import (parse_cpulist, numa_nodes, pinned_preexec_fn, CpuAllocator,
+                           get_cpu_allocator)
+
+logging.disable(logging.CRITICAL)
+
+NODES = {0: [0, 1, 2, 3], 1: [4, 5, 6, 7]}
+
+# Holds the lock file of a CPU, as the run of another process would
+HOLDER_SCRIPT = '''
+import os, sys, fcntl
+from time import sleep
+
+fd = os.open(sys.argv[1], os.O_RDWR | os.O_CREAT, 0600)
+fcntl.lockf(fd, fcntl.LOCK_EX)
+sys.stdout.write('locked\\n')
+sys.stdout.flush()
+sleep(600)
+'''
+
+
+class TopologyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sys_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.sys_dir)
+
+    def write_cpulist(self, sub_dir, name, cpulist):
+        os.makedirs(path.join(self.sys_dir, sub_dir))
+        file_obj = open(path.join(self.sys_dir, sub_dir, name), 'w')
+        file_obj.write(cpulist + '\n')
+        file_obj.close()
+
+    def test_parse_cpulist(self):
+        self.assertEqual(parse_cpulist('0-3,8-9,12\n'), [0, 1, 2, 3, 8, 9, 12])
+        self.assertEqual(parse_cpulist('5'), [5])
+        self.assertEqual(parse_cpulist('\n'), [])
+
+    def test_numa_nodes(self):
+        self.write_cpulist('node/node0', 'cpulist', '0-3')
+        self.write_cpulist('node/node1', 'cpulist', '4-7')
+        self.write_cpulist('node/node2', 'cpulist', '')
+
+        self.assertEqual(numa_nodes(self.sys_dir), NODES)
+
+    def test_no_numa_nodes(self):
+        self.write_cpulist('cpu', 'online', '0-5')
+
+        self.assertEqual(numa_nodes(self.sys_dir), {0: range(6)})
+
+
+class CpuAllocatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.lock_dir = tempfile.mkdtemp()
+        self.processes = []
+
+    def tearDown(self):
+        for process in self.processes:
+            process.kill()
+            process.wait()
+        shutil.rmtree(self.lock_dir)
+
+    def test_claims_are_disjoint(self):
+        allocator = CpuAllocator('cpus', cpus_per_run=2, lock_dir=self.lock_dir, nodes=NODES)
+
+        claims = [allocator.acquire() for x in range(4)]
+        self.assertEqual(sorted([x.node for x in claims]), [0, 0, 1, 1])
+        self.assertEqual(sorted(sum([x.cpus for x in claims], [])), range(8))
+        self.assertEqual(allocator.acquire(), None)
+
+        allocator.release(claims[0])
+        claim = allocator.acquire()
+        self.assertEqual(claim.cpus, claims[0].cpus)
+
+    def test_most_free_node(self):
+        allocator = CpuAllocator('cpus', cpus_per_run=1, lock_dir=self.lock_dir, nodes=NODES)
+
+        nodes = [allocator.acquire().node for x in range(4)]
+        self.assertEqual(sorted(nodes[:2]), [0, 1])
+        self.assertEqual(sorted(nodes[2:]), [0, 1])
+
+    def test_node_mode(self):
+        allocator = CpuAllocator('node', cpus_per_run=3, lock_dir=self.lock_dir, nodes=NODES)
+
+        first, second = allocator.acquire(), allocator.acquire()
+        self.assertEqual(len(first.claimed), 3)
+        self.assertEqual(first.cpus, NODES[first.node])
+        self.assertEqual(second.cpus, NODES[1 - first.node])
+        self.assertEqual(allocator.acquire(), None)
+
+    def test_none_mode(self):
+        allocator = CpuAllocator('none', lock_dir=self.lock_dir, nodes=NODES)
+        self.assertEqual(allocator.acquire(), None)
+        self.assertRaises(ValueError, CpuAllocator, 'socket', lock_dir=self.lock_dir)
+
+    def test_shared_lock_dir(self):
+        first = CpuAllocator('cpus', cpus_per_run=4, lock_dir=self.lock_dir, nodes=NODES)
+        second = CpuAllocator('cpus', cpus_per_run=4, lock_dir=self.lock_dir, nodes=NODES)
+
+        claims = [first.acquire(), second.acquire()]
+        self.assertEqual(sorted([x.node for x in claims]), [0, 1])
+        self.assertEqual(first.acquire(), None)
+
+    def test_claimed_by_another_process(self):
+        process = subprocess.Popen([sys.executable, '-c', HOLDER_SCRIPT,
+                                    path.join(self.lock_dir, 'cpu4.lock')],
+                                   stdout=subprocess.PIPE)
+        self.processes.append(process)
+        self.assertEqual(process.stdout.readline().strip(), 'locked')
+
+        allocator = CpuAllocator('cpus', cpus_per_run=1, lock_dir=self.lock_dir, nodes=NODES)
+        claims = [allocator.acquire() for x in range(7)]
+        self.assertEqual(sorted(sum([x.cpus for x in claims], [])), [0, 1, 2, 3, 5, 6, 7])
+        self.assertEqual(allocator.acquire(), None)
+
+    def test_get_cpu_allocator(self):
+        self.assertTrue(get_cpu_allocator('cpus', 2) is get_cpu_allocator('cpus', 2))
+        self.assertFalse(get_cpu_allocator('cpus', 2) is get_cpu_allocator('node', 2))
+
+
+class PinnedPreexecTest(unittest.TestCase):
+
+    def test_pinned_child(self):
+        cpu = numa_nodes()[min(numa_nodes())][0]
+        output = subprocess.Popen(['grep', 'Cpus_allowed_list', '/proc/self/status'],
+                                  stdout=subprocess.PIPE,
+                                  preexec_fn=pinned_preexec_fn(None, [cpu])).communicate()[0]
+
+        self.assertEqual(parse_cpulist(output.split()[1]), [cpu])
+
+    def test_not_pinned(self):
+        self.assertEqual(pinned_preexec_fn(None, []), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
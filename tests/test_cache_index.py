@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_cache_index.py
+
+Tests of the ancillary cache index (ANC/CacheIndex.py): the GDAS/GFS valid
+times chosen for a pass, and lookups in a cache shared by several indexes.
+
+Copyright (c) 2014 University of Wisconsin Regents.
+Licensed under GNU GPLv3.
+"""
+
+import os
+import shutil
+import logging
+import tempfile
+import unittest
+from os import path
+from datetime import datetime
+
+from ANC.CacheIndex import AncillaryCacheIndex, gdas_valid_time, gfs_valid_time
+
+logging.disable(logging.CRITICAL)
+
+
+class ValidTimeTest(unittest.TestCase):
+
+    def test_gdas_valid_time(self):
+        for hour, minute, valid_time in [(0, 0, datetime(2015, 3, 4, 0)),
+                                         (2, 59, datetime(2015, 3, 4, 0)),
+                                         (3, 0, datetime(2015, 3, 4, 6)),
+                                         (8, 59, datetime(2015, 3, 4, 6)),
+                                         (14, 30, datetime(2015, 3, 4, 12)),
+                                         (21, 0, datetime(2015, 3, 5, 0)),
+                                         (23, 59, datetime(2015, 3, 5, 0))]:
+            time_obj = datetime(2015, 3, 4, hour, minute, 30)
+            self.assertEqual(gdas_valid_time(time_obj), valid_time, time_obj)
+
+    def test_gfs_valid_time(self):
+        for hour, minute, valid_time in [(0, 0, datetime(2015, 3, 4, 0)),
+                                         (1, 30, datetime(2015, 3, 4, 0)),
+                                         (1, 31, datetime(2015, 3, 4, 3)),
+                                         (4, 30, datetime(2015, 3, 4, 3)),
+                                         (4, 31, datetime(2015, 3, 4, 6)),
+                                         (22, 31, datetime(2015, 3, 5, 0))]:
+            time_obj = datetime(2015, 3, 4, hour, minute)
+            self.assertEqual(gfs_valid_time(time_obj), valid_time, time_obj)
+
+    def test_year_end(self):
+        time_obj = datetime(2015, 12, 31, 22, 31)
+        self.assertEqual(gdas_valid_time(time_obj), datetime(2016, 1, 1, 0))
+        self.assertEqual(gfs_valid_time(time_obj), datetime(2016, 1, 1, 0))
+
+
+class CacheIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def cache_file(self, file_name):
+        cache_file = path.join(self.cache_dir, file_name)
+        open(cache_file, 'w').close()
+        return cache_file
+
+    def test_lookup_prefers_gdas(self):
+        gfs_file = self.cache_file('gfs.t00.150304.pgrbf06')
+        gdas_file = self.cache_file('gdas1.PGrbF00.150304.06z')
+        index = AncillaryCacheIndex(self.cache_dir)
+
+        self.assertEqual(index.lookup(datetime(2015, 3, 4, 5))['grib_file'], gdas_file)
+        os.unlink(gdas_file)
+        self.assertEqual(index.lookup(datetime(2015, 3, 4, 5))['grib_file'], gfs_file)
+        self.assertEqual(index.lookup(datetime(2015, 3, 4, 5), allow_forecast=False), None)
+        self.assertEqual(len(index), 1)
+
+    def test_shared_index(self):
+        self.cache_file('gdas1.PGrbF00.150304.00z')
+        first = AncillaryCacheIndex(self.cache_dir)
+        second = AncillaryCacheIndex(self.cache_dir)
+        self.assertEqual(len(first.lookup(datetime(2015, 3, 4, 0))), 6)
+        self.assertEqual(len(second.lookup(datetime(2015, 3, 4, 0))), 6)
+
+        # Each index sees the files added and evicted through the other
+        first.insert(self.cache_file('gdas1.PGrbF00.150304.06z'))
+        second.insert(self.cache_file('gdas1.PGrbF00.150304.12z'),
+                      self.cache_file('iapp_ancillary_2015030412-anl.nc'))
+        self.assertNotEqual(first.lookup(datetime(2015, 3, 4, 12)), None)
+        self.assertNotEqual(second.lookup(datetime(2015, 3, 4, 6)), None)
+        self.assertEqual(first.netcdf_file_of(path.join(self.cache_dir,
+                                                        'gdas1.PGrbF00.150304.12z')),
+                         path.join(self.cache_dir, 'iapp_ancillary_2015030412-anl.nc'))
+
+        first.evict(path.join(self.cache_dir, 'gdas1.PGrbF00.150304.00z'))
+        self.assertEqual(second.lookup(datetime(2015, 3, 4, 0), allow_forecast=False), None)
+
+        # A new index reads the same records
+        third = AncillaryCacheIndex(self.cache_dir)
+        third.prune()
+        self.assertEqual(len(third), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_composite.py
+
+Tests of the gridded composites of IAPP outputs (iapp_composite.py). They need
+numpy, and netCDF4 for the composites of files.
+
+Copyright (c) 2014 University of Wisconsin Regents.
+Licensed under GNU GPLv3.
+"""
+
+import shutil
+import logging
+import tempfile
+import unittest
+from os import path
+
+from iapp_composite import Grid, bin_values, merge_partials, window_start, update_composites
+
+from retrieval_files import netcdf_unavailable, make_retrieval
+
+logging.disable(logging.CRITICAL)
+
+HOUR_US = 3600 * 1000000
+
+
+class BinningTest(unittest.TestCase):
+
+    def setUp(self):
+        try:
+            import numpy
+        except ImportError:
+            raise unittest.SkipTest('numpy is unavailable')
+        self.np = numpy
+        self.grid = Grid(resolution=10., bounds=(0., 20., 0., 30.))
+
+    def test_cell_index(self):
+        np = self.np
+        cells = self.grid.cell_index(np, np.array([5., 15., 15., -5., 25.]),
+                                     np.array([5., 5., 29., 5., 5.]))
+        self.assertEqual(self.grid.size, 6)
+        self.assertEqual(cells.tolist(), [0, 3, 5, -1, -1])
+
+    def test_bin_values(self):
+        np = self.np
+        partial = bin_values(np, self.grid, np.array([0, 0, 3, -1, 3]),
+                             np.array([20, 10, 5, 1, 7]),
+                             np.array([1., 3., 5., 100., np.nan]))
+
+        self.assertEqual(partial['sum'].tolist(), [4., 0., 0., 5., 0., 0.])
+        self.assertEqual(partial['count'].tolist(), [2, 0, 0, 1, 0, 0])
+        # The latest value is that with the latest time, not the last given
+        self.assertEqual(partial['latest'][[0, 3]].tolist(), [1., 5.])
+        self.assertEqual(partial['latest_time'].tolist(), [20, -1, -1, 5, -1, -1])
+        self.assertTrue(np.isnan(partial['latest'][1]))
+
+    def test_merge_partials(self):
+        np = self.np
+        partial = bin_values(np, self.grid, np.array([0, 3]), np.array([10, 10]),
+                             np.array([1., 2.]))
+        other = bin_values(np, self.grid, np.array([0, 3, 4]), np.array([20, 5, 5]),
+                           np.array([3., 4., 5.]))
+
+        merged = merge_partials(np, partial, other)
+        self.assertTrue(merged is partial)
+        self.assertEqual(merged['count'].tolist(), [2, 0, 0, 2, 1, 0])
+        self.assertEqual(merged['sum'].tolist(), [4., 0., 0., 6., 5., 0.])
+        self.assertEqual(merged['latest'][[0, 3, 4]].tolist(), [3., 2., 5.])
+
+    def test_window_start(self):
+        np = self.np
+        times = np.array([0, 5 * HOUR_US + 1, 6 * HOUR_US, 23 * HOUR_US])
+        self.assertEqual(window_start(times, 6).tolist(),
+                         [0, 0, 6 * HOUR_US, 18 * HOUR_US])
+
+
+class UpdateCompositesTest(unittest.TestCase):
+
+    def setUp(self):
+        if netcdf_unavailable():
+            raise unittest.SkipTest('numpy/netCDF4 are unavailable')
+        self.work_dir = tempfile.mkdtemp()
+        self.composite_dir = path.join(self.work_dir, 'composites')
+        self.grid = Grid(resolution=5., bounds=(40., 50., -100., -90.))
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def output(self, start, end, water, creation='20150304020000000000'):
+        name = 'noaa19_L2_d20150304_t{}0_e{}0_c{}_iapp.nc'.format(start, end, creation)
+        return make_retrieval(path.join(self.work_dir, name), scanlines=2, fovs=2,
+                              retrieved=4, latitudes=(41., 49.), longitudes=(-99., -91.),
+                              water=water)
+
+    def read_composite(self, composite_file, name):
+        from netCDF4 import Dataset
+        nc_obj = Dataset(composite_file, 'r')
+        try:
+            return nc_obj.variables[name][:].filled(-9999.).tolist(), nc_obj.pass_count
+        finally:
+            nc_obj.close()
+
+    def test_update_composites(self):
+        first = self.output('010000', '010500', 10.)
+        second = self.output('030000', '030500', 30.)
+
+        files = update_composites(self.composite_dir, [first], grid=self.grid,
+                                  periods=['daily'])
+        self.assertEqual([path.basename(x) for x in files],
+                         ['iapp_composite_daily_2015030400.nc'])
+        update_composites(self.composite_dir, [second], grid=self.grid, periods=['daily'])
+
+        # FORs at 41, 43.7, 46.3, 49 N and 99, 96.3, 93.7, 91 W
+        mean, pass_count = self.read_composite(files[0], 'Total_Precipitable_Water_mean')
+        self.assertEqual(pass_count, 2)
+        self.assertEqual(mean, [[20., -9999.], [-9999., 20.]])
+        latest, pass_count = self.read_composite(files[0], 'Total_Precipitable_Water_latest')
+        self.assertEqual(latest, [[30., -9999.], [-9999., 30.]])
+        count, pass_count = self.read_composite(files[0], 'Total_Precipitable_Water_count')
+        self.assertEqual(count, [[4, 0], [0, 4]])
+
+    def test_pass_added_once(self):
+        first = self.output('010000', '010500', 10.)
+        rerun = self.output('010000', '010500', 50., creation='20150304030000000000')
+
+        files = update_composites(self.composite_dir, [first, rerun], grid=self.grid,
+                                  periods=['daily'])
+        self.assertEqual(update_composites(self.composite_dir, [rerun], grid=self.grid,
+                                           periods=['daily']), [])
+
+        count, pass_count = self.read_composite(files[0], 'Total_Precipitable_Water_count')
+        self.assertEqual(pass_count, 1)
+        self.assertEqual(count, [[2, 0], [0, 2]])
+
+    def test_six_hourly_windows(self):
+        first = self.output('050000', '050500', 10.)
+        second = self.output('070000', '070500', 30.)
+
+        files = update_composites(self.composite_dir, [first, second], grid=self.grid,
+                                  periods=['6hourly'], workers=2)
+        self.assertEqual(sorted([path.basename(x) for x in files]),
+                         ['iapp_composite_6hourly_2015030400.nc',
+                          'iapp_composite_6hourly_2015030406.nc'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_compression.py
+
+Tests of the reading of compressed level-1D files (iapp_compression.py).
+
+Copyright (c) 2014 University of Wisconsin Regents.
+Licensed under GNU GPLv3.
+"""
+
+import os
+import bz2
+import gzip
+import logging
+import unittest
+import subprocess
+from os import path
+from distutils.spawn import find_executable
+
+import iapp_compression
+from iapp_compression import compression_of, uncompressed_name, open_compressed, decompress_file
+from iapp_level2 import Level1D
+
+from level1d_files import Level1DFileTestCase, make_level1d
+
+logging.disable(logging.CRITICAL)
+
+
+class CompressionNameTest(unittest.TestCase):
+
+    def test_compression_of(self):
+        self.assertEqual(compression_of('/x/a.l1d.gz'), '.gz')
+        self.assertEqual(compression_of('/x/a.l1d.xz'), '.xz')
+        self.assertEqual(compression_of('/x/a.l1d'), None)
+        self.assertEqual(compression_of('/x/a.l1d.zip'), None)
+
+    def test_uncompressed_name(self):
+        self.assertEqual(uncompressed_name('/x/a.l1d.bz2'), '/x/a.l1d')
+        self.assertEqual(uncompressed_name('/x/a.l1d'), '/x/a.l1d')
+
+
+class DecompressTest(Level1DFileTestCase):
+
+    def setUp(self):
+        Level1DFileTestCase.setUp(self)
+        self.l1d_file = make_level1d(path.join(self.work_dir, 'pass.l1d'), self.start_time, 20)
+        self.data = open(self.l1d_file, 'rb').read()
+        self.out_dir = path.join(self.work_dir, 'out')
+        os.mkdir(self.out_dir)
+
+    def compress(self, suffix):
+        '''Write a compressed copy of the level-1D file, returning its name.'''
+        compressed_file = self.l1d_file + suffix
+        if suffix == '.gz':
+            file_obj = gzip.GzipFile(compressed_file, 'wb')
+        elif suffix == '.bz2':
+            file_obj = bz2.BZ2File(compressed_file, 'wb')
+        elif iapp_compression.lzma is not None:
+            file_obj = iapp_compression.lzma.LZMAFile(compressed_file, 'wb')
+        else:
+            subprocess.check_call(['xz', '--keep', self.l1d_file])
+            return compressed_file
+        file_obj.write(self.data)
+        file_obj.close()
+        return compressed_file
+
+    def check_decompress(self, suffix):
+        compressed_file = self.compress(suffix)
+
+        # The header is read from the start of the compressed stream
+        l1d_obj = Level1D(compressed_file)
+        self.assertEqual(l1d_obj.header_field_data['Number_of_Scanlines'], 20)
+        self.assertEqual(l1d_obj.timeObj_start, self.start_time)
+
+        out_file = decompress_file(compressed_file, self.out_dir)
+        self.assertEqual(out_file, path.join(self.out_dir, 'pass.l1d'))
+        self.assertEqual(open(out_file, 'rb').read(), self.data)
+        self.assertEqual(os.listdir(self.out_dir), ['pass.l1d'])
+
+    def test_gzip(self):
+        self.check_decompress('.gz')
+
+    def test_bzip2(self):
+        self.check_decompress('.bz2')
+
+    def test_xz(self):
+        if iapp_compression.lzma is None and find_executable('xz') is None:
+            raise unittest.SkipTest('neither lzma nor xz are available')
+        self.check_decompress('.xz')
+
+    def test_xz_command(self):
+        if find_executable('xz') is None:
+            raise unittest.SkipTest('xz is unavailable')
+        compressed_file = self.compress('.xz')
+
+        lzma = iapp_compression.lzma
+        iapp_compression.lzma = None
+        try:
+            file_obj = open_compressed(compressed_file)
+            self.assertEqual(file_obj.read(1000), self.data[:1000])
+            # Closing after reading only the header stops xz
+            file_obj.close()
+
+            file_obj = open_compressed(compressed_file)
+            self.assertEqual(file_obj.read(), self.data)
+            file_obj.close()
+        finally:
+            iapp_compression.lzma = lzma
+
+    def test_corrupt_file(self):
+        compressed_file = self.l1d_file + '.gz'
+        open(compressed_file, 'wb').write('not gzip data')
+
+        self.assertRaises(IOError, decompress_file, compressed_file, self.out_dir)
+        self.assertEqual(os.listdir(self.out_dir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
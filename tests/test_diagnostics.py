@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_diagnostics.py
+
+Tests of the iapp_main diagnostics parser and sidecar (iapp_diagnostics.py).
+
+Copyright (c) 2014 University of Wisconsin Regents.
+Licensed under GNU GPLv3.
+"""
+
+import shutil
+import logging
+import tempfile
+import unittest
+from os import path
+
+from iapp_diagnostics import (DiagnosticParser, write_diagnostics_sidecar,
+                              read_diagnostics_sidecar, KIND_NAMES)
+
+logging.disable(logging.CRITICAL)
+
+OUTPUT_LINES = ['Processing scanline 12 for 12 levels\n',
+                ' HIRS_Data_Flag fails data quality check\n',
+                'retrieval did not converge\n',
+                ' AMSUA_Data_Flag fails data quality check\n',
+                ' HIRS_Data_Flag fails data quality check\n']
+
+
+class DiagnosticParserTest(unittest.TestCase):
+
+    def test_quality_messages(self):
+        parser = DiagnosticParser()
+        for line in OUTPUT_LINES:
+            parser.feed(line)
+
+        self.assertEqual(len(parser), 3)
+        self.assertEqual(parser.counts(), {'hirs_quality': 2, 'amsua_quality': 1})
+        self.assertEqual(list(parser.columns['line']), [2, 4, 5])
+        self.assertEqual([KIND_NAMES[x] for x in parser.columns['kind']],
+                         ['hirs_quality', 'amsua_quality', 'hirs_quality'])
+
+    def test_sidecar(self):
+        try:
+            import numpy
+        except ImportError:
+            raise unittest.SkipTest('numpy is unavailable')
+
+        parser = DiagnosticParser()
+        for line in OUTPUT_LINES:
+            parser.feed(line)
+
+        work_dir = tempfile.mkdtemp()
+        try:
+            sidecar_file = path.join(work_dir, 'out.diag.npz')
+            self.assertEqual(write_diagnostics_sidecar(parser, sidecar_file), sidecar_file)
+            columns = read_diagnostics_sidecar(sidecar_file)
+        finally:
+            shutil.rmtree(work_dir)
+
+        self.assertEqual(columns['message_line'].tolist(), [2, 4, 5])
+        self.assertEqual([str(x) for x in columns['kind_names']], KIND_NAMES)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_discovery.py
+
+Tests of the discovery and selection of input files (iapp_discovery.py).
+
+Copyright (c) 2014 University of Wisconsin Regents.
+Licensed under GNU GPLv3.
+"""
+
+import os
+import shutil
+import logging
+import tempfile
+import unittest
+from os import path
+from datetime import datetime, timedelta
+
+from iapp_discovery import time_range_from_name, walk_files, discover_files, FileFilter
+
+logging.disable(logging.CRITICAL)
+
+
+class FakeHeader(object):
+
+    def __init__(self, start_time, end_time):
+        self.timeObj_start = start_time
+        self.timeObj_end = end_time
+
+
+class TimeRangeTest(unittest.TestCase):
+
+    def test_minute(self):
+        self.assertEqual(time_range_from_name('/x/hirsl1d_noaa19_20150304_0100_31234.l1d'),
+                         (datetime(2015, 3, 4, 1, 0), datetime(2015, 3, 4, 1, 1)))
+
+    def test_second(self):
+        self.assertEqual(time_range_from_name('hirsl1d_noaa19_d20150304_t0100230_e0110.l1d'),
+                         (datetime(2015, 3, 4, 1, 0, 23), datetime(2015, 3, 4, 1, 0, 24)))
+
+    def test_day(self):
+        self.assertEqual(time_range_from_name('hirs_20150304.l1d'),
+                         (datetime(2015, 3, 4), datetime(2015, 3, 5)))
+
+    def test_no_time(self):
+        self.assertEqual(time_range_from_name('hirs.l1d'), None)
+        self.assertEqual(time_range_from_name('hirs_20151340.l1d'), None)
+
+
+class FileFilterTest(unittest.TestCase):
+
+    def test_match_name(self):
+        file_filter = FileFilter(exclude=['*_test_*'])
+
+        self.assertTrue(file_filter.match_name('/x/a.l1d'))
+        self.assertTrue(file_filter.match_name('/x/a.l1d.gz'))
+        self.assertFalse(file_filter.match_name('/x/a.nc'))
+        self.assertFalse(file_filter.match_name('/x/a_test_1.l1d'))
+
+    def test_match_time(self):
+        file_filter = FileFilter(start_time=datetime(2015, 3, 4, 1, 0),
+                                 end_time=datetime(2015, 3, 4, 2, 0))
+
+        self.assertTrue(file_filter.match_time('a_20150304_0130.l1d'))
+        self.assertTrue(file_filter.match_time('a_20150304.l1d'))
+        self.assertFalse(file_filter.match_time('a_20150304_0300.l1d'))
+        self.assertFalse(file_filter.match_time('a_20150303.l1d'))
+
+        # Without a time in the name or a header_func, a file isn't selected
+        self.assertFalse(file_filter.match_time('a.l1d'))
+
+    def test_match_time_from_header(self):
+        def _header(file_name):
+            start_time = datetime(2015, 3, 4, 1, 50)
+            return FakeHeader(start_time, start_time + timedelta(minutes=15))
+
+        file_filter = FileFilter(start_time=datetime(2015, 3, 4, 2, 0), header_func=_header)
+
+        self.assertTrue(file_filter.match_time('a.l1d'))
+        self.assertFalse(file_filter.match_time('a_20150304_0130.l1d'))
+
+
+class DiscoverFilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        for name in ['b.l1d', 'a.l1d', 'c.l1d.gz', 'c.l1d', 'notes.txt',
+                     'sub/z.l1d', 'sub/y.l1d', 'sub/deeper/x.l1d']:
+            file_name = path.join(self.work_dir, name)
+            if not path.isdir(path.dirname(file_name)):
+                os.makedirs(path.dirname(file_name))
+            open(file_name, 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def names(self, file_names):
+        return [path.relpath(x, self.work_dir) for x in file_names]
+
+    def test_walk_files(self):
+        self.assertEqual(self.names(walk_files(self.work_dir)),
+                         ['a.l1d', 'b.l1d', 'c.l1d', 'c.l1d.gz', 'notes.txt'])
+        self.assertEqual(self.names(walk_files(self.work_dir, recursive=True)),
+                         ['a.l1d', 'b.l1d', 'c.l1d', 'c.l1d.gz', 'notes.txt',
+                          'sub/y.l1d', 'sub/z.l1d', 'sub/deeper/x.l1d'])
+
+    def test_discover_files(self):
+        sub_file = path.join(self.work_dir, 'sub', 'y.l1d')
+        manifest = path.join(self.work_dir, 'manifest')
+        manifest_obj = open(manifest, 'w')
+        manifest_obj.write('# comment\n{}\n\n{}\n'.format(
+            path.join(self.work_dir, 'notes.txt'), sub_file))
+        manifest_obj.close()
+
+        # The compressed copy of c.l1d and the repeated sub/y.l1d are skipped,
+        # and the explicitly listed notes.txt isn't subject to the name patterns
+        self.assertEqual(self.names(discover_files([self.work_dir, sub_file],
+                                                   manifests=[manifest])),
+                         ['a.l1d', 'b.l1d', 'c.l1d', 'sub/y.l1d', 'notes.txt'])
+
+
+if __name__ == '__main__':
+    unittest.main()
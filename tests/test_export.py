@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_export.py
+
+Tests of the export of retrieved FORs to date/satellite partitions
+(iapp_export.py).
+
+Copyright (c) 2014 University of Wisconsin Regents.
+Licensed under GNU GPLv3.
+"""
+
+import os
+import shutil
+import logging
+import tempfile
+import unittest
+from os import path
+from datetime import datetime, date
+
+from iapp_export import pass_of, read_for_table, export_granule, read_npz_partitions
+from iapp_export import partition_files
+
+from retrieval_files import netcdf_unavailable, make_retrieval
+
+logging.disable(logging.CRITICAL)
+
+OUTPUT_NAME = 'noaa19_L2_d20150304_t0100000_e0105000_c20150304013412345678_iapp.nc'
+
+
+class PassOfTest(unittest.TestCase):
+
+    def test_pass_of(self):
+        self.assertEqual(pass_of('/work/' + OUTPUT_NAME),
+                         ('noaa19_d20150304_t0100000_e0105000',
+                          datetime(2015, 3, 4, 1, 0), datetime(2015, 3, 4, 1, 5)))
+
+    def test_region_and_tenths(self):
+        pass_id, start_time, end_time = pass_of(
+            'metopb_L2_d20150304_t2355123_e0004567_c20150305001234567890_east_iapp.nc')
+
+        self.assertEqual(pass_id, 'metopb_d20150304_t2355123_e0004567_east')
+        self.assertEqual(start_time, datetime(2015, 3, 4, 23, 55, 12, 300000))
+        # The pass ends on the next day
+        self.assertEqual(end_time, datetime(2015, 3, 5, 0, 4, 56, 700000))
+
+    def test_not_an_output(self):
+        self.assertRaises(ValueError, pass_of, 'uwretrievals.nc')
+
+
+class ExportTest(unittest.TestCase):
+
+    def setUp(self):
+        if netcdf_unavailable():
+            raise unittest.SkipTest('numpy/netCDF4 are unavailable')
+        self.work_dir = tempfile.mkdtemp()
+        self.export_dir = path.join(self.work_dir, 'export')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_read_for_table(self):
+        import numpy as np
+
+        nc_file = make_retrieval(path.join(self.work_dir, OUTPUT_NAME), retrieved=6)
+        table = read_for_table(nc_file, datetime(2015, 3, 4, 1, 0), datetime(2015, 3, 4, 1, 5))
+
+        self.assertEqual(table['scanline'].tolist(), [0, 0, 0, 0, 1, 1])
+        self.assertEqual(table['fov'].tolist(), [0, 1, 2, 3, 0, 1])
+        self.assertTrue(table['retrieved'].all())
+        # Scanline 1 of 3 is half way through the pass
+        self.assertEqual(datetime(1970, 1, 1) + np.timedelta64(int(table['time'][4]), 'us')
+                         .astype(object), datetime(2015, 3, 4, 1, 2, 30))
+        self.assertEqual(table['Total_Precipitable_Water'].tolist(), [20.] * 6)
+        self.assertEqual(table['Temperature_Retrieval'].shape, (6, 5))
+        self.assertEqual(table['HIRS_Data_Flag'].tolist(), [0, 1, 0, 1, 0, 1])
+
+    def test_export_granule(self):
+        nc_file = make_retrieval(path.join(self.work_dir, OUTPUT_NAME))
+        files = export_granule(nc_file, self.export_dir, 'noaa19', datetime(2015, 3, 4, 1, 0),
+                               datetime(2015, 3, 4, 1, 5), export_format='npz')
+
+        self.assertEqual(files, [path.join(self.export_dir, 'date=2015-03-04',
+                                           'satellite=noaa19',
+                                           'noaa19_d20150304_t0100000_e0105000.npz')])
+        columns = read_npz_partitions(self.export_dir, ['granule', 'latitude'])
+        self.assertEqual(columns['latitude'].size, 5)
+        self.assertEqual(set(columns['granule'].tolist()),
+                         set(['noaa19_d20150304_t0100000_e0105000']))
+
+        # A re-run of the pass, with a new creation time, replaces its file
+        rerun_file = make_retrieval(path.join(self.work_dir, OUTPUT_NAME.replace('c2015', 'c2016')),
+                                    retrieved=2)
+        export_granule(rerun_file, self.export_dir, 'noaa19', datetime(2015, 3, 4, 1, 0),
+                       datetime(2015, 3, 4, 1, 5), export_format='npz')
+        self.assertEqual(read_npz_partitions(self.export_dir, ['latitude'])['latitude'].size, 2)
+
+    def test_partitioned_by_date(self):
+        name = 'noaa19_L2_d20150304_t2358000_e0002000_c20150305001234567890_iapp.nc'
+        nc_file = make_retrieval(path.join(self.work_dir, name), retrieved=12)
+        export_granule(nc_file, self.export_dir, 'noaa19', datetime(2015, 3, 4, 23, 58),
+                       datetime(2015, 3, 5, 0, 2), export_format='npz')
+
+        self.assertEqual(len(partition_files(self.export_dir)), 2)
+        self.assertEqual(len(partition_files(self.export_dir, start_date=date(2015, 3, 5))), 1)
+        self.assertEqual(partition_files(self.export_dir, satellites=['metopb']), [])
+        columns = read_npz_partitions(self.export_dir, ['scanline'], end_date=date(2015, 3, 4))
+        self.assertEqual(columns['scanline'].tolist(), [0] * 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
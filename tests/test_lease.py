@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_lease.py
+
+Tests of the claiming of granules through lease files (iapp_lease.py).
+
+Copyright (c) 2014 University of Wisconsin Regents.
+Licensed under GNU GPLv3.
+"""
+
+import os
+import sys
+import json
+import shutil
+import signal
+import logging
+import tempfile
+import unittest
+import subprocess
+from os import path
+from time import time, sleep
+
+from iapp_lease import LeaseManager, LEASE_SUFFIX, DONE_SUFFIX
+
+logging.disable(logging.CRITICAL)
+
+# A worker process: claims the granules given on the command line, and
+# "processes" each by sleeping for the given time and recording it.
+WORKER_SCRIPT = '''
+import os, sys
+from time import sleep
+from iapp_lease import LeaseManager
+
+lease_dir, record_dir, worker_id, delay = sys.argv[1:5]
+lease_manager = LeaseManager(lease_dir, worker_id, lease_timeout=1., heartbeat=0.2)
+for granule in lease_manager.claimed(sys.argv[5:], poll=0.2):
+    sleep(float(delay))
+    record_fd = os.open(os.path.join(record_dir, granule),
+                        os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+    os.write(record_fd, worker_id + '\\n')
+    os.close(record_fd)
+    lease_manager.finish(granule, 'success')
+lease_manager.close()
+'''
+
+
+class LeaseManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.lease_dir = tempfile.mkdtemp()
+        self.workers = []
+
+    def tearDown(self):
+        for worker in self.workers:
+            worker.close()
+        shutil.rmtree(self.lease_dir)
+
+    def worker(self, worker_id, lease_timeout=600.):
+        worker = LeaseManager(self.lease_dir, worker_id, lease_timeout=lease_timeout,
+                              heartbeat=3600.)
+        self.workers.append(worker)
+        return worker
+
+    def test_claim_is_exclusive(self):
+        first, second = self.worker('first'), self.worker('second')
+
+        self.assertTrue(first.claim('/data/a.l1d'))
+        self.assertFalse(second.claim('/data/a.l1d'))
+        # Granules are identified by their base names
+        self.assertFalse(second.claim('/elsewhere/a.l1d'))
+        self.assertTrue(second.claim('/data/b.l1d'))
+
+        lease_obj = open(path.join(self.lease_dir, 'a.l1d' + LEASE_SUFFIX))
+        self.assertEqual(json.load(lease_obj)['worker'], 'first')
+        lease_obj.close()
+
+    def test_finished_not_claimed_again(self):
+        first, second = self.worker('first'), self.worker('second')
+
+        self.assertTrue(first.claim('/data/a.l1d'))
+        first.finish('/data/a.l1d', 'success')
+
+        self.assertFalse(path.exists(path.join(self.lease_dir, 'a.l1d' + LEASE_SUFFIX)))
+        done_obj = open(path.join(self.lease_dir, 'a.l1d' + DONE_SUFFIX))
+        self.assertEqual(json.load(done_obj)['status'], 'success')
+        done_obj.close()
+        self.assertFalse(second.claim('/data/a.l1d'))
+        self.assertFalse(first.claim('/data/a.l1d'))
+
+    def test_released_claimed_again(self):
+        first, second = self.worker('first'), self.worker('second')
+
+        self.assertTrue(first.claim('/data/a.l1d'))
+        first.release('/data/a.l1d')
+
+        self.assertTrue(second.claim('/data/a.l1d'))
+
+    def test_expired_lease_reclaimed(self):
+        first, second = self.worker('first'), self.worker('second', lease_timeout=60.)
+
+        self.assertTrue(first.claim('/data/a.l1d'))
+        self.assertFalse(second.claim('/data/a.l1d'))
+
+        lease_file = path.join(self.lease_dir, 'a.l1d' + LEASE_SUFFIX)
+        os.utime(lease_file, (time() - 120., time() - 120.))
+
+        self.assertTrue(second.claim('/data/a.l1d'))
+        lease_obj = open(lease_file)
+        self.assertEqual(json.load(lease_obj)['worker'], 'second')
+        lease_obj.close()
+        self.assertEqual([x for x in os.listdir(self.lease_dir) if x.endswith('.stale')], [])
+
+    def test_close_releases_leases(self):
+        first, second = self.worker('first'), self.worker('second')
+
+        self.assertTrue(first.claim('/data/a.l1d'))
+        first.close()
+        self.workers.remove(first)
+
+        self.assertTrue(second.claim('/data/a.l1d'))
+
+    def test_claimed(self):
+        first, second = self.worker('first'), self.worker('second', lease_timeout=60.)
+        self.assertTrue(first.claim('/data/b.l1d'))
+        self.assertTrue(first.claim('/data/c.l1d'))
+        first.finish('/data/c.l1d', 'success')
+
+        # b.l1d is waited for until its lease expires
+        claimed = second.claimed(['/data/a.l1d', '/data/b.l1d', '/data/c.l1d'], poll=0.01)
+        self.assertEqual(next(claimed), '/data/a.l1d')
+        lease_file = path.join(self.lease_dir, 'b.l1d' + LEASE_SUFFIX)
+        os.utime(lease_file, (time() - 120., time() - 120.))
+        self.assertEqual(list(claimed), ['/data/b.l1d'])
+
+    def test_claimed_waits_for_finish(self):
+        first, second = self.worker('first'), self.worker('second')
+        self.assertTrue(first.claim('/data/a.l1d'))
+
+        claimed = second.claimed(['/data/a.l1d', '/data/b.l1d'], poll=0.01)
+        self.assertEqual(next(claimed), '/data/b.l1d')
+        first.finish('/data/a.l1d', 'success')
+        self.assertEqual(list(claimed), [])
+
+
+class WorkerProcessTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.lease_dir = path.join(self.work_dir, 'leases')
+        self.record_dir = path.join(self.work_dir, 'records')
+        os.mkdir(self.record_dir)
+        self.processes = []
+
+    def tearDown(self):
+        for process in self.processes:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+        shutil.rmtree(self.work_dir)
+
+    def start_worker(self, worker_id, delay, granules):
+        package_dir = path.dirname(path.dirname(path.abspath(__file__)))
+        env = dict(os.environ, PYTHONPATH=package_dir)
+        process = subprocess.Popen([sys.executable, '-c', WORKER_SCRIPT, self.lease_dir,
+                                    self.record_dir, worker_id, str(delay)] + granules,
+                                   env=env)
+        self.processes.append(process)
+        return process
+
+    def wait_for(self, condition, timeout=20.):
+        end_time = time() + timeout
+        while not condition():
+            self.assertTrue(time() < end_time, 'timed out')
+            sleep(0.05)
+
+    def lease_files(self, suffix):
+        if not path.isdir(self.lease_dir):
+            return []
+        return [x for x in os.listdir(self.lease_dir) if x.endswith(suffix)]
+
+    def test_killed_worker(self):
+        granules = ['g{:02d}.l1d'.format(x) for x in range(10)]
+
+        # The first worker hangs on its first granule...
+        hung = self.start_worker('hung', 600., granules)
+        self.wait_for(lambda: len(self.lease_files(LEASE_SUFFIX)) == 1)
+
+        # ...while the second processes the others, and then waits for it
+        survivor = self.start_worker('survivor', 0.01, granules)
+        self.wait_for(lambda: len(self.lease_files(DONE_SUFFIX)) == len(granules) - 1)
+        self.assertEqual(survivor.poll(), None)
+
+        os.kill(hung.pid, signal.SIGKILL)
+        hung.wait()
+        self.wait_for(lambda: survivor.poll() is not None)
+        self.assertEqual(survivor.returncode, 0)
+
+        self.assertEqual(sorted(self.lease_files(DONE_SUFFIX)),
+                         [x + DONE_SUFFIX for x in granules])
+        self.assertEqual(self.lease_files(LEASE_SUFFIX), [])
+        for granule in granules:
+            self.assertEqual(open(path.join(self.record_dir, granule)).read(), 'survivor\n',
+                             granule)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_limits.py
+
+Tests of the resource limits and memory admission of iapp_main runs
+(iapp_limits.py).
+
+Copyright (c) 2014 University of Wisconsin Regents.
+Licensed under GNU GPLv3.
+"""
+
+import signal
+import logging
+import unittest
+import subprocess
+from time import time
+
+from iapp_limits import (resource_limits, limit_kill_reason, mem_available, descendants_rss,
+                         MemoryAdmission, GIB)
+
+logging.disable(logging.CRITICAL)
+
+
+class Options(object):
+
+    def __init__(self, **limits):
+        for name in ['limit_memory', 'limit_cpu', 'limit_core', 'limit_files']:
+            setattr(self, name, limits.get(name))
+
+
+class LimitsTest(unittest.TestCase):
+
+    def test_resource_limits(self):
+        self.assertEqual(resource_limits(Options()), {})
+        self.assertEqual(resource_limits(Options(limit_memory=1.5, limit_cpu=600)),
+                         {'memory': int(1.5 * GIB), 'cpu': 600})
+
+    def test_cpu_limit(self):
+        limits = {'cpu': 600}
+        self.assertEqual(limit_kill_reason(-signal.SIGXCPU, limits, '', 10.), 'cpu_limit')
+        self.assertEqual(limit_kill_reason(128 + signal.SIGXCPU, limits, '', 10.), 'cpu_limit')
+        self.assertEqual(limit_kill_reason(-signal.SIGKILL, limits, '', 700.), 'cpu_limit')
+        # A SIGKILL before the CPU limit could have been reached isn't from it
+        self.assertEqual(limit_kill_reason(-signal.SIGKILL, limits, '', 100.), None)
+
+    def test_memory_limit(self):
+        limits = {'memory': GIB}
+        output = 'Reading coefficients\nforrtl: severe (41): insufficient virtual memory\n'
+        self.assertEqual(limit_kill_reason(174, limits, output, 10.), 'memory_limit')
+        self.assertEqual(limit_kill_reason(0, limits, output, 10.), None)
+        self.assertEqual(limit_kill_reason(1, limits, 'no convergence', 10.), None)
+
+    def test_no_limits(self):
+        self.assertEqual(limit_kill_reason(-signal.SIGXCPU, {}, 'Out of memory', 700.), None)
+
+
+class MemoryAdmissionTest(unittest.TestCase):
+
+    def setUp(self):
+        if mem_available() is None:
+            raise unittest.SkipTest('MemAvailable is unavailable')
+
+    def test_descendants_rss(self):
+        child = subprocess.Popen(['sleep', '10'])
+        try:
+            self.assertTrue(descendants_rss() > 0)
+        finally:
+            child.kill()
+            child.wait()
+
+    def test_admit_release(self):
+        admission = MemoryAdmission(poll_interval=0.05)
+
+        reserved = admission.admit(1024, max_wait=0.)
+        self.assertTrue(reserved >= 1024)
+        admission.release(reserved)
+        self.assertEqual(admission._reserved, 0)
+
+    def test_waits_for_reserved_memory(self):
+        admission = MemoryAdmission(poll_interval=0.05)
+
+        # A run which doesn't fit is started after max_wait, and its memory
+        # (not yet used by any process) holds back the next run
+        huge = mem_available() * 4
+        t_start = time()
+        reserved = admission.admit(huge, max_wait=0.2)
+        self.assertTrue(time() - t_start >= 0.2)
+        self.assertEqual(reserved, huge)
+
+        t_start = time()
+        small = admission.admit(1024, max_wait=0.2)
+        self.assertTrue(time() - t_start >= 0.2)
+
+        admission.release(reserved)
+        t_start = time()
+        admission.release(small)
+        admission.release(admission.admit(1024, max_wait=0.2))
+        self.assertTrue(time() - t_start < 0.2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_logging.py
+
+Tests of the per-thread log contexts and the queued logging of iapp_utils.py.
+
+Copyright (c) 2014 University of Wisconsin Regents.
+Licensed under GNU GPLv3.
+"""
+
+import logging
+import unittest
+from Queue import Queue
+from threading import Thread
+
+from iapp_utils import set_log_context, ContextFilter, QueueHandler
+
+
+def make_record(msg, *args):
+    return logging.LogRecord('test', logging.INFO, __file__, 1, msg, args, None)
+
+
+class LogContextTest(unittest.TestCase):
+
+    def tearDown(self):
+        set_log_context(None)
+
+    def test_filter_in_writing_thread(self):
+        east, west = ContextFilter('east'), ContextFilter('west')
+
+        set_log_context('east')
+        self.assertTrue(east.filter(make_record('x')))
+        self.assertFalse(west.filter(make_record('x')))
+        set_log_context(None)
+        self.assertFalse(east.filter(make_record('x')))
+
+    def test_queued_records_keep_their_context(self):
+        queue = Queue()
+        handler = QueueHandler(queue)
+
+        def _log(name):
+            set_log_context(name)
+            handler.emit(make_record('region %s', name))
+
+        threads = [Thread(target=_log, args=(name,)) for name in ['east', 'west']]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Filtered on this thread, which has no context
+        east = ContextFilter('east')
+        records = [queue.get_nowait(), queue.get_nowait()]
+        self.assertEqual([x.msg for x in records if east.filter(x)], ['region east'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_metar.py
+
+Tests of the METAR station table index (ANC/Utils.py).
+
+Copyright (c) 2014 University of Wisconsin Regents.
+Licensed under GNU GPLv3.
+"""
+
+import os
+import shutil
+import logging
+import tempfile
+import unittest
+from os import path
+from time import time
+
+from ANC.Utils import read_station_table, count_METAR_stations
+
+logging.disable(logging.CRITICAL)
+
+STATION_LINES = [
+    'KMSN      72641 MADISON                          WI US  4313  -8933   264  0\n',
+    '!comment\n',
+    'KORD      72530 CHICAGO                          IL US  4198  -8790   205  0\n',
+    'KBAD      72530 NO COORDINATES                   IL US   xxx   xxxx   205  0\n']
+
+
+class StationTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.table_file = path.join(self.work_dir, 'sfmetar_sa.tbl')
+        self.write_file(self.table_file, STATION_LINES)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def write_file(self, file_name, lines, mtime=None):
+        file_obj = open(file_name, 'w')
+        file_obj.writelines(lines)
+        file_obj.close()
+        if mtime is not None:
+            os.utime(file_name, (mtime, mtime))
+        return file_name
+
+    def test_read_station_table(self):
+        station_dict = read_station_table(self.table_file)
+
+        self.assertEqual(sorted(station_dict), ['KMSN', 'KORD'])
+        self.assertEqual(station_dict['KMSN'], (43.13, -89.33, 264))
+
+    def test_parsed_once(self):
+        station_dict = read_station_table(self.table_file)
+        self.assertTrue(read_station_table(self.table_file) is station_dict)
+
+        # A changed table is parsed again
+        self.write_file(self.table_file, STATION_LINES[:1], mtime=time() + 10)
+        self.assertEqual(sorted(read_station_table(self.table_file)), ['KMSN'])
+
+    def test_count_METAR_stations(self):
+        station_dict = read_station_table(self.table_file)
+        metar_file = self.write_file(path.join(self.work_dir, 'METAR.15063.0100'), [
+            'METAR KMSN 040053Z 27010KT 10SM CLR M05/M12 A3012\n',
+            'SPECI KMSN 040110Z 27012KT 10SM CLR M05/M12 A3012\n',
+            'KORD 040051Z 25008KT 10SM FEW250 M03/M11 A3010\n',
+            'METAR XXXX 040053Z 27010KT\n'])
+
+        self.assertEqual(count_METAR_stations(metar_file, station_dict), 2)
+        self.assertEqual(count_METAR_stations(metar_file, {}), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_overlap.py
+
+Tests of the detection of repeated passes and of the trimming of level-1D
+files (iapp_overlap.py), on synthetic files read back with
+iapp_level2.Level1D.
+
+Copyright (c) 2014 University of Wisconsin Regents.
+Licensed under GNU GPLv3.
+"""
+
+import logging
+import unittest
+from os import path
+from datetime import timedelta
+
+from iapp_level2 import Level1D
+from iapp_overlap import OverlapFilter, trim_level1d
+
+from level1d_files import (Level1DFileTestCase, make_level1d, scanline_numbers,
+                           SCANLINE_INTERVAL)
+
+logging.disable(logging.CRITICAL)
+
+
+class TrimTest(Level1DFileTestCase):
+
+    def test_trim(self):
+        l1d_file = make_level1d(path.join(self.work_dir, 'pass.l1d'), self.start_time, 100)
+        header_data = Level1D(l1d_file).header_field_data
+        times = [self.start_time + SCANLINE_INTERVAL * idx for idx in range(100)]
+
+        out_file = trim_level1d(l1d_file, self.work_dir, header_data, 20, 59, times)
+
+        self.assertEqual(out_file, path.join(self.work_dir, 'trimmed_pass.l1d'))
+        self.check_file(out_file, 40, times[20], times[59])
+        self.assertEqual(scanline_numbers(out_file), range(21, 61))
+
+    def test_trim_to_one_scanline(self):
+        l1d_file = make_level1d(path.join(self.work_dir, 'pass.l1d'), self.start_time, 10)
+        header_data = Level1D(l1d_file).header_field_data
+        times = [self.start_time + SCANLINE_INTERVAL * idx for idx in range(10)]
+
+        out_file = trim_level1d(l1d_file, self.work_dir, header_data, 9, 9, times)
+
+        self.check_file(out_file, 1, times[9], times[9])
+        self.assertEqual(scanline_numbers(out_file), [10])
+
+
+class OverlapFilterTest(Level1DFileTestCase):
+
+    def make_pass(self, name, first_scanline, scanlines, orbit=1000):
+        '''A pass of scanlines, starting with scanline first_scanline of the reference pass.'''
+        start_time = self.start_time + SCANLINE_INTERVAL * first_scanline
+        return Level1D(make_level1d(path.join(self.work_dir, name), start_time, scanlines,
+                                    orbit=orbit))
+
+    def test_first_pass_processed(self):
+        overlap_filter = OverlapFilter('trim')
+        self.assertEqual(overlap_filter.check(self.make_pass('a.l1d', 0, 100))['action'],
+                         'process')
+
+    def test_duplicate(self):
+        overlap_filter = OverlapFilter('skip')
+        overlap_filter.add(self.make_pass('a.l1d', 0, 100))
+
+        decision = overlap_filter.check(self.make_pass('b.l1d', 0, 100))
+        self.assertEqual(decision['action'], 'skip')
+        self.assertEqual(decision['reason'], 'duplicate of a.l1d')
+
+    def test_contained(self):
+        overlap_filter = OverlapFilter('trim', min_scanlines=10)
+        overlap_filter.add(self.make_pass('a.l1d', 0, 100))
+
+        self.assertEqual(overlap_filter.check(self.make_pass('b.l1d', 10, 50))['action'], 'skip')
+        # Fewer than min_scanlines new scanlines
+        self.assertEqual(overlap_filter.check(self.make_pass('c.l1d', 95, 12))['action'], 'skip')
+
+    def test_trim_overlap(self):
+        overlap_filter = OverlapFilter('trim', min_scanlines=10)
+        overlap_filter.add(self.make_pass('a.l1d', 0, 100))
+
+        decision = overlap_filter.check(self.make_pass('b.l1d', 80, 50))
+        self.assertEqual(decision['action'], 'trim')
+        self.assertEqual((decision['first'], decision['last']), (20, 49))
+        self.assertEqual(decision['reason'], 'overlaps a.l1d, 30 of 50 scanlines are new')
+
+    def test_skip_mode_processes_overlap(self):
+        overlap_filter = OverlapFilter('skip', min_scanlines=10)
+        overlap_filter.add(self.make_pass('a.l1d', 0, 100))
+
+        decision = overlap_filter.check(self.make_pass('b.l1d', 80, 50))
+        self.assertEqual(decision['action'], 'process')
+        self.assertTrue(decision['reason'].startswith('overlaps a.l1d'))
+
+    def test_covered_gap_kept(self):
+        overlap_filter = OverlapFilter('trim', min_scanlines=10)
+        overlap_filter.add(self.make_pass('a.l1d', 30, 20))
+
+        # The covered scanlines 30-49 lie between new ones, so all are kept
+        decision = overlap_filter.check(self.make_pass('b.l1d', 0, 100))
+        self.assertEqual((decision['first'], decision['last']), (0, 99))
+
+    def test_different_orbits(self):
+        overlap_filter = OverlapFilter('skip')
+        overlap_filter.add(self.make_pass('a.l1d', 0, 100, orbit=1000))
+
+        self.assertEqual(overlap_filter.check(self.make_pass('b.l1d', 0, 100, orbit=1001))
+                         ['action'], 'process')
+
+    def test_tolerance(self):
+        overlap_filter = OverlapFilter('skip', tolerance=3.)
+        overlap_filter.add(self.make_pass('a.l1d', 0, 100))
+
+        start_time = self.start_time + timedelta(seconds=2)
+        shifted = Level1D(make_level1d(path.join(self.work_dir, 'b.l1d'), start_time, 100))
+        self.assertEqual(overlap_filter.check(shifted)['action'], 'skip')
+
+    def test_scanline_times(self):
+        overlap_filter = OverlapFilter('trim', min_scanlines=10, scanline_times=True)
+        overlap_filter.add(self.make_pass('a.l1d', 0, 100))
+
+        l1d_obj = self.make_pass('b.l1d', 80, 50)
+        times = overlap_filter.times_of(l1d_obj, l1d_obj.input_file)
+        self.assertEqual(times, [self.start_time + SCANLINE_INTERVAL * (80 + idx)
+                                 for idx in range(50)])
+        self.assertEqual(overlap_filter.check(l1d_obj, l1d_obj.input_file)['first'], 20)
+
+    def test_unknown_mode(self):
+        self.assertRaises(ValueError, OverlapFilter, 'merge')
+
+
+if __name__ == '__main__':
+    unittest.main()
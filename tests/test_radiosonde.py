@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_radiosonde.py
+
+Tests of the radiosonde archive and its cache (ANC/Radiosonde.py).
+
+Copyright (c) 2014 University of Wisconsin Regents.
+Licensed under GNU GPLv3.
+"""
+
+import os
+import shutil
+import logging
+import tempfile
+import unittest
+from os import path
+from datetime import datetime
+
+from ANC.Radiosonde import RadiosondeArchive, get_radiosonde_archive, write_fsl_file
+
+logging.disable(logging.CRITICAL)
+
+
+def make_sounding(station, wmo_id, lat, lon, time_obj):
+    return {'station': station, 'wmo_id': wmo_id, 'lat': lat, 'lon': lon,
+            'elevation': 264, 'time': time_obj, 'wind_units': 'kt',
+            'levels': [[9, 9840, 264, -50, -120, 270, 10],
+                       [4, 8500, 1400, -110, -200, 280, 25]]}
+
+
+class RadiosondeArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.archive_dir = path.join(self.work_dir, 'archive')
+        self.cache_dir = path.join(self.work_dir, 'cache')
+        os.makedirs(path.join(self.archive_dir, '2015'))
+        self.time_obj = datetime(2015, 3, 4, 0)
+
+        write_fsl_file([make_sounding('MSN', 72641, 43.13, -89.33, self.time_obj),
+                        make_sounding('ORD', 72530, 41.98, -87.90, self.time_obj)],
+                       path.join(self.archive_dir, '2015', 'raob_1'))
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def add_sounding(self):
+        write_fsl_file([make_sounding('BRW', 70026, 71.28, -156.78, self.time_obj)],
+                       path.join(self.archive_dir, '2015', 'raob_2'))
+
+    def test_select(self):
+        archive = RadiosondeArchive(self.archive_dir, self.cache_dir)
+        archive.refresh()
+        soundings = archive.select(datetime(2015, 3, 3, 22), datetime(2015, 3, 4, 2),
+                                   (40., 45., -90., -85.))
+
+        self.assertEqual([x['station'] for x in soundings], ['MSN', 'ORD'])
+        self.assertEqual(soundings[0]['levels'][1], [4, 8500, 1400, -110, -200, 280, 25])
+        self.assertEqual(archive.select(datetime(2015, 3, 5), datetime(2015, 3, 6)), [])
+
+    def test_cache_reused(self):
+        archive = RadiosondeArchive(self.archive_dir, self.cache_dir)
+        archive.refresh()
+        self.add_sounding()
+
+        # A new archive object reads the manifest, and parses only the new file
+        archive = RadiosondeArchive(self.archive_dir, self.cache_dir)
+        archive.refresh()
+        self.assertEqual(len(archive.select(datetime(2015, 3, 4), datetime(2015, 3, 4))), 3)
+
+        os.unlink(path.join(self.archive_dir, '2015', 'raob_2'))
+        archive.refresh()
+        self.assertEqual(len(archive.select(datetime(2015, 3, 4), datetime(2015, 3, 4))), 2)
+
+    def test_refresh_interval(self):
+        archive = get_radiosonde_archive(self.archive_dir, self.cache_dir)
+        self.add_sounding()
+
+        # The archive isn't checked again within the refresh interval
+        self.assertTrue(get_radiosonde_archive(self.archive_dir, self.cache_dir) is archive)
+        self.assertEqual(len(archive.select(datetime(2015, 3, 4), datetime(2015, 3, 4))), 2)
+
+        get_radiosonde_archive(self.archive_dir, self.cache_dir, refresh_interval=0.)
+        self.assertEqual(len(archive.select(datetime(2015, 3, 4), datetime(2015, 3, 4))), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_scheduler.py
+
+Tests of the granule ordering policies of iapp_scheduler.py.
+
+Copyright (c) 2014 University of Wisconsin Regents.
+Licensed under GNU GPLv3.
+"""
+
+import logging
+import unittest
+from time import sleep
+from threading import Event
+from datetime import datetime, timedelta
+
+from iapp_scheduler import GranuleScheduler
+
+logging.disable(logging.CRITICAL)
+
+NOW = datetime(2015, 3, 4, 12, 0, 0)
+
+
+class FakeHeader(object):
+
+    def __init__(self, start_time, end_time):
+        self.timeObj_start = start_time
+        self.timeObj_end = end_time
+
+
+def header_func(pass_ends):
+    '''A header_func for the files of the dictionary pass_ends (minutes before NOW).'''
+    def _header(l1d_file):
+        end_time = NOW - timedelta(minutes=pass_ends[l1d_file])
+        return FakeHeader(end_time - timedelta(minutes=10), end_time)
+    return _header
+
+
+def slow_listing(l1d_files):
+    '''Yield l1d_files slowly, as a walk of a large tree might.'''
+    for l1d_file in l1d_files:
+        sleep(0.05)
+        yield l1d_file
+
+
+class GranuleSchedulerTest(unittest.TestCase):
+
+    def test_duplicates_ignored(self):
+        scheduler = GranuleScheduler('newest', header_func=header_func({'/a/x': 10, '/a/w': 5}),
+                                     now_func=lambda: NOW)
+        scheduler.extend(['/a/x', '/a/x', '/a/w'])
+
+        self.assertEqual(len(scheduler), 2)
+        self.assertEqual(list(scheduler), ['/a/w', '/a/x'])
+
+    def test_name_in_discovery_order(self):
+        scheduler = GranuleScheduler('name')
+        scheduler.feed(slow_listing(['/b/y', '/b/z', '/a/z', '/a/y']))
+
+        self.assertEqual(list(scheduler), ['/b/y', '/b/z', '/a/z', '/a/y'])
+
+    def test_name_starts_before_the_feed_ends(self):
+        released = Event()
+        waits = []
+
+        def _listing():
+            yield '/a/x'
+            # Not released until /a/x has been popped
+            waits.append(released.wait(5.))
+            yield '/a/y'
+
+        scheduler = GranuleScheduler('name')
+        scheduler.feed(_listing())
+
+        order = []
+        for l1d_file in scheduler:
+            order.append(l1d_file)
+            released.set()
+
+        self.assertEqual(order, ['/a/x', '/a/y'])
+        self.assertEqual(waits, [True])
+
+    def test_sorted_sorts_all_inputs(self):
+        scheduler = GranuleScheduler('sorted')
+        scheduler.feed(slow_listing(['/b/z', '/a/z', '/c/a', '/a/y']))
+
+        self.assertEqual(list(scheduler), ['/a/y', '/a/z', '/b/z', '/c/a'])
+
+    def test_newest(self):
+        pass_ends = {'/old': 300, '/new': 5, '/mid': 60}
+        scheduler = GranuleScheduler('newest', header_func=header_func(pass_ends),
+                                     now_func=lambda: NOW)
+        scheduler.extend(sorted(pass_ends))
+
+        self.assertEqual(list(scheduler), ['/new', '/mid', '/old'])
+
+    def test_deadline(self):
+        # With a one hour budget, /late and /later have missed their deadlines
+        pass_ends = {'/later': 180, '/late': 90, '/soon': 50, '/fresh': 5}
+        scheduler = GranuleScheduler('deadline', header_func=header_func(pass_ends),
+                                     latency_budget=3600., now_func=lambda: NOW)
+        scheduler.extend(sorted(pass_ends))
+
+        self.assertEqual(list(scheduler), ['/soon', '/fresh', '/late', '/later'])
+
+    def test_realtime_lane(self):
+        pass_ends = {'/a': 300, '/b': 200, '/z': 5}
+        scheduler = GranuleScheduler('name', header_func=header_func(pass_ends),
+                                     realtime_window=600., now_func=lambda: NOW)
+        scheduler.extend(sorted(pass_ends))
+
+        self.assertEqual(list(scheduler), ['/z', '/a', '/b'])
+
+    def test_unreadable_header_last(self):
+        pass_ends = {'/a': 300, '/b': 5}
+
+        def _header(l1d_file):
+            if l1d_file == '/broken':
+                raise IOError('unreadable')
+            return header_func(pass_ends)(l1d_file)
+
+        scheduler = GranuleScheduler('newest', header_func=_header, now_func=lambda: NOW)
+        scheduler.extend(['/broken', '/a', '/b'])
+
+        self.assertEqual(list(scheduler), ['/b', '/a', '/broken'])
+
+    def test_push_preempts_backlog(self):
+        pass_ends = {'/a': 300, '/b': 200, '/c': 100, '/z': 1}
+        scheduler = GranuleScheduler('name', header_func=header_func(pass_ends),
+                                     realtime_window=600., now_func=lambda: NOW)
+        scheduler.extend(['/a', '/b', '/c'])
+
+        order = []
+        for l1d_file in scheduler:
+            order.append(l1d_file)
+            if l1d_file == '/a':
+                scheduler.push('/z')
+
+        self.assertEqual(order, ['/a', '/z', '/b', '/c'])
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, GranuleScheduler, 'oldest')
+        self.assertRaises(ValueError, GranuleScheduler, 'newest')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_single_flight.py
+
+Tests of the inter-process locks on ancillary artifacts (ANC/SingleFlight.py).
+The locks are held by other processes, since fcntl locks don't exclude the
+process which holds them.
+
+Copyright (c) 2014 University of Wisconsin Regents.
+Licensed under GNU GPLv3.
+"""
+
+import os
+import sys
+import socket
+import shutil
+import logging
+import tempfile
+import unittest
+import subprocess
+from os import path
+from time import time, sleep
+from threading import Thread
+
+from ANC.SingleFlight import SingleFlight, single_flight, LOCK_DIR_NAME
+
+logging.disable(logging.CRITICAL)
+
+# Holds the lock with SingleFlight (and so its heartbeat)
+HOLDER_SCRIPT = '''
+import sys
+from time import sleep
+from ANC.SingleFlight import SingleFlight
+
+lock = SingleFlight(sys.argv[1], sys.argv[2], stale_timeout=float(sys.argv[3]))
+lock.acquire()
+sys.stdout.write('locked\\n')
+sys.stdout.flush()
+sleep(600)
+'''
+
+# Holds an fcntl lock on the lock file, with the given holder record, as a
+# holder which has gone silent would
+SILENT_HOLDER_SCRIPT = '''
+import os, sys, fcntl
+from time import sleep
+
+fd = os.open(sys.argv[1], os.O_RDWR | os.O_CREAT, 0664)
+fcntl.lockf(fd, fcntl.LOCK_EX)
+os.write(fd, sys.argv[2] + '\\n')
+os.utime(sys.argv[1], (float(sys.argv[3]), float(sys.argv[3])))
+sys.stdout.write('locked\\n')
+sys.stdout.flush()
+sleep(600)
+'''
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.lock_dir = path.join(self.cache_dir, LOCK_DIR_NAME)
+        os.mkdir(self.lock_dir)
+        self.lock_file = SingleFlight(self.lock_dir, 'gfs 2015-03-04 00Z').lock_file
+        self.processes = []
+        self.waiters = []
+
+    def tearDown(self):
+        for process in self.processes:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+        for thread, lock in self.waiters:
+            thread.join(10.)
+            lock.release()
+        shutil.rmtree(self.cache_dir)
+
+    def start_holder(self, script, *args):
+        '''Start a process holding the lock, returning once it holds it.'''
+        package_dir = path.dirname(path.dirname(path.abspath(__file__)))
+        env = dict(os.environ, PYTHONPATH=package_dir)
+        process = subprocess.Popen([sys.executable, '-c', script] + [str(x) for x in args],
+                                   stdout=subprocess.PIPE, env=env)
+        self.processes.append(process)
+        self.assertEqual(process.stdout.readline().strip(), 'locked')
+        return process
+
+    def start_waiter(self, stale_timeout):
+        '''Acquire the lock on a thread, returning the thread and the lock.'''
+        lock = SingleFlight(self.lock_dir, 'gfs 2015-03-04 00Z', stale_timeout=stale_timeout)
+        thread = Thread(target=lock.acquire)
+        thread.daemon = True
+        thread.start()
+        self.waiters.append((thread, lock))
+        return thread, lock
+
+    def dead_pid(self):
+        process = subprocess.Popen([sys.executable, '-c', 'pass'])
+        process.wait()
+        return process.pid
+
+    def test_acquire_release(self):
+        lock = single_flight(self.cache_dir, 'gfs 2015-03-04 00Z')
+        try:
+            self.assertEqual(path.basename(lock.lock_file), 'gfs_2015-03-04_00Z.lock')
+            self.assertEqual(open(lock.lock_file).read(),
+                             '{} {}\n'.format(socket.gethostname(), os.getpid()))
+        finally:
+            lock.release()
+        self.assertEqual(lock.fd, None)
+
+    def test_live_holder_not_broken(self):
+        holder = self.start_holder(HOLDER_SCRIPT, self.lock_dir, 'gfs 2015-03-04 00Z', 0.4)
+        inode = os.stat(self.lock_file).st_ino
+
+        # The waiter keeps waiting for a live holder, long after stale_timeout
+        thread, lock = self.start_waiter(0.4)
+        thread.join(2.)
+        self.assertTrue(thread.is_alive())
+        self.assertEqual(os.stat(self.lock_file).st_ino, inode)
+
+        holder.kill()
+        holder.wait()
+        thread.join(10.)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(open(self.lock_file).read().split()[1], str(os.getpid()))
+
+    def test_heartbeat(self):
+        self.start_holder(HOLDER_SCRIPT, self.lock_dir, 'gfs 2015-03-04 00Z', 0.4)
+        os.utime(self.lock_file, (time() - 60., time() - 60.))
+        sleep(0.5)
+        self.assertTrue(time() - os.stat(self.lock_file).st_mtime < 1.)
+
+    def test_silent_remote_holder_broken(self):
+        self.start_holder(SILENT_HOLDER_SCRIPT, self.lock_file, 'elsewhere 1', time() - 60.)
+
+        thread, lock = self.start_waiter(30.)
+        thread.join(10.)
+        self.assertFalse(thread.is_alive())
+
+    def test_silent_remote_holder_within_timeout(self):
+        self.start_holder(SILENT_HOLDER_SCRIPT, self.lock_file, 'elsewhere 1', time())
+
+        thread, lock = self.start_waiter(30.)
+        thread.join(1.)
+        self.assertTrue(thread.is_alive())
+
+    def test_dead_local_holder_broken(self):
+        self.start_holder(SILENT_HOLDER_SCRIPT, self.lock_file,
+                          '{} {}'.format(socket.gethostname(), self.dead_pid()), time())
+
+        thread, lock = self.start_waiter(1800.)
+        thread.join(10.)
+        self.assertFalse(thread.is_alive())
+
+    def test_unwritable_lock_dir(self):
+        not_a_dir = path.join(self.cache_dir, 'not_a_dir')
+        open(not_a_dir, 'w').close()
+
+        lock = single_flight(not_a_dir, 'key')
+        with lock:
+            self.assertFalse(isinstance(lock, SingleFlight))
+
+
+if __name__ == '__main__':
+    unittest.main()
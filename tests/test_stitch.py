@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_stitch.py
+
+Tests of the joining of level-1D segments (iapp_stitch.py): synthetic
+segments are stitched and read back with iapp_level2.Level1D.
+
+Copyright (c) 2014 University of Wisconsin Regents.
+Licensed under GNU GPLv3.
+"""
+
+import logging
+import unittest
+from os import path
+from datetime import timedelta
+
+from iapp_level2 import Level1D
+from iapp_utils import InvalidLevel1D
+from iapp_stitch import group_segments, stitch_segments
+
+from level1d_files import (Level1DFileTestCase, make_level1d, scanline_numbers,
+                           SCANLINE_INTERVAL)
+
+logging.disable(logging.CRITICAL)
+
+
+class StitchTest(Level1DFileTestCase):
+
+    def test_stitch(self):
+        second_start = self.start_time + SCANLINE_INTERVAL * 100
+        segments = [Level1D(make_level1d(path.join(self.work_dir, 'seg1.l1d'),
+                                         self.start_time, 100)),
+                    Level1D(make_level1d(path.join(self.work_dir, 'seg2.l1d'),
+                                         second_start, 50, orbit=1001))]
+
+        groups = group_segments(segments)
+        self.assertEqual([len(x) for x in groups], [2])
+        out_file = stitch_segments(groups[0], self.work_dir)
+
+        self.assertEqual(out_file, path.join(self.work_dir, 'stitched_seg1.l1d'))
+        l1d_obj = self.check_file(out_file, 150, self.start_time,
+                                  second_start + SCANLINE_INTERVAL * 49)
+        self.assertEqual(l1d_obj.header_field_data['Start_Orbit_Number'], 1000)
+        self.assertEqual(l1d_obj.header_field_data['End_Orbit_Number'], 1001)
+        self.assertEqual(scanline_numbers(out_file), range(1, 101) + range(1, 51))
+
+    def test_segments_not_joined(self):
+        gap_start = self.start_time + SCANLINE_INTERVAL * 99 + timedelta(seconds=60)
+        segments = [Level1D(make_level1d(path.join(self.work_dir, 'seg1.l1d'),
+                                         self.start_time, 100)),
+                    Level1D(make_level1d(path.join(self.work_dir, 'gap.l1d'),
+                                         gap_start, 10)),
+                    Level1D(make_level1d(path.join(self.work_dir, 'orbit.l1d'),
+                                         gap_start + SCANLINE_INTERVAL * 10, 10, orbit=1005))]
+
+        self.assertEqual([len(x) for x in group_segments(segments, max_gap=20.)], [1, 1, 1])
+
+    def test_stitch_different_record_lengths(self):
+        segments = [Level1D(make_level1d(path.join(self.work_dir, 'seg1.l1d'),
+                                         self.start_time, 10)),
+                    Level1D(make_level1d(path.join(self.work_dir, 'seg2.l1d'),
+                                         self.start_time + SCANLINE_INTERVAL * 10, 10,
+                                         record_length=500))]
+
+        self.assertRaises(InvalidLevel1D, stitch_segments, segments, self.work_dir)
+        self.assertFalse(path.exists(path.join(self.work_dir, 'stitched_seg1.l1d')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_store.py
+
+Tests of the store of IAPP outputs (iapp_store.py).
+
+Copyright (c) 2014 University of Wisconsin Regents.
+Licensed under GNU GPLv3.
+"""
+
+import os
+import shutil
+import logging
+import tempfile
+import unittest
+from os import path
+from time import time
+
+from iapp_store import (ResultStore, file_digest, tree_signature, inputs_digest,
+                        result_key, copy_file)
+
+logging.disable(logging.CRITICAL)
+
+
+class StoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def write_file(self, name, data, mtime=None):
+        file_name = path.join(self.work_dir, name)
+        if not path.isdir(path.dirname(file_name)):
+            os.makedirs(path.dirname(file_name))
+        file_obj = open(file_name, 'w')
+        file_obj.write(data)
+        file_obj.close()
+        if mtime is not None:
+            os.utime(file_name, (mtime, mtime))
+        return file_name
+
+
+class KeyTest(StoreTestCase):
+
+    def test_file_digest(self):
+        file_name = self.write_file('a.l1d', 'level-1D data')
+        digest = file_digest(file_name)
+        self.assertEqual(digest, file_digest(self.write_file('b.l1d', 'level-1D data')))
+
+        # A changed file is read again
+        self.write_file('a.l1d', 'other data', mtime=time() + 10)
+        self.assertNotEqual(file_digest(file_name), digest)
+
+    def test_tree_signature(self):
+        self.write_file('coeffs/a.dat', 'a', mtime=1000)
+        self.write_file('coeffs/sub/b.dat', 'b', mtime=1000)
+        coeff_dir = path.join(self.work_dir, 'coeffs')
+        signature = tree_signature([coeff_dir])
+
+        self.write_file('coeffs/sub/b.dat', 'b', mtime=2000)
+        self.assertNotEqual(tree_signature([coeff_dir]), signature)
+
+    def test_inputs_digest(self):
+        l1d_file = self.write_file('a.l1d', 'level-1D data')
+        gdas_file = self.write_file('gdas.nc', 'gdas data')
+        exe_file = self.write_file('iapp_main', 'executable')
+
+        digest = inputs_digest({'l1d': l1d_file, 'gdas': gdas_file, 'metar': ''}, [exe_file])
+        self.assertEqual(inputs_digest({'l1d': l1d_file, 'gdas': gdas_file, 'metar': ''},
+                                       [exe_file]), digest)
+        self.assertNotEqual(inputs_digest({'l1d': l1d_file, 'gdas': '', 'metar': gdas_file},
+                                          [exe_file]), digest)
+
+    def test_result_key(self):
+        settings = {'instrument_combo': 4, 'max_retries': 1}
+        self.assertEqual(result_key('x', settings), result_key('x', dict(settings)))
+        self.assertNotEqual(result_key('x', settings), result_key('y', settings))
+        self.assertNotEqual(result_key('x', settings),
+                            result_key('x', dict(settings, max_retries=2)))
+
+
+class ResultStoreTest(StoreTestCase):
+
+    def setUp(self):
+        StoreTestCase.setUp(self)
+        self.store = ResultStore(path.join(self.work_dir, 'store'))
+        self.output_file = self.write_file('out/noaa19_L2.nc', 'retrievals')
+        self.qa_file = self.write_file('out/noaa19_L2.qa.json', '{}')
+
+    def test_insert_lookup(self):
+        self.assertEqual(self.store.lookup('ab12'), None)
+
+        self.store.insert('ab12', self.output_file, self.qa_file, meta={'input_file': 'a.l1d'})
+        meta = self.store.lookup('ab12')
+
+        self.assertEqual(meta['input_file'], 'a.l1d')
+        self.assertEqual(open(meta['output_file']).read(), 'retrievals')
+        self.assertEqual(path.basename(meta['qa_file']), 'noaa19_L2.qa.json')
+        self.assertEqual(path.dirname(meta['output_file']),
+                         path.join(self.work_dir, 'store', 'ab', 'ab12'))
+
+    def test_stored_result_is_a_copy(self):
+        self.store.insert('ab12', self.output_file)
+
+        # Changing the published output in place doesn't change the stored one
+        file_obj = open(self.output_file, 'r+')
+        file_obj.write('edited')
+        file_obj.close()
+        meta = self.store.lookup('ab12')
+        self.assertEqual(open(meta['output_file']).read(), 'retrievals')
+
+        reused_file = copy_file(meta['output_file'], path.join(self.work_dir, 'reused.nc'))
+        file_obj = open(reused_file, 'r+')
+        file_obj.write('edited')
+        file_obj.close()
+        self.assertEqual(open(meta['output_file']).read(), 'retrievals')
+
+    def test_missing_output(self):
+        self.store.insert('ab12', self.output_file)
+        os.unlink(self.store.lookup('ab12')['output_file'])
+
+        self.assertEqual(self.store.lookup('ab12'), None)
+
+    def test_evict(self):
+        for key, mtime in [('aa01', 1000), ('aa02', 3000), ('aa03', 2000)]:
+            self.store.insert(key, self.output_file)
+            meta_file = path.join(self.work_dir, 'store', 'aa', key, 'meta.json')
+            os.utime(meta_file, (mtime, mtime))
+
+        entry_size = self.store.entries()[0][1]
+        self.store.max_size = 2 * entry_size
+        self.store.evict()
+
+        self.assertEqual(self.store.lookup('aa01'), None)
+        self.assertNotEqual(self.store.lookup('aa02'), None)
+        self.assertNotEqual(self.store.lookup('aa03'), None)
+
+    def test_copy_file_failure(self):
+        dst_file = path.join(self.work_dir, 'out', 'copy.nc')
+        self.assertRaises(IOError, copy_file, path.join(self.work_dir, 'missing.nc'), dst_file)
+        self.assertEqual(sorted(os.listdir(path.join(self.work_dir, 'out'))),
+                         ['noaa19_L2.nc', 'noaa19_L2.qa.json'])
+
+
+if __name__ == '__main__':
+    unittest.main()
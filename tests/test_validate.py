@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_validate.py
+
+Tests of the structural checks of level-1D files (iapp_validate.py).
+
+Copyright (c) 2014 University of Wisconsin Regents.
+Licensed under GNU GPLv3.
+"""
+
+import shutil
+import logging
+import tempfile
+import unittest
+from os import path
+from datetime import datetime
+
+from iapp_utils import InvalidLevel1D
+from iapp_validate import check_size, check_instruments, supported_combos, check_times
+from iapp_validate import validate_level1d
+
+logging.disable(logging.CRITICAL)
+
+NOW = datetime(2015, 3, 10, 12, 0, 0)
+
+
+def header(**fields):
+    '''The header fields of a valid 100 scanline HIRS/AMSU-A/MHS pass, with fields replaced.'''
+    header_data = {'Number_of_Header_Records': 1,
+                   'Number_of_Scanlines': 100,
+                   'Inst_Grid_Code': 5,
+                   'Instruments': 1 | 8 | 16,
+                   'Start_Data_Set_Year': 2015,
+                   'Start_Data_Set_DOY': 63,
+                   'Start_Data_Set_UTC_Time': 36000000,
+                   'End_Data_Set_Year': 2015,
+                   'End_Data_Set_DOY': 63,
+                   'End_Data_Set_UTC_Time': 36633600}
+    header_data.update(fields)
+    return header_data
+
+
+class ValidateTest(unittest.TestCase):
+
+    def test_check_size(self):
+        self.assertEqual(check_size(101 * 1000, header()), [])
+        self.assertEqual(check_size(101 * 1000, header(), 1000), [])
+        self.assertEqual(len(check_size(101 * 1000 + 1, header())), 1)
+        self.assertEqual(len(check_size(101 * 1000, header(), 992)), 1)
+        # Records too short to hold the header
+        self.assertEqual(len(check_size(101 * 80, header())), 1)
+        self.assertEqual(len(check_size(101 * 1000, header(Number_of_Scanlines=0))), 1)
+
+    def test_check_instruments(self):
+        self.assertEqual(check_instruments(header(), 4), [])
+        self.assertEqual(len(check_instruments(header(Instruments=1 | 8), 4)), 1)
+        self.assertEqual(len(check_instruments(header(Inst_Grid_Code=10), 1)), 1)
+        self.assertEqual(check_instruments(header(Inst_Grid_Code=10), 2), [])
+        self.assertEqual(len(check_instruments(header(Inst_Grid_Code=7), 2)), 1)
+
+    def test_supported_combos(self):
+        self.assertEqual(supported_combos(header()), [4, 1, 3, 2])
+        self.assertEqual(supported_combos(header(Instruments=1 | 8)), [1, 2])
+        self.assertEqual(supported_combos(header(Inst_Grid_Code=10, Instruments=8 | 16)),
+                         [3, 2])
+        self.assertEqual(supported_combos(header(Instruments=1)), [])
+
+    def test_check_times(self):
+        self.assertEqual(check_times(header(), NOW), [])
+        # A pass over midnight
+        self.assertEqual(check_times(header(Start_Data_Set_UTC_Time=86000000,
+                                            End_Data_Set_DOY=64,
+                                            End_Data_Set_UTC_Time=600000), NOW), [])
+        self.assertEqual(len(check_times(header(End_Data_Set_UTC_Time=35000000), NOW)), 1)
+        self.assertEqual(len(check_times(header(End_Data_Set_UTC_Time=36000000 + 3 * 3600000),
+                                         NOW)), 1)
+        self.assertEqual(len(check_times(header(Start_Data_Set_UTC_Time=86400000), NOW)), 1)
+        self.assertEqual(len(check_times(header(Start_Data_Set_DOY=367), NOW)), 1)
+        self.assertEqual(len(check_times(header(Start_Data_Set_Year=1970,
+                                                End_Data_Set_Year=1970), NOW)), 2)
+        self.assertEqual(len(check_times(header(Start_Data_Set_DOY=70,
+                                                End_Data_Set_DOY=70), NOW)), 2)
+
+
+class ValidateFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.l1d_file = path.join(self.work_dir, 'pass.l1d')
+        file_obj = open(self.l1d_file, 'wb')
+        file_obj.write('\0' * 101 * 1000)
+        file_obj.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_valid(self):
+        self.assertEqual(validate_level1d(self.l1d_file, header(), 4, now=NOW), 4)
+        self.assertEqual(validate_level1d(self.l1d_file, header(), 1, 1000, now=NOW), 1)
+
+    def test_invalid(self):
+        self.assertRaises(InvalidLevel1D, validate_level1d, self.l1d_file,
+                          header(Number_of_Scanlines=98), 4, now=NOW)
+        self.assertRaises(InvalidLevel1D, validate_level1d, self.l1d_file,
+                          header(Instruments=1 | 8), 4, now=NOW)
+
+    def test_auto_combo(self):
+        self.assertEqual(validate_level1d(self.l1d_file, header(Instruments=1 | 8), 4,
+                                          auto_combo=True, now=NOW), 1)
+        self.assertRaises(InvalidLevel1D, validate_level1d, self.l1d_file,
+                          header(Instruments=1), 4, auto_combo=True, now=NOW)
+
+
+if __name__ == '__main__':
+    unittest.main()